@@ -3,6 +3,7 @@
 import json
 import random
 import re
+import time
 from pathlib import Path
 
 import enchant
@@ -11,6 +12,7 @@ import openai
 
 import cfg
 import utils
+import my_cache
 import my_log
 import my_trans
 
@@ -92,17 +94,19 @@ def ai(prompt: str = '',
     shuffled_servers = [x for x in shuffled_servers if 'api.naga.ac' not in x[0]]
 
     for server in shuffled_servers:
-        openai.api_base = server[0]
-        openai.api_key = server[1]
-
+        start_time = time.time()
         try:
+            # сервер и ключ передаются в сам запрос, а не в openai.api_base/api_key,
+            # так как ai() может вызываться из нескольких потоков одновременно (my_router)
             # тут можно добавить степень творчества(бреда) от 0 до 1 дефолт - temperature=0.5
             completion = openai.ChatCompletion.create(
                 model = current_model,
                 messages=messages,
                 max_tokens=max_tok,
                 temperature=temp,
-                timeout=timeou
+                timeout=timeou,
+                api_base=server[0],
+                api_key=server[1],
             )
             response = completion.choices[0].message.content
             if response.strip() in ('Rate limit exceeded', 'You exceeded your current quota, please check your plan and billing details.'):
@@ -122,7 +126,7 @@ def ai(prompt: str = '',
                         response = content
                         break
             print(unknown_error1)
-            my_log.log2(f'gpt_basic.ai: {unknown_error1}\n\nServer: {openai.api_base}\n\n{server[1]}')
+            my_log.log2(f'gpt_basic.ai: {unknown_error1}\n\nServer: {server[0]}\n\n{server[1]}', chat_id or '', time.time() - start_time)
             if 'You exceeded your current quota, please check your plan and billing details' in str(unknown_error1) \
                 or 'The OpenAI account associated with this API key has been deactivated.' in str(unknown_error1):
                 # удалить отработавший ключ
@@ -187,13 +191,14 @@ def ai_compress(prompt: str, max_prompt: int  = 300, origin: str = 'user', force
     if len(prompt) > max_prompt or force:
         try:
             if origin == 'user':
-                compressed_prompt = ai(f'Сократи текст до {max_prompt} символов так что бы сохранить смысл и важные детали. \
-Этот текст является запросом юзера в переписке между юзером и ИИ. Используй короткие слова. Текст:\n{prompt}', max_tok = max_prompt)
+                query = f'Сократи текст до {max_prompt} символов так что бы сохранить смысл и важные детали. \
+Этот текст является запросом юзера в переписке между юзером и ИИ. Используй короткие слова. Текст:\n{prompt}'
             elif origin == 'assistant':
-                compressed_prompt = ai(f'Сократи текст до {max_prompt} символов так что бы сохранить смысл и важные детали. \
-Этот текст является ответом ИИ в переписке между юзером и ИИ. Используй короткие слова. Текст:\n{prompt}', max_tok = max_prompt)
+                query = f'Сократи текст до {max_prompt} символов так что бы сохранить смысл и важные детали. \
+Этот текст является ответом ИИ в переписке между юзером и ИИ. Используй короткие слова. Текст:\n{prompt}'
             elif origin == 'dialog':
-                compressed_prompt = ai(f'Резюмируй переписку между юзером и ассистентом до {max_prompt} символов, весь негативный контент исправь на нейтральный:\n{prompt}', max_tok = max_prompt)
+                query = f'Резюмируй переписку между юзером и ассистентом до {max_prompt} символов, весь негативный контент исправь на нейтральный:\n{prompt}'
+            compressed_prompt = my_cache.cached(lambda: ai(query, max_tok = max_prompt), cfg.model, query, 1)
             if len(compressed_prompt) < len(prompt) or force:
                 return compressed_prompt
         except Exception as error:
@@ -222,7 +227,7 @@ def translate_text(text, fr = 'autodetect', to = 'ru'):
     prompt += text
 
     try:
-        r = ai(prompt)
+        r = my_cache.cached(lambda: ai(prompt), cfg.model, prompt, 1)
     except Exception as e:
         print(e)
         return None
@@ -5,10 +5,12 @@ import threading
 import traceback
 
 import openai
-from sqlitedict import SqliteDict
 
 import cfg
+import my_dialogs
+import my_history
 import my_log
+import my_tokens
 
 
 ROLE = """Ты искусственный интеллект отвечающий на запросы юзера."""
@@ -26,7 +28,7 @@ LOCKS = {}
 MAX_REQUEST = 8000
 
 # хранилище диалогов {id:list(mem)}
-CHATS = SqliteDict('db/haiku_dialogs.db', autocommit=True)
+CHATS = my_dialogs.Dialogs('haiku')
 
 
 def ai(prompt: str = '', temp: float = 0.1, max_tok: int = 4000, timeou: int = 120, messages = None,
@@ -38,7 +40,8 @@ def ai(prompt: str = '', temp: float = 0.1, max_tok: int = 4000, timeou: int = 1
             assert prompt != '', 'prompt не может быть пустым'
             messages = [{"role": "system", "content": ROLE},
                         {"role": "user", "content": prompt}]
-        messages += [{"role": "user", "content": prompt}]
+        elif prompt:
+            messages = messages + [{"role": "user", "content": prompt}]
         current_model = MODEL
 
         response = ''
@@ -48,17 +51,17 @@ def ai(prompt: str = '', temp: float = 0.1, max_tok: int = 4000, timeou: int = 1
         random.shuffle(shuffled_servers)
 
         for server in shuffled_servers:
-            openai.api_base = server[0]
-            openai.api_key = server[1]
-
             try:
+                # сервер и ключ в самом запросе, глобальные openai.api_base/api_key не потокобезопасны
                 # тут можно добавить степень творчества(бреда) от 0 до 1 дефолт - temperature=0.5
                 completion = openai.ChatCompletion.create(
                     model = current_model,
                     messages=messages,
                     max_tokens=max_tok,
                     temperature=temp,
-                    timeout=timeou
+                    timeout=timeou,
+                    api_base=server[0],
+                    api_key=server[1],
                 )
                 response = completion.choices[0].message.content
                 if response.strip() in ('Rate limit exceeded', 'You exceeded your current quota, please check your plan and billing details.'):
@@ -67,7 +70,7 @@ def ai(prompt: str = '', temp: float = 0.1, max_tok: int = 4000, timeou: int = 1
                     break
             except Exception as unknown_error1:
                 error_tr = traceback.format_exc()
-                my_log.log2(f'gpt_basic_2.ai: {unknown_error1}\n\nServer: {openai.api_base}\n\n{server[1]}\n\n{error_tr}')
+                my_log.log2(f'gpt_basic_2.ai: {unknown_error1}\n\nServer: {server[0]}\n\n{server[1]}\n\n{error_tr}')
         return response
     except Exception as unknown_error2:
         error_tr = traceback.format_exc()
@@ -76,43 +79,20 @@ def ai(prompt: str = '', temp: float = 0.1, max_tok: int = 4000, timeou: int = 1
 
 
 def clear_mem(mem):
-    while 1:
-        sizeofmem = count_tokens(mem)
-        if sizeofmem <= MAX_CHARS:
-            break
-        try:
-            mem = mem[2:]
-        except IndexError:
-            mem = []
-            break
-
-    return mem[-MAX_MEM_LINES*2:]
+    return my_history.trim(mem, MAX_CHARS, MAX_MEM_LINES*2)
 
 
 def count_tokens(mem) -> int:
-    return sum([len(m['content']) for m in mem])
+    return my_tokens.count(mem, MODEL)
 
 
 def update_mem(query: str, resp: str, chat_id: str):
-    if chat_id not in CHATS:
-        CHATS[chat_id] = []
     mem = CHATS[chat_id]
-    mem += [{'role': 'user', 'content': query}]
-    mem += [{'role': 'assistant', 'content': resp}]
-    mem = clear_mem(mem)
-
-    mem__ = []
-    try:
-        i = 0
-        while i < len(mem):
-            if i == 0 or mem[i] != mem[i-1]:
-                mem__.append(mem[i])
-            i += 1
-    except Exception as error:
-        error_traceback = traceback.format_exc()
-        my_log.log_haiku(f'my_gpt_basic_2:update_mem: {error}\n\n{error_traceback}\n\n{query}\n\n{resp}\n\n{mem}')
-
-    CHATS[chat_id] = mem__
+    new_lines = [{'role': 'user', 'content': query}, {'role': 'assistant', 'content': resp}]
+    history = my_history.BoundedHistory(mem, MAX_CHARS, MAX_MEM_LINES*2)
+    history.extend(new_lines)
+    CHATS.append(chat_id, new_lines)
+    CHATS.trim(chat_id, history.evicted)
 
 
 def chat(query: str, chat_id: str = '', temperature: float = 0.1) -> str:
@@ -123,8 +103,6 @@ def chat(query: str, chat_id: str = '', temperature: float = 0.1) -> str:
         lock = threading.Lock()
         LOCKS[chat_id] = lock
     with lock:
-        if chat_id not in CHATS:
-            CHATS[chat_id] = []
         mem = CHATS[chat_id]
         text = ai(query, messages=mem, temp = temperature)
         if text:
@@ -5,10 +5,12 @@ import threading
 import traceback
 
 import openai
-from sqlitedict import SqliteDict
 
 import cfg
+import my_dialogs
+import my_history
 import my_log
+import my_tokens
 
 
 # ROLE = """Ты искусственный интеллект отвечающий на запросы юзера."""
@@ -27,7 +29,7 @@ LOCKS = {}
 MAX_REQUEST = 12000
 
 # хранилище диалогов {id:list(mem)}
-CHATS = SqliteDict('db/gemma2-9b_dialogs.db', autocommit=True)
+CHATS = my_dialogs.Dialogs('gemma2-9b')
 
 
 def ai(prompt: str = '', temp: float = 0.1, max_tok: int = 4000, timeou: int = 120, messages = None,
@@ -77,43 +79,20 @@ def ai(prompt: str = '', temp: float = 0.1, max_tok: int = 4000, timeou: int = 1
 
 
 def clear_mem(mem):
-    while 1:
-        sizeofmem = count_tokens(mem)
-        if sizeofmem <= MAX_CHARS:
-            break
-        try:
-            mem = mem[2:]
-        except IndexError:
-            mem = []
-            break
-
-    return mem[-MAX_MEM_LINES*2:]
+    return my_history.trim(mem, MAX_CHARS, MAX_MEM_LINES*2)
 
 
 def count_tokens(mem) -> int:
-    return sum([len(m['content']) for m in mem])
+    return my_tokens.count(mem, MODEL)
 
 
 def update_mem(query: str, resp: str, chat_id: str):
-    if chat_id not in CHATS:
-        CHATS[chat_id] = []
     mem = CHATS[chat_id]
-    mem += [{'role': 'user', 'content': query}]
-    mem += [{'role': 'assistant', 'content': resp}]
-    mem = clear_mem(mem)
-
-    mem__ = []
-    try:
-        i = 0
-        while i < len(mem):
-            if i == 0 or mem[i] != mem[i-1]:
-                mem__.append(mem[i])
-            i += 1
-    except Exception as error:
-        error_traceback = traceback.format_exc()
-        my_log.log_haiku(f'my_gpt_basic_3:update_mem: {error}\n\n{error_traceback}\n\n{query}\n\n{resp}\n\n{mem}')
-
-    CHATS[chat_id] = mem__
+    new_lines = [{'role': 'user', 'content': query}, {'role': 'assistant', 'content': resp}]
+    history = my_history.BoundedHistory(mem, MAX_CHARS, MAX_MEM_LINES*2)
+    history.extend(new_lines)
+    CHATS.append(chat_id, new_lines)
+    CHATS.trim(chat_id, history.evicted)
 
 
 def chat(query: str, chat_id: str = '', temperature: float = 0.1) -> str:
@@ -124,8 +103,6 @@ def chat(query: str, chat_id: str = '', temperature: float = 0.1) -> str:
         lock = threading.Lock()
         LOCKS[chat_id] = lock
     with lock:
-        if chat_id not in CHATS:
-            CHATS[chat_id] = []
         mem = CHATS[chat_id]
         text = ai(query, messages=mem, temp = temperature)
         if text:
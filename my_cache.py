@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# Кеш ответов LLM для служебных запросов которые зависят только от входа (переводы, репромпты,
+# исправление текста после распознавания речи, сжатие). Ключ - хеш от (модель, system, температура
+# округленная до корзины, запрос), так что одинаковый запрос второй раз стоит поиска в кеше, а не
+# похода в сеть. Два уровня: LRU в памяти и sqlite на диске (переживает перезапуск) с временем жизни
+# записей и ограничением на размер базы. Пустые ответы не кешируются. Если одинаковый запрос
+# уже выполняется в другом потоке то второй ждет его ответ, а не делает такой же запрос.
+#
+# Кеш включается в каждом месте отдельно:
+# translated = my_cache.cached(lambda: ai(query, temperature=0.1), 'gemini', query, 0.1)
+
+
+import collections
+import hashlib
+import json
+import threading
+import time
+import traceback
+
+import my_dialogs
+import my_log
+
+
+DB_PATH = 'db/llm_cache.db'
+
+# сколько записей держать в памяти
+MEMORY_ITEMS = 5000
+
+# время жизни записи по умолчанию, секунд
+TTL = 7 * 24 * 60 * 60
+
+# размер базы на диске, после превышения удаляются давно не использованные записи
+MAX_DISK_BYTES = 100 * 1024 * 1024
+
+# проверять размер базы и удалять просроченные записи раз в столько записей
+PRUNE_EVERY = 200
+
+# шаг округления температуры, 0.1 и 0.2 это практически одно и то же
+TEMPERATURE_STEP = 0.25
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires REAL NOT NULL,
+    used REAL NOT NULL,
+    size INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires);
+CREATE INDEX IF NOT EXISTS cache_used ON cache (used);
+'''
+
+
+def make_key(model: str, prompt: str, temperature: float = 0, system: str = '') -> str:
+    """ключ кеша для запроса"""
+    bucket = int(temperature / TEMPERATURE_STEP) * TEMPERATURE_STEP
+    data = json.dumps([model, system, bucket, prompt], ensure_ascii=False)
+    return hashlib.blake2b(data.encode('utf-8', errors='replace'), digest_size=20).hexdigest()
+
+
+class Cache:
+    def __init__(self, path: str = DB_PATH, memory_items: int = MEMORY_ITEMS, max_disk_bytes: int = MAX_DISK_BYTES):
+        self.path = path
+        self.memory_items = memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self.lock = threading.Lock()
+        # {key: (value, expires)}, последние использованные в конце
+        self.memory = collections.OrderedDict()
+        # {key: threading.Event} запросы которые сейчас выполняются
+        self.inflight = {}
+        self.pool = None
+        self.puts = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get_pool(self) -> my_dialogs.ConnectionPool:
+        with self.lock:
+            if self.pool is None:
+                self.pool = my_dialogs.ConnectionPool(self.path, schema=SCHEMA)
+            return self.pool
+
+    def remember(self, key: str, value: str, expires: float):
+        with self.lock:
+            self.memory[key] = (value, expires)
+            self.memory.move_to_end(key)
+            if len(self.memory) > self.memory_items:
+                self.memory.popitem(last=False)
+
+    def get(self, key: str) -> str:
+        """значение из кеша или None"""
+        now = time.time()
+        with self.lock:
+            item = self.memory.get(key)
+            if item is not None:
+                if item[1] > now:
+                    self.memory.move_to_end(key)
+                    self.hits += 1
+                    return item[0]
+                del self.memory[key]
+        try:
+            with self.get_pool().connection() as conn:
+                row = conn.execute('SELECT value, expires FROM cache WHERE key = ? AND expires > ?', (key, now)).fetchone()
+                if row:
+                    conn.execute('UPDATE cache SET used = ? WHERE key = ?', (now, key))
+        except Exception as error:
+            error_traceback = traceback.format_exc()
+            my_log.log2(f'my_cache:get: {error}\n\n{error_traceback}')
+            row = None
+        if row is None:
+            with self.lock:
+                self.misses += 1
+            return None
+        self.remember(key, row[0], row[1])
+        with self.lock:
+            self.disk_hits += 1
+        return row[0]
+
+    def put(self, key: str, value: str, ttl: float = TTL):
+        now = time.time()
+        expires = now + ttl
+        self.remember(key, value, expires)
+        try:
+            with self.get_pool().connection() as conn:
+                conn.execute('INSERT OR REPLACE INTO cache (key, value, expires, used, size) VALUES (?, ?, ?, ?, ?)',
+                             (key, value, expires, now, len(key) + len(value.encode('utf-8', errors='replace'))))
+        except Exception as error:
+            error_traceback = traceback.format_exc()
+            my_log.log2(f'my_cache:put: {error}\n\n{error_traceback}')
+            return
+        with self.lock:
+            self.puts += 1
+            prune = self.puts % PRUNE_EVERY == 0
+        if prune:
+            self.prune()
+
+    def prune(self):
+        """удаляет просроченные записи и самые давно использованные если база больше max_disk_bytes"""
+        try:
+            with self.get_pool().transaction() as conn:
+                conn.execute('DELETE FROM cache WHERE expires <= ?', (time.time(),))
+                total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+                if total > self.max_disk_bytes:
+                    # удаляем с запасом что бы не чистить после каждой записи
+                    extra = total - self.max_disk_bytes * 0.9
+                    conn.execute('''DELETE FROM cache WHERE key IN (
+                                        SELECT key FROM (
+                                            SELECT key, size, SUM(size) OVER (ORDER BY used, key) AS freed FROM cache)
+                                        WHERE freed - size < ?)''', (extra,))
+        except Exception as error:
+            error_traceback = traceback.format_exc()
+            my_log.log2(f'my_cache:prune: {error}\n\n{error_traceback}')
+
+    def cached(self, func, model: str, prompt: str, temperature: float = 0, system: str = '', ttl: float = TTL) -> str:
+        """
+        Ответ из кеша, если его нет то func() и ответ запоминается (если не пустой).
+        model, prompt, temperature, system - то от чего зависит ответ func
+        """
+        key = make_key(model, prompt, temperature, system)
+        while True:
+            value = self.get(key)
+            if value is not None:
+                return value
+            with self.lock:
+                event = self.inflight.get(key)
+                if event is None:
+                    event = self.inflight[key] = threading.Event()
+                    owner = True
+                else:
+                    owner = False
+            if owner:
+                break
+            # такой же запрос уже делает другой поток, ждем его ответ,
+            # если у него не получилось то следующий круг сделает запрос сам
+            event.wait()
+
+        try:
+            value = func()
+            if value and isinstance(value, str):
+                self.put(key, value, ttl)
+            return value
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+            event.set()
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.disk_hits + self.misses
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'hit_rate': round((self.hits + self.disk_hits) / total, 3) if total else 0.0,
+                    'memory_items': len(self.memory)}
+
+
+CACHE = Cache()
+
+
+def cached(func, model: str, prompt: str, temperature: float = 0, system: str = '', ttl: float = TTL) -> str:
+    return CACHE.cached(func, model, prompt, temperature, system, ttl)
+
+
+def stats() -> dict:
+    return CACHE.stats()
+
+
+if __name__ == '__main__':
+    import os
+    import tempfile
+
+    folder = tempfile.mkdtemp()
+    cache = Cache(os.path.join(folder, 'cache.db'), memory_items = 100, max_disk_bytes = 200 * 1024)
+
+    calls = []
+    def slow_translate(text):
+        def func():
+            calls.append(text)
+            time.sleep(0.05)
+            return f'translated {text}'
+        return func
+
+    # одинаковый запрос второй раз не делается, температура 0.1 и 0.2 в одной корзине
+    start = time.perf_counter()
+    for i in range(20):
+        assert cache.cached(slow_translate('привет'), 'gemini', 'привет', 0.1) == 'translated привет'
+    assert cache.cached(slow_translate('привет'), 'gemini', 'привет', 0.2) == 'translated привет'
+    assert len(calls) == 1
+    print(f'21 перевод, 1 запрос: {(time.perf_counter() - start) * 1000:.1f}ms')
+    # другая модель, температура или system это другой ключ
+    cache.cached(slow_translate('привет'), 'groq', 'привет', 0.1)
+    cache.cached(slow_translate('привет'), 'gemini', 'привет', 1)
+    cache.cached(slow_translate('привет'), 'gemini', 'привет', 0.1, system='x')
+    assert len(calls) == 4
+
+    # пустой ответ не кешируется
+    assert cache.cached(lambda: '', 'gemini', 'пусто') == ''
+    assert cache.get(make_key('gemini', 'пусто')) is None
+
+    # 10 потоков с одним запросом делают его один раз
+    calls.clear()
+    threads = [threading.Thread(target=cache.cached, args=(slow_translate('поток'), 'gemini', 'поток')) for _ in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1, calls
+
+    # после перезапуска ответы берутся с диска
+    restarted = Cache(cache.path)
+    assert restarted.cached(slow_translate('привет'), 'gemini', 'привет', 0.1) == 'translated привет'
+    assert restarted.disk_hits == 1 and len(calls) == 1
+
+    # просроченные записи не отдаются
+    cache.put('old', 'value', ttl = -1)
+    cache.memory.clear()
+    assert cache.get('old') is None
+
+    # база не растет больше лимита, остаются последние использованные
+    for i in range(1000):
+        cache.put(f'k{i}', 'x' * 1000)
+    cache.prune()
+    with cache.get_pool().connection() as conn:
+        size, count = conn.execute('SELECT SUM(size), COUNT(*) FROM cache').fetchone()
+    print(f'на диске {count} записей, {size} байт')
+    assert size <= 200 * 1024
+    cache.memory.clear()
+    assert cache.get('k999') is not None and cache.get('k0') is None
+
+    print(cache.stats())
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# Индикаторы "печатает...", "отправляет фото..." для всех чатов в одном потоке.
+# Телеграм гасит индикатор через 5 секунд, его надо повторять. Раньше на каждый запрос
+# запускался свой поток, теперь запросы регистрируются здесь, один поток раз в REFRESH_INTERVAL
+# обновляет индикаторы всех активных чатов, по одному запросу на (чат, тему) сколько бы
+# запросов там ни выполнялось, и не чаще чем позволяет ограничитель.
+
+
+import itertools
+import threading
+import time
+import traceback
+
+import my_log
+import my_ratelimit
+
+
+ACTIONS = ("typing", "upload_photo", "record_video", "upload_video", "record_audio",
+           "upload_audio", "upload_document", "find_location", "record_video_note", "upload_video_note")
+
+# как часто повторять индикатор, телеграм показывает его 5 секунд
+REFRESH_INTERVAL = 4.5
+
+# индикатор снимается сам если запрос висит дольше
+MAX_TIME = 60*5
+
+# сколько send_chat_action в секунду можно отправлять на все чаты вместе
+RATE_LIMIT = 10
+
+
+class Handle:
+    """зарегистрированный индикатор, можно использовать как контекстный менеджер"""
+    def __init__(self, service, key: tuple, action: str):
+        self.service = service
+        self.key = key
+        self.action = action
+        self.started_time = time.time()
+        self.id = next(service.counter)
+
+    def stop(self):
+        self.service.stop(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class ChatActionService:
+    def __init__(self, bot, interval: float = REFRESH_INTERVAL, max_time: float = MAX_TIME, rate: float = RATE_LIMIT):
+        self.bot = bot
+        self.interval = interval
+        self.max_time = max_time
+        self.bucket = my_ratelimit.TokenBucket(rate)
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        # {(chat_id, thread_id): {handle.id: handle}}
+        self.active = {}
+        # {(chat_id, thread_id): когда обновить индикатор}
+        self.next_refresh = {}
+        self.thread = None
+
+    def start(self, chat_id: int, thread_id: int = None, action: str = 'typing') -> Handle:
+        """включает индикатор, thread_id - номер темы если это сообщение в теме, иначе None"""
+        assert action in ACTIONS, f'Допустимые actions = {ACTIONS}'
+        key = (chat_id, thread_id)
+        with self.cond:
+            handle = Handle(self, key, action)
+            self.active.setdefault(key, {})[handle.id] = handle
+            # новый индикатор показываем сразу, уже показанный не трогаем
+            self.next_refresh.setdefault(key, 0)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='chat_action', daemon=True)
+                self.thread.start()
+            self.cond.notify()
+        return handle
+
+    def stop(self, handle: Handle):
+        with self.cond:
+            handles = self.active.get(handle.key)
+            if handles is None:
+                return
+            handles.pop(handle.id, None)
+            if not handles:
+                del self.active[handle.key]
+                del self.next_refresh[handle.key]
+
+    def due(self, now: float) -> list:
+        """[(key, action), ...] индикаторы которые пора обновить, заодно снимает зависшие"""
+        result = []
+        with self.cond:
+            for key, handles in list(self.active.items()):
+                for handle in list(handles.values()):
+                    if now - handle.started_time > self.max_time:
+                        my_log.log2(f'my_chat_action:stoped after {self.max_time}s {key} action: {handle.action}')
+                        handles.pop(handle.id)
+                if not handles:
+                    del self.active[key]
+                    del self.next_refresh[key]
+                    continue
+                if self.next_refresh[key] <= now:
+                    # если в чате несколько запросов то показываем самый новый
+                    result.append((key, handles[max(handles)].action))
+        return result
+
+    def send(self, key: tuple, action: str) -> bool:
+        """отправляет индикатор, False если не хватило лимита и надо повторить позже"""
+        if not self.bucket.try_acquire():
+            return False
+        chat_id, thread_id = key
+        try:
+            if thread_id:
+                self.bot.send_chat_action(chat_id, action, message_thread_id = thread_id)
+            else:
+                self.bot.send_chat_action(chat_id, action)
+        except Exception as error:
+            wait = my_ratelimit.retry_after(error)
+            if wait:
+                self.bucket.block(wait)
+            else:
+                my_log.log2(f'my_chat_action:send: {error}')
+        return True
+
+    def run(self):
+        while True:
+            try:
+                with self.cond:
+                    while not self.active:
+                        self.cond.wait()
+                    now = time.time()
+                    if self.next_refresh:
+                        wait = min(self.next_refresh.values()) - now
+                        if wait > 0:
+                            self.cond.wait(wait)
+                now = time.time()
+                for key, action in self.due(now):
+                    if self.send(key, action):
+                        with self.cond:
+                            if key in self.next_refresh:
+                                self.next_refresh[key] = now + self.interval
+                    else:
+                        time.sleep(max(0.01, self.bucket.delay()))
+                        break
+            except Exception as unknown:
+                error_traceback = traceback.format_exc()
+                my_log.log2(f'my_chat_action:run: {unknown}\n\n{error_traceback}')
+                time.sleep(1)
+
+
+if __name__ == '__main__':
+    class FakeBot:
+        def __init__(self):
+            self.calls = []
+
+        def send_chat_action(self, chat_id, action, message_thread_id = None):
+            self.calls.append((round(time.time(), 1), chat_id, message_thread_id, action))
+
+    bot = FakeBot()
+    service = ChatActionService(bot, interval=0.5, max_time=3)
+    # 5 запросов в одном чате должны давать один индикатор
+    handles = [service.start(1, None, 'typing') for _ in range(5)]
+    with service.start(2, 7, 'upload_photo'):
+        time.sleep(1.2)
+    for handle in handles:
+        handle.stop()
+    time.sleep(0.6)
+    for call in bot.calls:
+        print(call)
+    assert len([x for x in bot.calls if x[1] == 1]) == 3, bot.calls
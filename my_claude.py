@@ -8,8 +8,8 @@ import threading
 import claude_api
 
 import cfg
+import my_dialogs
 import my_log
-import my_dic
 
 
 # максимальный размер запроса 100к (символов или токенов или чего?)
@@ -18,7 +18,7 @@ MAX_QUERY = 90000
 # MAX_QUERY = 190000
 
 # хранилище сессий {chat_id(str):session(str),...}
-DIALOGS = my_dic.PersistentDict('db/claude_dialogs.pkl')
+DIALOGS = my_dialogs.Sessions('claude')
 
 # хранилище замков что бы юзеры не могли делать новые запросы пока не получен ответ на старый
 # {chat_id(str):threading.Lock(),...}
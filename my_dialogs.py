@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+# Единое хранилище истории диалогов всех провайдеров.
+# Одна строка = одно сообщение, ключ (chat_id, provider, seq), так что добавить
+# сообщение или обрезать начало истории это один sql запрос, а не перезапись всего списка.
+#
+# python my_dialogs.py migrate - перенести старые db/*_dialogs.db и db/*.pkl в новую базу
+
+
+import contextlib
+import json
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import traceback
+
+from sqlitedict import SqliteDict
+
+import my_dic
+import my_history
+import my_log
+
+
+DB_PATH = 'db/conversations.db'
+
+# сколько соединений может быть открыто одновременно
+POOL_SIZE = 8
+
+# старые хранилища {путь: провайдер}
+OLD_SQLITEDICT_DBS = {
+    'db/gemini_dialogs.db': 'gemini',
+    'db/groq_dialogs.db': 'groq',
+    'db/haiku_dialogs.db': 'haiku',
+    'db/gemma2-9b_dialogs.db': 'gemma2-9b',
+    'db/shadow_dialogs.db': 'shadowjourney',
+}
+OLD_PICKLE_DIALOGS = {
+    'db/dialogs.pkl': 'chatgpt',
+}
+OLD_PICKLE_SESSIONS = {
+    'db/claude_dialogs.pkl': 'claude',
+}
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    chat_id TEXT NOT NULL,
+    provider TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    message TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, provider, seq)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS sessions (
+    chat_id TEXT NOT NULL,
+    provider TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (chat_id, provider)
+) WITHOUT ROWID;
+'''
+
+
+class ConnectionPool:
+    """Пул соединений к sqlite в режиме WAL, читатели не ждут писателей.
+    Соединения создаются по мере надобности, но не больше max_size.
+    """
+    def __init__(self, path: str, max_size: int = POOL_SIZE, schema: str = SCHEMA):
+        self.path = path
+        self.max_size = max_size
+        self.created = 0
+        self.lock = threading.Lock()
+        self.idle = queue.LifoQueue()
+
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        with self.connection() as conn:
+            conn.executescript(schema)
+
+    def new_connection(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    @contextlib.contextmanager
+    def connection(self):
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_create = self.created < self.max_size
+                if can_create:
+                    self.created += 1
+            conn = self.new_connection() if can_create else self.idle.get()
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """соединение с открытой пишущей транзакцией, коммит при выходе, откат при ошибке"""
+        with self.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+
+POOL = None
+POOL_LOCK = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    global POOL
+    with POOL_LOCK:
+        if POOL is None:
+            POOL = ConnectionPool(DB_PATH)
+    return POOL
+
+
+def encode(message: dict) -> str:
+    return json.dumps(message, ensure_ascii=False)
+
+
+def insert_rows(conn: sqlite3.Connection, chat_id: str, provider: str, start_seq: int, messages: list, encoded: list):
+    conn.executemany('INSERT INTO messages (chat_id, provider, seq, message, size) VALUES (?, ?, ?, ?, ?)',
+                     [(chat_id, provider, start_seq + i, x, my_history.message_size(m)) for i, (m, x) in enumerate(zip(messages, encoded))])
+
+
+def get(chat_id: str, provider: str) -> list:
+    """вся история чата у провайдера, от старых сообщений к новым"""
+    with get_pool().connection() as conn:
+        rows = conn.execute('SELECT message FROM messages WHERE chat_id = ? AND provider = ? ORDER BY seq',
+                            (chat_id, provider)).fetchall()
+    return [json.loads(row[0]) for row in rows]
+
+
+def exists(chat_id: str, provider: str) -> bool:
+    with get_pool().connection() as conn:
+        row = conn.execute('SELECT 1 FROM messages WHERE chat_id = ? AND provider = ? LIMIT 1',
+                           (chat_id, provider)).fetchone()
+    return row is not None
+
+
+def append(chat_id: str, provider: str, messages: list):
+    """добавляет сообщения в конец истории"""
+    if not messages:
+        return
+    with get_pool().transaction() as conn:
+        last = conn.execute('SELECT MAX(seq) FROM messages WHERE chat_id = ? AND provider = ?',
+                            (chat_id, provider)).fetchone()[0]
+        insert_rows(conn, chat_id, provider, (last or 0) + 1, messages, [encode(x) for x in messages])
+
+
+def trim(chat_id: str, provider: str, n: int):
+    """удаляет n самых старых сообщений"""
+    if n <= 0:
+        return
+    with get_pool().transaction() as conn:
+        conn.execute('''DELETE FROM messages WHERE chat_id = ? AND provider = ? AND seq IN
+                        (SELECT seq FROM messages WHERE chat_id = ? AND provider = ? ORDER BY seq LIMIT ?)''',
+                     (chat_id, provider, chat_id, provider, n))
+
+
+def pop(chat_id: str, provider: str, n: int):
+    """удаляет n самых новых сообщений"""
+    if n <= 0:
+        return
+    with get_pool().transaction() as conn:
+        conn.execute('''DELETE FROM messages WHERE chat_id = ? AND provider = ? AND seq IN
+                        (SELECT seq FROM messages WHERE chat_id = ? AND provider = ? ORDER BY seq DESC LIMIT ?)''',
+                     (chat_id, provider, chat_id, provider, n))
+
+
+def reset(chat_id: str, provider: str):
+    with get_pool().transaction() as conn:
+        conn.execute('DELETE FROM messages WHERE chat_id = ? AND provider = ?', (chat_id, provider))
+
+
+def total_size(chat_id: str, provider: str) -> int:
+    """суммарная длина текста всех сообщений чата"""
+    with get_pool().connection() as conn:
+        row = conn.execute('SELECT COALESCE(SUM(size), 0) FROM messages WHERE chat_id = ? AND provider = ?',
+                           (chat_id, provider)).fetchone()
+    return row[0]
+
+
+def replace(chat_id: str, provider: str, messages: list):
+    """записывает новую историю вместо старой.
+    Старая и новая история сравниваются, и в базу идут только изменения:
+    добавленные в конец сообщения, удаленные из начала или из конца.
+    Если история поменялась как-то иначе то она переписывается целиком.
+    """
+    new = [encode(x) for x in messages]
+    with get_pool().transaction() as conn:
+        rows = conn.execute('SELECT seq, message FROM messages WHERE chat_id = ? AND provider = ? ORDER BY seq',
+                            (chat_id, provider)).fetchall()
+        seqs = [row[0] for row in rows]
+        old = [row[1] for row in rows]
+        if old == new:
+            return
+
+        # сколько сообщений убрано из начала старой истории
+        head = None
+        if not old:
+            head = 0
+        elif new:
+            for h in range(len(old)):
+                if old[h] == new[0] and old[h:] == new[:len(old) - h]:
+                    head = h
+                    break
+        if head is not None:
+            if head:
+                conn.execute('DELETE FROM messages WHERE chat_id = ? AND provider = ? AND seq <= ?',
+                             (chat_id, provider, seqs[head - 1]))
+            tail = len(old) - head
+            insert_rows(conn, chat_id, provider, (seqs[-1] if seqs else 0) + 1, messages[tail:], new[tail:])
+            return
+
+        # новая история это начало старой
+        if old[:len(new)] == new:
+            conn.execute('DELETE FROM messages WHERE chat_id = ? AND provider = ? AND seq >= ?',
+                         (chat_id, provider, seqs[len(new)]))
+            return
+
+        conn.execute('DELETE FROM messages WHERE chat_id = ? AND provider = ?', (chat_id, provider))
+        insert_rows(conn, chat_id, provider, 1, messages, new)
+
+
+class Dialogs:
+    """История диалогов одного провайдера в виде словаря {chat_id: list(mem)},
+    что бы модули могли работать с ней так же как раньше с SqliteDict/PersistentDict.
+    Для несуществующего чата возвращает пустой список.
+    """
+    def __init__(self, provider: str):
+        self.provider = provider
+
+    def __contains__(self, chat_id: str) -> bool:
+        return exists(chat_id, self.provider)
+
+    def __getitem__(self, chat_id: str) -> list:
+        return get(chat_id, self.provider)
+
+    def __setitem__(self, chat_id: str, messages: list):
+        replace(chat_id, self.provider, messages)
+
+    def __delitem__(self, chat_id: str):
+        reset(chat_id, self.provider)
+
+    def __iter__(self):
+        with get_pool().connection() as conn:
+            rows = conn.execute('SELECT DISTINCT chat_id FROM messages WHERE provider = ?', (self.provider,)).fetchall()
+        return iter([row[0] for row in rows])
+
+    def append(self, chat_id: str, messages: list):
+        append(chat_id, self.provider, messages)
+
+    def trim(self, chat_id: str, n: int):
+        trim(chat_id, self.provider, n)
+
+    def pop(self, chat_id: str, n: int):
+        pop(chat_id, self.provider, n)
+
+    def reset(self, chat_id: str):
+        reset(chat_id, self.provider)
+
+    def total_size(self, chat_id: str) -> int:
+        return total_size(chat_id, self.provider)
+
+
+class Sessions:
+    """Одно строковое значение на чат (например id сессии у claude.ai) в виде словаря {chat_id: str}"""
+    def __init__(self, provider: str):
+        self.provider = provider
+
+    def __contains__(self, chat_id: str) -> bool:
+        with get_pool().connection() as conn:
+            row = conn.execute('SELECT 1 FROM sessions WHERE chat_id = ? AND provider = ?', (chat_id, self.provider)).fetchone()
+        return row is not None
+
+    def __getitem__(self, chat_id: str) -> str:
+        with get_pool().connection() as conn:
+            row = conn.execute('SELECT value FROM sessions WHERE chat_id = ? AND provider = ?', (chat_id, self.provider)).fetchone()
+        if row is None:
+            raise KeyError(chat_id)
+        return row[0]
+
+    def __setitem__(self, chat_id: str, value: str):
+        with get_pool().transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO sessions (chat_id, provider, value) VALUES (?, ?, ?)',
+                         (chat_id, self.provider, value))
+
+    def __delitem__(self, chat_id: str):
+        with get_pool().transaction() as conn:
+            cur = conn.execute('DELETE FROM sessions WHERE chat_id = ? AND provider = ?', (chat_id, self.provider))
+        if not cur.rowcount:
+            raise KeyError(chat_id)
+
+
+def migrate(overwrite: bool = False):
+    """переносит старые хранилища диалогов в новую базу.
+    Чаты которые уже есть в новой базе не трогаются, если не указан overwrite.
+    """
+    def import_dialogs(source, provider: str, name: str):
+        store = Dialogs(provider)
+        n = 0
+        for chat_id in list(source.keys()):
+            try:
+                mem = source[chat_id]
+                if not isinstance(mem, list) or not mem:
+                    continue
+                if not overwrite and chat_id in store:
+                    continue
+                reset(chat_id, provider)
+                append(chat_id, provider, mem)
+                n += 1
+            except Exception as error:
+                error_traceback = traceback.format_exc()
+                my_log.log2(f'my_dialogs:migrate: {name} {chat_id} {error}\n\n{error_traceback}')
+        print(f'{name} -> {provider}: {n} chats')
+
+    for path, provider in OLD_SQLITEDICT_DBS.items():
+        if os.path.exists(path):
+            with SqliteDict(path) as source:
+                import_dialogs(source, provider, path)
+
+    for path, provider in OLD_PICKLE_DIALOGS.items():
+        if os.path.exists(path):
+            import_dialogs(my_dic.PersistentDict(path), provider, path)
+
+    for path, provider in OLD_PICKLE_SESSIONS.items():
+        if os.path.exists(path):
+            store = Sessions(provider)
+            source = my_dic.PersistentDict(path)
+            n = 0
+            for chat_id, value in source.items():
+                if overwrite or chat_id not in store:
+                    store[chat_id] = value
+                    n += 1
+            print(f'{path} -> {provider}: {n} sessions')
+
+
+if __name__ == '__main__':
+    if 'migrate' in sys.argv:
+        migrate(overwrite='--overwrite' in sys.argv)
+    else:
+        d = Dialogs('test')
+        d['1'] = [{'role': 'user', 'content': '1'}, {'role': 'assistant', 'content': '2'}]
+        d['1'] = d['1'] + [{'role': 'user', 'content': '3'}, {'role': 'assistant', 'content': '4'}]
+        d['1'] = d['1'][2:]
+        print(d['1'], d.total_size('1'))
+        d.reset('1')
@@ -1,20 +1,92 @@
 #!/usr/bin/env python3
 
 
+import atexit
+import os
 import pickle
+import shutil
+import sys
+import tempfile
 import threading
+import time
 import traceback
 from pprint import pprint
 
 import my_log
 
 
+# журнал сворачивается в снапшот когда он становится больше снапшота, но не раньше чем вырастет до 1мб
+COMPACT_MIN_SIZE = 1024 * 1024
+
+# в отложенном режиме изменения сбрасываются на диск не чаще чем раз в столько миллисекунд
+FLUSH_INTERVAL_MS = 1000
+
+
+class FlushScheduler:
+    """Один фоновый поток который сбрасывает на диск отложенные изменения PersistentDict и PersistentList.
+    Изменение только помечает контейнер грязным, поток ждет interval_ms собирая все изменения
+    за это время и пишет каждый контейнер один раз. При выходе из программы сбрасывает все что осталось.
+    """
+    def __init__(self, interval_ms: int = FLUSH_INTERVAL_MS):
+        self.interval = interval_ms / 1000
+        # {id(container): container}, сами контейнеры (dict и list) не хешируются
+        self.dirty = {}
+        self.cond = threading.Condition()
+        self.thread = None
+        atexit.register(self.flush_all)
+
+    def mark_dirty(self, container):
+        with self.cond:
+            self.dirty[id(container)] = container
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.dirty:
+                    self.cond.wait()
+            time.sleep(self.interval)
+            self.flush_all()
+
+    def flush_all(self):
+        with self.cond:
+            containers = list(self.dirty.values())
+            self.dirty.clear()
+        for container in containers:
+            try:
+                container.flush()
+            except Exception as unknown:
+                error_traceback = traceback.format_exc()
+                my_log.log2(f'my_dic:FlushScheduler:flush_all: {str(unknown)}\n\n{error_traceback}')
+
+
+FLUSHER = FlushScheduler()
+
+
 class PersistentDict(dict):
     """Словарь который хранит состояние в файле на диске, данные сохраняются между
-    перезапусками программы"""
-    def __init__(self, file_path):
+    перезапусками программы
+
+    Изменения не переписывают весь файл а дописываются в журнал file_path + '.journal',
+    запись стоит столько сколько весит измененное значение а не весь словарь.
+    Когда журнал становится больше снапшота он в фоне сворачивается в снапшот (file_path).
+    При старте читается снапшот и поверх него проигрывается журнал.
+
+    deferred=True - изменения не пишутся сразу а копятся в памяти и сбрасываются
+    фоновым потоком FLUSHER, можно сбросить явно через flush()
+    """
+    def __init__(self, file_path, compact_min_size: int = COMPACT_MIN_SIZE, deferred: bool = False):
         self.lock = threading.Lock()
         self.file_path = file_path
+        self.deferred = deferred
+        # записи журнала которые еще не сброшены на диск в отложенном режиме
+        self.pending = []
+        self.journal_path = file_path + '.journal'
+        self.compact_min_size = compact_min_size
+        self.compacting = False
         try:
             with open(self.file_path, 'rb') as f:
                 try:
@@ -22,62 +94,172 @@ class PersistentDict(dict):
                 except Exception as error:
                     print(error, 'Empty message history')
                     my_log.log2(f'my_dic:init:{str(error)}')
-                    data = []
-            self.update(data)
+                    data = {}
+            super().update(data)
         except FileNotFoundError:
             pass
+        self.snapshot_size = os.path.getsize(self.file_path) if os.path.exists(self.file_path) else 0
+
+        # .old остается если программа упала во время сворачивания журнала
+        self.replay(self.journal_path + '.old')
+        self.replay(self.journal_path)
+
+        self.journal = open(self.journal_path, 'ab')
+        self.journal_size = self.journal.tell()
+
+    def replay(self, path: str):
+        """проигрывает журнал поверх того что уже загружено, оборванную последнюю запись отрезает"""
+        try:
+            f = open(path, 'rb+')
+        except FileNotFoundError:
+            return
+        with f:
+            good_offset = 0
+            while True:
+                try:
+                    record = pickle.load(f)
+                except EOFError:
+                    break
+                except Exception as error:
+                    my_log.log2(f'my_dic:replay: {path} broken record at {good_offset}: {error}')
+                    f.truncate(good_offset)
+                    break
+                self.apply(record)
+                good_offset = f.tell()
+
+    def apply(self, record: tuple):
+        """применяет к словарю одну запись из журнала, без записи на диск"""
+        op = record[0]
+        if op == 'set':
+            super().__setitem__(record[1], record[2])
+        elif op == 'del':
+            super().pop(record[1], None)
+        elif op == 'update':
+            super().update(record[1])
+        elif op == 'clear':
+            super().clear()
+
+    def log(self, record: tuple):
+        """добавляет запись в журнал, вызывать только под self.lock"""
+        if self.deferred:
+            self.pending.append(record)
+            FLUSHER.mark_dirty(self)
+        else:
+            self.write_journal([record])
+
+    def write_journal(self, records: list):
+        """дописывает записи в файл журнала, вызывать только под self.lock"""
+        data = b''.join(pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL) for record in records)
+        self.journal.write(data)
+        self.journal.flush()
+        self.journal_size += len(data)
+        if not self.compacting and self.journal_size > max(self.compact_min_size, self.snapshot_size):
+            self.compacting = True
+            threading.Thread(target=self.compact, daemon=True).start()
+
+    def flush(self):
+        """сбрасывает на диск накопленные в отложенном режиме изменения"""
+        with self.lock:
+            if self.pending:
+                records = self.pending
+                self.pending = []
+                self.write_journal(records)
+
+    def compact(self):
+        """сворачивает журнал в снапшот. замок держится пока журнал переименовывается и копируется
+        верхний уровень словаря, сериализация и запись снапшота идут без замка и не тормозят запись в словарь"""
+        old_path = self.journal_path + '.old'
+        try:
+            with self.lock:
+                data = dict(self)
+                # несброшенные записи все равно дописываем в журнал, если снапшот не запишется они не пропадут
+                if self.pending:
+                    records = self.pending
+                    self.pending = []
+                    self.write_journal(records)
+                self.journal.close()
+                try:
+                    if os.path.exists(old_path):
+                        # прошлое сворачивание не удалось, дописываем журнал к старому что бы не потерять порядок
+                        with open(old_path, 'ab') as old, open(self.journal_path, 'rb') as cur:
+                            shutil.copyfileobj(cur, old)
+                        os.remove(self.journal_path)
+                    else:
+                        os.replace(self.journal_path, old_path)
+                finally:
+                    # журнал открывается заново даже если переименовать не вышло, иначе запись в словарь сломается
+                    self.journal = open(self.journal_path, 'ab')
+                    self.journal_size = self.journal.tell()
+
+            # верхний уровень уже скопирован, а вложенные значения pickle (C код) сериализует не отпуская GIL
+            blob = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+            tmp_path = self.file_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(blob)
+            os.replace(tmp_path, self.file_path)
+            self.snapshot_size = len(blob)
+            os.remove(old_path)
+        except Exception as unknown:
+            error_traceback = traceback.format_exc()
+            my_log.log2(f'my_dic:PersistentDict:compact: {self.file_path} {str(unknown)}\n\n{error_traceback}')
+        finally:
+            self.compacting = False
 
     def __setitem__(self, key, value):
-        super().__setitem__(key, value)
         with self.lock:
-            with open(self.file_path, 'wb') as f:
-                pickle.dump(dict(self), f)
+            super().__setitem__(key, value)
+            self.log(('set', key, value))
 
     def __delitem__(self, key):
-        super().__delitem__(key)
         with self.lock:
-            with open(self.file_path, 'wb') as f:
-                pickle.dump(dict(self), f)
+            super().__delitem__(key)
+            self.log(('del', key))
 
     def clear(self):
-        super().clear()
         with self.lock:
-            with open(self.file_path, 'wb') as f:
-                pickle.dump(dict(self), f)
+            super().clear()
+            self.log(('clear',))
 
     def pop(self, key, default=None):
-        value = super().pop(key, default)
         with self.lock:
-            with open(self.file_path, 'wb') as f:
-                pickle.dump(dict(self), f)
+            if key not in self:
+                return default
+            value = super().pop(key)
+            self.log(('del', key))
         return value
 
     def popitem(self):
-        item = super().popitem()
         with self.lock:
-            with open(self.file_path, 'rb') as f:
-                pickle.dump(dict(self), f)
+            item = super().popitem()
+            self.log(('del', item[0]))
         return item
 
     def setdefault(self, key, default=None):
-        value = super().setdefault(key, default)
         with self.lock:
-            with open(self.file_path, 'wb') as f:
-                pickle.dump(dict(self), f)
-        return value
+            if key in self:
+                return super().__getitem__(key)
+            super().__setitem__(key, default)
+            self.log(('set', key, default))
+        return default
 
     def update(self, E=None, **F):
-        super().update(E, **F)
+        changes = dict(E or {}, **F)
         with self.lock:
-            with open(self.file_path, 'wb') as f:
-                pickle.dump(dict(self), f)
+            super().update(changes)
+            self.log(('update', changes))
 
 
 PersistentListLock = {}
 class PersistentList(list):
-    """Постоянный список, хранящий состояние в файле на диске, данные сохраняются между перезапусками программы"""
-    def __init__(self, filename):
+    """Постоянный список, хранящий состояние в файле на диске, данные сохраняются между перезапусками программы
+
+    deferred=True - изменения сбрасываются на диск фоновым потоком FLUSHER не чаще чем раз в FLUSH_INTERVAL_MS,
+    можно сбросить явно через flush()
+    """
+    def __init__(self, filename, deferred: bool = False):
         self.filename = filename
+        self.deferred = deferred
+        self.dirty = False
         PersistentListLock[self.filename] = threading.Lock()
         try:
             with open(filename, 'rb') as f:
@@ -88,13 +270,27 @@ class PersistentList(list):
                 my_log.log2(f'my_dic:PersistentList:init: {filename} {str(unknown)}\n\n{error_traceback}')
 
     def save(self):
+        self.dirty = True
+        if self.deferred:
+            FLUSHER.mark_dirty(self)
+        else:
+            self.flush()
+
+    def flush(self):
+        """пишет список на диск через временный файл, что бы при сбое не остаться с половиной файла"""
         with PersistentListLock[self.filename]:
-            with open(self.filename, 'wb') as f:
-                try:
-                    pickle.dump(self, f)
-                except Exception as unknown:
-                    error_traceback = traceback.format_exc()
-                    my_log.log2(f'my_dic:PersistentList:save: {str(unknown)}\n\n{error_traceback}')
+            if not self.dirty:
+                return
+            self.dirty = False
+            try:
+                data = pickle.dumps(list(self))
+                tmp_path = self.filename + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, self.filename)
+            except Exception as unknown:
+                error_traceback = traceback.format_exc()
+                my_log.log2(f'my_dic:PersistentList:save: {str(unknown)}\n\n{error_traceback}')
 
     def __setitem__(self, key, value):
         super().__setitem__(key, value)
@@ -142,6 +338,84 @@ class PersistentList(list):
         self.save()
 
 
+def benchmark(n_keys: int, n_writes: int = 100):
+    """сравнивает старую запись (перепись всего словаря при каждом изменении) с журналом
+    на словаре из n_keys диалогов, печатает среднее время одной записи и время старта"""
+    value = [{'role': 'user', 'content': 'привет ' * 20}, {'role': 'assistant', 'content': 'ответ ' * 40}]
+    data = {f'[{i}] [0]': value for i in range(n_keys)}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # как было раньше
+        path = os.path.join(tmp, 'old.pkl')
+        start = time.perf_counter()
+        for i in range(n_writes):
+            data[f'[{i}] [0]'] = value + value
+            with open(path, 'wb') as f:
+                pickle.dump(dict(data), f)
+        old_time = (time.perf_counter() - start) / n_writes
+
+        # с журналом
+        path = os.path.join(tmp, 'new.pkl')
+        with open(path, 'wb') as f:
+            pickle.dump(data, f)
+        d = PersistentDict(path)
+        start = time.perf_counter()
+        for i in range(n_writes):
+            d[f'[{i}] [0]'] = value + value
+        new_time = (time.perf_counter() - start) / n_writes
+        d.journal.close()
+
+        # с журналом в отложенном режиме, в цикле только отметка о изменении
+        path = os.path.join(tmp, 'deferred.pkl')
+        with open(path, 'wb') as f:
+            pickle.dump(data, f)
+        d = PersistentDict(path, deferred=True)
+        start = time.perf_counter()
+        for i in range(n_writes):
+            d[f'[{i}] [0]'] = value + value
+        deferred_time = (time.perf_counter() - start) / n_writes
+        d.flush()
+        d.journal.close()
+
+        start = time.perf_counter()
+        d2 = PersistentDict(path)
+        load_time = time.perf_counter() - start
+        assert d2 == d
+        d2.journal.close()
+
+    print(f'{n_keys} keys: full rewrite {old_time*1000:.2f} ms/write, '
+          f'journal {new_time*1000:.3f} ms/write ({old_time/new_time:.0f}x), '
+          f'deferred journal {deferred_time*1000:.4f} ms/write, '
+          f'startup with replay {load_time*1000:.0f} ms')
+
+
 if __name__ == '__main__':
-    my_dict = PersistentDict('db/super_chat.pkl')
-    pprint(my_dict)
+    if 'bench' in sys.argv:
+        for n in (10000, 100000):
+            benchmark(n)
+    else:
+        # сворачивание упало на переименовании журнала, словарь продолжает писаться и ничего не теряется
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'check.pkl')
+            d = PersistentDict(path, deferred=True)
+            d['a'] = 1
+            replace = os.replace
+            def broken_replace(*args):
+                raise OSError('disk error')
+            os.replace = broken_replace
+            try:
+                d.compact()
+            finally:
+                os.replace = replace
+            d['b'] = 2
+            d.flush()
+            d.journal.close()
+            d2 = PersistentDict(path)
+            assert d2 == {'a': 1, 'b': 2}, d2
+            d2.compact()
+            assert not os.path.exists(path + '.journal.old') and PersistentDict(path) == d2
+            d2.journal.close()
+            print('compact after OSError ok')
+
+        my_dict = PersistentDict('db/super_chat.pkl')
+        pprint(my_dict)
@@ -5,8 +5,6 @@ import pickle
 import threading
 from pprint import pprint
 
-import my_log
-
 
 class PersistentDict(dict):
     """Словарь который хранит состояние в файле на диске, данные сохраняются между
@@ -141,6 +139,10 @@ class PersistentList(list):
         self.save()
 
 
+# my_log импортирует отсюда PersistentDict, поэтому после определения классов
+import my_log
+
+
 if __name__ == '__main__':
     my_dict = PersistentDict('db/super_chat.pkl')
     pprint(my_dict)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# Диспетчер задач бота.
+# Фиксированный пул рабочих потоков и очередь задач для каждого чата. Задачи одного чата
+# выполняются строго по очереди, одновременно в работе не больше одной задачи на чат,
+# разные чаты обрабатываются параллельно. Очереди ограничены, если места нет то submit
+# возвращает False и бот должен ответить что занят.
+
+
+import collections
+import threading
+import time
+import traceback
+
+import my_log
+
+
+# сколько задач выполняется одновременно
+WORKERS = 40
+
+# сколько задач может ждать в очереди одного чата
+MAX_CHAT_QUEUE = 5
+
+# сколько задач может ждать во всех очередях вместе
+MAX_QUEUE = 500
+
+# по скольким последним задачам считать перцентили времени ожидания
+STATS_WINDOW = 1000
+
+
+class Dispatcher:
+    """
+    submit(key, func, *args, **kwargs) - поставить задачу в очередь чата key
+    stats() - глубина очередей и время ожидания задач
+    """
+    def __init__(self, workers: int = WORKERS, max_chat_queue: int = MAX_CHAT_QUEUE, max_queue: int = MAX_QUEUE):
+        self.workers = workers
+        self.max_chat_queue = max_chat_queue
+        self.max_queue = max_queue
+        self.lock = threading.Lock()
+        # {key: deque([(func, args, kwargs, enqueue_time), ...])}, ключ есть пока у чата есть задачи
+        self.queues = {}
+        # чаты которые ждут свободного рабочего потока, чат попадает сюда один раз
+        # и возвращается в конец после каждой задачи, так что чаты обслуживаются по кругу
+        self.ready = collections.deque()
+        self.cond = threading.Condition(self.lock)
+        self.threads = []
+        # сколько задач ждет во всех очередях
+        self.pending = 0
+        # сколько задач сейчас выполняется
+        self.running = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.max_pending = 0
+        self.wait_times = collections.deque(maxlen=STATS_WINDOW)
+        self.run_times = collections.deque(maxlen=STATS_WINDOW)
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.worker, name=f'dispatcher-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, key: str, func, *args, **kwargs) -> bool:
+        """ставит задачу в очередь чата, возвращает False если очередь переполнена"""
+        with self.cond:
+            if not self.threads:
+                self.start()
+            chat_queue = self.queues.get(key)
+            if self.pending >= self.max_queue or (chat_queue and len(chat_queue) >= self.max_chat_queue):
+                self.rejected += 1
+                return False
+            if chat_queue is None:
+                chat_queue = collections.deque()
+                self.queues[key] = chat_queue
+                self.ready.append(key)
+                self.cond.notify()
+            chat_queue.append((func, args, kwargs, time.time()))
+            self.submitted += 1
+            self.pending += 1
+            self.max_pending = max(self.max_pending, self.pending)
+            return True
+
+    def worker(self):
+        while True:
+            with self.cond:
+                while not self.ready:
+                    self.cond.wait()
+                key = self.ready.popleft()
+                func, args, kwargs, enqueue_time = self.queues[key].popleft()
+                self.pending -= 1
+                self.running += 1
+            start_time = time.time()
+            self.wait_times.append(start_time - enqueue_time)
+            try:
+                func(*args, **kwargs)
+                failed = False
+            except Exception as unknown:
+                failed = True
+                error_traceback = traceback.format_exc()
+                my_log.log2(f'my_dispatcher:worker: {key} {getattr(func, "__name__", func)}: {unknown}\n\n{error_traceback}')
+            self.run_times.append(time.time() - start_time)
+            with self.cond:
+                self.running -= 1
+                self.completed += 1
+                self.failed += failed
+                if self.queues[key]:
+                    self.ready.append(key)
+                    self.cond.notify()
+                else:
+                    del self.queues[key]
+
+    def stats(self) -> dict:
+        with self.lock:
+            depths = sorted((len(x) for x in self.queues.values()), reverse=True)
+            result = {
+                'workers': self.workers,
+                'running': self.running,
+                'pending': self.pending,
+                'max_pending': self.max_pending,
+                'chats': len(self.queues),
+                'deepest_queue': depths[0] if depths else 0,
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+                'completed': self.completed,
+                'failed': self.failed,
+            }
+        result['wait_p50'], result['wait_p95'], result['wait_max'] = percentiles(self.wait_times)
+        result['run_p50'], result['run_p95'], result['run_max'] = percentiles(self.run_times)
+        return result
+
+
+def percentiles(values) -> tuple:
+    """медиана, 95 перцентиль и максимум в секундах"""
+    values = sorted(values)
+    if not values:
+        return 0, 0, 0
+    return (round(values[len(values) // 2], 3),
+            round(values[min(len(values) - 1, int(len(values) * 0.95))], 3),
+            round(values[-1], 3))
+
+
+DISPATCHER = Dispatcher()
+
+
+def submit(key: str, func, *args, **kwargs) -> bool:
+    return DISPATCHER.submit(key, func, *args, **kwargs)
+
+
+def stats() -> dict:
+    return DISPATCHER.stats()
+
+
+def stats_as_string() -> str:
+    return '\n'.join(f'{k}: {v}' for k, v in stats().items())
+
+
+if __name__ == '__main__':
+    # 20 чатов по 5 задач, задачи одного чата не должны пересекаться
+    dispatcher = Dispatcher(workers=8)
+    in_flight = collections.Counter()
+    check_lock = threading.Lock()
+    done = threading.Semaphore(0)
+
+    def task(key, n):
+        with check_lock:
+            in_flight[key] += 1
+            assert in_flight[key] == 1, key
+        time.sleep(0.01)
+        with check_lock:
+            in_flight[key] -= 1
+        done.release()
+
+    for n in range(5):
+        for chat in range(20):
+            assert dispatcher.submit(f'chat{chat}', task, f'chat{chat}', n)
+    for _ in range(100):
+        done.acquire()
+
+    # пока первая задача чата висит, в очередь влезает только MAX_CHAT_QUEUE задач
+    release = threading.Event()
+    dispatcher.submit('busy', release.wait)
+    time.sleep(0.1)
+    accepted = [dispatcher.submit('busy', time.sleep, 0) for _ in range(MAX_CHAT_QUEUE + 1)]
+    assert accepted == [True] * MAX_CHAT_QUEUE + [False], accepted
+    release.set()
+    time.sleep(0.1)
+    print(dispatcher.stats())
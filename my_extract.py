@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# Извлечение текста из html и pdf в отдельных процессах.
+# trafilatura, lxml и PyPDF2 это в основном питоновский код, из потоков они дерутся за GIL,
+# и одна тяжелая страница тормозит весь бот. Здесь разбор идет в пуле процессов по числу ядер,
+# скачивание остается в потоках (my_fetch). У каждого процесса ограничена память (RLIMIT_AS),
+# у каждой задачи время: внутри процесса по таймеру, а если процесс и после этого не ответил
+# то пул убивается и создается заново. Процессы запускаются через fork: при spawn и forkserver
+# каждый процесс заново импортирует главный модуль (tb2.py) со всеми его базами и потоками,
+# а модули для разбора тут импортированы заранее и в дочернем процессе уже готовы.
+#
+# text, kind = my_extract.extract(content, content_type)
+#
+# python my_extract.py bench [папка с сохраненными .html и .pdf] - сравнение потоков и процессов
+
+
+import concurrent.futures
+import concurrent.futures.process
+import io
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import chardet
+import PyPDF2
+import trafilatura
+
+
+# сколько процессов
+WORKERS = os.cpu_count() or 2
+
+# сколько секунд можно разбирать одну страницу
+TASK_TIMEOUT = 30
+
+# сколько ждать сверх TASK_TIMEOUT прежде чем убить пул
+KILL_GRACE = 5
+
+# сколько памяти может взять один процесс сверх той что досталась от бота при fork
+MEMORY_LIMIT = 1024 * 1024 * 1024
+
+
+def decode(content: bytes, content_type: str = '') -> str:
+    """байты в текст: кодировка из заголовка, иначе utf-8, и только если не подошло - угадывание chardet"""
+    charset = ''
+    for part in (content_type or '').split(';')[1:]:
+        key, _, value = part.strip().partition('=')
+        if key.lower() == 'charset':
+            charset = value.strip('"\' ')
+    for encoding in (charset, 'utf-8'):
+        if encoding:
+            try:
+                return content.decode(encoding)
+            except (UnicodeDecodeError, LookupError):
+                pass
+    encoding = chardet.detect(content[:2000])['encoding']
+    try:
+        return content.decode(encoding or 'utf-8', errors='replace')
+    except LookupError:
+        return content.decode('utf-8', errors='replace')
+
+
+def extract_local(content: bytes, content_type: str = ''):
+    """(текст, вид) из скачанной страницы, в этом процессе"""
+    if content.startswith(b'%PDF-') or 'application/pdf' in (content_type or ''):
+        pdf_reader = PyPDF2.PdfReader(io.BytesIO(content))
+        return ''.join(page.extract_text() for page in pdf_reader.pages), 'pdf'
+    html = decode(content, content_type)
+    if (content_type or '').lower().startswith('text/plain'):
+        return html, 'text'
+    return trafilatura.extract(html) or '', 'html'
+
+
+def alarm(signum, frame):
+    raise TimeoutError('extraction timeout')
+
+
+def address_space() -> int:
+    """сколько адресного пространства уже занято процессом, 0 если не узнать"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def init_worker(memory_limit: int):
+    # Ctrl+C обрабатывает основной процесс
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(signal, 'SIGALRM'):
+        signal.signal(signal.SIGALRM, alarm)
+    if resource and memory_limit:
+        # после fork процесс уже занимает столько же сколько бот, лимит считается сверх этого
+        limit = address_space() + memory_limit
+        try:
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ValueError, OSError):
+            pass
+
+
+def run_task(content: bytes, content_type: str, timeout: float):
+    """выполняется в процессе пула, таймер прерывает разбор если он идет слишком долго"""
+    if hasattr(signal, 'setitimer'):
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return extract_local(content, content_type)
+    finally:
+        if hasattr(signal, 'setitimer'):
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+POOL = None
+POOL_LOCK = threading.Lock()
+
+# задач в пуле не больше чем процессов, остальные ждут в своих потоках. Иначе время ожидания
+# в очереди пула считалось бы временем разбора и здоровую задачу принимали бы за зависшую
+SLOTS = threading.BoundedSemaphore(WORKERS)
+
+
+def get_pool() -> concurrent.futures.ProcessPoolExecutor:
+    global POOL
+    with POOL_LOCK:
+        if POOL is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+            POOL = concurrent.futures.ProcessPoolExecutor(max_workers=WORKERS, mp_context=context,
+                                                          initializer=init_worker, initargs=(MEMORY_LIMIT,))
+        return POOL
+
+
+def reset_pool(pool: concurrent.futures.ProcessPoolExecutor, killed: bool = False):
+    """
+    убивает зависший или сломанный пул, следующая задача создаст новый.
+    killed - пул убивается из-за зависшей задачи, остальные его задачи ни при чем и пойдут в новый пул
+    """
+    global POOL
+    with POOL_LOCK:
+        if killed:
+            pool.killed = True
+        if POOL is not pool:
+            return
+        POOL = None
+    # у ProcessPoolExecutor нет способа убить одну задачу, убиваем все процессы пула
+    for process in list((pool._processes or {}).values()):
+        process.kill()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def extract(content: bytes, content_type: str = '', timeout: float = TASK_TIMEOUT):
+    """
+    (текст, вид) из скачанной страницы, разбор в пуле процессов.
+    Исключение TimeoutError если не уложился в timeout, MemoryError если не хватило памяти.
+    """
+    with SLOTS:
+        for attempt in range(2):
+            pool = get_pool()
+            try:
+                future = pool.submit(run_task, content, content_type, timeout)
+            except (concurrent.futures.process.BrokenProcessPool, RuntimeError):
+                # пул уже сломан или закрыт в другом потоке
+                reset_pool(pool)
+                pool = get_pool()
+                future = pool.submit(run_task, content, content_type, timeout)
+            try:
+                # свободный процесс есть всегда (SLOTS), задача начинает выполняться сразу
+                return future.result(timeout=timeout + KILL_GRACE)
+            except concurrent.futures.TimeoutError:
+                # таймер внутри процесса не сработал (завис в C коде)
+                reset_pool(pool, killed = True)
+                raise TimeoutError('extraction timeout')
+            except (concurrent.futures.process.BrokenProcessPool, concurrent.futures.CancelledError):
+                # CancelledError - задача еще ждала очереди когда пул закрыли
+                killed = getattr(pool, 'killed', False)
+                reset_pool(pool)
+                # пул убили из-за чужой зависшей задачи, или умер процесс и неизвестно на какой задаче,
+                # при сломанном пуле исключение получают все его задачи. Еще раз в новом пуле,
+                # если процесс умрет и там то скорее всего виновата эта страница
+                if attempt == 0:
+                    continue
+                if killed:
+                    raise TimeoutError('extraction pool restarted')
+                raise MemoryError('extraction worker died')
+
+
+def bench_corpus(folder: str = '') -> list:
+    """[(bytes, content_type), ...] из сохраненных страниц в папке, или сгенерированные страницы"""
+    corpus = []
+    if folder:
+        for name in sorted(os.listdir(folder)):
+            path = os.path.join(folder, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            content_type = 'application/pdf' if name.lower().endswith('.pdf') else 'text/html'
+            corpus.append((data, content_type))
+        return corpus
+    for i in range(40):
+        rows = ''.join(f'<tr><td>{j}</td><td>ячейка {j}</td><td><a href="/x{j}">ссылка</a></td></tr>' for j in range(300))
+        paragraphs = ''.join(f'<p>Статья {i}, абзац {j}. Текст страницы, который надо извлечь, с <b>разметкой</b> и <i>стилями</i>.</p>'
+                             for j in range(400))
+        html = f'<html><head><title>Страница {i}</title></head><body><nav>меню</nav><article><h1>Заголовок {i}</h1>{paragraphs}</article><table>{rows}</table><footer>подвал</footer></body></html>'
+        corpus.append((html.encode('utf-8'), 'text/html; charset=utf-8'))
+    return corpus
+
+
+def bench(folder: str = ''):
+    corpus = bench_corpus(folder)
+    print(f'{len(corpus)} страниц, {sum(len(x[0]) for x in corpus) // 1024}кб, {WORKERS} процессов')
+
+    def measure(name, func):
+        # как часто успевает проснуться другой поток (обработчик сообщений бота) пока идет разбор
+        stop = threading.Event()
+        lags = []
+        def ticker():
+            while not stop.is_set():
+                start = time.perf_counter()
+                time.sleep(0.005)
+                lags.append(time.perf_counter() - start - 0.005)
+        t = threading.Thread(target=ticker)
+        t.start()
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=20) as executor:
+            results = list(executor.map(lambda x: func(*x), corpus))
+        total = time.perf_counter() - start
+        stop.set()
+        t.join()
+        lags.sort()
+        print(f'{name}: {total:.2f}s, задержка другого потока p50 {lags[len(lags) // 2] * 1000:.1f}ms '
+              f'p99 {lags[int(len(lags) * 0.99)] * 1000:.1f}ms max {lags[-1] * 1000:.1f}ms')
+        return results
+
+    # первый запуск пула (старт процессов) не считаем
+    extract(*corpus[0])
+    local = measure('20 потоков в этом процессе', extract_local)
+    pooled = measure('20 потоков + пул процессов', extract)
+    assert [x[0] for x in local] == [x[0] for x in pooled]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        bench(sys.argv[2] if len(sys.argv) > 2 else '')
+    else:
+        # задача которая не укладывается во время прерывается, пул продолжает работать
+        page = ('<html><body><article>' + '<p>абзац текста</p>' * 200000 + '</article></body></html>').encode()
+        start = time.perf_counter()
+        try:
+            extract(page, 'text/html', timeout = 0.5)
+            raise AssertionError('не прервалось')
+        except TimeoutError:
+            print(f'таймаут через {time.perf_counter() - start:.2f}s')
+        text, kind = extract(b'<html><body><article><p>Short page text for extraction test here.</p></article></body></html>')
+        print(kind, text)
+        assert kind == 'html' and 'Short page' in text
+
+        # процесс упирается в лимит памяти, пул продолжает работать
+        try:
+            extract(b'x' * (MEMORY_LIMIT // 2), 'text/plain')
+            raise AssertionError('лимит памяти не сработал')
+        except MemoryError as error:
+            print('лимит памяти:', repr(error))
+        assert extract(b'still works', 'text/plain') == ('still works', 'text')
+
+        # пул убит из-за чужой зависшей задачи, остальные задачи доделываются в новом пуле
+        page = ('<html><body><article>' + '<p>абзац текста</p>' * 20000 + '</article></body></html>').encode()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(extract, page, 'text/html') for _ in range(4)]
+            time.sleep(0.1)
+            reset_pool(POOL, killed = True)
+            assert all(x.result()[1] == 'html' for x in futures)
+        print('после перезапуска пула задачи доделаны')
+
+        # задачи которые ждут свободного процесса не считаются зависшими
+        page = ('<html><body><article>' + '<p>абзац текста</p>' * 3000 + '</article></body></html>').encode()
+        pool = get_pool()
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=WORKERS * 8) as executor:
+            futures = [executor.submit(extract, page, 'text/html', 1) for _ in range(WORKERS * 8)]
+            assert all(x.result()[1] == 'html' for x in futures) and POOL is pool
+        print(f'{WORKERS * 8} задач на {WORKERS} процессов за {time.perf_counter() - start:.2f}s, пул не перезапускался')
+        bench()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# Скачивание веб страниц и извлечение из них текста, с кешем на диске.
+# Страница читается кусками по 64кб в заранее выделенный буфер (раньше было content += chunk
+# по 1кб, это квадратичное копирование), не больше MAX_SIZE. Если сервер говорит что это не текст
+# (картинка, видео, архив) то тело не качается вообще. Извлеченный текст хранится в sqlite по url
+# вместе с ETag/Last-Modified, повторный запрос в течение FRESH_TIME отдается из кеша сразу,
+# позже делается условный запрос и если страница не изменилась (304) то текст снова берется из кеша.
+# Сам разбор html и pdf идет в пуле процессов (my_extract).
+# Через этот модуль качают /sum, /sum2, /tts <url> и поиск (my_sum.summ_url).
+#
+# text, kind = my_fetch.get_text(url)  # kind - 'html', 'pdf', 'text', '' если не получилось
+
+
+import threading
+import time
+import traceback
+
+import my_dialogs
+import my_extract
+import my_http
+import my_log
+
+
+DB_PATH = 'db/pages.db'
+
+# сколько качать максимум
+MAX_SIZE = 1 * 1024 * 1024
+READ_SIZE = 64 * 1024
+
+TIMEOUT = 20
+
+# сколько секунд отдавать текст из кеша без проверки на сервере
+FRESH_TIME = 10 * 60
+
+# через сколько удалять страницу из кеша совсем
+MAX_AGE = 7 * 24 * 60 * 60
+
+# размер кеша на диске, после превышения удаляются самые старые страницы
+MAX_DISK_BYTES = 200 * 1024 * 1024
+
+# проверять размер кеша раз в столько страниц
+PRUNE_EVERY = 100
+
+HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'}
+
+# какие Content-Type качать, остальные бросаются не читая тело
+TEXT_TYPES = ('text/', 'application/xhtml', 'application/xml', 'application/json', 'application/pdf',
+              'application/rss', 'application/atom', 'application/octet-stream')
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pages (
+    url TEXT PRIMARY KEY,
+    text TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    etag TEXT NOT NULL,
+    last_modified TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    checked REAL NOT NULL,
+    size INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS pages_checked ON pages (checked);
+'''
+
+
+POOL = None
+POOL_LOCK = threading.Lock()
+PUTS = 0
+
+
+def get_pool() -> my_dialogs.ConnectionPool:
+    global POOL
+    with POOL_LOCK:
+        if POOL is None:
+            POOL = my_dialogs.ConnectionPool(DB_PATH, schema=SCHEMA)
+    return POOL
+
+
+def is_text_type(content_type: str) -> bool:
+    content_type = (content_type or '').lower().strip()
+    return not content_type or content_type.startswith(TEXT_TYPES)
+
+
+def download(url: str, headers: dict = None):
+    """
+    Скачивает страницу, не больше MAX_SIZE.
+    Возвращает (статус, тело, заголовки ответа), тело None если это не текст или ошибка.
+    """
+    response = my_http.get(url, stream=True, headers={**HEADERS, **(headers or {})}, timeout=TIMEOUT)
+    try:
+        if response.status_code != 200:
+            return response.status_code, None, response.headers
+        if not is_text_type(response.headers.get('Content-Type')):
+            return response.status_code, None, response.headers
+        length = response.headers.get('Content-Length', '')
+        buffer = bytearray(min(int(length), MAX_SIZE) if length.isdigit() else READ_SIZE)
+        size = 0
+        for chunk in response.iter_content(chunk_size=READ_SIZE):
+            chunk = chunk[:MAX_SIZE - size]
+            if size + len(chunk) > len(buffer):
+                # сервер не сказал размер или соврал, буфер растет вдвое
+                buffer.extend(bytes(min(max(len(buffer), len(chunk)), MAX_SIZE - len(buffer))))
+            buffer[size:size + len(chunk)] = chunk
+            size += len(chunk)
+            if size >= MAX_SIZE:
+                break
+        del buffer[size:]
+        return response.status_code, bytes(buffer), response.headers
+    finally:
+        response.close()
+
+
+def get_cached(url: str):
+    with get_pool().connection() as conn:
+        return conn.execute('SELECT text, kind, etag, last_modified, checked FROM pages WHERE url = ? AND fetched > ?',
+                            (url, time.time() - MAX_AGE)).fetchone()
+
+
+def put(url: str, text: str, kind: str, etag: str, last_modified: str):
+    global PUTS
+    now = time.time()
+    with get_pool().connection() as conn:
+        conn.execute('INSERT OR REPLACE INTO pages (url, text, kind, etag, last_modified, fetched, checked, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                     (url, text, kind, etag, last_modified, now, now, len(url) + len(text.encode('utf-8', errors='replace'))))
+    with POOL_LOCK:
+        PUTS += 1
+        prune_now = PUTS % PRUNE_EVERY == 0
+    if prune_now:
+        prune()
+
+
+def prune():
+    """удаляет устаревшие страницы и самые давно проверенные если кеш больше MAX_DISK_BYTES"""
+    try:
+        with get_pool().transaction() as conn:
+            conn.execute('DELETE FROM pages WHERE fetched <= ?', (time.time() - MAX_AGE,))
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()[0]
+            if total > MAX_DISK_BYTES:
+                extra = total - MAX_DISK_BYTES * 0.9
+                conn.execute('''DELETE FROM pages WHERE url IN (
+                                    SELECT url FROM (
+                                        SELECT url, size, SUM(size) OVER (ORDER BY checked, url) AS freed FROM pages)
+                                    WHERE freed - size < ?)''', (extra,))
+    except Exception as error:
+        error_traceback = traceback.format_exc()
+        my_log.log2(f'my_fetch:prune: {error}\n\n{error_traceback}')
+
+
+def get_text(url: str):
+    """
+    Текст страницы и ее вид ('html', 'pdf', 'text'), из кеша если страница не изменилась.
+    ('', '') если скачать или разобрать не получилось.
+    """
+    try:
+        cached = get_cached(url)
+    except Exception as error:
+        error_traceback = traceback.format_exc()
+        my_log.log2(f'my_fetch:get_text: {error}\n\n{error_traceback}')
+        cached = None
+
+    headers = {}
+    if cached:
+        text, kind, etag, last_modified, checked = cached
+        if time.time() - checked < FRESH_TIME:
+            return text, kind
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+    try:
+        status, content, response_headers = download(url, headers)
+    except Exception as error:
+        my_log.log2(f'my_fetch:get_text: {url} {error}')
+        return ('', '') if not cached else (cached[0], cached[1])
+
+    if status == 304 and cached:
+        with get_pool().connection() as conn:
+            conn.execute('UPDATE pages SET checked = ? WHERE url = ?', (time.time(), url))
+        return cached[0], cached[1]
+    if not content:
+        return '', ''
+
+    try:
+        # разбор в пуле процессов, не занимает GIL бота
+        text, kind = my_extract.extract(content, response_headers.get('Content-Type', ''))
+    except Exception as error:
+        error_traceback = traceback.format_exc()
+        my_log.log2(f'my_fetch:get_text: {url} {error}\n\n{error_traceback}')
+        return '', ''
+
+    if text:
+        try:
+            put(url, text, kind, response_headers.get('ETag', ''), response_headers.get('Last-Modified', ''))
+        except Exception as error:
+            error_traceback = traceback.format_exc()
+            my_log.log2(f'my_fetch:get_text: {error}\n\n{error_traceback}')
+    return text, kind
+
+
+if __name__ == '__main__':
+    import http.server
+    import os
+    import tempfile
+
+    DB_PATH = os.path.join(tempfile.mkdtemp(), 'pages.db')
+
+    page = ('<html><body><article><h1>Заголовок</h1>' + '<p>Абзац текста страницы. </p>' * 20000 + '</article></body></html>').encode('cp1251')
+    requests_log = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            requests_log.append((self.path, self.headers.get('If-None-Match')))
+            if self.path == '/image':
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(10 * 1024 * 1024))
+                self.end_headers()
+                return
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=windows-1251')
+            self.send_header('ETag', '"v1"')
+            if self.path != '/chunked':
+                self.send_header('Content-Length', str(len(page)))
+                self.end_headers()
+                self.wfile.write(page)
+            else:
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                for i in range(0, len(page), 10000):
+                    part = page[i:i + 10000]
+                    self.wfile.write(f'{len(part):x}\r\n'.encode() + part + b'\r\n')
+                self.wfile.write(b'0\r\n\r\n')
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{server.server_address[1]}'
+
+    # чтение кусками в буфер против content += chunk по 1кб на 1мб
+    data = [bytes(1024)] * 1024
+    start = time.perf_counter()
+    content = b''
+    for chunk in data:
+        content += chunk
+    old = time.perf_counter() - start
+    start = time.perf_counter()
+    buffer = bytearray(MAX_SIZE)
+    size = 0
+    for chunk in [bytes(READ_SIZE)] * (MAX_SIZE // READ_SIZE):
+        buffer[size:size + len(chunk)] = chunk
+        size += len(chunk)
+    new = time.perf_counter() - start
+    print(f'1мб: content += chunk(1кб) {old * 1000:.2f}ms, bytearray по 64кб {new * 1000:.2f}ms')
+
+    for path in ('/page', '/chunked'):
+        status, content, headers = download(base + path)
+        print(path, status, len(content), len(page))
+        assert len(content) == min(len(page), MAX_SIZE)
+
+    # не текст бросается не читая тело
+    start = time.perf_counter()
+    assert download(base + '/image')[1] is None
+    assert get_text(base + '/image') == ('', '')
+    print(f'картинка отброшена за {(time.perf_counter() - start) * 1000:.1f}ms')
+
+    requests_log.clear()
+    start = time.perf_counter()
+    text, kind = get_text(base + '/page')
+    first = time.perf_counter() - start
+    assert kind == 'html' and text.startswith('Заголовок') and 'Абзац текста' in text
+    start = time.perf_counter()
+    assert get_text(base + '/page') == (text, kind)
+    print(f'первый раз {first * 1000:.1f}ms, из кеша {(time.perf_counter() - start) * 1000:.1f}ms')
+    assert len(requests_log) == 1
+
+    # кеш устарел, условный запрос получает 304 и текст не разбирается заново
+    with get_pool().connection() as conn:
+        conn.execute('UPDATE pages SET checked = 0')
+    assert get_text(base + '/page') == (text, kind)
+    assert requests_log[-1] == ('/page', '"v1"')
+
+    assert my_extract.decode('привет'.encode('utf-8'), 'text/html') == 'привет'
+    assert my_extract.decode('привет'.encode('cp1251'), 'text/html; charset=windows-1251') == 'привет'
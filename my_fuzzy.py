@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# Быстрый поиск стоп-слов похожих на слово из сообщения.
+# Раньше каждое слово сообщения сравнивалось через fuzz.ratio со всеми стоп-словами.
+# Теперь стоп-слова один раз складываются в BK-дерево по расстоянию вставок/удалений
+# (именно на нем основан fuzz.ratio: ratio = 1 - d / (len1 + len2)), и для слова проверяются
+# только те ветки дерева где может найтись похожее стоп-слово. Найденные кандидаты
+# проверяются тем же fuzz.ratio, так что результат точно такой же как у полного перебора.
+
+
+import random
+import time
+
+from fuzzywuzzy import fuzz
+
+try:
+    import Levenshtein
+    Levenshtein.distance('a', 'b', weights=(1, 1, 2))
+except Exception:
+    Levenshtein = None
+
+
+# стоп-слово найдено если fuzz.ratio больше этого
+THRESHOLD = 90
+
+
+def distance(s1: str, s2: str) -> int:
+    """сколько символов надо удалить и вставить что бы из s1 получить s2"""
+    if Levenshtein:
+        # замена стоит 2, то есть это удаление + вставка
+        return Levenshtein.distance(s1, s2, weights=(1, 1, 2))
+    # длина наибольшей общей подпоследовательности
+    previous = [0] * (len(s2) + 1)
+    for c1 in s1:
+        current = [0]
+        for j, c2 in enumerate(s2):
+            current.append(previous[j] + 1 if c1 == c2 else max(previous[j + 1], current[j]))
+        previous = current
+    return len(s1) + len(s2) - 2 * previous[-1]
+
+
+def max_distance(length: int, threshold: int = THRESHOLD) -> int:
+    """на каком расстоянии от слова длиной length могут быть слова с fuzz.ratio > threshold.
+    fuzz.ratio округляет, ratio > threshold значит 100 * (1 - d / (len1 + len2)) >= threshold + 0.5,
+    а длина второго слова не больше len1 + d.
+    """
+    c = (100 - threshold - 0.5) / 100
+    return int(2 * c * length / (1 - c) + 1e-9)
+
+
+class BKTree:
+    def __init__(self, words=()):
+        # узел = [слово, {расстояние: дочерний узел}]
+        self.root = None
+        for word in words:
+            self.add(word)
+
+    def add(self, word: str):
+        if self.root is None:
+            self.root = [word, {}]
+            return
+        node = self.root
+        while True:
+            d = distance(word, node[0])
+            if d == 0:
+                return
+            child = node[1].get(d)
+            if child is None:
+                node[1][d] = [word, {}]
+                return
+            node = child
+
+    def search(self, word: str, radius: int) -> list:
+        """все слова на расстоянии не больше radius"""
+        result = []
+        if self.root is None:
+            return result
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            d = distance(word, node[0])
+            if d <= radius:
+                result.append(node[0])
+            for child_d, child in node[1].items():
+                if d - radius <= child_d <= d + radius:
+                    stack.append(child)
+        return result
+
+
+class StopWords:
+    """Индекс стоп-слов, строится один раз, при изменении списка надо создать новый.
+    match(word) - стоп-слова для которых fuzz.ratio(word, стоп-слово) > threshold, по алфавиту
+    """
+    def __init__(self, words, threshold: int = THRESHOLD):
+        self.threshold = threshold
+        self.words = sorted(set(words))
+        self.set = set(self.words)
+        self.tree = BKTree(self.words)
+
+    def __contains__(self, word: str) -> bool:
+        return word in self.set
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    def match(self, word: str) -> list:
+        candidates = self.tree.search(word, max_distance(len(word), self.threshold))
+        return sorted(x for x in candidates if fuzz.ratio(word, x) > self.threshold)
+
+
+def match_slow(word: str, words: list, threshold: int = THRESHOLD) -> list:
+    """то же самое полным перебором"""
+    return [x for x in words if fuzz.ratio(word, x) > threshold]
+
+
+def benchmark(n_words: int = 10000, n_message: int = 1000):
+    random.seed(1)
+    letters = 'абвгдеёжзийклмнопрстуфхцчшщъыьэюя'
+    def random_word() -> str:
+        return ''.join(random.choice(letters) for _ in range(random.randint(3, 12)))
+    def typo(word: str) -> str:
+        i = random.randrange(len(word))
+        return word[:i] + random.choice(letters) + word[i + 1:]
+
+    words = sorted(set(random_word() for _ in range(n_words)))
+    # сообщение из случайных слов, точных стоп-слов и стоп-слов с опечаткой
+    message = []
+    for _ in range(n_message):
+        r = random.random()
+        if r < 0.05:
+            message.append(random.choice(words))
+        elif r < 0.1:
+            message.append(typo(random.choice(words)))
+        else:
+            message.append(random_word())
+
+    start = time.time()
+    index = StopWords(words)
+    build_time = time.time() - start
+
+    start = time.time()
+    slow = [match_slow(x, words) for x in message]
+    slow_time = time.time() - start
+
+    start = time.time()
+    fast = [index.match(x) for x in message]
+    fast_time = time.time() - start
+
+    assert slow == fast
+    print(f'{len(words)} стоп-слов, сообщение из {len(message)} слов, найдено {sum(1 for x in fast if x)}')
+    print(f'полный перебор: {slow_time:.2f}s, индекс: {fast_time:.2f}s (построение {build_time:.2f}s)')
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -4,9 +4,11 @@
 # pip install langcodes[data]
 
 
-import concurrent.futures
 import base64
+import json
+import os
 import random
+import sys
 import threading
 import time
 import requests
@@ -16,10 +18,17 @@ import langcodes
 from sqlitedict import SqliteDict
 
 import cfg
+import my_cache
+import my_dialogs
 import my_dic
 import my_google
+import my_history
+import my_http
+import my_keys
 import my_log
 import my_proxy
+import my_proxy_pool
+import my_tokens
 
 
 STOP_DAEMON = False
@@ -35,10 +44,19 @@ USER_KEYS = SqliteDict('db/gemini_user_keys.db', autocommit=True)
 ALL_KEYS = []
 USER_KEYS_LOCK = threading.Lock()
 
+# какой ключ брать для запроса, по тем лимитам что выше
+KEYS = my_keys.KeyScheduler('db/gemini_keys_usage.pkl', rpm = 2, rpd = 50, tpm = 32000)
+# сколько ключей пробовать в одном запросе
+MAX_KEYS_PER_REQUEST = 4
+# столько токенов считать за картинку в img2txt
+IMAGE_TOKENS = 258
+
 
 # максимальное время для запросов к gemini
 TIMEOUT = 120
 
+API_URL = 'https://generativelanguage.googleapis.com'
+
 
 # блокировка чатов что бы не испортить историю 
 # {id:lock}
@@ -64,7 +82,7 @@ if hasattr(cfg, 'GEMINI_MAX_CHAT_LINES'):
 MAX_SUM_REQUEST = 150000
 
 # хранилище диалогов {id:list(mem)}
-CHATS = SqliteDict('db/gemini_dialogs.db', autocommit=True)
+CHATS = my_dialogs.Dialogs('gemini')
 
 # magic string
 CANDIDATES = '78fgh892890df@d7gkln2937DHf98723Dgh'
@@ -74,10 +92,19 @@ CANDIDATES = '78fgh892890df@d7gkln2937DHf98723Dgh'
 # If no proxies are specified in the config, then we first try to work directly
 # and if that doesn't work, we start looking for free proxies using
 # a constantly running daemon
-PROXY_POOL = my_dic.PersistentList('db/gemini_proxy_pool_v2.pkl')
-PROXY_POLL_SPEED = SqliteDict('db/gemini_proxy_pool_speed_v2.pkl')
-# PROXY_POOL_REMOVED = my_dic.PersistentList('db/gemini_proxy_pool_removed_v2.pkl')
-PROXY_POOL_REMOVED = [] # не надо наверное помнить всегда все удаленные прокси
+try:
+    PROXY_POOL = my_proxy_pool.ProxyPool('db/gemini_proxy_pool_v3.pkl', pinned = cfg.gemini_proxies)
+except AttributeError:
+    PROXY_POOL = my_proxy_pool.ProxyPool('db/gemini_proxy_pool_v3.pkl')
+# прокси найденные старым пулом, замеров у них нет
+if not len(PROXY_POOL) and os.path.exists('db/gemini_proxy_pool_v2.pkl'):
+    PROXY_POOL.recreate(my_dic.PersistentList('db/gemini_proxy_pool_v2.pkl'))
+
+# с этим хостом прокси должен уметь соединиться что бы его стоило проверять запросом к gemini
+GEMINI_HOST = 'generativelanguage.googleapis.com:443'
+
+# ответ медленнее этого считается неудачей прокси
+SLOW_PROXY = 50
 
 # искать и добавлять прокси пока не найдется хотя бы 10 проксей
 MAX_PROXY_POOL = 10
@@ -89,6 +116,17 @@ POOL_MAX_WORKERS = 50
 ##################################################################################
 
 
+def key_failed(key: str, response) -> bool:
+    """ответ говорит что дело в ключе (лимит, нет доступа, неправильный ключ) а не в прокси,
+    тогда ключ отправляется на паузу и отвечает True
+    """
+    if response.status_code in (403, 429) or response.status_code == 400 and 'API_KEY_INVALID' in response.text:
+        retry_after = response.headers.get('Retry-After', '')
+        KEYS.failure(key, response.status_code, int(retry_after) if retry_after.isdigit() else None)
+        return True
+    return False
+
+
 def img2txt(data_: bytes, prompt: str = "Что на картинке, подробно?") -> str:
     """
     Generates a textual description of an image based on its contents.
@@ -103,7 +141,6 @@ def img2txt(data_: bytes, prompt: str = "Что на картинке, подр
     Raises:
         None.
     """
-    global PROXY_POOL
     try:
         img_data = base64.b64encode(data_).decode("utf-8")
         data = {
@@ -123,24 +160,27 @@ def img2txt(data_: bytes, prompt: str = "Что на картинке, подр
             }
 
         result = ''
-        keys = cfg.gemini_keys[:]  + ALL_KEYS
-        random.shuffle(keys)
-        keys = keys[:4]
+        keys = KEYS.choose(cfg.gemini_keys + ALL_KEYS,
+                           n = MAX_KEYS_PER_REQUEST,
+                           tokens = IMAGE_TOKENS + my_tokens.text_tokens(prompt, 'gemini'))
 
-        proxies = PROXY_POOL[:]
-        random.shuffle(proxies)
+        # прокси которые уже подвели в этом запросе, для других ключей их не пробуем
+        failed = set()
 
         for api_key in keys:
             url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent?key={api_key}"
 
-            if proxies:
-                sort_proxies_by_speed(proxies)
-                for proxy in proxies:
+            if len(PROXY_POOL):
+                # дошел ли хоть один запрос с этим ключом до сервера
+                sent = False
+                for proxy in PROXY_POOL.choose(exclude = failed):
                     start_time = time.time()
-                    session = requests.Session()
-                    session.proxies = {"http": proxy, "https": proxy}
                     try:
-                        response = session.post(url, json=data, timeout=TIMEOUT).json()
+                        response = my_http.post(url, proxy, json=data, timeout=TIMEOUT)
+                        sent = True
+                        if key_failed(api_key, response):
+                            break
+                        response = response.json()
                         try:
                             result = response['candidates'][0]['content']['parts'][0]['text']
                         except Exception as error_ca:
@@ -150,17 +190,31 @@ def img2txt(data_: bytes, prompt: str = "Что на картинке, подр
                         if result:
                             end_time = time.time()
                             total_time = end_time - start_time
-                            if total_time > 45:
-                                remove_proxy(proxy)
+                            if total_time > SLOW_PROXY:
+                                PROXY_POOL.failure(proxy, total_time)
+                            else:
+                                PROXY_POOL.success(proxy, total_time)
+                            KEYS.success(api_key, my_tokens.text_tokens(result, 'gemini'))
                             break
                     except (requests.exceptions.ProxyError, requests.exceptions.ConnectionError) as error:
-                        remove_proxy(proxy)
+                        PROXY_POOL.failure(proxy)
+                        failed.add(proxy)
                         continue
+                if not sent:
+                    KEYS.refund(api_key)
             else:
                 try:
-                    response = requests.post(url, json=data, timeout=TIMEOUT).json()
+                    try:
+                        response = my_http.post(url, json=data, timeout=TIMEOUT)
+                    except (requests.exceptions.ProxyError, requests.exceptions.ConnectionError):
+                        KEYS.refund(api_key)
+                        raise
+                    if key_failed(api_key, response):
+                        continue
+                    response = response.json()
                     try:
                         result = response['candidates'][0]['content']['parts'][0]['text']
+                        KEYS.success(api_key, my_tokens.text_tokens(result, 'gemini'))
                     except Exception as error_ca:
                         if 'candidates' in str(error_ca):
                             my_log.log2(f'my_gemini:img2txt:{error_ca}')
@@ -194,26 +248,16 @@ def update_mem(query: str, resp: str, mem):
     chat_id = ''
     if isinstance(mem, str): # if mem - chat_id
         chat_id = mem
-        if mem not in CHATS:
-            CHATS[mem] = []
         mem = CHATS[mem]
 
-    mem.append({"role": "user", "parts": [{"text": query}]})
-    mem.append({"role": "model", "parts": [{"text": resp}]})
-    size = 0
-    for x in mem:
-        text = x['parts'][0]['text']
-        size += len(text)
-    while size > MAX_CHAT_SIZE:
-        mem = mem[2:]
-        size = 0
-        for x in mem:
-            text = x['parts'][0]['text']
-            size += len(text)
-    mem = mem[-MAX_CHAT_LINES:]
+    new_lines = [{"role": "user", "parts": [{"text": query}]},
+                 {"role": "model", "parts": [{"text": resp}]}]
+    history = my_history.BoundedHistory(mem, MAX_CHAT_SIZE, MAX_CHAT_LINES)
+    history.extend(new_lines)
     if chat_id:
-        CHATS[chat_id] = mem
-    return mem
+        CHATS.append(chat_id, new_lines)
+        CHATS.trim(chat_id, history.evicted)
+    return history.to_list()
 
 
 def undo(chat_id: str):
@@ -248,36 +292,9 @@ def undo(chat_id: str):
         my_log.log_gemini(f'Failed to undo chat {chat_id}: {error}\n\n{error_traceback}')
 
 
-def ai(q: str, mem = [], temperature: float = 0.1, proxy_str: str = '', model: str = '') -> str:
-    """
-    A function that utilizes a pretrained model to generate content based on a given input question.
-    
-    Parameters:
-    - q (str): The input question for which content needs to be generated.
-    - mem (list): A list of previous memory contents.
-    - temperature (float): Controls the randomness of the generated content, default is 0.1.
-    - proxy_str (str): A string indicating the proxy settings.
-    - model (str): The pretrained model to be used for content generation, default is 'gemini-1.0-pro-latest'.
-    
-    Returns:
-    - str: The generated content based on the input question.
-    """
-    if model == '':
-        model = 'gemini-1.5-flash-latest'
-        # model = 'gemini-1.0-pro-latest'
-        # models/gemini-1.0-pro
-        # models/gemini-1.0-pro-001
-        # models/gemini-1.0-pro-latest
-        # models/gemini-1.0-pro-vision-latest
-        # models/gemini-1.5-flash-latest
-        # models/gemini-1.5-pro-latest
-        # models/gemini-pro
-        # models/gemini-pro-vision
-    global PROXY_POOL, PROXY_POLL_SPEED
-    # bugfix температура на самом деле от 0 до 1 а не от 0 до 2
-    temperature = round(temperature / 2, 2)
-
-    mem_ = {"contents": mem + [{"role": "user", "parts": [{"text": q}]}],
+def make_request(q: str, mem: list, temperature: float) -> dict:
+    """тело запроса к gemini, temperature уже от 0 до 1"""
+    return {"contents": mem + [{"role": "user", "parts": [{"text": q}]}],
             "safetySettings": [
                 {
                     "category": "HARM_CATEGORY_HARASSMENT",
@@ -307,39 +324,71 @@ def ai(q: str, mem = [], temperature: float = 0.1, proxy_str: str = '', model: s
                 }
             }
 
-    keys = cfg.gemini_keys[:] + ALL_KEYS
-    random.shuffle(keys)
-    keys = keys[:4]
+
+def ai(q: str, mem = [], temperature: float = 0.1, proxy_str: str = '', model: str = '', chat_id: str = '') -> str:
+    """
+    A function that utilizes a pretrained model to generate content based on a given input question.
+    
+    Parameters:
+    - q (str): The input question for which content needs to be generated.
+    - mem (list): A list of previous memory contents.
+    - temperature (float): Controls the randomness of the generated content, default is 0.1.
+    - proxy_str (str): A string indicating the proxy settings.
+    - model (str): The pretrained model to be used for content generation, default is 'gemini-1.0-pro-latest'.
+    - chat_id (str): Chat for the logs.
+    
+    Returns:
+    - str: The generated content based on the input question.
+    """
+    if model == '':
+        model = 'gemini-1.5-flash-latest'
+        # model = 'gemini-1.0-pro-latest'
+        # models/gemini-1.0-pro
+        # models/gemini-1.0-pro-001
+        # models/gemini-1.0-pro-latest
+        # models/gemini-1.0-pro-vision-latest
+        # models/gemini-1.5-flash-latest
+        # models/gemini-1.5-pro-latest
+        # models/gemini-pro
+        # models/gemini-pro-vision
+    request_start = time.time()
+    # bugfix температура на самом деле от 0 до 1 а не от 0 до 2
+    temperature = round(temperature / 2, 2)
+
+    mem_ = make_request(q, mem, temperature)
+
+    keys = KEYS.choose(cfg.gemini_keys + ALL_KEYS,
+                       n = MAX_KEYS_PER_REQUEST,
+                       tokens = my_tokens.count(mem_['contents'], 'gemini'))
     result = ''
 
-    if proxy_str == 'probe':
-        proxies = []
-    elif proxy_str:
-        proxies = [proxy_str, ]
-    else:
-        proxies = PROXY_POOL[:]
-        random.shuffle(proxies)
+    # проверка прокси (или работы напрямую) идет мимо пула
+    use_pool = not proxy_str and len(PROXY_POOL) > 0
+    # прокси которые уже подвели в этом запросе, для других ключей их не пробуем
+    failed = set()
 
     proxy = ''
     try:
         for key in keys:
             url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={key}"
 
-            if proxies:
-                sort_proxies_by_speed(proxies)
+            if use_pool or proxy_str and proxy_str != 'probe':
+                proxies = PROXY_POOL.choose(exclude = failed) if use_pool else [proxy_str, ]
+                # дошел ли хоть один запрос с этим ключом до сервера
+                sent = False
                 for proxy in proxies:
                     start_time = time.time()
-                    session = requests.Session()
-                    session.proxies = {"http": proxy, "https": proxy}
 
                     n = 6
                     c_s = False
                     while n > 0:
                         n -= 1
                         try:
-                            response = session.post(url, json=mem_, timeout=TIMEOUT)
+                            response = my_http.post(url, proxy, json=mem_, timeout=TIMEOUT)
+                            sent = True
                         except (requests.exceptions.ProxyError, requests.exceptions.ConnectionError) as error:
-                            remove_proxy(proxy)
+                            PROXY_POOL.failure(proxy)
+                            failed.add(proxy)
                             c_s = True
                             break
                         if response.status_code == 503 and 'The model is overloaded. Please try again later.' in str(response.text):
@@ -357,28 +406,47 @@ def ai(q: str, mem = [], temperature: float = 0.1, proxy_str: str = '', model: s
                                 result = CANDIDATES
                         end_time = time.time()
                         total_time = end_time - start_time
-                        if total_time > 50:
-                            remove_proxy(proxy)
+                        if total_time > SLOW_PROXY:
+                            PROXY_POOL.failure(proxy, total_time)
                         else:
-                            PROXY_POLL_SPEED[proxy] = total_time
+                            PROXY_POOL.success(proxy, total_time)
+                        KEYS.success(key, my_tokens.text_tokens(result, 'gemini'))
+                        break
+                    elif key_failed(key, response):
+                        # прокси не виноват, а с этим ключом дальше пробовать нет смысла
+                        PROXY_POOL.success(proxy, time.time() - start_time)
                         break
                     else:
-                        remove_proxy(proxy)
-                        my_log.log_gemini(f'my_gemini:ai:{proxy} {key} {str(response)} {response.text}')
+                        PROXY_POOL.failure(proxy)
+                        failed.add(proxy)
+                        my_log.log_gemini(f'my_gemini:ai:{proxy} {key} {str(response)} {response.text}', chat_id, time.time() - start_time)
+                if not sent:
+                    KEYS.refund(key)
+                    if proxy_str:
+                        # проверяемый прокси не работает, другие ключи через него тоже не пройдут
+                        break
             else:
                 n = 6
                 while n > 0:
                     n -= 1
-                    response = requests.post(url, json=mem_, timeout=TIMEOUT)
+                    try:
+                        response = my_http.post(url, json=mem_, timeout=TIMEOUT)
+                    except (requests.exceptions.ProxyError, requests.exceptions.ConnectionError):
+                        # нет связи, ключ ни при чем
+                        KEYS.refund(key)
+                        raise
                     if response.status_code == 200:
                         try:
                             result = response.json()['candidates'][0]['content']['parts'][0]['text']
                         except Exception as error_:
                             if 'candidates' in str(error_):
                                 result = CANDIDATES
+                        KEYS.success(key, my_tokens.text_tokens(result, 'gemini'))
                         break
                     else:
-                        my_log.log_gemini(f'my_gemini:ai:{key} {str(response)} {response.text}')
+                        my_log.log_gemini(f'my_gemini:ai:{key} {str(response)} {response.text}', chat_id, time.time() - request_start)
+                        if key_failed(key, response):
+                            break
                         if response.status_code == 503 and 'The model is overloaded. Please try again later.' in str(response.text):
                             time.sleep(5)
                         else:
@@ -386,11 +454,11 @@ def ai(q: str, mem = [], temperature: float = 0.1, proxy_str: str = '', model: s
             if result:
                 break
     except Exception as unknown_error:
-        my_log.log_gemini(f'my_gemini:ai:{unknown_error}')
+        my_log.log_gemini(f'my_gemini:ai:{unknown_error}', chat_id, time.time() - request_start)
 
     answer = result.strip()
     if not answer and model == 'gemini-1.5-pro-latest':
-        answer = ai(q, mem, temperature, proxy_str, 'gemini-1.0-pro-latest')
+        answer = ai(q, mem, temperature, proxy_str, 'gemini-1.0-pro-latest', chat_id)
 
     if answer.startswith('[Info to help you answer.'):
         pos = answer.find('"]')
@@ -400,39 +468,105 @@ def ai(q: str, mem = [], temperature: float = 0.1, proxy_str: str = '', model: s
     return answer
 
 
+def sse_texts(response):
+    """куски текста из ответа streamGenerateContent?alt=sse по мере того как они приходят"""
+    for line in response.iter_lines():
+        if not line.startswith(b'data:'):
+            continue
+        data = json.loads(line[5:])
+        for candidate in data.get('candidates', [])[:1]:
+            for part in candidate.get('content', {}).get('parts', []):
+                if part.get('text'):
+                    yield part['text']
+
+
+def ai_stream(q: str, mem = [], temperature: float = 0.1, model: str = '', chat_id: str = ''):
+    """
+    То же что ai() только через streamGenerateContent, генератор кусков ответа по мере их прихода.
+    Ключи и прокси перебираются пока сервер не начнет отвечать, дальше ответ идет только через них.
+    Если ответ оборвался посередине то генератор заканчивается на том что успело прийти.
+    """
+    model = model or 'gemini-1.5-flash-latest'
+    body = make_request(q, mem, round(temperature / 2, 2))
+    keys = KEYS.choose(cfg.gemini_keys + ALL_KEYS,
+                       n = MAX_KEYS_PER_REQUEST,
+                       tokens = my_tokens.count(body['contents'], 'gemini'))
+    # прокси которые уже подвели в этом запросе, для других ключей их не пробуем
+    failed = set()
+
+    for key in keys:
+        url = f'{API_URL}/v1beta/models/{model}:streamGenerateContent?alt=sse&key={key}'
+        proxies = PROXY_POOL.choose(exclude = failed) if len(PROXY_POOL) else [None, ]
+        # дошел ли хоть один запрос с этим ключом до сервера
+        sent = False
+        for proxy in proxies:
+            start_time = time.time()
+            try:
+                response = my_http.post(url, proxy, json=body, stream=True, timeout=TIMEOUT)
+                sent = True
+            except (requests.exceptions.ProxyError, requests.exceptions.ConnectionError) as error:
+                if proxy:
+                    PROXY_POOL.failure(proxy)
+                    failed.add(proxy)
+                else:
+                    my_log.log_gemini(f'my_gemini:ai_stream:{key} {error}', chat_id, time.time() - start_time)
+                continue
+
+            with response:
+                if response.status_code != 200:
+                    my_log.log_gemini(f'my_gemini:ai_stream:{proxy} {key} {str(response)} {response.text}', chat_id, time.time() - start_time)
+                    if key_failed(key, response):
+                        if proxy:
+                            PROXY_POOL.success(proxy, time.time() - start_time)
+                        break
+                    if proxy:
+                        PROXY_POOL.failure(proxy)
+                        failed.add(proxy)
+                    continue
+
+                # время до начала ответа, на длинных ответах полное время ничего не говорит о прокси
+                if proxy:
+                    PROXY_POOL.success(proxy, time.time() - start_time)
+                answer = ''
+                try:
+                    for text in sse_texts(response):
+                        answer += text
+                        yield text
+                except (requests.exceptions.RequestException, ValueError) as error:
+                    my_log.log_gemini(f'my_gemini:ai_stream:{proxy} {key} {error}', chat_id, time.time() - start_time)
+                KEYS.success(key, my_tokens.text_tokens(answer, 'gemini'))
+                return
+        if not sent:
+            KEYS.refund(key)
+
+
 def get_models() -> str:
     """some error, return 404"""
-    global PROXY_POOL
     keys = cfg.gemini_keys[:]
     random.shuffle(keys)
     result = ''
 
-    proxies = PROXY_POOL[:] + ALL_KEYS
-    random.shuffle(proxies)
-
     proxy = ''
     try:
         for key in keys:
             url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-pro?key={key}"
 
-            if proxies:
-                sort_proxies_by_speed(proxies)
-                for proxy in proxies:
-                    session = requests.Session()
-                    session.proxies = {"http": proxy, "https": proxy}
+            if len(PROXY_POOL):
+                for proxy in PROXY_POOL.choose():
                     try:
-                        response = session.post(url, timeout=TIMEOUT)
+                        response = my_http.post(url, proxy, timeout=TIMEOUT)
                     except (requests.exceptions.ProxyError, requests.exceptions.ConnectionError) as error:
+                        PROXY_POOL.failure(proxy)
                         continue
 
                     if response.status_code == 200:
                         result = response.json()###################
                         break
                     else:
-                        remove_proxy(proxy)
+                        PROXY_POOL.failure(proxy)
                         my_log.log2(f'my_gemini:get_models:{proxy} {key} {str(response)} {response.text}')
             else:
-                response = requests.post(url, timeout=TIMEOUT)
+                response = my_http.post(url, timeout=TIMEOUT)
                 if response.status_code == 200:
                     result = response.json()###############
                 else:
@@ -467,16 +601,30 @@ def chat(query: str, chat_id: str, temperature: float = 0.1, update_memory: bool
         lock = threading.Lock()
         LOCKS[chat_id] = lock
     with lock:
-        if chat_id not in CHATS:
-            CHATS[chat_id] = []
         mem = CHATS[chat_id]
-        r = ai(query, mem, temperature, model = model)
+        r = ai(query, mem, temperature, model = model, chat_id = chat_id)
         if r and update_memory:
-            mem = update_mem(query, r, mem)
-            CHATS[chat_id] = mem
+            update_mem(query, r, chat_id)
         return r
 
 
+def chat_stream(query: str, chat_id: str, temperature: float = 0.1, update_memory: bool = True, model: str = ''):
+    """как chat() только генератор кусков ответа (ai_stream), в память попадает весь ответ когда он закончится"""
+    if chat_id in LOCKS:
+        lock = LOCKS[chat_id]
+    else:
+        lock = threading.Lock()
+        LOCKS[chat_id] = lock
+    with lock:
+        mem = CHATS[chat_id]
+        answer = ''
+        for text in ai_stream(query, mem, temperature, model = model, chat_id = chat_id):
+            answer += text
+            yield text
+        if answer and update_memory:
+            update_mem(query, answer, chat_id)
+
+
 def reset(chat_id: str):
     """
     Resets the chat history for the given ID.
@@ -557,7 +705,7 @@ def translate(text: str, from_lang: str = '', to_lang: str = '', help: str = '')
     else:
         query = f'Translate from language [{from_lang}] to language [{to_lang}]:\n\n{text}'
     # inject_explicit_content(chat_id)
-    translated = ai(query, temperature=0.1)
+    translated = my_cache.cached(lambda: ai(query, temperature=0.1), 'gemini', query, 0.1)
     return translated
 
 
@@ -600,100 +748,38 @@ def check_phone_number(number: str) -> str:
     return response
 
 
-def remove_proxy(proxy: str):
-    """
-    Remove a proxy from the proxy pool and add it to the removed proxy pool.
-
-    Args:
-        proxy (str): The proxy to be removed.
-
-    Returns:
-        None
-    """
-    global PROXY_POOL, PROXY_POOL_REMOVED
-    # не удалять прокси из конфига
-    try:
-        if proxy in cfg.gemini_proxies:
-            return
-    except AttributeError:
-        pass
-
-    PROXY_POOL.remove_all(proxy)
-
-    PROXY_POOL_REMOVED.append(proxy)
-    try:
-        PROXY_POOL_REMOVED.deduplicate()
-    except: # это обычный список а не постоянный, у него нет такого метода
-        PROXY_POOL_REMOVED = list(set(PROXY_POOL_REMOVED))
+def test_direct_for_gemini() -> bool:
+    """проверяет работает ли gemini напрямую, без прокси"""
+    return bool(ai('1+1= answer very short', proxy_str='probe'))
 
 
-def sort_proxies_by_speed(proxies):
-    """
-    Sort proxies by speed.
-
-    Args:
-        proxies (list): The list of proxies to be sorted.
-
-    Returns:
-        list: The sorted list of proxies.
-    """
-    global PROXY_POOL, PROXY_POLL_SPEED
-    # неопробованные прокси считаем что имеют скорость как было при поиске = 5 секунд(или менее)
-    for x in PROXY_POOL:
-        if x not in PROXY_POLL_SPEED:
-            PROXY_POLL_SPEED[x] = 5
-
-    try:
-        proxies.sort(key=lambda x: PROXY_POLL_SPEED[x])
-    except KeyError as key_error:
-        # my_log.log2(f'sort_proxies_by_speed: {key_error}')
-        pass
-
-
-def test_proxy_for_gemini(proxy: str = '') -> bool:
+def test_proxy_for_gemini(proxy: str) -> str:
     """
     A function that tests a proxy for the Gemini API.
 
     Parameters:
-        proxy (str): The proxy to be tested (default is an empty string).
+        proxy (str): The proxy to be tested.
 
     Returns:
-        Если proxy = '', то проверяем работу напрямую и отвечает True/False.
-        Если proxy != '', то заполняем пул новыми проксями.
+        Прокси если он прошел проверку и добавлен в пул, иначе ''.
 
     Description:
         This function tests a given proxy for the Gemini API by sending a query to the AI
         with the specified proxy. The query is set to '1+1= answer very short'. The function
         measures the time it takes to get an answer from the AI and stores it in the variable
-        'total_time'. If the proxy parameter is not provided, the function checks if the answer
-        from the AI is True. If it is, the function returns True, otherwise it returns False.
-        If the proxy parameter is provided and the answer from the AI is not in the list
-        'PROXY_POOL_REMOVED', and the total time is less than 5 seconds, the proxy is added
-        to the 'PROXY_POOL' list.
-
-    Note:
-        - The 'ai' function is assumed to be defined elsewhere in the code.
-        - The 'PROXY_POOL_REMOVED' and 'PROXY_POOL' variables are assumed to be defined elsewhere in the code.
-        - The 'time' module is assumed to be imported.
-    """
-    global PROXY_POOL, PROXY_POOL_REMOVED, PROXY_POLL_SPEED
+        'total_time'. If the AI answered and the total time is less than 5 seconds,
+        the proxy is added to the 'PROXY_POOL' with this time as its first latency sample
+        (proxies removed from the pool earlier are not added back).
+        Работа напрямую проверяется в test_direct_for_gemini().
+    """
     query = '1+1= answer very short'
     start_time = time.time()
-    answer = ai(query, proxy_str=proxy or 'probe')
+    answer = ai(query, proxy_str=proxy)
     total_time = time.time() - start_time
 
-    # если проверяем работу напрямую то нужен ответ - True/False
-    if not proxy:
-        if answer:
-            return True
-        else:
-            return False
-    # если с прокси то ответ не нужен
-    else:
-        if answer and answer not in PROXY_POOL_REMOVED:
-            if total_time < 5:
-                PROXY_POOL.append(proxy)
-                PROXY_POLL_SPEED[proxy] = total_time
+    if answer and total_time < 5 and PROXY_POOL.add(proxy, total_time):
+        return proxy
+    return ''
 
 
 def get_proxies():
@@ -703,28 +789,17 @@ def get_proxies():
         Returns:
             None
     """
-    global PROXY_POOL
     try:
-        proxies = my_proxy.get_proxies()
-
-        n = 0
-        maxn = len(proxies)
-        step = POOL_MAX_WORKERS
-
-        while n < maxn:
-            if len(PROXY_POOL) > MAX_PROXY_POOL:
-                break
-            if len(PROXY_POOL) == 0:
-                step = 500
-            else:
-                step = POOL_MAX_WORKERS
-            chunk = proxies[n:n+step]
-            n += step
-            print(f'Proxies found: {len(PROXY_POOL)} (processing {n} of {maxn})')
-            with concurrent.futures.ThreadPoolExecutor(max_workers=step) as executor:
-                futures = [executor.submit(test_proxy_for_gemini, proxy) for proxy in chunk]
-                for future in futures:
-                    future.result()
+        need = MAX_PROXY_POOL - PROXY_POOL.healthy() + 1
+        if need <= 0:
+            return
+        # прокси проверяются потоком, сначала быстрая проверка соединения, потом запрос к gemini,
+        # как только найдено сколько надо остальные проверки отменяются
+        for proxy in my_proxy.stream_working_proxies(test_proxy_for_gemini,
+                                                     max_results = need,
+                                                     probe_concurrency = POOL_MAX_WORKERS,
+                                                     target = GEMINI_HOST):
+            print(f'Proxies found: {PROXY_POOL.healthy()} ({proxy})')
 
     except Exception as error:
         my_log.log2(f'my_gemini:get_proxies: {error}')
@@ -734,9 +809,9 @@ def update_proxy_pool_daemon():
     """
         Update the proxy pool daemon.
 
-        This function continuously updates the global `PROXY_POOL` list with new proxies.
-        It ensures that the number of proxies in the pool is maintained below the maximum
-        limit specified by the `MAX_PROXY_POOL` constant.
+        This function continuously updates the global `PROXY_POOL` with new proxies.
+        It starts a new search when fewer than `MAX_PROXY_POOL_LOW_MARGIN` proxies
+        in the pool are healthy (not tripped by the circuit breaker).
 
         Parameters:
         None
@@ -744,11 +819,9 @@ def update_proxy_pool_daemon():
         Returns:
         None
     """
-    global PROXY_POOL
     while not STOP_DAEMON:
-        if len(PROXY_POOL) < MAX_PROXY_POOL_LOW_MARGIN:
+        if PROXY_POOL.healthy() < MAX_PROXY_POOL_LOW_MARGIN:
                 get_proxies()
-                PROXY_POOL.deduplicate()
                 time.sleep(60*60)
         else:
             time.sleep(2)
@@ -793,7 +866,6 @@ def run_proxy_pool_daemon():
     load_users_keys()
 
 
-    global PROXY_POOL
     try:
         proxies = cfg.gemini_proxies
     except AttributeError:
@@ -801,11 +873,11 @@ def run_proxy_pool_daemon():
 
     # если проксей нет то проверяем возможна ли работа напрямую
     if not proxies:
-        direct_connect_available = test_proxy_for_gemini()
+        direct_connect_available = test_direct_for_gemini()
         # вторая попытка
         if not direct_connect_available:
             time.sleep(2)
-            direct_connect_available = test_proxy_for_gemini()
+            direct_connect_available = test_direct_for_gemini()
             if not direct_connect_available:
                 my_log.log2('proxy:run_proxy_pool_daemon: direct connect unavailable')
     else:
@@ -862,18 +934,56 @@ def repair_text_after_speech_to_text(text: str) -> str:
     """
     if len(text) > 5000:
         return text
-    query1 = f"Anwser super short if this text has any content you can't work with, yes or no:\n\n{text}"
-    r1 = ai(query1).lower()
-    if r1 and 'no' in r1:
-        query2 = f"Repair this text after speech-to-text conversion:\n\n{text}"
-        r2 = ai(query2, temperature=0.1)
-        if r2:
-            return r2
-    return text
+
+    # пустой ответ (ошибка) не кешируется
+    def repair() -> str:
+        query1 = f"Anwser super short if this text has any content you can't work with, yes or no:\n\n{text}"
+        r1 = ai(query1).lower()
+        if not r1:
+            return ''
+        if 'no' in r1:
+            query2 = f"Repair this text after speech-to-text conversion:\n\n{text}"
+            r2 = ai(query2, temperature=0.1)
+            if r2:
+                return r2
+        return text
+
+    return my_cache.cached(repair, 'gemini:repair_stt', text, 0.1) or text
+
+
+def test_ai_stream():
+    """проверка ai_stream на локальном ненастоящем сервере, без сети и настоящих ключей"""
+    global API_URL, KEYS, PROXY_POOL
+    import tempfile
+    import my_stream
+
+    tmp = tempfile.mkdtemp()
+    KEYS = my_keys.KeyScheduler(os.path.join(tmp, 'keys.pkl'), rpm = 2, rpd = 50, tpm = 32000)
+    PROXY_POOL = my_proxy_pool.ProxyPool(os.path.join(tmp, 'proxies.pkl'))
+    cfg.gemini_keys = []
+    ALL_KEYS[:] = ['fake_key1', 'fake_key2']
+
+    chunks = ['Привет', ', это ', 'потоковый ', 'ответ.']
+    API_URL = my_stream.fake_sse_server(chunks, delay = 0.5)
+    start = time.time()
+    times = []
+    for text in ai_stream('привет'):
+        times.append(round(time.time() - start, 2))
+        print(times[-1], text)
+    assert times[0] < 0.3 and times[-1] > 1.4, times
+
+    # ключ с 429 уходит на паузу и следующий запрос начинается с другого ключа
+    API_URL = my_stream.fake_sse_server(chunks, status = 429)
+    assert list(ai_stream('привет')) == []
+    assert all(KEYS.stats(x)['blocked'] for x in ALL_KEYS)
 
 
 if __name__ == '__main__':
 
+    if 'test_stream' in sys.argv:
+        test_ai_stream()
+        sys.exit()
+
     run_proxy_pool_daemon()
 
     # print(sum_big_text(open('1.txt', 'r', encoding='utf-8').read(), 'Перескажи кратко о чем этот текст, уложись в 1000 слов'))
@@ -17,7 +17,6 @@ import gradio_client
 import langdetect
 import numpy as np
 import PIL
-import requests
 from duckduckgo_search import DDGS
 from sqlitedict import SqliteDict
 from PIL import Image
@@ -25,7 +24,9 @@ from PIL import Image
 import bing_img
 import cfg
 import gpt_basic
+import my_cache
 import my_gemini
+import my_http
 import my_log
 import my_trans
 
@@ -44,6 +45,9 @@ WHO_AUTOR = {}
 # {prompt:True/False, ...}
 huggingface_prompts = SqliteDict('db/kandinski_prompts.db', autocommit=True)
 
+# сколько помнить репромпты из get_reprompt, у них высокая температура и разнообразие тоже нужно
+REPROMPT_TTL = 24 * 60 * 60
+
 
 
 def upscale(image_bytes: bytes) -> bytes:
@@ -236,7 +240,7 @@ def huggin_face_api(prompt: str) -> bytes:
             headers = {"Authorization": f"Bearer {api_key}"}
 
             try:
-                response = requests.post(url, headers=headers, json=p, timeout=120, proxies=proxy)
+                response = my_http.post(url, headers=headers, json=p, timeout=120, proxies=proxy)
             except Exception as error:
                 my_log.log_huggin_face_api(f'my_genimg:huggin_face_api: {error}\nPrompt: {prompt}\nAPI key: {api_key}\nProxy: {proxy}\nURL: {url}')
                 continue
@@ -455,7 +459,7 @@ def kandinski(prompt: str, width: int = 1024, height: int = 1024, num: int = 1):
 		    }
 	    }
         def get_model():
-            response = requests.get('https://api-key.fusionbrain.ai/key/api/v1/models', headers=AUTH_HEADERS)
+            response = my_http.get('https://api-key.fusionbrain.ai/key/api/v1/models', headers=AUTH_HEADERS)
             data = response.json()
             return data[0]['id']
 
@@ -463,13 +467,13 @@ def kandinski(prompt: str, width: int = 1024, height: int = 1024, num: int = 1):
             'model_id': (None, get_model()),
             'params': (None, json.dumps(params), 'application/json')
         }
-        response = requests.post('https://api-key.fusionbrain.ai/key/api/v1/text2image/run', headers=AUTH_HEADERS, files=data)
+        response = my_http.post('https://api-key.fusionbrain.ai/key/api/v1/text2image/run', headers=AUTH_HEADERS, files=data)
         data = response.json()
         uuid = data['uuid']
 
         def check_generation(request_id, attempts=10, delay=10):
             while attempts > 0:
-                response = requests.get('https://api-key.fusionbrain.ai/key/api/v1/text2image/status/' + request_id, headers=AUTH_HEADERS)
+                response = my_http.get('https://api-key.fusionbrain.ai/key/api/v1/text2image/status/' + request_id, headers=AUTH_HEADERS)
                 data = response.json()
                 if  data['censored']:
                     return []
@@ -538,7 +542,7 @@ def stability_ai(prompt: str = 'An australian cat', amount: int = 1):
             random.shuffle(keys)
             key = keys[0]
 
-            response = requests.post(
+            response = my_http.post(
                 f"https://api.stability.ai/v2beta/stable-image/generate/core",
                 headers={
                     "authorization": f"Bearer {key}",
@@ -583,7 +587,7 @@ def get_ynd_iam_token(oauth_tokens):
   for oauth_token in oauth_tokens:
     data = {"yandexPassportOauthToken": oauth_token}
 
-    response = requests.post(url, headers=headers, json=data, timeout=10)
+    response = my_http.post(url, headers=headers, json=data, timeout=10)
 
     if response.status_code == 200:
         return response.json()['iamToken']
@@ -619,13 +623,13 @@ def yandex_cloud_generate_image_async(iam_token: str, prompt: str, seed=None, ti
         else:
             data["generation_options"]["seed"] = random.randint(0, 2**64 - 1)
 
-        response = requests.post(url, headers=headers, json=data, timeout=120)
+        response = my_http.post(url, headers=headers, json=data, timeout=120)
 
         if response.status_code == 200:
             url = f" https://llm.api.cloud.yandex.net:443/operations/{response.json()['id']}"
             while timeout > 0:
                 try:
-                    response = requests.get(url, headers=headers, timeout=20)
+                    response = my_http.get(url, headers=headers, timeout=20)
                     if response.status_code == 200:
                         if hasattr(response, 'text'):
                             response = response.json()
@@ -683,18 +687,25 @@ Answer as a professional image prompt engineer, very short but completely gramma
 
 User's prompt: {prompt}
 """
-    reprompt = my_gemini.ai(query, temperature=1.2)
-    my_log.log_reprompts(f'{prompt}\n\n{reprompt}')
 
-    query2 = f"""
+    # пустой ответ (ошибка) не кешируется
+    def reprompt_() -> str:
+        reprompt = my_gemini.ai(query, temperature=1.2)
+        if not reprompt:
+            return ''
+        my_log.log_reprompts(f'{prompt}\n\n{reprompt}')
+
+        query2 = f"""
 Does this text look like a user request to generate an image? Yes or No, answer supershort.
 
 Text: {reprompt}
 """
-    if 'yes' in my_gemini.ai(query2, temperature=0.1).lower():
-        return reprompt
-    else:
-        return prompt
+        if 'yes' in my_gemini.ai(query2, temperature=0.1).lower():
+            return reprompt
+        else:
+            return prompt
+
+    return my_cache.cached(reprompt_, 'gemini:reprompt', query, 1.2, ttl=REPROMPT_TTL) or prompt
 
 
 def gen_images(prompt: str, moderation_flag: bool = False, user_id: str = ''):
@@ -10,7 +10,7 @@ import cfg
 import my_log
 import my_gemini
 import my_ddg
-import my_groq
+import my_router
 import my_sum
 import utils
 
@@ -106,22 +106,10 @@ Search results:
 
 {text[:my_gemini.MAX_SUM_REQUEST]}
 '''
-    r = ''
-    r =  my_gemini.ai(q[:my_gemini.MAX_SUM_REQUEST], model='gemini-1.5-flash-latest')
+    r, provider = my_router.complete([{'role': 'user', 'content': q}],
+                                     {'providers': ['gemini', 'groq-mixtral', 'groq-llama']})
     if r:
-        r += '\n\n--\n[Gemini Pro Flash]'
-    if not r:
-        r = my_gemini.ai(q[:32000], model='gemini-1.5-flash-latest')
-        if r:
-            r += '\n\n--\n[Gemini Pro Flash]'
-        if not r:
-            r = my_groq.ai(q[:32000], max_tokens_ = 4000, model_ = 'mixtral-8x7b-32768')
-            if r:
-                r += '\n\n--\n[Mixtral-8x7b-32768]'
-            if not r:
-                r = my_groq.ai(q[:12000], max_tokens_ = 4000)
-                if r:
-                    r += '\n\n--\n[Llama 3 70b]'
+        r += f'\n\n--\n[{provider.label}]'
 
     return r, f'Data extracted from Google with query "{query}":\n\n' + text
 
@@ -8,12 +8,15 @@ import time
 import threading
 import traceback
 
-import httpx
 from groq import Groq
-from sqlitedict import SqliteDict
 
 import cfg
+import my_cache
+import my_dialogs
+import my_history
+import my_http
 import my_log
+import my_tokens
 
 
 # блокировка чатов что бы не испортить историю 
@@ -24,11 +27,33 @@ LOCKS = {}
 MAX_REQUEST = 8000
 
 MAX_QUERY_LENGTH = 10000
+# сколько токенов истории отправлять, у запасных моделей llama3-*-8192 контекст 8к и 4к из них под ответ
+MAX_HISTORY_TOKENS = 3500
+
+GROQ_URL = 'https://api.groq.com'
+# {(key, proxy): Groq}
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+
 # максимальное количество запросов которые можно хранить в памяти
 MAX_LINES = 20
 
 # хранилище диалогов {id:list(mem)}
-CHATS = SqliteDict('db/groq_dialogs.db', autocommit=True)
+CHATS = my_dialogs.Dialogs('groq')
+
+def get_client(key: str) -> Groq:
+    """клиент groq для ключа (и случайного прокси из cfg.GROQ_PROXIES если они есть),
+    клиенты не создаются на каждый запрос и ходят через общий пул соединений my_http
+    """
+    if hasattr(cfg, 'GROQ_PROXIES') and cfg.GROQ_PROXIES:
+        proxy = random.choice(cfg.GROQ_PROXIES)
+    else:
+        proxy = None
+    with CLIENTS_LOCK:
+        if (key, proxy) not in CLIENTS:
+            CLIENTS[(key, proxy)] = Groq(api_key=key, http_client=my_http.httpx_client(GROQ_URL, proxy), timeout=120)
+        return CLIENTS[(key, proxy)]
+
 
 def ai(prompt: str = '',
        system: str = '',
@@ -38,6 +63,7 @@ def ai(prompt: str = '',
        max_tokens_: int = 4000,
        key_: str = '',
        timeout: int = 120,
+       chat_id: str = '',
        ) -> str:
     """
     Generates a response using the GROQ AI model.
@@ -50,6 +76,7 @@ def ai(prompt: str = '',
         model_ (str, optional): The name of the GROQ model to use. Defaults to 'llama3-70b-8192'.
         max_tokens_ (int, optional): The maximum number of tokens in the generated response. Defaults to 2000.
         key_ (str, optional): The API key for the GROQ model. Defaults to ''.
+        chat_id (str, optional): Chat for the logs. Defaults to ''.
 
     Returns:
         str: The generated response from the GROQ AI model. Returns an empty string if error.
@@ -57,6 +84,7 @@ def ai(prompt: str = '',
     Raises:
         Exception: If an error occurs during the generation of the response. The error message and traceback are logged.
     """
+    start_time = time.time()
     try:
         mem = []
         if mem_:
@@ -66,7 +94,7 @@ def ai(prompt: str = '',
                 if prompt:
                     mem.append({'role': 'user', 'content': prompt})
             else:
-                mem = mem_
+                mem = mem_[:]
                 if prompt:
                     mem.append({'role': 'user', 'content': prompt})
         else:
@@ -79,14 +107,7 @@ def ai(prompt: str = '',
             return ''
 
         key = key_ if key_ else random.choice(cfg.GROQ_API_KEY)
-        if hasattr(cfg, 'GROQ_PROXIES') and cfg.GROQ_PROXIES:
-            client = Groq(
-                api_key=key,
-                http_client = httpx.Client(proxy = random.choice(cfg.GROQ_PROXIES)),
-                timeout = 120,
-            )
-        else:
-            client = Groq(api_key=key, timeout = 120,)
+        client = get_client(key)
 
         # model="llama3-70b-8192", # 'llama-3.1-70b-versatile', llama3-8b-8192, mixtral-8x7b-32768, gemma-7b-it, whisper-large-v3??
         model = model_ if model_ else 'llama-3.1-70b-versatile'
@@ -109,53 +130,37 @@ def ai(prompt: str = '',
                 model__ = 'llama3-8b-8192'
             else:
                 return ''
-            return ai(prompt, system, mem_, temperature*2, model__, max_tokens_, key_, timeout)
+            return ai(prompt, system, mem_, temperature*2, model__, max_tokens_, key_, timeout, chat_id)
         return resp
     except Exception as error:
         error_traceback = traceback.format_exc()
-        my_log.log_groq(f'my_groq:ai: {error}\n\n{error_traceback}\n\n{prompt}\n\n{system}\n\n{mem_}\n{temperature}\n{model_}\n{max_tokens_}\n{key_}')
+        my_log.log_groq(f'my_groq:ai: {error}\n\n{error_traceback}\n\n{prompt}\n\n{system}\n\n{mem_}\n{temperature}\n{model_}\n{max_tokens_}\n{key_}',
+                        chat_id, time.time() - start_time)
 
     return ''
 
 
 def token_count(mem, model:str = "meta-llama/Meta-Llama-3-8B") -> int:
-    '''broken, only counts symbols not tokens'''
+    '''сколько токенов в тексте или в списке сообщений'''
     if isinstance(mem, str):
-        text = mem
-    else:
-        text = ' '.join([m['content'] for m in mem])
-    return len(text)
+        return my_tokens.text_tokens(mem, model)
+    return my_tokens.count(mem, model)
 
 
 def update_mem(query: str, resp: str, mem):
     chat_id = None
     if isinstance(mem, str): # if mem - chat_id
         chat_id = mem
-        if mem not in CHATS:
-            CHATS[mem] = []
         mem = CHATS[mem]
-    mem += [{'role': 'user', 'content': query}]
-    mem += [{'role': 'assistant', 'content': resp}]
-    while token_count(mem) > MAX_QUERY_LENGTH:
-        mem = mem[2:]
-    mem = mem[:MAX_LINES*2]
-
-    # непонятный глюк с задвоением памяти, убираем дубли
-    mem__ = []
-    try:
-        i = 0
-        while i < len(mem):
-            if i == 0 or mem[i] != mem[i-1]:
-                mem__.append(mem[i])
-            i += 1
-    except Exception as error:
-        error_traceback = traceback.format_exc()
-        my_log.log_groq(f'my_groq:update_mem: {error}\n\n{error_traceback}\n\n{query}\n\n{resp}\n\n{mem}')
-    
+    new_lines = [{'role': 'user', 'content': query}, {'role': 'assistant', 'content': resp}]
+    history = my_history.BoundedHistory(mem, MAX_HISTORY_TOKENS, MAX_LINES*2, my_tokens.size_func('llama-3.1-70b-versatile'))
+    history.extend(new_lines)
+
     if chat_id:
-        CHATS[chat_id] = mem__
+        CHATS.append(chat_id, new_lines)
+        CHATS.trim(chat_id, history.evicted)
     else:
-        return mem__
+        return history.to_list()
 
 
 def chat(query: str, chat_id: str,
@@ -170,16 +175,13 @@ def chat(query: str, chat_id: str,
         lock = threading.Lock()
         LOCKS[chat_id] = lock
     with lock:
-        if chat_id not in CHATS:
-            CHATS[chat_id] = []
         mem = CHATS[chat_id]
         if style:
-            r = ai(query, system = style, mem_ = mem, temperature = temperature, model_ = model)
+            r = ai(query, system = style, mem_ = mem, temperature = temperature, model_ = model, chat_id = chat_id)
         else:
-            r = ai(query, mem_ = mem, temperature = temperature, model_ = model)
+            r = ai(query, mem_ = mem, temperature = temperature, model_ = model, chat_id = chat_id)
         if r and update_memory:
-            mem = update_mem(query, r, mem)
-            CHATS[chat_id] = mem
+            update_mem(query, r, chat_id)
         return r
 
 
@@ -278,14 +280,7 @@ def stt(data: bytes = None, lang: str = '', key_: str = '') -> str:
                 data = f.read()
 
         key = key_ if key_ else random.choice(cfg.GROQ_API_KEY)
-        if hasattr(cfg, 'GROQ_PROXIES') and cfg.GROQ_PROXIES:
-            client = Groq(
-                api_key=key,
-                http_client = httpx.Client(proxy = random.choice(cfg.GROQ_PROXIES)),
-                timeout = 120,
-            )
-        else:
-            client = Groq(api_key=key, timeout = 120,)
+        client = get_client(key)
         transcription = client.audio.transcriptions.create(file=("123.ogg", data),
                                                            model="whisper-large-v3",
                                                            language=lang,
@@ -331,7 +326,7 @@ def translate_text(text: str, lang: str = 'ru') -> str:
         "¡Hola, mundo!"
     """
     query = f'Translate the following text to language "{lang}", in your answer should be only the translated text:\n\n{text}'
-    return ai(query, temperature=0, max_tokens_ = 8000)
+    return my_cache.cached(lambda: ai(query, temperature=0, max_tokens_ = 8000), 'groq', query, 0)
 
 
 # def summ_text_file(path: str) -> str:
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# история диалога с ограничением по размеру и по количеству сообщений
+# размер каждого сообщения считается один раз при добавлении, общий размер хранится в счетчике,
+# поэтому обрезка старых сообщений стоит O(1) на сообщение а не пересчет всей истории на каждом шаге
+
+
+import collections
+import time
+
+
+def message_size(message: dict) -> int:
+    """длина текста сообщения, у gemini текст лежит в parts, у остальных в content"""
+    if 'parts' in message:
+        return sum(len(part.get('text', '')) for part in message['parts'])
+    content = message.get('content', '')
+    return len(content) if isinstance(content, str) else len(str(content))
+
+
+class BoundedHistory:
+    """
+    Очередь сообщений с лимитами.
+
+    max_size - максимальный суммарный размер сообщений (0 - без лимита), старые сообщения
+               удаляются по step штук (вопрос+ответ) пока размер не влезет в лимит
+    max_lines - максимальное количество сообщений (0 - без лимита), лишние удаляются с начала
+    size_func - как считать размер одного сообщения
+    evicted - сколько сообщений было удалено с начала, нужно что бы так же обрезать историю в базе
+    """
+    def __init__(self, messages = (), max_size: int = 0, max_lines: int = 0, size_func = message_size, step: int = 2):
+        self.max_size = max_size
+        self.max_lines = max_lines
+        self.size_func = size_func
+        self.step = step
+        self.messages = collections.deque()
+        self.sizes = collections.deque()
+        self.size = 0
+        self.evicted = 0
+        for message in messages:
+            self.push(message)
+        self.shrink()
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def push(self, message):
+        size = self.size_func(message)
+        self.messages.append(message)
+        self.sizes.append(size)
+        self.size += size
+
+    def popleft(self):
+        self.size -= self.sizes.popleft()
+        self.evicted += 1
+        return self.messages.popleft()
+
+    def shrink(self):
+        """удаляет старые сообщения пока история не влезет в лимиты"""
+        if self.max_size:
+            while self.messages and self.size > self.max_size:
+                for _ in range(min(self.step, len(self.messages))):
+                    self.popleft()
+        if self.max_lines:
+            while len(self.messages) > self.max_lines:
+                self.popleft()
+
+    def append(self, message):
+        self.push(message)
+        self.shrink()
+
+    def extend(self, messages):
+        for message in messages:
+            self.push(message)
+        self.shrink()
+
+    def to_list(self) -> list:
+        return list(self.messages)
+
+
+def trim(messages: list, max_size: int = 0, max_lines: int = 0, size_func = message_size, step: int = 2) -> list:
+    """обрезает список сообщений по лимитам, возвращает новый список"""
+    return BoundedHistory(messages, max_size, max_lines, size_func, step).to_list()
+
+
+def benchmark(turns: int = 1000, max_size: int = 31000, max_lines: int = 0, msg_len: int = 500):
+    """сравнивает старую обрезку (mem = mem[2:] с пересчетом размера) с BoundedHistory"""
+    def old_trim(mem: list) -> list:
+        size = sum(message_size(x) for x in mem)
+        while size > max_size:
+            mem = mem[2:]
+            size = sum(message_size(x) for x in mem)
+        return mem[-max_lines:] if max_lines else mem
+
+    mem = []
+    for i in range(turns):
+        mem.append({"role": "user", "parts": [{"text": 'q' * msg_len}]})
+        mem.append({"role": "model", "parts": [{"text": 'a' * msg_len}]})
+
+    # обрезка длинной истории (например после уменьшения лимита)
+    start = time.perf_counter()
+    r1 = old_trim(mem)
+    t_old = time.perf_counter() - start
+    start = time.perf_counter()
+    r2 = trim(mem, max_size, max_lines)
+    t_new = time.perf_counter() - start
+    assert r1 == r2
+    print(f'{turns} turns, trim to {max_size} chars: old {t_old*1000:.1f}ms, new {t_new*1000:.1f}ms')
+
+    # добавление 1000 новых пар в полную историю
+    old_mem = r1
+    start = time.perf_counter()
+    for i in range(turns):
+        old_mem = old_mem + [{"role": "user", "parts": [{"text": 'q' * msg_len}]},
+                             {"role": "model", "parts": [{"text": 'a' * msg_len}]}]
+        old_mem = old_trim(old_mem)
+    t_old = time.perf_counter() - start
+    history = BoundedHistory(r2, max_size, max_lines)
+    start = time.perf_counter()
+    for i in range(turns):
+        history.extend([{"role": "user", "parts": [{"text": 'q' * msg_len}]},
+                        {"role": "model", "parts": [{"text": 'a' * msg_len}]}])
+    t_new = time.perf_counter() - start
+    assert old_mem == history.to_list()
+    print(f'{turns} appends to full history: old {t_old*1000:.1f}ms, new {t_new*1000:.1f}ms')
+
+
+if __name__ == '__main__':
+    benchmark(1000)
+    benchmark(1000, max_size=100000, msg_len=50)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# Общие HTTP соединения для всех модулей которые ходят к внешним API.
+# Раньше почти каждый запрос делался через requests.get/post или новый requests.Session(),
+# и на каждый запрос заново открывалось TCP соединение и делалось TLS рукопожатие.
+# Здесь сессии хранятся по ключу (хост, прокси) и переиспользуют соединения (keep-alive),
+# у каждого хоста ограничено сколько соединений держать открытыми, таймауты по умолчанию одинаковые.
+# Для httpx (groq) тоже общий клиент на хост и прокси, с HTTP/2 если установлен пакет h2.
+#
+# my_http.get(url, ...) / my_http.post(url, ...) - как requests.get/post, proxy='socks5h://...' вместо proxies={}
+# my_http.session(url, proxy) - сессия requests для этого хоста и прокси
+# my_http.httpx_client(url, proxy) - клиент httpx для этого хоста и прокси
+
+
+import collections
+import http.cookiejar
+import threading
+import urllib.parse
+
+import requests
+import requests.adapters
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    import h2
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+
+# таймауты по умолчанию, (соединение, чтение)
+CONNECT_TIMEOUT = 10
+TIMEOUT = 120
+
+# сколько соединений к одному хосту (через один прокси) держать открытыми
+MAX_CONNECTIONS_PER_HOST = 20
+
+# сколько сессий помнить, при поиске прокси их проверяют тысячами, давно не нужные закрываются
+MAX_SESSIONS = 256
+
+
+# {(хост, прокси): requests.Session}, последние использованные в конце
+SESSIONS = collections.OrderedDict()
+# {(хост, прокси): httpx.Client}
+HTTPX_CLIENTS = {}
+LOCK = threading.Lock()
+
+
+def host_key(url: str) -> str:
+    """https://host:port/path?query -> https://host:port"""
+    url = urllib.parse.urlsplit(url.strip())
+    return f'{url.scheme}://{url.netloc}'.lower()
+
+
+def session(url: str, proxy: str = None) -> requests.Session:
+    """сессия requests с пулом соединений для хоста из url, одна на весь процесс.
+    Куки в общих сессиях не сохраняются, что бы запросы разных юзеров не смешивались.
+    """
+    key = (host_key(url), proxy or '')
+    with LOCK:
+        s = SESSIONS.get(key)
+        if s is not None:
+            SESSIONS.move_to_end(key)
+        else:
+            s = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=MAX_CONNECTIONS_PER_HOST)
+            s.mount('http://', adapter)
+            s.mount('https://', adapter)
+            s.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            if proxy:
+                s.proxies = {'http': proxy, 'https': proxy}
+            SESSIONS[key] = s
+            if len(SESSIONS) > MAX_SESSIONS:
+                SESSIONS.popitem(last=False)[1].close()
+        return s
+
+
+def request(method: str, url: str, proxy: str = None, timeout = None, **kwargs) -> requests.Response:
+    """как requests.request, но через общую сессию, timeout по умолчанию (CONNECT_TIMEOUT, TIMEOUT)"""
+    if timeout is None:
+        timeout = (CONNECT_TIMEOUT, TIMEOUT)
+    # proxies={'http': ..., 'https': ...} как у requests тоже понимаем
+    proxies = kwargs.pop('proxies', None)
+    if proxies and not proxy:
+        proxy = proxies.get(urllib.parse.urlsplit(url).scheme) or proxies.get('https') or proxies.get('http')
+    return session(url, proxy).request(method, url, timeout=timeout, **kwargs)
+
+
+def get(url: str, proxy: str = None, timeout = None, **kwargs) -> requests.Response:
+    return request('GET', url, proxy, timeout, **kwargs)
+
+
+def post(url: str, proxy: str = None, timeout = None, **kwargs) -> requests.Response:
+    return request('POST', url, proxy, timeout, **kwargs)
+
+
+def httpx_client(url: str, proxy: str = None):
+    """клиент httpx с пулом соединений для хоста из url (и HTTP/2 если есть h2), один на весь процесс"""
+    key = (host_key(url), proxy or '')
+    with LOCK:
+        client = HTTPX_CLIENTS.get(key)
+        if client is None:
+            client = httpx.Client(proxy = proxy or None,
+                                  http2 = HTTP2,
+                                  timeout = httpx.Timeout(TIMEOUT, connect = CONNECT_TIMEOUT),
+                                  limits = httpx.Limits(max_connections = MAX_CONNECTIONS_PER_HOST,
+                                                        max_keepalive_connections = MAX_CONNECTIONS_PER_HOST))
+            HTTPX_CLIENTS[key] = client
+        return client
+
+
+def close():
+    """закрывает все соединения"""
+    with LOCK:
+        for s in SESSIONS.values():
+            s.close()
+        for client in HTTPX_CLIENTS.values():
+            client.close()
+        SESSIONS.clear()
+        HTTPX_CLIENTS.clear()
+
+
+if __name__ == '__main__':
+    # локальный сервер считает сколько соединений к нему открыто, на https каждое новое
+    # соединение это еще и TLS рукопожатие (~1-2 RTT и вычисления на обоих концах)
+    import http.server
+    import time
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # иначе заголовки и тело уходят разными пакетами и keep-alive упирается в задержку ACK
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            body = b'ok'
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_POST = do_GET
+
+        def log_message(self, *args):
+            pass
+
+    class Server(http.server.ThreadingHTTPServer):
+        connections = 0
+
+        def process_request(self, request, client_address):
+            Server.connections += 1
+            super().process_request(request, client_address)
+
+    server = Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/v1/models'
+
+    n = 300
+    for name, func in (('requests.get', lambda: requests.get(url, timeout=10)),
+                       ('my_http.get', lambda: get(url))):
+        Server.connections = 0
+        start = time.perf_counter()
+        for _ in range(n):
+            assert func().text == 'ok'
+        print(f'{name}: {n} запросов, {Server.connections} соединений (рукопожатий), '
+              f'{Server.connections / n:.2f} на запрос, {(time.perf_counter() - start) / n * 1000:.2f}ms на запрос')
+
+    # из нескольких потоков соединений не больше чем потоков
+    Server.connections = 0
+    threads = [threading.Thread(target=lambda: [get(url) for _ in range(50)]) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    print(f'8 потоков по 50 запросов: {Server.connections} соединений')
+    assert Server.connections <= 8
+    assert session(url) is session(url.replace('/v1/models', '/other'))
+    assert session(url) is not session(url, 'socks5h://127.0.0.1:1080')
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# Выбор API ключа с учетом лимитов.
+# У каждого ключа скользящими окнами считается сколько запросов было за минуту и за сутки
+# и сколько токенов за минуту, ключи выдаются по убыванию запаса до ближайшего лимита.
+# Запрос записывается на ключ в момент выдачи, так что параллельные запросы расходятся
+# по разным ключам, а не бьют все в один. Если запрос так и не дошел до сервера (прокси или сеть
+# не работают) то он снимается с ключа (refund), лимиты тратят только настоящие запросы. Ответ 429 отправляет ключ на паузу (Retry-After
+# если он есть, иначе с каждым разом вдвое дольше), 403 и неправильный ключ - на сутки.
+# Ключи на паузе и исчерпанные выдаются только если других не осталось.
+# Состояние пишется на диск пачками через my_dic.FLUSHER и переживает перезапуск.
+#
+# for key in KEYS.choose(all_keys, n = 4, tokens = 1000):
+#     ...
+#     KEYS.success(key, tokens_in_answer) или KEYS.failure(key, status_code, retry_after)
+#     или KEYS.refund(key) если ни одного запроса с этим ключом не отправилось
+
+
+import collections
+import math
+import os
+import pickle
+import random
+import threading
+import time
+import traceback
+
+import my_dic
+import my_log
+
+
+MINUTE = 60
+DAY = 24 * 60 * 60
+
+# пауза после первого 429, потом вдвое дольше до суток
+COOLDOWN = 60
+MAX_COOLDOWN = DAY
+
+# на сколько выключается ключ после 403 или ответа что ключ неправильный
+DISABLE_TIME = DAY
+
+
+class KeyState:
+    def __init__(self):
+        # [(время, запросов, токенов), ...] за последние сутки
+        self.events = collections.deque()
+        # до какого времени ключ на паузе
+        self.blocked_until = 0
+        # 429 подряд
+        self.strikes = 0
+
+
+class KeyScheduler:
+    def __init__(self, filename: str, rpm: int = 0, rpd: int = 0, tpm: int = 0):
+        """
+        filename - файл где хранится состояние ключей
+        rpm, rpd, tpm - запросов в минуту, запросов в сутки, токенов в минуту, 0 - без лимита
+        """
+        self.filename = filename
+        self.limits = ((MINUTE, 1, rpm), (DAY, 1, rpd), (MINUTE, 2, tpm))
+        self.lock = threading.Lock()
+        # {key: KeyState}
+        self.states = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, 'rb') as f:
+                data = pickle.load(f)
+            for key, (events, blocked_until, strikes) in data.items():
+                state = KeyState()
+                state.events.extend(events)
+                state.blocked_until = blocked_until
+                state.strikes = strikes
+                self.states[key] = state
+        except Exception as unknown:
+            error_traceback = traceback.format_exc()
+            my_log.log2(f'my_keys:load: {self.filename} {unknown}\n\n{error_traceback}')
+
+    def save(self):
+        self.dirty = True
+        my_dic.FLUSHER.mark_dirty(self)
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            data = pickle.dumps({key: (list(x.events), x.blocked_until, x.strikes) for key, x in self.states.items()})
+        try:
+            tmp_path = self.filename + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.filename)
+        except Exception as unknown:
+            error_traceback = traceback.format_exc()
+            my_log.log2(f'my_keys:flush: {self.filename} {unknown}\n\n{error_traceback}')
+
+    def state(self, key: str) -> KeyState:
+        if key not in self.states:
+            self.states[key] = KeyState()
+        return self.states[key]
+
+    def headroom(self, key: str, tokens: int = 0, now: float = None) -> float:
+        """какая доля самого тесного лимита ключа еще свободна (с учетом tokens для этого запроса),
+        0 и меньше - лимит исчерпан, -inf - ключ на паузе
+        """
+        now = now or time.time()
+        state = self.state(key)
+        if state.blocked_until > now:
+            return -math.inf
+        events = state.events
+        while events and events[0][0] <= now - DAY:
+            events.popleft()
+        result = 1.0
+        for window, field, limit in self.limits:
+            if not limit:
+                continue
+            used = sum(x[field] for x in events if x[0] > now - window)
+            if field == 2:
+                used += tokens
+            result = min(result, 1 - used / limit)
+        return result
+
+    def choose(self, keys: list, n: int = 0, tokens: int = 0):
+        """
+        Генератор ключей из keys, лучший (с самым большим запасом) первым.
+        Каждый выданный ключ сразу записывается как использованный на 1 запрос и tokens токенов.
+        n - сколько ключей выдать максимум, 0 - все.
+        """
+        keys = list(dict.fromkeys(keys))
+        n = n or len(keys)
+        for _ in range(n):
+            if not keys:
+                return
+            now = time.time()
+            with self.lock:
+                # случайность только среди равных, иначе первыми всегда шли бы одни и те же ключи
+                ranked = [(self.headroom(x, tokens, now), random.random(), x) for x in keys]
+                best = max(ranked)
+                key = best[2]
+                if best[0] == -math.inf:
+                    # все на паузе, берем тот что освободится раньше
+                    key = min(keys, key=lambda x: self.states[x].blocked_until)
+                self.state(key).events.append((now, 1, tokens))
+            self.save()
+            keys.remove(key)
+            yield key
+
+    def refund(self, key: str):
+        """запрос с выданным ключом не дошел до сервера, снимает с ключа запись сделанную в choose()"""
+        with self.lock:
+            events = self.state(key).events
+            for i in range(len(events) - 1, -1, -1):
+                if events[i][1]:
+                    del events[i]
+                    break
+        self.save()
+
+    def success(self, key: str, tokens: int = 0):
+        """ключ сработал, tokens - сколько токенов было в ответе"""
+        with self.lock:
+            state = self.state(key)
+            state.strikes = 0
+            state.blocked_until = 0
+            if tokens:
+                state.events.append((time.time(), 0, tokens))
+        self.save()
+
+    def failure(self, key: str, status: int, retry_after: float = None):
+        """
+        ключ не сработал из-за лимита (429) или доступа (403, неправильный ключ)
+        retry_after - сколько секунд ждать если сервер сказал
+        """
+        with self.lock:
+            state = self.state(key)
+            if status == 429:
+                state.strikes += 1
+                pause = retry_after or min(COOLDOWN * 2 ** (state.strikes - 1), MAX_COOLDOWN)
+            else:
+                pause = DISABLE_TIME
+            state.blocked_until = time.time() + pause
+        self.save()
+
+    def stats(self, key: str) -> dict:
+        """сколько ключ использован, для отладки"""
+        now = time.time()
+        with self.lock:
+            state = self.state(key)
+            events = [x for x in state.events if x[0] > now - DAY]
+            return {'rpm': sum(x[1] for x in events if x[0] > now - MINUTE),
+                    'rpd': sum(x[1] for x in events),
+                    'tpm': sum(x[2] for x in events if x[0] > now - MINUTE),
+                    'blocked': max(0, round(state.blocked_until - now)),
+                    'headroom': round(self.headroom(key, 0, now), 2)}
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    filename = os.path.join(tempfile.mkdtemp(), 'keys.pkl')
+    scheduler = KeyScheduler(filename, rpm = 2, rpd = 50, tpm = 32000)
+    keys = [f'key{i}' for i in range(5)]
+
+    # 10 запросов подряд расходятся по всем ключам, по 2 на ключ, и только потом ключи исчерпаны
+    first = [next(scheduler.choose(keys, tokens = 1000)) for _ in range(10)]
+    print(first)
+    assert sorted(first) == sorted(keys * 2)
+    assert all(scheduler.headroom(x) <= 0 for x in keys)
+
+    # 429 отправляет ключ на паузу, он выдается последним
+    scheduler.failure('key0', 429)
+    assert list(scheduler.choose(keys))[-1] == 'key0'
+    assert scheduler.stats('key0')['blocked'] == COOLDOWN
+
+    # большой запрос уходит на ключ где хватает токенов в минуту
+    scheduler2 = KeyScheduler(os.path.join(tempfile.mkdtemp(), 'keys.pkl'), tpm = 32000)
+    list(scheduler2.choose(['a'], tokens = 30000))
+    assert next(scheduler2.choose(['a', 'b'], tokens = 5000)) == 'b'
+
+    # запрос не дошедший до сервера не тратит лимит
+    scheduler3 = KeyScheduler(os.path.join(tempfile.mkdtemp(), 'keys.pkl'), rpm = 2, rpd = 50)
+    for _ in range(20):
+        for key in scheduler3.choose(['a', 'b'], n = 2):
+            scheduler3.refund(key)
+    assert scheduler3.stats('a')['rpd'] == 0 and scheduler3.stats('b')['headroom'] == 1
+
+    # состояние переживает перезапуск
+    my_dic.FLUSHER.flush_all()
+    restored = KeyScheduler(filename, rpm = 2, rpd = 50, tpm = 32000)
+    for key in keys:
+        print(key, restored.stats(key))
+        assert restored.stats(key) == scheduler.stats(key)
@@ -1,15 +1,22 @@
 #!/usr/bin/env python3
 
 
-import os
+import atexit
+import collections
 import datetime
+import gzip
 import html
+import json
+import os
+import queue
+import shutil
 import threading
 import time
 
 import telebot
 
 import cfg
+import my_ratelimit
 from my_dic2 import PersistentDict
 
 
@@ -18,101 +25,178 @@ from my_dic2 import PersistentDict
 USERS_LOGS = PersistentDict('db/users_logs.pkl')
 
 
-lock = threading.Lock()
+# сколько отчетов может ждать отправки в группу логов
+REPORT_QUEUE_SIZE = 1000
+
+# сколько сообщений в секунду можно отправлять в группу логов и сколько подряд
+REPORT_RATE = 20 / 60
+REPORT_BURST = 5
+
+# до какой длины склеивать отчеты одного юзера в одно сообщение
+REPORT_MAX_LEN = 4000
+
+# писать отладочные логи (log2, log_gemini и т.п.) в формате jsonl вместо текста,
+# одна строка = {"time", "provider", "chat_id", "latency", "text"}
+LOG_JSONL = getattr(cfg, 'LOG_JSONL', False)
+
+# когда файл лога становится больше он переименовывается в file.log.<время> и сжимается в gzip
+LOG_MAX_SIZE = getattr(cfg, 'LOG_MAX_SIZE', 20 * 1024 * 1024)
+
+# сколько файлов логов держать открытыми, давно не используемые закрываются
+LOG_MAX_OPEN_FILES = 100
 
 
 if not os.path.exists('logs'):
     os.mkdir('logs')
 
 
-def log2(text: str) -> None:
-    """для дебага"""
-    global lock
-    with lock:
+class LogWriter:
+    """Все записи в файлы логов идут через одну очередь и один фоновый поток.
+    write() только кладет запись в очередь и сразу возвращается, поток держит файлы
+    открытыми, пишет пачками все что накопилось и сбрасывает буферы после каждой пачки.
+    """
+    def __init__(self, max_size: int = LOG_MAX_SIZE):
+        self.queue = queue.SimpleQueue()
+        self.max_size = max_size
+        # {path: file}, последние использованные в конце
+        self.files = collections.OrderedDict()
+        self.thread = None
+        self.thread_lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def write(self, path: str, text: str):
+        if self.thread is None:
+            with self.thread_lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name='log_writer', daemon=True)
+                    self.thread.start()
+        # путь от текущей папки на момент вызова, бот меняет папку после импорта модулей
+        self.queue.put((os.path.abspath(path), text))
+
+    def flush(self, timeout: float = 5):
+        """ждет пока все что уже в очереди будет записано на диск"""
+        if self.thread is None:
+            return
+        event = threading.Event()
+        self.queue.put((None, event))
+        event.wait(timeout)
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            events = []
+            # {path: [text, ...]} порядок записей в каждом файле сохраняется
+            by_file = {}
+            for path, text in batch:
+                if path is None:
+                    events.append(text)
+                else:
+                    by_file.setdefault(path, []).append(text)
+            for path, texts in by_file.items():
+                try:
+                    f = self.files.get(path)
+                    if f is None:
+                        f = open(path, 'a', encoding="utf-8")
+                        self.files[path] = f
+                        # у каждого чата свой лог, все держать открытыми нельзя
+                        if len(self.files) > LOG_MAX_OPEN_FILES:
+                            self.files.popitem(last=False)[1].close()
+                    else:
+                        self.files.move_to_end(path)
+                    f.write(''.join(texts))
+                    f.flush()
+                    if f.tell() > self.max_size:
+                        self.rotate(path)
+                except Exception as error:
+                    print(f'my_log:LogWriter: {path}: {error}')
+                    self.files.pop(path, None)
+            for event in events:
+                event.set()
+
+    def rotate(self, path: str):
+        self.files.pop(path).close()
+        rotated = f'{path}.{datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")}'
+        os.replace(path, rotated)
+        threading.Thread(target=gzip_file, args=(rotated,), daemon=True).start()
+
+
+def gzip_file(path: str):
+    """сжимает файл в path.gz и удаляет оригинал"""
+    try:
+        with open(path, 'rb') as f_in, gzip.open(path + '.gz', 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(path)
+    except Exception as error:
+        print(f'my_log:gzip_file: {path}: {error}')
+
+
+WRITER = LogWriter()
+
+
+def log_debug(log_file_path: str, text: str, separator: str = "=" * 80,
+              provider: str = '', chat_id: str = '', latency: float = None) -> None:
+    """общая запись для отладочных логов, в текстовом виде или в jsonl"""
+    if LOG_JSONL:
+        record = {'time': time.time(), 'provider': provider, 'chat_id': chat_id, 'latency': latency, 'text': text}
+        WRITER.write(log_file_path[:-4] + '.jsonl', json.dumps(record, ensure_ascii=False) + '\n')
+    else:
         time_now = datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S')
-        log_file_path = 'logs/debug.log'
-        open(log_file_path, 'a', encoding="utf-8").write(f'{time_now}\n\n{text}\n{"="*89}\n')
+        WRITER.write(log_file_path, f'{time_now}\n\n{text}\n{separator}\n')
 
 
-def log_haiku(text: str) -> None:
+def log2(text: str, chat_id: str = '', latency: float = None) -> None:
+    """для дебага"""
+    log_debug('logs/debug.log', text, "=" * 89, '', chat_id, latency)
+
+
+def log_haiku(text: str, chat_id: str = '', latency: float = None) -> None:
     """для дебага haiku"""
-    global lock
-    with lock:
-        time_now = datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S')
-        log_file_path = 'logs/debug_haiku.log'
-        open(log_file_path, 'a', encoding="utf-8").write(f'{time_now}\n\n{text}\n{"="*89}\n')
+    log_debug('logs/debug_haiku.log', text, "=" * 89, 'haiku', chat_id, latency)
 
 
-def log_shadowjourney(text: str) -> None:
+def log_shadowjourney(text: str, chat_id: str = '', latency: float = None) -> None:
     """для дебага shadowjourney"""
-    global lock
-    with lock:
-        time_now = datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S')
-        log_file_path = 'logs/debug_shadowjourney.log'
-        open(log_file_path, 'a', encoding="utf-8").write(f'{time_now}\n\n{text}\n{"="*89}\n')
+    log_debug('logs/debug_shadowjourney.log', text, "=" * 89, 'shadowjourney', chat_id, latency)
 
 
-def log_groq(text: str) -> None:
+def log_groq(text: str, chat_id: str = '', latency: float = None) -> None:
     """для дебага groq"""
-    global lock
-    with lock:
-        time_now = datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S')
-        log_file_path = 'logs/debug_groq.log'
-        open(log_file_path, 'a', encoding="utf-8").write(f'{time_now}\n\n{text}\n{"="*89}\n')
+    log_debug('logs/debug_groq.log', text, "=" * 89, 'groq', chat_id, latency)
 
 
-def log_huggin_face_api(text: str) -> None:
+def log_huggin_face_api(text: str, chat_id: str = '', latency: float = None) -> None:
     """для логов от hugging_face_api"""
-    global lock
-    with lock:
-        time_now = datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S')
-        log_file_path = 'logs/debug_hugging_face_api.log'
-        open(log_file_path, 'a', encoding="utf-8").write(f'{time_now}\n\n{text}\n{"=" * 80}\n')
+    log_debug('logs/debug_hugging_face_api.log', text, "=" * 80, 'hugging_face_api', chat_id, latency)
 
 
-def log_bing_success(text: str) -> None:
+def log_bing_success(text: str, chat_id: str = '', latency: float = None) -> None:
     """для логов от hugging_face_api"""
-    global lock
-    with lock:
-        time_now = datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S')
-        log_file_path = 'logs/debug_bing_success.log'
-        open(log_file_path, 'a', encoding="utf-8").write(f'{time_now}\n\n{text}\n{"=" * 80}\n')
+    log_debug('logs/debug_bing_success.log', text, "=" * 80, 'bing', chat_id, latency)
 
 
-def log_bing_img(text: str) -> None:
+def log_bing_img(text: str, chat_id: str = '', latency: float = None) -> None:
     """для логов от hugging_face_api"""
-    global lock
-    with lock:
-        time_now = datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S')
-        log_file_path = 'logs/debug_bing_img.log'
-        open(log_file_path, 'a', encoding="utf-8").write(f'{time_now}\n\n{text}\n{"=" * 80}\n')
+    log_debug('logs/debug_bing_img.log', text, "=" * 80, 'bing', chat_id, latency)
 
 
-def log_reprompts(text: str) -> None:
+def log_reprompts(text: str, chat_id: str = '', latency: float = None) -> None:
     """для логов переводов промптов для рисования"""
-    global lock
-    with lock:
-        time_now = datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S')
-        log_file_path = 'logs/debug_img_reprompts.log'
-        open(log_file_path, 'a', encoding="utf-8").write(f'{time_now}\n\n{text}\n{"=" * 80}\n')
+    log_debug('logs/debug_img_reprompts.log', text, "=" * 80, 'reprompts', chat_id, latency)
 
 
-def log_translate(text: str) -> None:
+def log_translate(text: str, chat_id: str = '', latency: float = None) -> None:
     """для дебага ошибок автоперевода с помощью ai"""
-    global lock
-    with lock:
-        time_now = datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S')
-        log_file_path = 'logs/debug_translate.log'
-        open(log_file_path, 'a', encoding="utf-8").write(f'{time_now}\n\n{text}\n{"=" * 80}\n')
+    log_debug('logs/debug_translate.log', text, "=" * 80, 'translate', chat_id, latency)
 
 
-def log_gemini(text: str) -> None:
+def log_gemini(text: str, chat_id: str = '', latency: float = None) -> None:
     """для дебага ошибок gemini"""
-    global lock
-    with lock:
-        time_now = datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S')
-        log_file_path = 'logs/debug_gemini.log'
-        open(log_file_path, 'a', encoding="utf-8").write(f'{time_now}\n\n{text}\n{"=" * 80}\n')
+    log_debug('logs/debug_gemini.log', text, "=" * 80, 'gemini', chat_id, latency)
 
 
 def log_echo(message: telebot.types.Message, reply_from_bot: str = '', debug: bool = False) -> None:
@@ -142,12 +226,10 @@ def log_echo(message: telebot.types.Message, reply_from_bot: str = '', debug: bo
     if topic_id:
         log_file_path = log_file_path[:-4] + f' [{topic_id}].log'
 
-    with lock:
-        with open(log_file_path, 'a', encoding="utf-8") as log_file:
-            if reply_from_bot:
-                log_file.write(f"[{time_now}] [BOT]: {reply_from_bot}\n")
-            else:
-                log_file.write(f"[{time_now}] [{user_name}]: {message.text or message.caption or ''}\n")
+    if reply_from_bot:
+        WRITER.write(log_file_path, f"[{time_now}] [BOT]: {reply_from_bot}\n")
+    else:
+        WRITER.write(log_file_path, f"[{time_now}] [{user_name}]: {message.text or message.caption or ''}\n")
 
 
 def log_media(message: telebot.types.Message) -> None:
@@ -182,40 +264,31 @@ def log_media(message: telebot.types.Message) -> None:
         file_duration = message.audio.duration
         file_title = message.audio.title
         file_mime_type = message.audio.mime_type
-        with lock:
-            with open(log_file_path, 'a', encoding="utf-8") as log_file:
-                log_file.write(f"[{time_now}] [{user_name}]: [Отправил аудио файл] [caption: {caption}] [title: {file_title}] \
+        WRITER.write(log_file_path, f"[{time_now}] [{user_name}]: [Отправил аудио файл] [caption: {caption}] [title: {file_title}] \
 [filename: {file_name}] [filesize: {file_size}] [duration: {file_duration}] [mime type: {file_mime_type}]\n")
 
     if message.voice:
         file_size = message.voice.file_size
         file_duration = message.voice.duration
-        with lock:
-            with open(log_file_path, 'a', encoding="utf-8") as log_file:
-                log_file.write(f"[{time_now}] [{user_name}]: [Отправил голосовое сообщение] [filesize: \
+        WRITER.write(log_file_path, f"[{time_now}] [{user_name}]: [Отправил голосовое сообщение] [filesize: \
 {file_size}] [duration: {file_duration}]\n")
 
     if message.document:
         file_name = message.document.file_name
         file_size = message.document.file_size
         file_mime_type = message.document.mime_type
-        with lock:
-            with open(log_file_path, 'a', encoding="utf-8") as log_file:
-                log_file.write(f"[{time_now}] [{user_name}]: [Отправил документ] [caption: {caption}] \
+        WRITER.write(log_file_path, f"[{time_now}] [{user_name}]: [Отправил документ] [caption: {caption}] \
 [filename: {file_name}] [filesize: {file_size}] [mime type: {file_mime_type}]\n")
 
     if message.photo or message.video:
-        with lock:
-            with open(log_file_path, 'a', encoding="utf-8") as log_file:
-                log_file.write(f"[{time_now}] [{user_name}]: [Отправил фото] [caption]: {caption}\n")
+        WRITER.write(log_file_path, f"[{time_now}] [{user_name}]: [Отправил фото] [caption]: {caption}\n")
 
 
 def log_google(request: str, respond: str):
     """записывает в журнал сообщение полученное обработчиком google"""
     time_now = datetime.datetime.now().strftime('%d-%m-%Y %H.%M.%S')
     log_file_path = f'logs/askgoogle at {time_now}.log'
-    with open(log_file_path, 'a', encoding="utf-8") as log_file:
-        log_file.write(f'{respond}\n\n{"="*40}\n\n{request}')
+    WRITER.write(log_file_path, f'{respond}\n\n{"="*40}\n\n{request}')
 
 
 def log_report(bot: telebot.TeleBot, message: telebot.types.Message, 
@@ -232,47 +305,144 @@ def log_report(bot: telebot.TeleBot, message: telebot.types.Message,
 
     log_file_path = logname
 
-    with lock:
-        with open(log_file_path, 'a', encoding="utf-8") as log_file:
-            log_file.write('=' * 40 + '\n')
-            log_file.write(f"{time_now}\n")
-            log_file.write(f"{ftime_now}\n")
-            log_file.write(f'{chat_id_full}\n')
-            log_file.write('-' * 40 + '\n')
-            log_file.write(f"{user_text}\n")
-            log_file.write('-' * 40 + '\n')
-            log_file.write(f"{resp}\n")
-            log_file.write('=' * 40 + '\n')
+    WRITER.write(log_file_path, '=' * 40 + '\n' +
+                 f"{time_now}\n" +
+                 f"{ftime_now}\n" +
+                 f'{chat_id_full}\n' +
+                 '-' * 40 + '\n' +
+                 f"{user_text}\n" +
+                 '-' * 40 + '\n' +
+                 f"{resp}\n" +
+                 '=' * 40 + '\n')
+    # my_reports импортирует my_dialogs, а тот my_log, поэтому не на уровне модуля
+    import my_reports
+    my_reports.add(time_now, message.from_user.id, chat_id_full, user_text, resp)
 
     user_id = message.from_user.id
     user_name = message.from_user.first_name or message.from_user.username or "[пусто]"
     user_id_with_name = f'[{user_id}] [{user_name}]'
-    logs_group = cfg.log_gpoup
-    if user_id in USERS_LOGS:
-        user_thread = USERS_LOGS[user_id]
+    if parse_mode == 'HTML':
+        bot_text = resp
     else:
-        user_thread = bot.create_forum_topic(logs_group, user_id_with_name).message_thread_id
-        USERS_LOGS[user_id] = user_thread
+        bot_text = html.escape(resp)
+    REPORTS.put(bot, user_id, user_id_with_name, f'USER: {html.escape(user_text[:3500])}\n\nBOT: {bot_text}')
 
-    try:
-        bot.send_message(logs_group, message_thread_id=user_thread, text = f'USER: {user_text[:3500]}')
-        time.sleep(1)
-        bot.send_message(logs_group, message_thread_id=user_thread, text = f'BOT: {resp}', parse_mode=parse_mode)
-    except Exception as error:
-        log2(f'my_log:log_report: {error}\n\n{resp}')
-
-        # возможно удалили тему и надо создать ее заново
-        user_thread = bot.create_forum_topic(logs_group, user_id_with_name).message_thread_id
-        USERS_LOGS[user_id] = user_thread
 
+class ReportShipper:
+    """Отправляет отчеты log_report в группу логов в фоне, запрос юзера их не ждет.
+    Очередь ограничена, если она переполнена то отчет в группу не попадет (в файле он останется).
+    Пока поток ждет лимита в очереди копятся новые отчеты, идущие подряд отчеты одного юзера
+    склеиваются в одно сообщение в его теме.
+    """
+    def __init__(self, maxsize: int = REPORT_QUEUE_SIZE):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.bucket = my_ratelimit.TokenBucket(REPORT_RATE, REPORT_BURST)
+        # отчет который уже забрали из очереди но он не влез в предыдущую пачку
+        self.pending = None
+        self.dropped = 0
+        self.thread = None
+        self.thread_lock = threading.Lock()
+
+    def put(self, bot: telebot.TeleBot, user_id: int, user_id_with_name: str, text: str):
+        with self.thread_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='report_shipper', daemon=True)
+                self.thread.start()
         try:
-            bot.send_message(logs_group, message_thread_id=user_thread, text = html.escape(f'USER: {user_text[:3500]}'))
-            time.sleep(1)
-            bot.send_message(logs_group, message_thread_id=user_thread, text = html.escape(f'BOT: {resp}'), parse_mode=parse_mode)
-        except Exception as error2:
-            log2(f'my_log:log_report:2: {error}\n\n{resp}')
+            self.queue.put_nowait((bot, user_id, user_id_with_name, text))
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                log2(f'my_log:ReportShipper: queue is full, dropped {self.dropped} reports')
+
+    def next_batch(self) -> tuple:
+        """первый отчет и все следующие за ним отчеты того же юзера что влезают в одно сообщение.
+        Из очереди берется только то что нужно для пачки, первый не подошедший отчет ждет следующей.
+        """
+        bot, user_id, user_id_with_name, text = self.pending or self.queue.get()
+        self.pending = None
+        texts = [text]
+        size = len(text)
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            # + 2 на '\n\n' между отчетами
+            if item[1] != user_id or size + 2 + len(item[3]) > REPORT_MAX_LEN:
+                self.pending = item
+                break
+            size += 2 + len(item[3])
+            texts.append(item[3])
+        return bot, user_id, user_id_with_name, '\n\n'.join(texts)
+
+    def run(self):
+        while True:
+            try:
+                if self.pending is None:
+                    self.pending = self.queue.get()
+                self.bucket.acquire()
+                self.send(*self.next_batch())
+            except Exception as error:
+                log2(f'my_log:ReportShipper:run: {error}')
+                time.sleep(1)
+
+    def send(self, bot: telebot.TeleBot, user_id: int, user_id_with_name: str, text: str):
+        # utils импортирует my_log, поэтому не на уровне модуля
+        import utils
+        # длинный запрос с ответом не влезает в одно сообщение телеграма
+        for i, chunk in enumerate(utils.split_html(text, REPORT_MAX_LEN)):
+            if i:
+                self.bucket.acquire()
+            self.send_chunk(bot, user_id, user_id_with_name, chunk)
+
+    def send_chunk(self, bot: telebot.TeleBot, user_id: int, user_id_with_name: str, text: str):
+        logs_group = cfg.log_gpoup
+        recreated = False
+        parse_mode = 'HTML'
+        while True:
+            try:
+                if user_id not in USERS_LOGS:
+                    USERS_LOGS[user_id] = bot.create_forum_topic(logs_group, user_id_with_name).message_thread_id
+                bot.send_message(logs_group, message_thread_id=USERS_LOGS[user_id], text = text, parse_mode=parse_mode)
+                return
+            except Exception as error:
+                wait = my_ratelimit.retry_after(error)
+                if wait:
+                    self.bucket.block(wait)
+                    self.bucket.acquire()
+                    continue
+                error_text = str(error).lower()
+                if 'message thread not found' in error_text and not recreated:
+                    # удалили тему, создаем ее заново
+                    USERS_LOGS.pop(user_id, None)
+                    recreated = True
+                    continue
+                if "can't parse entities" in error_text and parse_mode:
+                    # сломанная разметка, отправляем как есть без нее
+                    parse_mode = None
+                    continue
+                log2(f'my_log:log_report: {error}\n\n{text}')
+                return
+
+
+REPORTS = ReportShipper()
 
 
 if __name__ == '__main__':
-    pass
-    log_google('1', '2')
+    # сравнение со старой записью (открыть файл, дописать, закрыть под общим замком)
+    n = 20000
+    old_lock = threading.Lock()
+    start = time.time()
+    for i in range(n):
+        with old_lock:
+            open('logs/debug_bench_old.log', 'a', encoding="utf-8").write(f'{i}\n\n{"x" * 200}\n{"=" * 89}\n')
+    print(f'open/append/close: {n} records in {time.time() - start:.2f}s')
+    start = time.time()
+    for i in range(n):
+        log_debug('logs/debug_bench_new.log', f'{i}\n\n{"x" * 200}')
+    print(f'LogWriter enqueue: {n} records in {time.time() - start:.2f}s')
+    WRITER.flush(60)
+    print(f'LogWriter on disk: {n} records in {time.time() - start:.2f}s')
+    os.remove('logs/debug_bench_old.log')
+    os.remove('logs/debug_bench_new.log')
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+# Перевод маркдауна от чатботов в html для телеграма (utils.bot_markdown_to_html).
+# Текст один раз разбирается на куски: блоки кода ```, инлайн код `, латекс ($...$, \[...\] и тп)
+# и обычный текст, потом по строкам переделываются списки, заголовки, жирный текст, ссылки и таблицы,
+# и результат собирается за один проход. Правила те же что были в старой версии на регулярках
+# (bot_markdown_to_html_old), python my_markdown.py сравнивает их на наборе примеров и делает замер.
+
+
+import functools
+import html
+import random
+import re
+import string
+import time
+
+import prettytable
+from pylatexenc.latex2text import LatexNodes2Text
+
+import my_log
+
+
+# блок кода после которого перенос строки, и блок в самом конце текста
+FENCE = re.compile('```(.*?)```\n', flags=re.DOTALL)
+FENCE_TAIL = re.compile('```(.*?)```', flags=re.DOTALL)
+INLINE_CODE = re.compile('`(.*?)`')
+LATEX = re.compile(r"(?:\$\$?|\\\[|\\\(|\\\[)(.*?)(?:\$\$?|\\\]|\\\)|\\\])", flags=re.DOTALL)
+# заголовки ## ### #### и странные варианты с точкой в начале которые иногда пишут модели
+HEADER = re.compile(r'^(?:#{2,4}|\. ###|\.  #{2,4}) (.*)$')
+# **жирный** и [ссылка](http://...)
+INLINE = re.compile(r'\*\*(?P<bold>.+?)\*\*|\[(?P<text>.*?)\]\((?P<url>https?://\S+)\)')
+# на время разбора строк код заменяется метками \ue000номер\ue001
+PLACEHOLDER = re.compile('\ue000(\\d+)\ue001')
+# а в таблицах метками такой же ширины как были в старой версии
+TABLE_PLACEHOLDER = re.compile('CODE(\\d{12})')
+
+
+LATEX_TO_TEXT = LatexNodes2Text()
+
+
+@functools.lru_cache(maxsize=1000)
+def latex_to_text(latex: str) -> str:
+    return LATEX_TO_TEXT.latex_to_text(latex.replace('\\\\', '\\'))
+
+
+def replace_latex(match: re.Match) -> str:
+    # старая версия заменяла в тексте $$x$$, $x$, \[x\] и \(x\), если скобки разные то замены нет
+    latex = match.group(1)
+    new = latex_to_text(latex)
+    return match.group(0).replace(f'$${latex}$$', new).replace(f'${latex}$', new).replace(f'\\[{latex}\\]', new).replace(f'\\({latex}\\)', new)
+
+
+def render_inline(text: str) -> str:
+    """жирный текст и ссылки, внутри них тоже может быть разметка"""
+    def replace(match: re.Match) -> str:
+        if match.group('bold') is not None:
+            return f'<b>{render_inline(match.group("bold"))}</b>'
+        return f'<a href="{match.group("url")}">{render_inline(match.group("text"))}</a>'
+    return INLINE.sub(replace, text)
+
+
+def tokenize(text: str) -> tuple:
+    """разбирает экранированный текст на куски, возвращает (текст с метками вместо кода, [код, ...]).
+    Код - ('code', текст) для `инлайн` и ('pre', текст) для ```блоков```, латекс сразу переводится в юникод.
+    """
+    codes = []
+    parts = []
+
+    def add_text(chunk: str):
+        # одиночные ``` меняются на ''', дальше инлайн код, в остальном латекс
+        chunk = chunk.replace('```', "'''")
+        position = 0
+        for match in INLINE_CODE.finditer(chunk):
+            parts.append(LATEX.sub(replace_latex, chunk[position:match.start()]))
+            parts.append(f'\ue000{len(codes)}\ue001')
+            codes.append(('code', match.group(1)))
+            position = match.end()
+        parts.append(LATEX.sub(replace_latex, chunk[position:]))
+
+    def add_fences(chunk: str, pattern: re.Pattern) -> str:
+        position = 0
+        for match in pattern.finditer(chunk):
+            add_text(chunk[position:match.start()])
+            parts.append(f'\ue000{len(codes)}\ue001')
+            codes.append(('pre', match.group(1)))
+            # перенос строки после блока остается в тексте
+            position = match.end() - (1 if pattern is FENCE else 0)
+        return chunk[position:]
+
+    # сначала блоки за которыми перенос строки, потом блоки в хвосте текста, так же как было раньше
+    tail = add_fences(text, FENCE)
+    tail = add_fences(tail, FENCE_TAIL)
+    add_text(tail)
+    return ''.join(parts), codes
+
+
+def render_line(line: str) -> str:
+    stripped = line.strip()
+    if stripped.startswith('* '):
+        line = line.replace('* ', '• ', 1)
+    elif stripped.startswith('- '):
+        line = line.replace('- ', '– ', 1)
+    match = HEADER.match(line)
+    if match:
+        return f'<b>{render_inline(match.group(1))}</b>'
+    return render_inline(line)
+
+
+def is_table_line(line: str) -> bool:
+    return line.count('|') > 2 and len(line) > 4
+
+
+def split_long_string(long_string: str, header = False, MAX_LENGTH = 24) -> str:
+    if len(long_string) <= MAX_LENGTH:
+        return long_string
+    if header:
+        return long_string[:MAX_LENGTH-2] + '..'
+    split_strings = []
+    while len(long_string) > MAX_LENGTH:
+        split_strings.append(long_string[:MAX_LENGTH])
+        long_string = long_string[MAX_LENGTH:]
+
+    if long_string:
+        split_strings.append(long_string)
+
+    result = "\n".join(split_strings)
+    return result
+
+
+def format_table(table: str) -> str:
+    """маркдаун таблица (строки с |, вторая строка разделитель) в текстовую для <pre>, None если не получилось"""
+    x = prettytable.PrettyTable(align = "l",
+                                set_style = prettytable.MSWORD_FRIENDLY,
+                                hrules = prettytable.HEADER,
+                                junction_char = '|')
+
+    lines = table.split('\n')
+    header = [x.strip().replace('<b>', '').replace('</b>', '') for x in lines[0].split('|') if x]
+    header = [split_long_string(x, header = True) for x in header]
+    try:
+        x.field_names = header
+    except Exception as error:
+        my_log.log2(f'tb:replace_tables: {error}')
+        return None
+    for line in lines[2:]:
+        row = [x.strip().replace('<b>', '').replace('</b>', '') for x in line.split('|') if x]
+        row = [split_long_string(x) for x in row]
+        try:
+            x.add_row(row)
+        except Exception as error2:
+            my_log.log2(f'tb:replace_tables: {error2}')
+            continue
+    return x.get_string()
+
+
+def render_code(kind: str, code: str, line_start: bool) -> str:
+    # блок кода с названием языка в первой строке с начала строки становится <pre>, остальное <code>
+    if kind == 'pre' and line_start:
+        language, _, body = code.partition('\n')
+        if len(language) > 1 and _:
+            if body and not body.endswith('\n'):
+                body += '\n'
+            return f'<pre><code class = "language-{language}">{body}</code></pre>'
+    return f'<code>{code}</code>'
+
+
+def render_table(lines: list, codes: list) -> str:
+    # в таблице код заменяется метками по 16 символов, по ним prettytable считает ширину колонок
+    table = PLACEHOLDER.sub(lambda m: f'CODE{int(m.group(1)):012d}', '\n'.join(lines))
+    new_table = format_table(table)
+    if new_table is None:
+        return None
+    new_table = TABLE_PLACEHOLDER.sub(lambda m: render_code(*codes[int(m.group(1))], False), new_table)
+    return f'<pre><code>{new_table}\n</code></pre>'
+
+
+def bot_markdown_to_html(text: str) -> str:
+    # переделывает маркдаун от чатботов в хтмл для телеграма
+    # сначала делается полное экранирование
+    # затем меняются маркдаун теги и оформление на аналогичное в хтмл
+    # при этом не затрагивается то что внутри тегов код, там только экранирование
+    # латекс код в тегах $ и $$ меняется на юникод текст
+    text, codes = tokenize(html.escape(text))
+    lines = [render_line(line) for line in text.strip().split('\n')]
+
+    def replace_code(match: re.Match) -> str:
+        return render_code(*codes[int(match.group(1))], match.start() == 0)
+
+    result = []
+    table = []
+    for line in lines + ['']:
+        if is_table_line(line):
+            table.append(line)
+            continue
+        if table:
+            new_table = render_table(table, codes)
+            if new_table is None:
+                result += [PLACEHOLDER.sub(replace_code, x) for x in table]
+            else:
+                result.append(new_table)
+            table = []
+        result.append(PLACEHOLDER.sub(replace_code, line))
+    return '\n'.join(result) + '\n'
+
+
+# старая версия на регулярках, нужна только для сравнения в __main__
+
+
+def bot_markdown_to_html_old(text: str) -> str:
+    # экранируем весь текст для html
+    text = html.escape(text)
+
+    # найти все куски кода между ``` и заменить на хеши
+    # спрятать код на время преобразований
+    matches = re.findall('```(.*?)```\n', text, flags=re.DOTALL)
+    list_of_code_blocks = []
+    for match in matches:
+        random_string = str(hash(match))
+        list_of_code_blocks.append([match, random_string])
+        text = text.replace(f'```{match}```', random_string)
+
+    matches = re.findall('```(.*?)```', text, flags=re.DOTALL)
+    for match in matches:
+        random_string = str(hash(match))
+        list_of_code_blocks.append([match, random_string])
+        text = text.replace(f'```{match}```', random_string)
+
+    # тут могут быть одиночные поворяющиеся `, меняем их на '
+    text = text.replace('```', "'''")
+
+    matches = re.findall('`(.*?)`', text)
+    list_of_code_blocks2 = []
+    for match in matches:
+        random_string = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(16))
+        list_of_code_blocks2.append([match, random_string])
+        text = text.replace(f'`{match}`', random_string)
+
+    # переделываем списки на более красивые
+    new_text = ''
+    for i in text.split('\n'):
+        ii = i.strip()
+        if ii.startswith('* '):
+            i = i.replace('* ', '• ', 1)
+        if ii.startswith('- '):
+            i = i.replace('- ', '– ', 1)
+        new_text += i + '\n'
+    text = new_text.strip()
+
+    # 2,3,4 # в начале строки меняем всю строку на жирный текст
+    text = re.sub('^#### (.*)$', '<b>\\1</b>', text, flags=re.MULTILINE)
+    text = re.sub('^### (.*)$', '<b>\\1</b>', text, flags=re.MULTILINE)
+    text = re.sub('^## (.*)$', '<b>\\1</b>', text, flags=re.MULTILINE)
+    # точка пробел три хеша и пробел в начале тоже делать жирным
+    text = re.sub('^\. ### (.*)$', '<b>\\1</b>', text, flags=re.MULTILINE)
+    text = re.sub('^\.  ## (.*)$', '<b>\\1</b>', text, flags=re.MULTILINE)
+    text = re.sub('^\.  ### (.*)$', '<b>\\1</b>', text, flags=re.MULTILINE)
+    text = re.sub('^\.  #### (.*)$', '<b>\\1</b>', text, flags=re.MULTILINE)
+
+    # 1 или 2 * в <b></b>
+    text = re.sub('\*\*(.+?)\*\*', '<b>\\1</b>', text)
+
+    # tex в unicode
+    matches = re.findall(r"(?:\$\$?|\\\[|\\\(|\\\[)(.*?)(?:\$\$?|\\\]|\\\)|\\\])", text, flags=re.DOTALL)
+    for match in matches:
+        new_match = LatexNodes2Text().latex_to_text(match.replace('\\\\', '\\'))
+        text = text.replace(f'$${match}$$', new_match)
+        text = text.replace(f'${match}$', new_match)
+        text = text.replace(f'\[{match}\]', new_match)
+        text = text.replace(f'\({match}\)', new_match)
+
+    # меняем маркдаун ссылки на хтмл
+    text = re.sub('''\[(.*?)\]\((https?://\S+)\)''', r'<a href="\2">\1</a>', text)
+
+    # меняем таблицы до возвращения кода
+    text = replace_tables_old(text)
+
+    # меняем обратно хеши на блоки кода
+    for match, random_string in list_of_code_blocks2:
+        new_match = match
+        text = text.replace(random_string, f'<code>{new_match}</code>')
+
+    # меняем обратно хеши на блоки кода
+    for match, random_string in list_of_code_blocks:
+        new_match = match
+        text = text.replace(random_string, f'<code>{new_match}</code>')
+
+    text = replace_code_lang_old(text)
+
+    return text
+
+
+def replace_code_lang_old(t: str) -> str:
+    result = ''
+    state = 0
+    for i in t.split('\n'):
+        if i.startswith('<code>') and len(i) > 7:
+            result += f'<pre><code class = "language-{i[6:]}">'
+            state = 1
+        else:
+            if state == 1:
+                if i == '</code>':
+                    result += '</code></pre>\n'
+                    state = 0
+                else:
+                    result += i + '\n'
+            else:
+                result += i + '\n'
+    return result
+
+
+def replace_tables_old(text: str) -> str:
+    text += '\n'
+    state = 0
+    table = ''
+    results = []
+    for line in text.split('\n'):
+        if line.count('|') > 2 and len(line) > 4:
+            if state == 0:
+                state = 1
+            table += line + '\n'
+        else:
+            if state == 1:
+                results.append(table[:-1])
+                table = ''
+                state = 0
+
+    for table in results:
+        new_table = format_table(table)
+        if new_table is not None:
+            text = text.replace(table, f'<pre><code>{new_table}\n</code></pre>')
+
+    return text
+
+
+# примеры ответов на которых новая и старая версии должны давать одинаковый результат
+SAMPLES = [
+    '',
+    'Привет! Чем могу помочь?',
+    '  \n\nтекст с пробелами по краям  \n\n',
+    '## Заголовок\n\nТекст **жирный** и еще **один**, a < b & c > "d" \'e\'',
+    '#### Четвертый\n### Третий\n## Второй **с жирным**\n# Первый\n##### Пятый\n. ### С точкой\n.  ## С двумя пробелами',
+    '* пункт 1\n* пункт **2**\n  * вложенный\n- минус\n  - вложенный минус\n*не список*\n-1 не список',
+    'Пример:\n\n```python\ndef f(x):\n    return x * 2 < 3\n```\n\nИ еще:\n\n```bash\necho "**не жирный**" `uname`\n```\n',
+    'Код в конце\n```js\nconsole.log("a")\n```',
+    '```\nбез языка\n```\nтекст',
+    '```c\nint x;\n```\nязык из одной буквы',
+    'Текст ```python\nprint(1)\n```\nблок не с начала строки',
+    'одиночные ``` кавычки',
+    'Инлайн код: `x = 1` и `y**2**`, и еще **`жирный код`**',
+    'Ссылка [Google](https://google.com) и [**жирная**](http://example.com/a_b?c=1&d=2).',
+    'Список ссылок:\n* [один](https://a.com)\n* [два](https://b.com), текст',
+    'Формула $E = mc^2$ и $$\\frac{a}{b}$$ и \\(\\alpha + \\beta\\) и \\[\\sum_{i=1}^n i\\]',
+    'Цена $5 и $10',
+    'Блок формулы:\n$$\n\\int_0^1 x^2 dx = \\frac{1}{3}\n$$\nконец',
+    '| Имя | Возраст |\n|---|---|\n| Вася | 25 |\n| **Петя** | 30 |\n\nПосле таблицы',
+    'Таблица с кодом:\n| Команда | Описание |\n|---|---|\n| `ls` | список файлов |\n| `cd` | сменить папку |',
+    '| очень длинный заголовок колонки который не влезет | b |\n|---|---|\n| очень длинное значение ячейки которое надо разбить | 2 |',
+    '| a | b |\n|---|---|\n| 1 | 2 | 3 |\n| 4 | 5 |',
+    'не таблица | a | b',
+    '## План\n\n1. **Шаг 1**: установить `pip install x`\n2. **Шаг 2**: запустить\n\n```python\nimport x\nx.run()\n```\n\n* Примечание: [документация](https://docs.python.org/3/)\n',
+    'строка с \\r\r\nи табом\tконец',
+]
+
+# примеры где старая версия давала сломанный html, новая делает так
+FIXED = {
+    # инлайн код в начале строки превращался в незакрытый <pre><code class = "language-...
+    '`ls -la` покажет файлы\nвторая строка': '<code>ls -la</code> покажет файлы\nвторая строка\n\n',
+    # блок кода без переноса перед закрывающими ``` не закрывался
+    '```python\nprint(1)```': '<pre><code class = "language-python">print(1)\n</code></pre>\n\n',
+    # однострочный блок кода тоже
+    '```python print(1)```': '<code>python print(1)</code>\n\n',
+}
+
+
+if __name__ == '__main__':
+    for sample in SAMPLES:
+        old = bot_markdown_to_html_old(sample)
+        new = bot_markdown_to_html(sample)
+        assert old == new, f'\n{sample!r}\nold: {old!r}\nnew: {new!r}'
+    for sample, expected in FIXED.items():
+        new = bot_markdown_to_html(sample)
+        assert new == expected, f'\n{sample!r}\nnew: {new!r}'
+    print(f'ok, {len(SAMPLES)} samples')
+
+    # ответ на 30к символов
+    answer = ''
+    n = 0
+    while len(answer) < 30000:
+        answer += SAMPLES[n % len(SAMPLES)] + f'\n\n```python\nprint({n})\n```\n\n'
+        n += 1
+    for func in (bot_markdown_to_html_old, bot_markdown_to_html):
+        start = time.time()
+        for _ in range(10):
+            result = func(answer)
+        print(f'{func.__name__}: {(time.time() - start) / 10 * 1000:.1f}ms на {len(answer)} символов')
+    assert bot_markdown_to_html_old(answer) == bot_markdown_to_html(answer)
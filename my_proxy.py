@@ -1,16 +1,24 @@
 #!/usr/bin/env python3
 # pip install Proxy-List-Scrapper
+#
+# Поиск рабочих прокси идет потоком через asyncio: кандидаты сначала проходят дешевую проверку
+# (TCP соединение и CONNECT/socks рукопожатие), и только выжившие отправляются на дорогую проверку
+# probe_function (например запрос к API через прокси) в постоянном пуле потоков.
+# Рабочие прокси выдаются сразу как нашлись, после max_results все остальные проверки отменяются.
 
 
+import asyncio
+import queue
 import random
 import time
 import threading
 import concurrent.futures
+import urllib.parse
 
-import requests
 from sqlitedict import SqliteDict
 from Proxy_List_Scrapper import Scrapper
 
+import my_http
 import my_log
 
 
@@ -20,6 +28,19 @@ cache = SqliteDict('db/proxy_cache.db', autocommit=True)
 cache_lock = threading.Lock()
 MAX_CACHE_TIME = 3600*4
 
+# сколько кандидатов одновременно проходят дешевую проверку соединения
+PRECHECK_CONCURRENCY = 200
+# сколько секунд ждать соединения и ответа на CONNECT
+PRECHECK_TIMEOUT = 5
+# куда просить прокси соединиться при проверке
+PRECHECK_TARGET = 'www.google.com:443'
+# сколько дорогих проверок probe_function идут одновременно
+PROBE_CONCURRENCY = 100
+
+# постоянный пул потоков для дорогих проверок
+PROBE_EXECUTOR = None
+PROBE_EXECUTOR_LOCK = threading.Lock()
+
 
 def get_proxies():
     """
@@ -43,11 +64,11 @@ def get_proxies():
         p_http = 'https://raw.githubusercontent.com/MuRongPIG/Proxy-Master/main/http.txt'
 
         try:
-            p_socks5h = requests.get(p_socks5h, timeout=60).text.split('\n')
+            p_socks5h = my_http.get(p_socks5h, timeout=60).text.split('\n')
             p_socks5h = [f'socks5h://{x}' for x in p_socks5h if x]
-            p_socks4 = requests.get(p_socks4, timeout=60).text.split('\n')
+            p_socks4 = my_http.get(p_socks4, timeout=60).text.split('\n')
             p_socks4 = [f'socks4://{x}' for x in p_socks4 if x]
-            p_http = requests.get(p_http, timeout=60).text.split('\n')
+            p_http = my_http.get(p_http, timeout=60).text.split('\n')
             p_http = [f'http://{x}' for x in p_http if x]
             proxies += p_socks5h + p_socks4 + p_http
             random.shuffle(proxies)
@@ -63,42 +84,259 @@ def get_proxies():
     return proxies
 
 
+async def handshake(scheme: str, host: str, port: int, target: str) -> bool:
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        if scheme in ('http', 'https'):
+            writer.write(f'CONNECT {target} HTTP/1.1\r\nHost: {target}\r\n\r\n'.encode())
+            await writer.drain()
+            status = (await reader.readline()).split()
+            return len(status) > 1 and status[1] == b'200'
+        if scheme.startswith('socks5'):
+            # без авторизации
+            writer.write(b'\x05\x01\x00')
+            await writer.drain()
+            return await reader.readexactly(2) == b'\x05\x00'
+        # socks4 хочет ip адрес цели, для него хватит и соединения
+        return True
+    finally:
+        writer.close()
+
+
+async def precheck(proxy: str, target: str = PRECHECK_TARGET, timeout: float = PRECHECK_TIMEOUT) -> bool:
+    """дешевая проверка: прокси принимает соединение и соглашается соединить с target"""
+    try:
+        url = urllib.parse.urlsplit(proxy)
+        if not url.hostname or not url.port:
+            return False
+        return await asyncio.wait_for(handshake(url.scheme, url.hostname, url.port, target), timeout)
+    except Exception:
+        return False
+
+
+def get_probe_executor(max_workers: int) -> concurrent.futures.ThreadPoolExecutor:
+    global PROBE_EXECUTOR
+    with PROBE_EXECUTOR_LOCK:
+        if PROBE_EXECUTOR is None or PROBE_EXECUTOR._max_workers < max_workers:
+            PROBE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='proxy_probe')
+        return PROBE_EXECUTOR
+
+
+async def probe_stream(probe_function,
+                       proxies,
+                       max_results: int = 20,
+                       concurrency: int = PRECHECK_CONCURRENCY,
+                       probe_concurrency: int = PROBE_CONCURRENCY,
+                       target: str = PRECHECK_TARGET,
+                       timeout: float = PRECHECK_TIMEOUT):
+    """
+    Асинхронный генератор результатов probe_function(proxy) для прокси которые прошли проверку.
+    probe_function может быть обычной функцией (выполняется в пуле потоков) или корутиной,
+    пустой результат или исключение значит что прокси не годится.
+    После max_results результатов или при закрытии генератора все проверки отменяются
+    (обычная функция в потоке доработает до конца, но ее результат уже никому не нужен).
+    """
+    loop = asyncio.get_running_loop()
+    candidates = iter(proxies)
+    results = asyncio.Queue()
+    probe_limit = asyncio.Semaphore(probe_concurrency)
+    is_coroutine = asyncio.iscoroutinefunction(probe_function)
+    executor = None if is_coroutine else get_probe_executor(probe_concurrency)
+
+    async def worker():
+        # все воркеры берут кандидатов из одного итератора, в asyncio это безопасно
+        for proxy in candidates:
+            if not await precheck(proxy, target, timeout):
+                continue
+            async with probe_limit:
+                try:
+                    if is_coroutine:
+                        result = await probe_function(proxy)
+                    else:
+                        result = await loop.run_in_executor(executor, probe_function, proxy)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    result = None
+            if result:
+                results.put_nowait(result)
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    running = len(workers)
+
+    def worker_done(_):
+        nonlocal running
+        running -= 1
+        if not running:
+            results.put_nowait(None)
+
+    for task in workers:
+        task.add_done_callback(worker_done)
+    try:
+        found = 0
+        while found < max_results:
+            result = await results.get()
+            if result is None:
+                break
+            found += 1
+            yield result
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
+def stream_working_proxies(probe_function, proxies: list = None, max_results: int = 20, **kwargs):
+    """
+    Обычный генератор поверх probe_stream, выдает результаты probe_function по мере нахождения.
+    proxies - кандидаты, по умолчанию get_proxies() в случайном порядке.
+    Если перестать читать и закрыть генератор (break в цикле) то проверки останавливаются.
+    Остальные параметры как у probe_stream.
+    """
+    if proxies is None:
+        proxies = get_proxies()[:]
+        random.shuffle(proxies)
+
+    results = queue.Queue()
+    done = object()
+    loop = asyncio.new_event_loop()
+
+    async def run():
+        try:
+            async for result in probe_stream(probe_function, proxies, max_results, **kwargs):
+                results.put(result)
+        finally:
+            results.put(done)
+
+    task = loop.create_task(run())
+
+    def run_loop():
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+        except Exception as error:
+            my_log.log2(f'my_proxy:stream_working_proxies: {error}')
+        finally:
+            loop.close()
+
+    thread = threading.Thread(target=run_loop, name='proxy_prober', daemon=True)
+    thread.start()
+    try:
+        while True:
+            result = results.get()
+            if result is done:
+                break
+            yield result
+    finally:
+        try:
+            loop.call_soon_threadsafe(task.cancel)
+        except RuntimeError:
+            # цикл уже закончился сам
+            pass
+        thread.join()
+
+
 def find_working_proxies(probe_function, max_workers: int = 100, max_results: int = 20):
     """
     Find working proxies using a probe function.
 
     Parameters:
         probe_function (function): The function to probe the proxies.
-        max_workers (int, optional): The maximum number of workers for the thread pool. Defaults to 100.
+        max_workers (int, optional): How many probes run at the same time. Defaults to 100.
         max_results (int, optional): The maximum number of results to return. Defaults to 20.
 
     Returns:
         list: A list of working proxies.
     """
-    proxies = get_proxies()
-    random.shuffle(proxies)
-    n = 0
-    maxn = len(proxies)
-    step = max_workers
-    results = []
-
-    while n < maxn:
-        if len(results) >= max_results:
-            break
-        step = max_workers
-        chunk = proxies[n:n+step]
-        n += step
-        print(f'Proxies found: {len(results)} (processing {n} of {maxn})')
-        with concurrent.futures.ThreadPoolExecutor(max_workers=step) as executor:
-            futures = [executor.submit(probe_function, proxy) for proxy in chunk]
-            for future in futures:
-                r = future.result()
-                if r:
-                    results.append(r)
-                    if len(results) >= max_results:
-                        break
-    return results[:max_results]
+    return list(stream_working_proxies(probe_function, max_results=max_results, probe_concurrency=max_workers))
+
+
+def fake_proxy_farm(n_good: int = 20, n_forbidden: int = 20, n_silent: int = 20, n_dead: int = 20) -> dict:
+    """
+    Локальные ненастоящие прокси для проверки: отвечают на CONNECT 200, 403, молчат или не слушают порт.
+    Возвращает {прокси: вид}, серверы работают в фоновом потоке до конца программы.
+    """
+    import socket
+
+    async def reply(reader, writer, status: bytes):
+        await reader.readline()
+        writer.write(b'HTTP/1.1 ' + status + b'\r\n\r\n')
+        await writer.drain()
+        writer.close()
+
+    async def good(reader, writer):
+        await reply(reader, writer, b'200 Connection established')
+
+    async def forbidden(reader, writer):
+        await reply(reader, writer, b'403 Forbidden')
+
+    async def silent(reader, writer):
+        await asyncio.sleep(3600)
+
+    farm = {}
+    started = threading.Event()
+    loop = asyncio.new_event_loop()
+
+    async def start():
+        for kind, handler, n in (('good', good, n_good), ('forbidden', forbidden, n_forbidden), ('silent', silent, n_silent)):
+            for _ in range(n):
+                server = await asyncio.start_server(handler, '127.0.0.1', 0)
+                farm[f'http://127.0.0.1:{server.sockets[0].getsockname()[1]}'] = kind
+        started.set()
+
+    def run():
+        loop.run_until_complete(start())
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+    for _ in range(n_dead):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            farm[f'http://127.0.0.1:{s.getsockname()[1]}'] = 'dead'
+    return farm
 
 
 if __name__ == '__main__':
-    print(get_proxies())
\ No newline at end of file
+    farm = fake_proxy_farm()
+    candidates = list(farm)
+    random.seed(1)
+    random.shuffle(candidates)
+    # у части хороших прокси "API" отвечает, у остальных нет, время ответа разное
+    delays = {x: random.uniform(0.1, 1) for x in farm}
+    works = {x: farm[x] == 'good' and random.random() < 0.5 for x in farm}
+    probed = []
+
+    def probe(proxy: str) -> str:
+        probed.append(proxy)
+        time.sleep(delays[proxy])
+        return proxy if works[proxy] else ''
+
+    start = time.time()
+    found = []
+    for proxy in stream_working_proxies(probe, candidates, max_results=100, timeout=0.5, probe_concurrency=10):
+        found.append(proxy)
+        print(f'{time.time() - start:.2f}s {proxy} {delays[proxy]:.2f}')
+    print(f'найдено {len(found)} за {time.time() - start:.2f}s, дорогих проверок {len(probed)} из {len(farm)} кандидатов')
+    assert sorted(found) == sorted(x for x in farm if works[x])
+    # дорогую проверку проходят только те кто ответил на CONNECT 200
+    assert sorted(probed) == sorted(x for x in farm if farm[x] == 'good')
+
+    # первые 3 и стоп, остальные проверки отменяются
+    probed.clear()
+    start = time.time()
+    found = list(stream_working_proxies(probe, candidates, max_results=3, timeout=0.5, probe_concurrency=10))
+    n = len(probed)
+    time.sleep(1.5)
+    print(f'первые {len(found)} за {time.time() - start - 1.5:.2f}s, дорогих проверок {n}, после остановки новых {len(probed) - n}')
+    assert len(found) == 3 and all(works[x] for x in found)
+    assert len(probed) == n < sum(1 for x in farm if farm[x] == 'good')
+
+    # break в цикле тоже останавливает
+    probed.clear()
+    for proxy in stream_working_proxies(probe, candidates, timeout=0.5, probe_concurrency=10):
+        break
+    n = len(probed)
+    time.sleep(1.5)
+    assert len(probed) == n
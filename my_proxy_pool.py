@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# Пул прокси с оценкой здоровья.
+# У каждого прокси помнится скользящее среднее (EWMA) времени ответа и доли удачных запросов.
+# Прокси выбираются случайно с весом успех² / время, так что быстрые и надежные получают
+# больше запросов, но остальные тоже иногда проверяются. Несколько неудач подряд размыкают
+# прокси (circuit breaker) на время, которое растет с каждым разом, после паузы прокси получает
+# один пробный запрос (half-open): удачный возвращает его в работу, неудачный снова размыкает.
+# Из пула прокси удаляется только если много раз подряд не пережил пробный запрос.
+# Состояние пишется на диск пачками через my_dic.FLUSHER, а не после каждого запроса.
+#
+# for proxy in POOL.choose():
+#     ...
+#     POOL.success(proxy, seconds) или POOL.failure(proxy)
+
+
+import os
+import pickle
+import random
+import threading
+import time
+import traceback
+
+import my_dic
+import my_log
+
+
+# вес нового замера в скользящих средних
+ALPHA = 0.3
+
+# время ответа для прокси которые еще не замерялись
+DEFAULT_LATENCY = 5
+
+# столько неудач подряд размыкают прокси
+FAILURES_TO_OPEN = 3
+
+# на сколько секунд размыкается прокси в первый раз, потом каждый раз вдвое дольше
+OPEN_TIME = 30
+MAX_OPEN_TIME = 60 * 60
+
+# после стольких размыканий подряд без единой удачи прокси удаляется из пула
+OPENS_TO_REMOVE = 6
+
+# если пробный запрос не отчитался за это время то считается брошенным и можно пробовать снова
+PROBE_TIMEOUT = 180
+
+
+class ProxyState:
+    def __init__(self, latency: float = DEFAULT_LATENCY):
+        self.latency = latency
+        self.success = 1.0
+        # неудач подряд
+        self.failures = 0
+        # размыканий подряд
+        self.opens = 0
+        # до какого времени прокси разомкнут, 0 - замкнут (работает)
+        self.open_until = 0
+        # когда начался пробный запрос после размыкания, 0 - не идет
+        self.probe = 0
+
+    def weight(self) -> float:
+        return max(self.success, 0.05) ** 2 / max(self.latency, 0.1)
+
+
+class ProxyPool:
+    def __init__(self, filename: str, pinned = ()):
+        """
+        filename - файл где хранится пул
+        pinned - прокси из конфига, их нельзя удалять, только размыкать
+        """
+        self.filename = filename
+        self.pinned = set(pinned)
+        self.lock = threading.Lock()
+        # {proxy: ProxyState}
+        self.states = {}
+        # удаленные за время работы, повторно не добавляются
+        self.removed = set()
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, 'rb') as f:
+                data = pickle.load(f)
+            for proxy, values in data.items():
+                state = ProxyState()
+                state.__dict__.update(values)
+                self.states[proxy] = state
+        except Exception as unknown:
+            error_traceback = traceback.format_exc()
+            my_log.log2(f'my_proxy_pool:load: {self.filename} {unknown}\n\n{error_traceback}')
+
+    def save(self):
+        """отложенная запись, все изменения за FLUSH_INTERVAL_MS пишутся одним разом"""
+        self.dirty = True
+        my_dic.FLUSHER.mark_dirty(self)
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            data = pickle.dumps({proxy: dict(state.__dict__) for proxy, state in self.states.items()})
+        try:
+            tmp_path = self.filename + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.filename)
+        except Exception as unknown:
+            error_traceback = traceback.format_exc()
+            my_log.log2(f'my_proxy_pool:flush: {self.filename} {unknown}\n\n{error_traceback}')
+
+    def __len__(self) -> int:
+        return len(self.states)
+
+    def __contains__(self, proxy: str) -> bool:
+        return proxy in self.states
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.states))
+
+    def healthy(self) -> int:
+        """сколько прокси сейчас не разомкнуто"""
+        with self.lock:
+            return sum(1 for x in self.states.values() if not x.open_until)
+
+    def add(self, proxy: str, latency: float = DEFAULT_LATENCY) -> bool:
+        with self.lock:
+            if proxy in self.states or proxy in self.removed:
+                return False
+            self.states[proxy] = ProxyState(latency)
+        self.save()
+        return True
+
+    def remove(self, proxy: str):
+        with self.lock:
+            if proxy in self.pinned:
+                return
+            self.states.pop(proxy, None)
+            self.removed.add(proxy)
+        self.save()
+
+    def recreate(self, proxies: list):
+        """заменяет пул этими прокси, замеры тех что уже были в пуле сохраняются"""
+        with self.lock:
+            self.states = {x: self.states.get(x) or ProxyState() for x in dict.fromkeys(proxies)}
+        self.save()
+
+    def choose(self, exclude = ()):
+        """
+        Генератор прокси в случайном порядке с учетом веса (лучшие чаще оказываются первыми).
+        Разомкнутые пропускаются, у тех чья пауза истекла забирается пробный запрос
+        (его получает только один вызывающий). Если рабочих нет совсем то выдает
+        один разомкнутый, тот что должен был замкнуться раньше всех.
+        """
+        now = time.time()
+        with self.lock:
+            candidates = [(proxy, state) for proxy, state in self.states.items() if proxy not in exclude]
+        # взвешенная выборка без возвращения, ключ u^(1/w) (Efraimidis-Spirakis)
+        order = sorted(candidates, key=lambda x: random.random() ** (1 / x[1].weight()), reverse=True)
+
+        given = False
+        for proxy, state in order:
+            if state.open_until:
+                with self.lock:
+                    if state.open_until > now or now - state.probe < PROBE_TIMEOUT:
+                        continue
+                    state.probe = now
+            given = True
+            yield proxy
+
+        if not given and order:
+            with self.lock:
+                proxy, state = min(order, key=lambda x: x[1].open_until)
+                state.probe = time.time()
+            yield proxy
+
+    def success(self, proxy: str, latency: float):
+        with self.lock:
+            state = self.states.get(proxy)
+            if state is None:
+                return
+            state.latency += ALPHA * (latency - state.latency)
+            state.success += ALPHA * (1 - state.success)
+            state.failures = 0
+            state.opens = 0
+            state.open_until = 0
+            state.probe = 0
+        self.save()
+
+    def failure(self, proxy: str, latency: float = None):
+        """неудачный запрос, latency - если ответ все таки был но слишком медленный"""
+        remove = False
+        with self.lock:
+            state = self.states.get(proxy)
+            if state is None:
+                return
+            if latency is not None:
+                state.latency += ALPHA * (latency - state.latency)
+            state.success -= ALPHA * state.success
+            state.failures += 1
+            # неудачный пробный запрос сразу размыкает снова
+            if state.open_until or state.failures >= FAILURES_TO_OPEN:
+                state.opens += 1
+                state.open_until = time.time() + min(OPEN_TIME * 2 ** (state.opens - 1), MAX_OPEN_TIME)
+                state.probe = 0
+                remove = state.opens >= OPENS_TO_REMOVE
+        if remove:
+            self.remove(proxy)
+        else:
+            self.save()
+
+
+if __name__ == '__main__':
+    import collections
+    import tempfile
+
+    filename = os.path.join(tempfile.mkdtemp(), 'pool.pkl')
+    pool = ProxyPool(filename, pinned = ['pinned'])
+
+    # быстрый, медленный, ненадежный, мертвый и мертвый из конфига
+    latency = {'fast': 1, 'slow': 8, 'flaky': 2, 'dead': None, 'pinned': None}
+    reliability = {'fast': 0.98, 'slow': 0.98, 'flaky': 0.5, 'dead': 0, 'pinned': 0}
+    pool.recreate(list(latency))
+
+    random.seed(1)
+    used = collections.Counter()
+    tries = []
+    for i in range(2000):
+        for n, proxy in enumerate(pool.choose(), start = 1):
+            if random.random() < reliability[proxy]:
+                pool.success(proxy, latency[proxy])
+                used[proxy] += 1
+                tries.append(n)
+                break
+            pool.failure(proxy)
+        if i % 200 == 0:
+            # прошло время, паузы истекли, будут пробные запросы
+            for state in pool.states.values():
+                if state.open_until:
+                    state.open_until = 1
+
+    print('удачных запросов через прокси:', dict(used))
+    print('попыток на запрос в среднем:', round(sum(tries) / len(tries), 2))
+    for proxy in pool:
+        state = pool.states[proxy]
+        print(proxy, round(state.latency, 2), round(state.success, 2), state.opens, bool(state.open_until))
+    assert used['fast'] > used['slow'] > 0
+    assert 'dead' not in pool and 'pinned' in pool
+
+    my_dic.FLUSHER.flush_all()
+    assert set(ProxyPool(filename)) == set(pool)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# Ограничители частоты запросов (token bucket).
+# Ведро на capacity токенов пополняется со скоростью rate токенов в секунду,
+# каждый запрос забирает токен, если токенов нет то запрос надо отложить.
+
+
+import re
+import threading
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        rate - сколько запросов в секунду в среднем
+        capacity - сколько запросов можно сделать подряд без ожидания, по умолчанию rate
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        # до этого момента запросы делать нельзя совсем (сервер ответил retry_after)
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, tokens: float = 1) -> float:
+        """сколько секунд ждать пока наберется tokens токенов, 0 если уже можно"""
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            wait = max(0, self.blocked_until - now)
+            if self.tokens < tokens:
+                wait = max(wait, (tokens - self.tokens) / self.rate)
+            return wait
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        """забирает токены если они есть, не ждет"""
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            if now < self.blocked_until or self.tokens < tokens:
+                return False
+            self.tokens -= tokens
+            return True
+
+    def acquire(self, tokens: float = 1):
+        """ждет пока не наберется нужное количество токенов и забирает их"""
+        while not self.try_acquire(tokens):
+            time.sleep(max(0.01, self.delay(tokens)))
+
+    def block(self, seconds: float):
+        """сервер попросил подождать (429 retry_after), до этого времени токены не выдаются"""
+        with self.lock:
+            now = time.monotonic()
+            self.blocked_until = max(self.blocked_until, now + seconds)
+            self.tokens = 0
+            self.updated = max(self.updated, now)
+
+
+def retry_after(error: Exception) -> int:
+    """сколько секунд просит подождать телеграм в ответе 429, 0 если это другая ошибка"""
+    if getattr(error, 'error_code', None) == 429:
+        try:
+            return int(error.result_json['parameters']['retry_after'])
+        except Exception:
+            pass
+    match = re.search(r'Too Many Requests: retry after\s+(\d+)', str(error))
+    if match:
+        return int(match.group(1))
+    return 5 if getattr(error, 'error_code', None) == 429 else 0
+
+
+if __name__ == '__main__':
+    bucket = TokenBucket(rate=10, capacity=5)
+    start = time.monotonic()
+    for _ in range(25):
+        bucket.acquire()
+    # 5 сразу и еще 20 со скоростью 10 в секунду
+    print(f'25 tokens in {time.monotonic() - start:.2f}s (expected ~2.0s)')
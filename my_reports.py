@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# Индекс отчетов log_report для /export.
+# Каждый отчет кроме файла logs/<user_id>.log пишется строкой в sqlite (db/reports.db)
+# с индексами по времени и юзеру, так что экспорт читает только нужные записи, а не
+# разбирает все логи заново. Старые логи, которые были записаны до появления индекса,
+# разбираются один раз при запуске бота, до первой записи в лог. Позже нельзя: логи больше
+# LOG_MAX_SIZE my_log переименовывает и сжимает, и их старые записи пропали бы из индекса.
+#
+# python my_reports.py import - разобрать старые логи без запуска бота
+
+
+import datetime
+import glob
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+import openpyxl
+
+import my_dialogs
+import my_log
+
+
+DB_PATH = 'db/reports.db'
+
+# сколько отчетов вставлять в базу одной транзакцией
+BATCH_SIZE = 500
+
+# сколько символов запроса и ответа попадает в таблицу экспорта
+EXPORT_TEXT_LEN = 20
+
+SEPARATOR = '=' * 40
+SEPARATOR2 = '-' * 40
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS reports (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    user_id INTEGER NOT NULL,
+    chat_id_full TEXT NOT NULL,
+    request TEXT NOT NULL,
+    response TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reports_time ON reports (time);
+CREATE INDEX IF NOT EXISTS reports_user_time ON reports (user_id, time);
+
+-- старые логи которые уже разобраны, дальше в них пишутся только записи которые и так есть в индексе
+CREATE TABLE IF NOT EXISTS imported (
+    path TEXT PRIMARY KEY
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+) WITHOUT ROWID;
+'''
+
+
+POOL = None
+POOL_LOCK = threading.Lock()
+
+
+def get_pool() -> my_dialogs.ConnectionPool:
+    global POOL
+    with POOL_LOCK:
+        if POOL is None:
+            POOL = my_dialogs.ConnectionPool(DB_PATH, schema=SCHEMA)
+            with POOL.transaction() as conn:
+                # все отчеты после этого момента пишутся в индекс сразу,
+                # из старых логов надо брать только то что было раньше
+                conn.execute('INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)', ('started', str(time.time())))
+    return POOL
+
+
+def started() -> float:
+    with get_pool().connection() as conn:
+        return float(conn.execute("SELECT value FROM meta WHERE key = 'started'").fetchone()[0])
+
+
+class Indexer:
+    """Пишет отчеты в базу из фонового потока пачками, log_report его не ждет."""
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def add(self, time_: float, user_id: int, chat_id_full: str, request: str, response: str):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='reports', daemon=True)
+                self.thread.start()
+        self.queue.put((time_, user_id, chat_id_full, request, response))
+
+    def flush(self, timeout: float = 5):
+        """ждет пока все добавленные отчеты попадут в базу"""
+        if self.thread is None:
+            return
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait(timeout)
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            rows = [x for x in batch if isinstance(x, tuple)]
+            try:
+                if rows:
+                    with get_pool().transaction() as conn:
+                        conn.executemany('INSERT INTO reports (time, user_id, chat_id_full, request, response) VALUES (?, ?, ?, ?, ?)', rows)
+            except Exception as unknown:
+                error_traceback = traceback.format_exc()
+                my_log.log2(f'my_reports:run: {unknown}\n\n{error_traceback}')
+            for x in batch:
+                if isinstance(x, threading.Event):
+                    x.set()
+
+
+INDEXER = Indexer()
+
+
+def add(time_: float, user_id: int, chat_id_full: str, request: str, response: str):
+    INDEXER.add(time_, user_id, chat_id_full, request, response)
+
+
+def parse_log(path: str):
+    """читает старый лог logs/<user_id>.log.
+    Выдает записи (time, chat_id_full, request, response), недописанная в конце запись пропускается.
+    """
+    with open(path, 'rb') as f:
+        lines = None
+        for line in f:
+            line = line.decode('utf-8', errors='replace').rstrip('\n')
+            if line == SEPARATOR:
+                if lines is None:
+                    lines = []
+                    continue
+                if len(lines) >= 4:
+                    request, response, stage = [], [], 0
+                    for l in lines[4:]:
+                        if l == SEPARATOR2:
+                            stage += 1
+                            continue
+                        (request if stage == 0 else response).append(l)
+                    try:
+                        yield float(lines[0]), lines[2], '\n'.join(request).strip(), '\n'.join(response).strip()
+                    except ValueError:
+                        pass
+                lines = None
+            elif lines is not None:
+                lines.append(line)
+
+
+def import_legacy():
+    """дописывает в индекс записи из старых логов, вызывается при запуске бота до первого log_report.
+    Разобранный файл больше не читается, все что в него пишется после запуска уже есть в индексе.
+    """
+    start = started()
+    files = []
+    for path in glob.glob('logs/*.log'):
+        path = path.replace('\\', '/')
+        try:
+            user_id = int(os.path.basename(path).split('.', maxsplit=1)[0])
+        except ValueError:
+            continue
+        files.append((path, user_id))
+
+    with get_pool().connection() as conn:
+        imported = {x[0] for x in conn.execute('SELECT path FROM imported')}
+
+    for path, user_id in files:
+        if path in imported:
+            continue
+        try:
+            rows = []
+            for record in parse_log(path):
+                if record[0] >= start:
+                    break
+                rows.append((record[0], user_id) + record[1:])
+            with get_pool().transaction() as conn:
+                conn.executemany('INSERT INTO reports (time, user_id, chat_id_full, request, response) VALUES (?, ?, ?, ?, ?)', rows)
+                conn.execute('INSERT OR IGNORE INTO imported (path) VALUES (?)', (path,))
+        except Exception as unknown:
+            error_traceback = traceback.format_exc()
+            my_log.log2(f'my_reports:import_legacy: {path} {unknown}\n\n{error_traceback}')
+
+
+def query(date_from: float = None, date_to: float = None, user_id: int = None):
+    """отчеты за период [date_from, date_to) и/или одного юзера, по порядку времени.
+    Генератор, записи читаются из базы по мере надобности.
+    """
+    sql = 'SELECT time, user_id, chat_id_full, request, response FROM reports'
+    where, params = [], []
+    if user_id is not None:
+        where.append('user_id = ?')
+        params.append(user_id)
+    if date_from is not None:
+        where.append('time >= ?')
+        params.append(date_from)
+    if date_to is not None:
+        where.append('time < ?')
+        params.append(date_to)
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY time'
+    with get_pool().connection() as conn:
+        for row in conn.execute(sql, params):
+            yield row
+
+
+def export(date_from: float = None, date_to: float = None, user_id: int = None) -> tuple:
+    """пишет отчеты в xlsx во временный файл, возвращает (путь к файлу, сколько записей).
+    Файл удаляет вызывающий.
+    """
+    INDEXER.flush()
+
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(['chat_id_full', 'user_id', 'date_time_str', 'user_request', 'bot_response', 'date', 'chat_id', 'thread_id'])
+    n = 0
+    for time_, user_id_, chat_id_full, request, response in query(date_from, date_to, user_id):
+        try:
+            chat_id, thread_id = chat_id_full.replace('[', '').replace(']', '').split(' ')
+        except ValueError:
+            chat_id, thread_id = chat_id_full, ''
+        sheet.append([chat_id_full,
+                      str(user_id_),
+                      datetime.datetime.fromtimestamp(time_).strftime('%d-%m-%Y %H:%M:%S'),
+                      request[:EXPORT_TEXT_LEN],
+                      response[:EXPORT_TEXT_LEN],
+                      datetime.datetime.utcfromtimestamp(time_),
+                      chat_id,
+                      thread_id])
+        n += 1
+
+    fd, path = tempfile.mkstemp(prefix='export_', suffix='.xlsx')
+    os.close(fd)
+    try:
+        workbook.save(path)
+    except:
+        os.remove(path)
+        raise
+    return path, n
+
+
+def parse_export_args(args: list) -> tuple:
+    """разбирает аргументы /export: даты ГГГГ-ММ-ДД (с какой и по какую включительно) и id юзера
+    /export 2024-01-01 2024-01-31 123456
+    возвращает (date_from, date_to, user_id), ValueError если аргумент непонятный
+    """
+    dates = []
+    user_id = None
+    for arg in args:
+        if arg.lstrip('-').isdigit():
+            user_id = int(arg)
+        else:
+            dates.append(datetime.datetime.strptime(arg, '%Y-%m-%d'))
+    if len(dates) > 2:
+        raise ValueError('too many dates')
+    date_from = dates[0].timestamp() if dates else None
+    date_to = (dates[1] + datetime.timedelta(days=1)).timestamp() if len(dates) == 2 else None
+    return date_from, date_to, user_id
+
+
+if __name__ == '__main__':
+    if 'import' in sys.argv:
+        import_legacy()
+    else:
+        DB_PATH = os.path.join(tempfile.mkdtemp(), 'reports.db')
+        os.makedirs('logs', exist_ok=True)
+        # старый лог из двух записей, вторая уже после запуска индекса и должна быть пропущена
+        with open('logs/999000111.log', 'w', encoding='utf-8') as f:
+            for t, text in ((time.time() - 100, 'старый запрос'), (time.time() + 100, 'новый запрос')):
+                f.write(f'{SEPARATOR}\n{t}\n-\n[999000111] [0]\n{SEPARATOR2}\n{text}\n{SEPARATOR2}\nответ\n{SEPARATOR}\n')
+        import_legacy()
+        add(time.time(), 999000111, '[999000111] [0]', 'запрос из индекса', 'ответ')
+        path, n = export(user_id=999000111)
+        os.remove('logs/999000111.log')
+        rows = list(openpyxl.load_workbook(path).active.values)
+        os.remove(path)
+        for row in rows:
+            print(row)
+        assert [x[3] for x in rows[1:]] == ['старый запрос', 'запрос из индекса'], rows
+        # повторный импорт ничего не добавляет
+        import_legacy()
+        assert len(list(query(user_id=999000111))) == 2
@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+# Общий вход для разовых запросов к LLM через любого из провайдеров (gemini, groq, openai, haiku, shadowjourney).
+# Раньше каждый модуль сам перебирал провайдеров по очереди, и медленный первый провайдер
+# съедал весь свой таймаут прежде чем дело доходило до следующего. Здесь у каждого провайдера
+# и модели живая гистограмма времени ответов и ошибок, провайдеры пробуются от самого быстрого
+# и надежного, а если первый не ответил за свой p95 то параллельно запускается запрос ко второму
+# (hedged request). Берется первый непустой ответ, остальные отменяются. Поток который уже
+# выполняет запрос убить нельзя, его ответ просто выбрасывается, но время и токены которые
+# он потратил записываются в статистику провайдера.
+#
+# text, provider = my_router.complete([{'role': 'user', 'content': '...'}],
+#                                     {'providers': ['gemini', 'groq-mixtral', 'groq-llama'], 'timeout': 120})
+# if text:
+#     text += f'\n\n--\n[{provider.label}]'
+
+
+import bisect
+import concurrent.futures
+import math
+import threading
+import time
+import traceback
+
+import cfg
+import gpt_basic
+import gpt_basic_2
+import my_gemini
+import my_groq
+import my_log
+import my_shadowjourney
+import my_tokens
+
+
+# общий таймаут запроса по умолчанию, секунд
+TIMEOUT = 120
+
+# сколько провайдеров могут одновременно работать над одним запросом
+MAX_PARALLEL = 2
+
+# через сколько запускать второй запрос если у первого еще нет статистики, и не раньше чем
+DEFAULT_HEDGE_DELAY = 20
+MIN_HEDGE_DELAY = 1
+
+# после скольких ответов статистике можно верить
+MIN_SAMPLES = 5
+
+# границы корзин гистограммы времени ответа, секунд, от 0.05 до ~300 с шагом 25%
+BUCKETS = tuple(0.05 * 1.25 ** i for i in range(40))
+
+# на сколько уменьшаются старые замеры с каждым новым, старые постепенно забываются
+DECAY = 0.98
+
+
+class Stats:
+    """гистограммы времени удачных и неудачных ответов одного провайдера, с затуханием"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ok = [0.0] * (len(BUCKETS) + 1)
+        self.failed = [0.0] * (len(BUCKETS) + 1)
+        self.requests = 0
+        # ответы которые пришли после того как их отменили
+        self.cancelled = 0
+        self.wasted_seconds = 0.0
+        self.wasted_tokens = 0
+
+    def record(self, latency: float, ok: bool):
+        with self.lock:
+            self.ok = [x * DECAY for x in self.ok]
+            self.failed = [x * DECAY for x in self.failed]
+            (self.ok if ok else self.failed)[bisect.bisect_left(BUCKETS, latency)] += 1
+            self.requests += 1
+
+    def waste(self, latency: float, tokens: int):
+        with self.lock:
+            self.cancelled += 1
+            self.wasted_seconds += latency
+            self.wasted_tokens += tokens
+
+    def percentile(self, q: float) -> float:
+        """время ответа которое не превышают q удачных ответов, None если замеров мало"""
+        with self.lock:
+            if self.requests < MIN_SAMPLES or not sum(self.ok):
+                return None
+            need = sum(self.ok) * q
+            lower = 0
+            for i, count in enumerate(self.ok):
+                upper = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1] * 2
+                if count >= need:
+                    # внутри корзины считаем замеры распределенными равномерно
+                    return lower + (upper - lower) * need / count
+                need -= count
+                lower = upper
+            return lower
+
+    def error_rate(self) -> float:
+        with self.lock:
+            total = sum(self.ok) + sum(self.failed)
+            return sum(self.failed) / total if total else 0.0
+
+    def summary(self) -> dict:
+        return {'p50': self.percentile(0.5), 'p95': self.percentile(0.95),
+                'errors': round(self.error_rate(), 2), 'requests': self.requests,
+                'cancelled': self.cancelled, 'wasted_seconds': round(self.wasted_seconds, 1),
+                'wasted_tokens': self.wasted_tokens}
+
+
+class Provider:
+    def __init__(self, name: str, label: str, model: str, func, max_chars: int, available = lambda: True):
+        """
+        name - имя для constraints['providers']
+        label - как подписывать ответ
+        func(messages, model, temperature, max_tokens, timeout) -> str
+        max_chars - сколько символов запроса провайдер принимает, длинный запрос обрезается с конца,
+                    число или функция (лимиты из модулей читаются при запросе, их импорт тут может быть еще не закончен)
+        available() - настроен ли провайдер (есть ли ключи в конфиге)
+        """
+        self.name = name
+        self.label = label
+        self.model = model
+        self.func = func
+        self._max_chars = max_chars
+        self.available = available
+        self.stats = Stats()
+
+    @property
+    def max_chars(self) -> int:
+        return self._max_chars() if callable(self._max_chars) else self._max_chars
+
+    def score(self) -> float:
+        """ожидаемое время до удачного ответа, None если статистики еще нет"""
+        if self.stats.requests < MIN_SAMPLES:
+            return None
+        p50 = self.stats.percentile(0.5)
+        if p50 is None:
+            # ни одного удачного ответа
+            return math.inf
+        return p50 / max(1 - self.stats.error_rate(), 0.05)
+
+    def hedge_delay(self) -> float:
+        """через сколько секунд без ответа запускать запрос к следующему провайдеру"""
+        p95 = self.stats.percentile(0.95)
+        if p95 is None:
+            return DEFAULT_HEDGE_DELAY
+        return max(p95, MIN_HEDGE_DELAY)
+
+
+def to_gemini(messages: list):
+    """сообщения в формате openai -> (запрос, история) для my_gemini.ai, system приклеивается к первому запросу"""
+    system = '\n\n'.join(x['content'] for x in messages if x['role'] == 'system')
+    messages = [x for x in messages if x['role'] != 'system']
+    mem = [{'role': 'model' if x['role'] == 'assistant' else 'user', 'parts': [{'text': x['content']}]}
+           for x in messages[:-1]]
+    q = messages[-1]['content'] if messages else ''
+    if system:
+        if mem:
+            mem[0]['parts'][0]['text'] = f"{system}\n\n{mem[0]['parts'][0]['text']}"
+        else:
+            q = f'{system}\n\n{q}'
+    return q, mem
+
+
+def gemini(messages, model, temperature, max_tokens, timeout) -> str:
+    q, mem = to_gemini(messages)
+    return my_gemini.ai(q, mem, temperature, model=model)
+
+
+def groq(messages, model, temperature, max_tokens, timeout) -> str:
+    return my_groq.ai(mem_=messages, temperature=temperature, model_=model, max_tokens_=max_tokens, timeout=timeout)
+
+
+def openai(messages, model, temperature, max_tokens, timeout) -> str:
+    return gpt_basic.ai(messages=messages, temp=temperature, max_tok=max_tokens, timeou=timeout, model_to_use=model)
+
+
+def haiku(messages, model, temperature, max_tokens, timeout) -> str:
+    return gpt_basic_2.ai(messages=messages, temp=temperature, max_tok=max_tokens, timeou=timeout)
+
+
+def shadowjourney(messages, model, temperature, max_tokens, timeout) -> str:
+    return my_shadowjourney.ai(mem=messages, model=model, temperature=temperature, max_tokens=max_tokens, timeout=timeout)
+
+
+# в порядке предпочтения, пока статистики нет провайдеры пробуются в этом порядке
+PROVIDERS = [
+    Provider('gemini', 'Gemini Pro Flash', 'gemini-1.5-flash-latest', gemini, lambda: my_gemini.MAX_SUM_REQUEST,
+             lambda: bool(getattr(cfg, 'gemini_keys', None) or my_gemini.ALL_KEYS)),
+    Provider('groq-mixtral', 'Mixtral-8x7b-32768 [Groq]', 'mixtral-8x7b-32768', groq, 32000,
+             lambda: bool(getattr(cfg, 'GROQ_API_KEY', None))),
+    Provider('groq-llama', 'Llama 3.1 70b [Groq]', 'llama-3.1-70b-versatile', groq, lambda: my_groq.MAX_QUERY_LENGTH,
+             lambda: bool(getattr(cfg, 'GROQ_API_KEY', None))),
+    Provider('openai', 'GPT', '', openai, 12000,
+             lambda: bool(getattr(cfg, 'openai_servers', None))),
+    Provider('haiku', 'Claude 3 Haiku', 'anthropic/claude-3-haiku', haiku, 12000,
+             lambda: bool(getattr(cfg, 'openai_servers', None))),
+    Provider('shadowjourney', 'GPT-4o [ShadowJourney]', 'gpt-4o', shadowjourney, 12000,
+             lambda: bool(getattr(cfg, 'SHADOWJOURNEY', None))),
+]
+
+
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=32, thread_name_prefix='my_router')
+
+
+def get_provider(name: str) -> Provider:
+    for provider in PROVIDERS:
+        if provider.name == name:
+            return provider
+    return None
+
+
+def fit(messages: list, max_chars: int) -> list:
+    """обрезает последнее сообщение так что бы все вместе влезло в max_chars символов"""
+    extra = sum(len(x['content']) for x in messages) - max_chars
+    if extra <= 0 or not messages:
+        return messages
+    last = messages[-1]
+    return messages[:-1] + [dict(last, content=last['content'][:max(len(last['content']) - extra, 0)])]
+
+
+def rank(providers: list) -> list:
+    """сначала провайдеры с меньшим ожидаемым временем ответа, без статистики - по порядку после них
+    если их ожидаемое время не лучше DEFAULT_HEDGE_DELAY
+    """
+    def key(x):
+        score = x[1].score()
+        return (DEFAULT_HEDGE_DELAY if score is None else score, x[0])
+    return [x[1] for x in sorted(enumerate(providers), key=key)]
+
+
+class Attempt:
+    """один запрос к одному провайдеру"""
+    def __init__(self, provider: Provider, messages: list):
+        self.provider = provider
+        self.messages = messages
+        self.lock = threading.Lock()
+        self.started = None
+        self.latency = None
+        self.text = ''
+        self.cancelled = False
+
+    def run(self, temperature: float, max_tokens: int, timeout: float) -> str:
+        provider = self.provider
+        self.started = time.monotonic()
+        text = ''
+        try:
+            text = provider.func(self.messages, provider.model, temperature, max_tokens, timeout) or ''
+            if not isinstance(text, str):
+                text = ''
+        except Exception as error:
+            error_traceback = traceback.format_exc()
+            my_log.log2(f'my_router:run: {provider.name} {error}\n\n{error_traceback}', latency = time.monotonic() - self.started)
+        latency = time.monotonic() - self.started
+        provider.stats.record(latency, bool(text.strip()))
+        with self.lock:
+            self.latency = latency
+            self.text = text
+            cancelled = self.cancelled
+        if cancelled:
+            self.waste()
+        return text
+
+    def cancel(self, future: concurrent.futures.Future):
+        """ответ больше не нужен, если запрос уже идет то его цена запишется когда он закончится"""
+        if future.cancel():
+            return
+        with self.lock:
+            self.cancelled = True
+            finished = self.latency is not None
+        if finished:
+            self.waste()
+
+    def waste(self):
+        tokens = my_tokens.count(self.messages, self.provider.model) + my_tokens.text_tokens(self.text, self.provider.model)
+        self.provider.stats.waste(self.latency, tokens)
+
+
+def complete(messages: list, constraints: dict = None):
+    """
+    Запрос к самому быстрому из подходящих провайдеров, с подстраховкой вторым.
+    messages - [{'role': 'system'|'user'|'assistant', 'content': str}, ...]
+    constraints:
+        providers - имена провайдеров которые можно использовать, по умолчанию все настроенные
+        timeout - сколько ждать всего, секунд
+        temperature, max_tokens
+        hedge - False что бы пробовать провайдеров строго по очереди
+    Возвращает (текст ответа, Provider) или ('', None).
+    """
+    constraints = constraints or {}
+    timeout = constraints.get('timeout', TIMEOUT)
+    temperature = constraints.get('temperature', 0.1)
+    max_tokens = constraints.get('max_tokens', 4000)
+    hedge = constraints.get('hedge', True)
+    names = constraints.get('providers')
+    if names:
+        providers = [get_provider(x) for x in names if get_provider(x)]
+    else:
+        providers = PROVIDERS
+    queue = rank([x for x in providers if x.available()])
+
+    deadline = time.monotonic() + timeout
+    # {Future: Attempt}
+    running = {}
+    next_start = 0
+    result = ('', None)
+    while (queue or running) and time.monotonic() < deadline:
+        now = time.monotonic()
+        if queue and (not running or (hedge and len(running) < MAX_PARALLEL and now >= next_start)):
+            provider = queue.pop(0)
+            attempt = Attempt(provider, fit(messages, provider.max_chars))
+            future = EXECUTOR.submit(attempt.run, temperature, max_tokens, max(deadline - now, 1))
+            running[future] = attempt
+            next_start = now + provider.hedge_delay()
+            continue
+
+        wait = deadline - now
+        if queue and hedge and len(running) < MAX_PARALLEL:
+            wait = min(wait, next_start - now)
+        done, _ = concurrent.futures.wait(running, timeout=max(wait, 0),
+                                          return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            attempt = running.pop(future)
+            text = future.result()
+            if text.strip() and not result[1]:
+                result = (text.strip(), attempt.provider)
+        if result[1]:
+            break
+        if done:
+            # провайдер не ответил, следующий запускается сразу не дожидаясь задержки
+            next_start = 0
+
+    for future, attempt in running.items():
+        attempt.cancel(future)
+    return result
+
+
+def stats() -> dict:
+    return {f'{x.name} {x.model}': x.stats.summary() for x in PROVIDERS}
+
+
+if __name__ == '__main__':
+    import random
+
+    # провайдеры-заглушки: быстрый но иногда зависающий, медленный но надежный, сломанный
+    def fake(delays, errors = 0.0):
+        def func(messages, model, temperature, max_tokens, timeout):
+            delay = random.choice(delays)
+            time.sleep(min(delay, timeout))
+            if delay >= timeout or random.random() < errors:
+                return ''
+            return f'{model} answer'
+        return func
+
+    random.seed(1)
+    PROVIDERS[:] = [Provider('fast', 'Fast', 'fast-1', fake([0.05] * 49 + [3]), 1000),
+                    Provider('slow', 'Slow', 'slow-1', fake([0.4]), 1000),
+                    Provider('broken', 'Broken', 'broken-1', fake([0.01], errors = 1), 1000)]
+    DEFAULT_HEDGE_DELAY = 0.2
+    MIN_HEDGE_DELAY = 0.05
+
+    messages = [{'role': 'user', 'content': 'привет ' * 300}]
+    for hedge in (False, True):
+        random.seed(2)
+        for provider in PROVIDERS:
+            provider.stats = Stats()
+        times = []
+        winners = []
+        for _ in range(200):
+            start = time.monotonic()
+            text, provider = complete(messages, {'hedge': hedge, 'timeout': 5})
+            times.append(time.monotonic() - start)
+            winners.append(provider.name if provider else None)
+        times.sort()
+        print(f'hedge={hedge}: p50 {times[100]:.2f}s p95 {times[190]:.2f}s p99 {times[198]:.2f}s max {times[-1]:.2f}s',
+              {x: winners.count(x) for x in set(winners)})
+        if hedge:
+            # зависания быстрого провайдера закрываются медленным, хвост около 0.05 + 0.4
+            assert times[198] < 1 and None not in winners and winners.count('fast') > 160
+        else:
+            assert times[198] >= 3
+
+    time.sleep(3.5)
+    for name, summary in stats().items():
+        print(name, summary)
+    # отмененные зависшие запросы досчитали свою цену
+    assert PROVIDERS[0].stats.cancelled > 0 and PROVIDERS[0].stats.wasted_tokens > 0
+
+    # сломанный провайдер первым в списке: его ошибка сразу запускает следующего,
+    # а после MIN_SAMPLES ошибок он уходит в конец очереди
+    broken = PROVIDERS.pop()
+    PROVIDERS.insert(0, broken)
+    for provider in PROVIDERS:
+        provider.stats = Stats()
+    for _ in range(20):
+        text, provider = complete(messages, {'timeout': 5})
+        assert provider.name != 'broken'
+    print('broken', broken.stats.summary())
+    assert broken.stats.requests == MIN_SAMPLES
+
+    # обрезка длинного запроса под провайдера
+    short = fit([{'role': 'system', 'content': 'x' * 10}, {'role': 'user', 'content': 'y' * 100}], 50)
+    assert sum(len(x['content']) for x in short) == 50 and short[0]['content'] == 'x' * 10
+    assert to_gemini([{'role': 'system', 'content': 's'}, {'role': 'user', 'content': 'q'}]) == ('s\n\nq', [])
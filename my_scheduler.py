@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# Один поток-таймер на всю программу.
+# call_later(delay, func, *args) кладет задачу в кучу по времени срабатывания, поток спит до
+# ближайшей задачи и выполняет ее. Задачи должны быть короткими (поставить в очередь, отправить
+# один запрос), все долгое надо передавать дальше в my_dispatcher.
+
+
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+import my_log
+
+
+# сколько ждать тишины после последнего куска длинного сообщения
+COALESCE_DELAY = 0.5
+
+# дольше этого не собирать куски даже если они продолжают приходить
+COALESCE_MAX_DELAY = 5
+
+
+class Timer:
+    """то что возвращает call_later, можно отменить пока не сработало"""
+    def __init__(self, when: float, func, args: tuple, kwargs: dict):
+        self.when = when
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    def __init__(self):
+        self.cond = threading.Condition()
+        # [(when, n, timer), ...], n нужен что бы не сравнивать таймеры с одинаковым временем
+        self.heap = []
+        self.counter = itertools.count()
+        self.thread = None
+
+    def call_at(self, when: float, func, *args, **kwargs) -> Timer:
+        timer = Timer(when, func, args, kwargs)
+        with self.cond:
+            heapq.heappush(self.heap, (when, next(self.counter), timer))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='scheduler', daemon=True)
+                self.thread.start()
+            # будим поток только если новая задача стала ближайшей
+            if self.heap[0][2] is timer:
+                self.cond.notify()
+        return timer
+
+    def call_later(self, delay: float, func, *args, **kwargs) -> Timer:
+        return self.call_at(time.time() + delay, func, *args, **kwargs)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    delay = self.heap[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    self.cond.wait(delay)
+                timer = heapq.heappop(self.heap)[2]
+            if timer.cancelled:
+                continue
+            try:
+                timer.func(*timer.args, **timer.kwargs)
+            except Exception as unknown:
+                error_traceback = traceback.format_exc()
+                my_log.log2(f'my_scheduler:run: {getattr(timer.func, "__name__", timer.func)}: {unknown}\n\n{error_traceback}')
+
+
+SCHEDULER = Scheduler()
+
+
+def call_later(delay: float, func, *args, **kwargs) -> Timer:
+    return SCHEDULER.call_later(delay, func, *args, **kwargs)
+
+
+def call_at(when: float, func, *args, **kwargs) -> Timer:
+    return SCHEDULER.call_at(when, func, *args, **kwargs)
+
+
+class Coalescer:
+    """Собирает куски длинных сообщений которые телеграм присылает по отдельности.
+    add(key, item) дописывает кусок в буфер ключа, когда по ключу delay секунд ничего
+    не приходит (но не дольше max_delay от первого куска) вызывается callback(key, items)
+    из потока планировщика. Пока идет ожидание ни один поток не занят.
+    """
+    def __init__(self, callback, delay: float = COALESCE_DELAY, max_delay: float = COALESCE_MAX_DELAY,
+                 scheduler: Scheduler = None):
+        self.callback = callback
+        self.delay = delay
+        self.max_delay = max_delay
+        self.scheduler = scheduler or SCHEDULER
+        self.lock = threading.Lock()
+        # {key: [items, first_time, deadline]}
+        self.buffers = {}
+
+    def add(self, key, item):
+        now = time.time()
+        with self.lock:
+            buffer = self.buffers.get(key)
+            if buffer:
+                buffer[0].append(item)
+                buffer[2] = min(now + self.delay, buffer[1] + self.max_delay)
+                # таймер уже стоит, он сам перенесется на новый deadline когда сработает
+                return
+            self.buffers[key] = [[item], now, now + self.delay]
+        self.scheduler.call_at(now + self.delay, self.fire, key)
+
+    def fire(self, key):
+        with self.lock:
+            buffer = self.buffers.get(key)
+            if not buffer:
+                return
+            deadline = buffer[2]
+            if deadline > time.time():
+                self.scheduler.call_at(deadline, self.fire, key)
+                return
+            del self.buffers[key]
+        self.callback(key, buffer[0])
+
+
+if __name__ == '__main__':
+    results = []
+    coalescer = Coalescer(lambda key, items: results.append((key, items)), delay=0.2)
+    for i in range(5):
+        coalescer.add('chat', f'part{i}')
+        time.sleep(0.05)
+    coalescer.add('other', 'single')
+    time.sleep(0.5)
+    print(results)
+    assert sorted(results) == [('chat', ['part0', 'part1', 'part2', 'part3', 'part4']), ('other', ['single'])]
+
+    order = []
+    call_later(0.2, order.append, 2)
+    call_later(0.1, order.append, 1)
+    call_later(0.05, order.append, 0).cancel()
+    time.sleep(0.3)
+    assert order == [1, 2], order
+    print('ok')
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# Очередь исходящих сообщений телеграма.
+# Лимиты телеграма соблюдаются заранее а не после ошибки 429: в личку не чаще ~1 сообщения
+# в секунду, в группу не больше 20 в минуту, на всех вместе не больше 30 в секунду.
+# У каждого чата своя очередь, сообщения одного чата уходят строго по порядку, одно за другим,
+# разные чаты отправляются параллельно. send() возвращает Future, можно дождаться доставки
+# через .result() а можно не ждать. retry_after из ответа 429 тормозит ведро чата.
+
+
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import threading
+import time
+
+import my_log
+import my_ratelimit
+
+
+# общий лимит бота, сообщений в секунду
+GLOBAL_RATE = 30
+
+# личные чаты, сообщений в секунду и сколько можно отправить подряд
+PRIVATE_RATE = 1
+PRIVATE_BURST = 3
+
+# группы, 20 сообщений в минуту
+GROUP_RATE = 20 / 60
+GROUP_BURST = 3
+
+# сколько потоков одновременно делают запросы к телеграму
+WORKERS = 8
+
+# сколько раз повторять сообщение после 429
+MAX_RETRIES = 3
+
+# когда ведер чатов становится столько, полные ведра молчащих чатов выбрасываются
+BUCKETS_SWEEP = 10000
+
+
+class Sender:
+    def __init__(self, bot, workers: int = WORKERS):
+        self.bot = bot
+        self.workers = workers
+        self.global_bucket = my_ratelimit.TokenBucket(GLOBAL_RATE)
+        # {chat_id: TokenBucket}, только чаты которые недавно что то отправляли
+        self.buckets = {}
+        self.sweep_at = BUCKETS_SWEEP
+        # {chat_id: deque([(future, func, args, kwargs, fallback, retries), ...])}
+        self.queues = {}
+        # [(when, n, chat_id), ...] чаты у которых есть что отправить и никто сейчас не отправляет
+        self.ready = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.threads = []
+
+    def bucket(self, chat_id: int) -> my_ratelimit.TokenBucket:
+        """ведро чата, новое ведро создается только под self.cond"""
+        if chat_id not in self.buckets:
+            if len(self.buckets) >= self.sweep_at:
+                self.sweep()
+            if chat_id > 0:
+                self.buckets[chat_id] = my_ratelimit.TokenBucket(PRIVATE_RATE, PRIVATE_BURST)
+            else:
+                self.buckets[chat_id] = my_ratelimit.TokenBucket(GROUP_RATE, GROUP_BURST)
+        return self.buckets[chat_id]
+
+    def sweep(self):
+        """выбрасывает ведра чатов у которых нет очереди и ведро полное, вызывать под self.cond.
+        Полное ведро ничем не отличается от нового, так что лимиты чата от этого не меняются"""
+        for chat_id, bucket in list(self.buckets.items()):
+            if chat_id not in self.queues and not bucket.delay(bucket.capacity):
+                del self.buckets[chat_id]
+        # следующая чистка когда ведер станет вдвое больше, иначе при большом числе активных чатов
+        # чистка шла бы на каждое новое ведро
+        self.sweep_at = max(BUCKETS_SWEEP, len(self.buckets) * 2)
+
+    def send(self, chat_id: int, func, *args, fallback: dict = None, **kwargs) -> concurrent.futures.Future:
+        """
+        ставит в очередь чата вызов func(*args, **kwargs), например bot.send_message или bot.reply_to
+        fallback - если вызов упал не из-за 429 то повторить его один раз с этими kwargs
+                   (например {'parse_mode': ''} если телеграм не принял html)
+        """
+        future = concurrent.futures.Future()
+        with self.cond:
+            if not self.threads:
+                for i in range(self.workers):
+                    thread = threading.Thread(target=self.worker, name=f'sender-{i}', daemon=True)
+                    thread.start()
+                    self.threads.append(thread)
+            if chat_id not in self.queues:
+                self.queues[chat_id] = collections.deque()
+                heapq.heappush(self.ready, (0, next(self.counter), chat_id))
+                self.cond.notify()
+            self.queues[chat_id].append([future, func, args, kwargs, fallback, 0])
+        return future
+
+    def next_item(self):
+        """ждет чат которому можно отправить следующее сообщение, возвращает (chat_id, item)"""
+        with self.cond:
+            while True:
+                if not self.ready:
+                    self.cond.wait()
+                    continue
+                when, _, chat_id = self.ready[0]
+                wait = max(when - time.monotonic(), self.global_bucket.delay())
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+                heapq.heappop(self.ready)
+                bucket = self.bucket(chat_id)
+                if not bucket.try_acquire():
+                    heapq.heappush(self.ready, (time.monotonic() + bucket.delay(), next(self.counter), chat_id))
+                    continue
+                if not self.global_bucket.try_acquire():
+                    # токен чата уже потрачен, но это не страшно, просто следующее сообщение чата уйдет чуть позже
+                    heapq.heappush(self.ready, (0, next(self.counter), chat_id))
+                    continue
+                return chat_id, self.queues[chat_id][0]
+
+    def worker(self):
+        while True:
+            chat_id, item = self.next_item()
+            future, func, args, kwargs, fallback, retries = item
+            done = True
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as error:
+                wait = my_ratelimit.retry_after(error)
+                if wait and retries < MAX_RETRIES:
+                    # сообщение остается первым в очереди чата и уйдет когда телеграм разрешит
+                    self.bucket(chat_id).block(wait)
+                    item[5] += 1
+                    done = False
+                elif fallback is not None and not wait:
+                    try:
+                        future.set_result(func(*args, **dict(kwargs, **fallback)))
+                    except Exception as error2:
+                        future.set_exception(error2)
+                else:
+                    future.set_exception(error)
+                if done and future.exception():
+                    my_log.log2(f'my_sender:worker: {chat_id} {getattr(func, "__name__", func)}: {future.exception()}')
+            with self.cond:
+                queue = self.queues[chat_id]
+                if done:
+                    queue.popleft()
+                if queue:
+                    heapq.heappush(self.ready, (time.monotonic() + self.bucket(chat_id).delay(), next(self.counter), chat_id))
+                    self.cond.notify()
+                else:
+                    del self.queues[chat_id]
+
+
+# {id(bot): Sender}
+SENDERS = {}
+SENDERS_LOCK = threading.Lock()
+
+
+def get(bot) -> Sender:
+    """очередь отправки для этого бота, одна на весь процесс"""
+    with SENDERS_LOCK:
+        if id(bot) not in SENDERS:
+            SENDERS[id(bot)] = Sender(bot)
+        return SENDERS[id(bot)]
+
+
+if __name__ == '__main__':
+    class TooManyRequests(Exception):
+        error_code = 429
+        result_json = {'parameters': {'retry_after': 1}}
+
+    class FakeBot:
+        def __init__(self):
+            self.sent = []
+            self.failed_once = False
+
+        def send_message(self, chat_id, text, parse_mode = None):
+            if text == 'private 5' and not self.failed_once:
+                self.failed_once = True
+                raise TooManyRequests('Too Many Requests: retry after 1')
+            if parse_mode == 'HTML' and '<' in text:
+                raise ValueError("Bad Request: can't parse entities")
+            self.sent.append((round(time.monotonic() - start, 1), chat_id, text, parse_mode))
+
+    bot = FakeBot()
+    sender = get(bot)
+    start = time.monotonic()
+    futures = [sender.send(1, bot.send_message, 1, f'private {i}') for i in range(8)]
+    futures += [sender.send(-100, bot.send_message, -100, f'group {i}') for i in range(4)]
+    futures.append(sender.send(2, bot.send_message, 2, '<b', parse_mode='HTML', fallback={'parse_mode': ''}))
+    for future in futures:
+        future.result()
+    for x in bot.sent:
+        print(x)
+    assert [x[2] for x in bot.sent if x[1] == 1] == [f'private {i}' for i in range(8)]
+
+    # ведра чатов которые давно ничего не отправляли не копятся
+    for chat_id in range(1000, 1050):
+        sender.send(chat_id, bot.send_message, chat_id, 'x').result()
+    time.sleep(PRIVATE_BURST / PRIVATE_RATE)
+    sender.sweep_at = len(sender.buckets)
+    sender.send(2000, bot.send_message, 2000, 'x').result()
+    print(f'ведер после чистки: {len(sender.buckets)}')
+    assert 1000 not in sender.buckets and len(sender.buckets) < 50
@@ -2,15 +2,17 @@
 
 import json
 import random
-import requests
 import threading
 import traceback
 
 import langcodes
-from sqlitedict import SqliteDict
 
 import cfg
+import my_dialogs
+import my_history
+import my_http
 import my_log
+import my_tokens
 
 
 # сколько запросов хранить
@@ -27,7 +29,7 @@ MAX_REQUEST = 10000
 MAX_SUM_REQUEST = 12000
 
 # хранилище диалогов {id:list(mem)}
-CHATS = SqliteDict('db/shadow_dialogs.db', autocommit=True)
+CHATS = my_dialogs.Dialogs('shadowjourney')
 
 
 # {user_id:bool} в каких чатах добавлять разблокировку цензуры
@@ -43,21 +45,11 @@ MEM_UNCENSORED = [
 
 
 def clear_mem(mem, user_id: str):
-    while 1:
-        sizeofmem = count_tokens(mem)
-        if sizeofmem <= maxhistchars:
-            break
-        try:
-            mem = mem[2:]
-        except IndexError:
-            mem = []
-            break
-
-    return mem[-maxhistlines*2:]
+    return my_history.trim(mem, maxhistchars, maxhistlines*2)
 
 
-def count_tokens(mem) -> int:
-    return sum([len(m['content']) for m in mem])
+def count_tokens(mem, model: str = 'gpt-4o') -> int:
+    return my_tokens.count(mem, model)
 
 
 def ai(prompt: str = '',
@@ -107,7 +99,7 @@ def ai(prompt: str = '',
             "temperature": temperature,
         }
 
-        response = requests.post(url, headers=headers, json=data, timeout=timeout)
+        response = my_http.post(url, headers=headers, json=data, timeout=timeout)
 
         status = response.status_code
         if status == 200:
@@ -124,7 +116,7 @@ def ai(prompt: str = '',
                         "messages": mem_[-2:],
                         "temperature": temperature,
                     }
-                    response = requests.post(url, headers=headers, json=data, timeout=timeout)
+                    response = my_http.post(url, headers=headers, json=data, timeout=timeout)
 
                     status = response.status_code
                     if status == 200:
@@ -149,26 +141,14 @@ def ai(prompt: str = '',
     return ''
 
 
-def update_mem(query: str, resp: str, chat_id: str):
-    if chat_id not in CHATS:
-        CHATS[chat_id] = []
-    mem = CHATS[chat_id]
-    mem += [{'role': 'user', 'content': query}]
-    mem += [{'role': 'assistant', 'content': resp}]
-    mem = clear_mem(mem, chat_id)
-
-    mem__ = []
-    try:
-        i = 0
-        while i < len(mem):
-            if i == 0 or mem[i] != mem[i-1]:
-                mem__.append(mem[i])
-            i += 1
-    except Exception as error:
-        error_traceback = traceback.format_exc()
-        my_log.log_shadowjourney(f'my_shadowjourney:update_mem: {error}\n\n{error_traceback}\n\n{query}\n\n{resp}\n\n{mem}')
-
-    CHATS[chat_id] = mem__
+def update_mem(query: str, resp: str, chat_id: str, mem = None):
+    if mem is None:
+        mem = CHATS[chat_id]
+    new_lines = [{'role': 'user', 'content': query}, {'role': 'assistant', 'content': resp}]
+    history = my_history.BoundedHistory(mem, maxhistchars, maxhistlines*2)
+    history.extend(new_lines)
+    CHATS.append(chat_id, new_lines)
+    CHATS.trim(chat_id, history.evicted)
 
 
 def chat(query: str, chat_id: str = '', temperature: float = 0.1, system: str = '') -> str:
@@ -179,15 +159,10 @@ def chat(query: str, chat_id: str = '', temperature: float = 0.1, system: str =
         lock = threading.Lock()
         LOCKS[chat_id] = lock
     with lock:
-        if chat_id not in CHATS:
-            CHATS[chat_id] = []
         mem = CHATS[chat_id]
         text = ai(query, mem, user_id=chat_id, temperature = temperature, system=system)
         if text:
-            mem += [{'role': 'user', 'content': query}]
-            mem += [{'role': 'assistant', 'content': text}]
-            mem = clear_mem(mem, chat_id)
-            CHATS[chat_id] = mem
+            update_mem(query, text, chat_id, mem)
         return text
 
 
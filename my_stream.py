@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# Ответ в телеграм который показывается по мере генерации.
+# Первый кусок ответа сразу уходит сообщением, дальше это сообщение редактируется по мере
+# прихода новых кусков, но не чаще чем раз в EDIT_INTERVAL секунд (в группах реже) и только
+# когда предыдущая правка уже ушла, так что лимиты телеграма не нарушаются и правки не копятся
+# в очереди. Пока ответ идет он показывается простым текстом, в конце сообщение заменяется
+# готовым html, если html не влез в одно сообщение то остальные части уходят следом.
+#
+# reply = StreamReply(bot, SENDER, message)
+# for text in my_gemini.chat_stream(...):
+#     reply.add(text)
+# if not reply.finish(html, reply_markup):
+#     ничего не было показано, отправить ответ обычным способом
+
+
+import threading
+import time
+
+import telebot
+
+import my_log
+import utils
+
+
+# как часто можно править сообщение, секунд
+EDIT_INTERVAL = 1
+GROUP_EDIT_INTERVAL = 3
+
+# сколько символов показывать пока ответ еще идет, дальше только в конце
+MAX_PREVIEW = 3800
+
+# на сколько частей делить готовый html
+CHUNK_SIZE = 3800
+
+
+class StreamReply:
+    def __init__(self, bot, sender, message, interval: float = None):
+        self.bot = bot
+        self.sender = sender
+        self.message = message
+        self.chat_id = message.chat.id
+        if interval is None:
+            interval = EDIT_INTERVAL if self.chat_id > 0 else GROUP_EDIT_INTERVAL
+        self.interval = interval
+        self.text = ''
+        # что сейчас показано
+        self.shown = ''
+        # отправленное сообщение которое правим
+        self.reply = None
+        # Future последней отправки или правки
+        self.pending = None
+        self.last_update = 0
+        self.preview = telebot.types.LinkPreviewOptions(is_disabled=True)
+
+    def add(self, text: str):
+        self.text += text
+        self.update()
+
+    def wait(self):
+        """ждет последнюю отправку, первое сообщение запоминается для правок"""
+        if self.pending is None:
+            return
+        try:
+            result = self.pending.result()
+            if self.reply is None:
+                self.reply = result
+        except Exception as error:
+            my_log.log2(f'my_stream:wait: {error}')
+        self.pending = None
+
+    def update(self):
+        # пока предыдущая правка не ушла новые не ставим, следующая покажет все сразу
+        if self.pending is not None:
+            if not self.pending.done():
+                return
+            self.wait()
+        if time.monotonic() - self.last_update < self.interval:
+            return
+        text = self.text if len(self.text) <= MAX_PREVIEW else self.text[:MAX_PREVIEW] + ' …'
+        if not text.strip() or text == self.shown:
+            return
+        if self.reply is None:
+            if self.shown:
+                # первое сообщение не отправилось
+                return
+            self.pending = self.sender.send(self.chat_id, self.bot.reply_to, self.message, text,
+                                            link_preview_options=self.preview,
+                                            disable_notification=True)
+        else:
+            # chat_id и message_id позиционные, у sender.send свой chat_id
+            self.pending = self.sender.send(self.chat_id, self.bot.edit_message_text, text,
+                                            self.chat_id, self.reply.message_id,
+                                            link_preview_options=self.preview)
+        self.shown = text
+        self.last_update = time.monotonic()
+
+    def finish(self, html: str, reply_markup = None) -> bool:
+        """
+        Заменяет показанный текст готовым html (первая часть правкой, остальные новыми сообщениями).
+        Возвращает False если так ничего и не было показано, тогда ответ надо отправить как обычно.
+        """
+        self.wait()
+        if self.reply is None:
+            return False
+        chunks = utils.split_html(html, CHUNK_SIZE) or [html]
+        futures = []
+        for i, chunk in enumerate(chunks):
+            markup = reply_markup if i == len(chunks) - 1 else None
+            if i == 0:
+                futures.append(self.sender.send(self.chat_id, self.bot.edit_message_text, chunk,
+                                                self.chat_id, self.reply.message_id,
+                                                parse_mode='HTML',
+                                                link_preview_options=self.preview,
+                                                reply_markup=markup,
+                                                fallback={'parse_mode': ''}))
+            else:
+                futures.append(self.sender.send(self.chat_id, self.bot.reply_to, self.message, chunk,
+                                                parse_mode='HTML',
+                                                link_preview_options=self.preview,
+                                                reply_markup=markup,
+                                                disable_notification=True,
+                                                fallback={'parse_mode': ''}))
+        for future in futures:
+            try:
+                future.result()
+            except Exception as error:
+                my_log.log2(f'my_stream:finish: {error}')
+        return True
+
+
+def fake_sse_server(chunks: list, delay: float = 0.1, status: int = 200) -> str:
+    """
+    Локальный сервер который на любой POST отвечает потоком SSE в формате streamGenerateContent
+    (по событию на кусок, с паузой delay между ними). Возвращает адрес сервера,
+    работает в фоновом потоке до конца программы.
+    """
+    import http.server
+    import json
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.send_response(status)
+            if status != 200:
+                body = json.dumps({'error': {'code': status, 'message': 'fake error'}}).encode()
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for chunk in chunks:
+                event = {'candidates': [{'content': {'parts': [{'text': chunk}], 'role': 'model'}, 'index': 0}]}
+                data = f'data: {json.dumps(event)}\r\n\r\n'.encode()
+                self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+                self.wfile.flush()
+                time.sleep(delay)
+            self.wfile.write(b'0\r\n\r\n')
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_address[1]}'
+
+
+if __name__ == '__main__':
+    import my_sender
+
+    class FakeBot:
+        def __init__(self):
+            self.log = []
+            self.messages = {}
+
+        def reply_to(self, message, text, **kwargs):
+            reply = telebot.types.Message(len(self.messages) + 1, None, None, message.chat, 'text', {}, '')
+            self.messages[reply.message_id] = text
+            self.log.append((round(time.monotonic() - start, 1), 'send', reply.message_id, text[-20:], kwargs.get('parse_mode')))
+            return reply
+
+        def edit_message_text(self, text, chat_id, message_id, **kwargs):
+            if kwargs.get('parse_mode') == 'HTML' and text.count('<') != text.count('>'):
+                raise ValueError("Bad Request: can't parse entities")
+            self.messages[message_id] = text
+            self.log.append((round(time.monotonic() - start, 1), 'edit', message_id, text[-20:], kwargs.get('parse_mode')))
+
+    chat = telebot.types.Chat(1, 'private')
+    message = telebot.types.Message(100, None, None, chat, 'text', {}, '')
+
+    bot = FakeBot()
+    sender = my_sender.get(bot)
+    start = time.monotonic()
+    reply = StreamReply(bot, sender, message, interval = 0.5)
+    # 40 кусков по 0.05 секунды, правок должно быть около 2 секунд / 0.5
+    words = [f'слово{i} ' for i in range(40)]
+    for word in words:
+        reply.add(word)
+        time.sleep(0.05)
+    answer = ''.join(words)
+    html = '<b>' + answer + '</b>' + ' длинный хвост' * 400
+    assert reply.finish(html)
+    for x in bot.log:
+        print(x)
+    first = bot.log[0]
+    assert first[0] < 0.2 and first[1] == 'send'
+    edits = [x for x in bot.log if x[1] == 'edit' and x[4] is None]
+    assert 2 <= len(edits) <= 5, edits
+    # последняя правка html, хвост ушел следующими сообщениями
+    assert bot.messages[1].startswith('<b>слово0') and len(bot.messages) > 1
+    assert sum(x.count('длинный хвост') for x in bot.messages.values()) == 400
+
+    # ответ пустой - ничего не показано
+    reply = StreamReply(bot, sender, message)
+    assert not reply.finish('')
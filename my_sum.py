@@ -1,23 +1,36 @@
 #!/usr/bin/env python3
 #pip install lxml[html_clean]
 
-import io
+import concurrent.futures
 import os
 import re
 import sys
 from urllib.parse import urlparse
 from youtube_transcript_api import YouTubeTranscriptApi
 
-import chardet
 # import magic
-import PyPDF2
-import requests
-import trafilatura
 
+import my_fetch
 import my_log
-import my_gemini
-import my_groq
-import utils
+import my_router
+
+
+# текст длиннее пересказывается по частям (map-reduce), это лимит запроса к gemini
+MAX_SINGLE_REQUEST = 150000
+
+# размер части, столько влезает и в gemini и в groq mixtral
+MAP_CHUNK_SIZE = 25000
+
+# на сколько частей делить текст, если текст очень длинный то части крупнее,
+# но не больше чем влезает в запрос, так что у очень длинных текстов частей больше
+MAX_CHUNKS = 8
+
+# сколько частей пересказывать одновременно максимум. Все части одного уровня идут сразу,
+# одной волной, только если их больше (текст длиннее ~4.5 млн символов) то волн несколько
+MAP_CONCURRENCY = 32
+
+# границы по которым делится текст, от лучших к худшим
+SEPARATORS = ('\n\n', '\n', '. ', '! ', '? ', '; ', ', ', ' ')
 
 
 def get_text_from_youtube(url: str) -> str:
@@ -48,6 +61,89 @@ def get_text_from_youtube(url: str) -> str:
     return text.strip() or ''
 
 
+def split_text(text: str, size: int) -> list:
+    """
+    Делит текст на куски не больше size символов по смысловым границам:
+    по абзацам если получается, иначе по строкам, предложениям, словам.
+    Граница ищется в последней трети куска что бы куски не получались слишком мелкими.
+    """
+    chunks = []
+    start = 0
+    while len(text) - start > size:
+        end = start + size
+        window = text[start + size * 2 // 3:end]
+        for separator in SEPARATORS:
+            i = window.rfind(separator)
+            if i != -1:
+                end = start + size * 2 // 3 + i + len(separator)
+                break
+        chunks.append(text[start:end])
+        start = end
+    chunks.append(text[start:])
+    return [x for x in chunks if x.strip()]
+
+
+def chunk_prompt(chunk: str, n: int, total: int, lang: str, query: str) -> str:
+    """запрос на пересказ одной части длинного текста"""
+    if query:
+        task = f'''Extract from this part everything that is needed to answer the request below, keep facts, names and numbers.
+If there is nothing relevant in this part answer only "-".
+
+Request: {query}'''
+    else:
+        task = '''Summarize this part in detail, keep key facts, names, numbers, conclusions and the order of events.'''
+    q = f'''This is part {n} of {total} of a long text.
+{task}
+
+Answer in [{lang}] language.
+
+Part {n}:
+
+{chunk}'''
+    return q
+
+
+def summ_chunk(chunk: str, n: int, total: int, lang: str, query: str, providers: list) -> str:
+    """пересказ одной части длинного текста (map)"""
+    q = chunk_prompt(chunk, n, total, lang, query)
+    r, _ = my_router.complete([{'role': 'user', 'content': q}], {'providers': providers, 'temperature': 0.1})
+    return r
+
+
+def map_reduce(text: str, lang: str = 'ru', query: str = '', max_len: int = MAX_SINGLE_REQUEST) -> str:
+    """
+    Пересказывает все части длинного текста параллельно (все сразу, но не больше MAP_CONCURRENCY,
+    запросы сами расходятся по ключам и провайдерам через my_router) и склеивает пересказы.
+    Если склеенные пересказы все еще длиннее max_len то они пересказываются еще раз.
+    Возвращает текст из пересказов частей, пустую строку если ни одна часть не получилась.
+    """
+    while len(text) > max_len:
+        # обычно частей не больше MAX_CHUNKS, запас 15% на то что куски режутся
+        # по границам абзацев и получаются короче
+        size = max(MAP_CHUNK_SIZE, len(text) * 115 // (100 * MAX_CHUNKS) + 1)
+        # в groq mixtral влезают только небольшие части
+        providers = ['gemini', 'groq-mixtral'] if size <= MAP_CHUNK_SIZE else ['gemini']
+        # часть вместе с заданием должна влезть в запрос целиком, иначе my_router обрежет ее конец
+        overhead = len(chunk_prompt('', 999999, 999999, lang, query))
+        size = min(size, min(my_router.get_provider(x).max_chars for x in providers) - overhead)
+        chunks = split_text(text, size)
+        # все части сразу, тогда время это время самой медленной части, а не сумма
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(chunks), MAP_CONCURRENCY)) as executor:
+            parts = list(executor.map(lambda x: summ_chunk(x[1], x[0], len(chunks), lang, query, providers),
+                                      enumerate(chunks, start=1)))
+        failed = sum(1 for x in parts if not x)
+        if failed:
+            my_log.log2(f'my_sum:map_reduce: {failed} of {len(chunks)} parts failed')
+        if failed == len(chunks):
+            return ''
+        reduced = '\n\n'.join(f'Part {i}:\n{x}' for i, x in enumerate(parts, start=1) if x and x.strip() != '-')
+        if not reduced or len(reduced) >= len(text):
+            # дальше не сжимается
+            return reduced[:max_len]
+        text = reduced
+    return text
+
+
 def summ_text_worker(text: str, subj: str = 'text', lang: str = 'ru', query: str = '') -> str:
     """параллельный воркер для summ_text
        subj == 'text' or 'pdf'  - обычный текст о котором ничего не известно
@@ -85,39 +181,23 @@ Show a block with a detail summary of the content of the text in your own words,
 
 Text:'''
 
-    if not result:
-        try:
-            if query:
-                qq = query
-            r = my_gemini.sum_big_text(text[:my_gemini.MAX_SUM_REQUEST], qq).strip()
-            if r != '':
-                result = f'{r}\n\n--\nGemini Pro [{len(text[:my_gemini.MAX_SUM_REQUEST])}]'
-        except Exception as error:
-            print(f'my_sum:summ_text_worker:gpt: {error}')
-            my_log.log2(f'my_sum:summ_text_worker:gpt: {error}')
-
-
-    if not result:
-        try:
-            if query:
-                qq = query
-            r = my_groq.sum_big_text(text[:32000], qq, model = 'mixtral-8x7b-32768').strip()
-            if r != '':
-                result = f'{r}\n\n--\nMixtral-8x7b-32768 [Groq] [{len(text[:32000])}]'
-        except Exception as error:
-            print(f'my_sum:summ_text_worker:gpt: {error}')
-            my_log.log2(f'my_sum:summ_text_worker:gpt: {error}')
-
-    if not result:
-        try:
-            if query:
-                qq = query
-            r = my_groq.sum_big_text(text[:my_groq.MAX_QUERY_LENGTH], qq).strip()
-            if r != '':
-                result = f'{r}\n\n--\nLlama3 70b [Groq] [{len(text[:my_groq.MAX_QUERY_LENGTH])}]'
-        except Exception as error:
-            print(f'my_sum:summ_text_worker:gpt: {error}')
-            my_log.log2(f'my_sum:summ_text_worker:gpt: {error}')
+    if query:
+        qq = query
+
+    # сколько текста влезает в запрос вместе с заданием
+    max_len = MAX_SINGLE_REQUEST - len(qq) - 2
+    if len(text) > max_len:
+        # длинный текст пересказывается по частям, потом части сводятся в один пересказ
+        text = map_reduce(text, lang, query, max_len)
+        if not text:
+            return ''
+
+    # самый быстрый из провайдеров, если он завис то параллельно спрашивается следующий
+    r, provider = my_router.complete([{'role': 'user', 'content': f'{qq}\n\n{text}'}],
+                                     {'providers': ['gemini', 'groq-mixtral', 'groq-llama'],
+                                      'temperature': 0.1})
+    if r:
+        result = f'{r}\n\n--\n{provider.label} [{len(text[:provider.max_chars])}]'
 
     return result
 
@@ -139,48 +219,15 @@ def summ_url(url:str, download_only: bool = False, lang: str = 'ru'):
         text = get_text_from_youtube(url)
         youtube = True
     else:
-        # Получаем содержимое страницы
-                
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'}
-
-        try:
-            response = requests.get(url, stream=True, headers=headers, timeout=20)
-            content = b''
-            # Ограничиваем размер
-            for chunk in response.iter_content(chunk_size=1024):
-                content += chunk
-                if len(content) > 1 * 1024 * 1024: # 1 MB
-                    break
-        except:
+        # скачанные страницы помнятся и проверяются по ETag/Last-Modified
+        text, kind = my_fetch.get_text(url)
+        if not text:
             if download_only:
                 return ''
             else:
                 return '', ''
+        pdf = kind == 'pdf'
 
-        if utils.mime_from_buffer(content) == 'application/pdf':
-            pdf = True
-            file_bytes = io.BytesIO(content)
-            pdf_reader = PyPDF2.PdfReader(file_bytes)
-            text = ''
-            for page in pdf_reader.pages:
-                text += page.extract_text()
-        else:
-            # Определяем кодировку текста
-            encoding = chardet.detect(content[:2000])['encoding']
-            # Декодируем содержимое страницы
-            try:
-                content = content.decode(encoding)
-            except:
-                try:
-                    content = content.decode('utf-8')
-                except:
-                    if download_only:
-                        return ''
-                    else:
-                        return '', ''
-
-            text = trafilatura.extract(content)
-   
     if download_only:
         if youtube:
             r = f'URL: {url}\nСубтитры из видео на ютубе (полное содержание, отметки времени были удалены):\n\n{text}'
@@ -208,10 +255,47 @@ def is_valid_url(url: str) -> bool:
 
 
 if __name__ == "__main__":
+    import time
+
+    # деление по абзацам, куски не больше size и склеиваются обратно без потерь
+    text = ''.join(f'Абзац {i}. ' + 'Предложение текста. ' * (i % 50 + 1) + '\n\n' for i in range(3000))
+    chunks = split_text(text, 10000)
+    assert ''.join(chunks) == text
+    assert all(len(x) <= 10000 for x in chunks) and all(x.endswith('\n\n') for x in chunks[:-1])
+    # без абзацев по предложениям, без предложений по словам
+    flat = text.replace('\n\n', ' ')
+    assert ''.join(split_text(flat, 10000)) == flat and all(x.endswith('. ') for x in split_text(flat, 10000)[:-1])
+    words = 'слово ' * 10000
+    assert ''.join(split_text(words, 1000)) == words and all(len(x) <= 1000 for x in split_text(words, 1000))
+
+    # map-reduce без сети: части идут параллельно, каждая влезает в запрос целиком и ничего не теряется
+    book = text[:1200000]
+    prompts = []
+    def complete(messages: list, constraints: dict):
+        q = messages[0]['content']
+        provider = my_router.get_provider(constraints['providers'][0])
+        assert len(q) <= provider.max_chars, (len(q), provider.max_chars)
+        prompts.append(q)
+        time.sleep(0.3)
+        return f'пересказ части {q.split()[3]}', provider
+    my_router.complete = complete
+    start = time.perf_counter()
+    result = map_reduce(book)
+    print(f'{len(book)} символов, {len(prompts)} частей за {time.perf_counter() - start:.2f}s')
+    # части по максимуму, но не больше лимита gemini, частей больше MAX_CHUNKS,
+    # и все равно время это время одной части, а не сумма
+    assert max(len(x) for x in prompts) > MAX_SINGLE_REQUEST * 0.9 and len(prompts) > MAX_CHUNKS
+    assert time.perf_counter() - start < 0.3 * 1.5
+    parts = sorted(prompts, key=lambda x: int(x.split()[3]))
+    assert ''.join(x.split('\n\n', 3)[-1] for x in parts) == book
+    assert all(f'пересказ части {i}' in result for i in range(1, len(prompts) + 1))
+
+    # длинная книга, пересказ по частям
+    # print(summ_text(open('1.txt', 'r', encoding='utf-8').read(), 'pdf'))
 
     # print(summ_url('https://telegra.ph/Tomm-05-19', download_only=True))
 
-    print(summ_url('https://www.youtube.com/watch?v=nrFjjsAc_E8')[0])
+    # print(summ_url('https://www.youtube.com/watch?v=nrFjjsAc_E8')[0])
     # print(summ_url('https://www.youtube.com/watch?v=0uOCF04QcHk')[0])
     # print(summ_url('https://www.youtube.com/watch?v=IVTzUg50f_4')[0])
     # print(summ_url('https://www.youtube.com/watch?v=0MehBAmxj-E')[0])
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# Подсчет токенов для обрезки истории диалогов.
+# У каждого семейства моделей свой токенизатор, для openai и llama это tiktoken (если установлен
+# и его словарь уже скачан, из бота он не качается), для остальных оценка по символам. Токенизаторы можно подменять
+# через register(). Количество токенов каждого сообщения кешируется по хешу текста, так что
+# история, которую каждый раз загружают из базы и обрезают, пересчитывается только для новых сообщений.
+#
+# my_history.BoundedHistory(mem, max_tokens, size_func = my_tokens.size_func(model)) - история с лимитом в токенах
+
+
+import collections
+import functools
+import hashlib
+import math
+import os
+import re
+import tempfile
+import threading
+import traceback
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+import my_log
+
+
+# сколько сообщений помнить в кеше
+CACHE_SIZE = 50000
+
+# служебные токены на каждое сообщение (роль, разделители)
+MESSAGE_OVERHEAD = 4
+
+# начало названия модели -> семейство
+FAMILIES = (
+    ('gpt-4o', 'openai-4o'),
+    ('gpt-', 'openai'),
+    ('o1', 'openai'),
+    ('openai/', 'openai'),
+    ('llama', 'llama'),
+    ('meta-llama/', 'llama'),
+    ('gemma', 'gemma'),
+    ('gemini', 'gemini'),
+    ('claude', 'claude'),
+    ('anthropic/', 'claude'),
+    ('mixtral', 'mistral'),
+)
+
+# семейство -> словарь tiktoken. У llama 3 свой словарь на основе cl100k, без сети его не взять,
+# cl100k_base считает почти так же
+TIKTOKEN_ENCODINGS = {
+    'openai-4o': 'o200k_base',
+    'openai': 'cl100k_base',
+    'llama': 'cl100k_base',
+}
+
+# словарь tiktoken -> откуда tiktoken его скачивает, по этому адресу ищется файл в его кеше
+TIKTOKEN_FILES = {
+    'cl100k_base': 'https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken',
+    'o200k_base': 'https://openaipublic.blob.core.windows.net/encodings/o200k_base.tiktoken',
+}
+
+
+WORD = re.compile(r'[A-Za-z]+|\d+|[^\W\d_A-Za-z]+|\S')
+
+
+def estimate(text: str) -> int:
+    """примерное количество токенов без токенизатора:
+    латиница ~4 символа на токен, кириллица и прочие буквы ~2.5, цифры ~3, знаки по одному
+    """
+    tokens = 0
+    for word in WORD.findall(text):
+        c = word[0]
+        if 'a' <= c.lower() <= 'z':
+            tokens += math.ceil(len(word) / 4)
+        elif c.isdigit():
+            tokens += math.ceil(len(word) / 3)
+        elif c.isalpha():
+            tokens += math.ceil(len(word) / 2.5)
+        else:
+            tokens += 1
+    return tokens
+
+
+# {семейство: функция(text) -> int}
+TOKENIZERS = {}
+TOKENIZERS_LOCK = threading.Lock()
+
+
+def register(family: str, func):
+    """подключает свой токенизатор для семейства моделей"""
+    with TOKENIZERS_LOCK:
+        TOKENIZERS[family] = func
+    CACHE.clear()
+
+
+def family(model: str) -> str:
+    model = (model or '').lower()
+    for prefix, name in FAMILIES:
+        if model.startswith(prefix):
+            return name
+    return 'default'
+
+
+def tiktoken_cached(name: str) -> bool:
+    """лежит ли словарь tiktoken уже на диске, так же как ищет сам tiktoken (tiktoken/load.py)"""
+    cache_dir = os.environ.get('TIKTOKEN_CACHE_DIR', os.environ.get('DATA_GYM_CACHE_DIR'))
+    if cache_dir is None:
+        cache_dir = os.path.join(tempfile.gettempdir(), 'data-gym-cache')
+    if not cache_dir or name not in TIKTOKEN_FILES:
+        # пустая папка значит без кеша, каждый раз из сети
+        return False
+    return os.path.exists(os.path.join(cache_dir, hashlib.sha1(TIKTOKEN_FILES[name].encode()).hexdigest()))
+
+
+def get_tokenizer(family_: str):
+    """токенизатор семейства, при первом обращении пробует загрузить tiktoken, иначе оценка.
+    Словарь грузится только если уже скачан, без сети и без замка: чтение большого файла
+    не должно останавливать подсчет токенов для остальных семейств.
+    """
+    with TOKENIZERS_LOCK:
+        if family_ in TOKENIZERS:
+            return TOKENIZERS[family_]
+
+    func = estimate
+    name = TIKTOKEN_ENCODINGS.get(family_)
+    if tiktoken and name:
+        if tiktoken_cached(name):
+            try:
+                encoding = tiktoken.get_encoding(name)
+                func = lambda text: len(encoding.encode(text, disallowed_special=()))
+            except Exception as error:
+                error_traceback = traceback.format_exc()
+                my_log.log2(f'my_tokens:get_tokenizer: {family_} {error}\n\n{error_traceback}')
+        else:
+            my_log.log2(f'my_tokens:get_tokenizer: {family_} {name} not downloaded, using estimate')
+
+    with TOKENIZERS_LOCK:
+        # пока грузили другой поток мог успеть раньше или register() подменил токенизатор
+        return TOKENIZERS.setdefault(family_, func)
+
+
+class TokenCache:
+    """LRU {(семейство, хеш текста): токенов}"""
+    def __init__(self, max_size: int = CACHE_SIZE):
+        self.max_size = max_size
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.data.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.data.move_to_end(key)
+            return value
+
+    def put(self, key, value: int):
+        with self.lock:
+            self.data[key] = value
+            if len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+CACHE = TokenCache()
+
+
+def text_tokens(text: str, model: str = '') -> int:
+    """сколько токенов в тексте для этой модели"""
+    if not text:
+        return 0
+    family_ = family(model)
+    key = (family_, hashlib.blake2b(text.encode('utf-8', errors='replace'), digest_size=16).digest())
+    tokens = CACHE.get(key)
+    if tokens is None:
+        tokens = get_tokenizer(family_)(text)
+        CACHE.put(key, tokens)
+    return tokens
+
+
+def message_text(message: dict) -> str:
+    """текст сообщения, у gemini текст лежит в parts, у остальных в content"""
+    if 'parts' in message:
+        return ''.join(part.get('text', '') for part in message['parts'])
+    content = message.get('content', '')
+    return content if isinstance(content, str) else str(content)
+
+
+def message_tokens(message: dict, model: str = '') -> int:
+    return text_tokens(message_text(message), model) + MESSAGE_OVERHEAD
+
+
+def count(messages: list, model: str = '') -> int:
+    """сколько токенов во всех сообщениях"""
+    return sum(message_tokens(x, model) for x in messages)
+
+
+def size_func(model: str = ''):
+    """функция размера сообщения в токенах для my_history.BoundedHistory"""
+    return functools.partial(message_tokens, model=model)
+
+
+if __name__ == '__main__':
+    import time
+
+    import my_history
+
+    # словаря нет в кеше tiktoken - оценка, в сеть не ходим
+    os.environ['TIKTOKEN_CACHE_DIR'] = tempfile.mkdtemp()
+    assert not tiktoken_cached('cl100k_base') and get_tokenizer('openai') is estimate
+    del os.environ['TIKTOKEN_CACHE_DIR']
+    TOKENIZERS.pop('openai')
+
+    text = 'Привет, как дела? Hello, how are you doing today? 12345 ' * 20
+    for model in ('gpt-4o', 'llama-3.1-70b-versatile', 'gemini-1.5-flash', 'claude-3-haiku'):
+        print(f'{model}: {len(text)} символов, {text_tokens(text, model)} токенов ({get_tokenizer(family(model)).__name__})')
+
+    # история на 40 сообщений, которую каждый раз загружают и обрезают заново
+    mem = [{'role': 'user' if i % 2 == 0 else 'assistant', 'content': f'{i} {text}'} for i in range(40)]
+    CACHE.clear()
+    for n in range(3):
+        start = time.perf_counter()
+        history = my_history.BoundedHistory(mem, 5000, size_func = size_func('gpt-4o'))
+        print(f'обрезка {len(mem)} -> {len(history)} сообщений, {history.size} токенов, {(time.perf_counter() - start) * 1000:.2f}ms')
+    print(f'кеш: {CACHE.hits} попаданий, {CACHE.misses} промахов')
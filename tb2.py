@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import io
-import glob
 import os
 import re
 import tempfile
@@ -13,7 +12,6 @@ import openai
 import prettytable
 import telebot
 from fuzzywuzzy import fuzz
-import pandas as pd
 
 import bing_img
 import cfg
@@ -21,16 +19,26 @@ import gpt_basic
 import gpt_basic_2
 import gpt_basic_3
 import my_bard
+import my_chat_action
 import my_claude
 import my_gemini
 import my_genimg
 import my_groq
+import my_dialogs
 import my_dic
+import my_dispatcher
+import my_fuzzy
 import my_google
+import my_history
 import my_log
+import my_reports
+import my_scheduler
+import my_sender
 import my_shadowjourney
+import my_stream
 import my_sum
 import my_stt
+import my_tokens
 import my_trans
 import my_tts
 import utils
@@ -51,18 +59,15 @@ pics_group = cfg.pics_group
 pics_group_url = cfg.pics_group_url
 
 
-# до 40 одновременных потоков для чата с гпт и бингом
-semaphore_talks = threading.Semaphore(40)
-
 # папка для постоянных словарей, памяти бота
 if not os.path.exists('db'):
     os.mkdir('db')
 
 # история диалогов для GPT chat
-DIALOGS_DB = my_dic.PersistentDict('db/dialogs.pkl')
+DIALOGS_DB = my_dialogs.Dialogs('chatgpt')
 
 # для запоминания ответов на команду /sum
-SUM_CACHE = my_dic.PersistentDict('db/sum_cache.pkl')
+SUM_CACHE = my_dic.PersistentDict('db/sum_cache.pkl', deferred=True)
 
 # в каких чатах активирован режим работы
 # {chat_id:False|True}
@@ -71,9 +76,11 @@ SUPER_CHAT = my_dic.PersistentDict('db/super_chat.pkl')
 # в каких чатах какой бот отвечает 'chatGPT', 'bard', 'perplexity', 'claude'
 CHAT_MODE = my_dic.PersistentDict('db/chat_mode.pkl')
 
-# хранилище замков что бы юзеры не могли делать новые запросы пока не получен ответ на старый
-# {chat_id(str):threading.Lock(),...}
-GPT_CHAT_LOCKS = {}
+# очередь исходящих сообщений с лимитами телеграма
+SENDER = my_sender.get(bot)
+
+# индикаторы активности ("печатает...") всех чатов, обновляются одним потоком
+CHAT_ACTIONS = my_chat_action.ChatActionService(bot)
 
 # блокировка отправки сообщений об изображениях что бы не было перехлестов
 SEND_IMG_LOCK = threading.Lock()
@@ -84,20 +91,22 @@ try:
 except FileNotFoundError:
     STOP_WORDS = []
 STOP_WORDS = [x.lower() for x in STOP_WORDS]
-STOP_WORDS = sorted(STOP_WORDS)
+STOP_WORDS = sorted(set(STOP_WORDS))
 with open('stop_words.txt', 'w', encoding='utf-8') as f:
     f.write(','.join(STOP_WORDS))
+# индекс для быстрого поиска похожих на стоп слова, пересоздается при /add и /del
+STOP_WORDS_INDEX = my_fuzzy.StopWords(STOP_WORDS)
 stop_words_lock = threading.Lock()
 
 # исключения из стоп слов
 # STOP_WORDS_FALSE_POSITIVE = [
 #     'кончая', 'ездишь', 'стирать', 'посуда'
 # ]
-STOP_WORDS_FALSE_POSITIVE = []
+STOP_WORDS_FALSE_POSITIVE = set()
 with open('russian.txt', 'r', encoding="cp1251") as f:
-    STOP_WORDS_FALSE_POSITIVE += [x.strip() for x in f.readlines()]
+    STOP_WORDS_FALSE_POSITIVE.update(x.strip() for x in f.readlines())
 with open('russian_surnames.txt', 'r', encoding="cp1251") as f:
-    STOP_WORDS_FALSE_POSITIVE += [x.strip() for x in f.readlines()]
+    STOP_WORDS_FALSE_POSITIVE.update(x.strip() for x in f.readlines())
 
 
 # защита от спама, временный бан юзера
@@ -105,13 +114,9 @@ with open('russian_surnames.txt', 'r', encoding="cp1251") as f:
 SPAMERS = {}
 
 # запоминаем прилетающие сообщения, если они слишком длинные и
-# были отправлены клеинтом по кускам {id:[messages]}
-# ловим сообщение и ждем полсекунды не прилетит ли еще кусок
-MESSAGE_QUEUE = {}
-
-# защита от одновременного доступа к файлу экспорта
-panda_export_lock = threading.Lock()
-
+# были отправлены клеинтом по кускам
+# ловим сообщение и ждем полсекунды не прилетит ли еще кусок, потом склеиваем и отдаем в do_task
+MESSAGE_QUEUE = my_scheduler.Coalescer(lambda chat_id_full, messages: do_task_coalesced(chat_id_full, messages))
 
 supported_langs_tts = [
         'af', 'am', 'ar', 'as', 'az', 'be', 'bg', 'bn', 'bs', 'ca', 'cs', 'cy', 'da',
@@ -124,9 +129,10 @@ supported_langs_tts = [
         'tl', 'tr', 'tt', 'ug', 'uk', 'ur', 'uz', 'vi', 'xh', 'yi', 'yo', 'zh', 'zu']
 
 
-class ShowAction(threading.Thread):
-    """A thread that can be stopped. Continuously sends a notification of activity to the chat.
-    Telegram automatically extinguishes the notification after 5 seconds, so it must be repeated.
+class ShowAction:
+    """Continuously sends a notification of activity to the chat.
+    Telegram automatically extinguishes the notification after 5 seconds, so it must be repeated,
+    all active notifications are refreshed by one CHAT_ACTIONS thread.
 
     To use in the code, you need to do something like this:
     with ShowAction(message, 'typing'):
@@ -140,44 +146,18 @@ class ShowAction(threading.Thread):
             action (_type_):  "typing", "upload_photo", "record_video", "upload_video", "record_audio", 
                               "upload_audio", "upload_document", "find_location", "record_video_note", "upload_video_note"
         """
-        super().__init__()
-        self.actions = [  "typing", "upload_photo", "record_video", "upload_video", "record_audio",
-                         "upload_audio", "upload_document", "find_location", "record_video_note", "upload_video_note"]
-        assert action in self.actions, f'Допустимые actions = {self.actions}'
+        assert action in my_chat_action.ACTIONS, f'Допустимые actions = {my_chat_action.ACTIONS}'
         self.chat_id = message.chat.id
-        self.thread_id = message.message_thread_id
-        self.is_topic = True if message.is_topic_message else False
+        self.thread_id = message.message_thread_id if message.is_topic_message else None
         self.action = action
-        self.is_running = True
-        self.timerseconds = 1
-        self.started_time = time.time()
-
-    def run(self):
-        while self.is_running:
-            if time.time() - self.started_time > 60*5:
-                self.stop()
-                my_log.log2(f'tb:show_action:stoped after 5min [{self.chat_id}] [{self.thread_id}] is topic: {self.is_topic} action: {self.action}')
-                return
-            try:
-                if self.is_topic:
-                    bot.send_chat_action(self.chat_id, self.action, message_thread_id = self.thread_id)
-                else:
-                    bot.send_chat_action(self.chat_id, self.action)
-            except Exception as error:
-                if 'A request to the Telegram API was unsuccessful. Error code: 429. Description: Too Many Requests' not in str(error):
-                    my_log.log2(f'tb:show_action:run: {error}')
-            n = 50
-            while n > 0:
-                time.sleep(0.1)
-                n = n - self.timerseconds
+        self.handle = None
+
+    def start(self):
+        self.handle = CHAT_ACTIONS.start(self.chat_id, self.thread_id, self.action)
 
     def stop(self):
-        self.timerseconds = 50
-        self.is_running = False
-        try:
-            bot.send_chat_action(self.chat_id, 'cancel', message_thread_id = self.thread_id)
-        except Exception as error:
-            my_log.log2(f'tb:show_action: {error}')
+        if self.handle:
+            self.handle.stop()
 
     def __enter__(self):
         self.start()
@@ -249,6 +229,11 @@ def authorized(message: telebot.types.Message) -> bool:
     return True
 
 
+def chatgpt_message_size(message: dict) -> int:
+    """размер одного сообщения в токенах, сумма по всем сообщениям равна utils.count_tokens(messages, cfg.model)"""
+    return my_tokens.message_tokens(message, cfg.model)
+
+
 def dialog_add_user_request(chat_id: str, text: str, engine: str = 'gpt') -> str:
     """добавляет в историю переписки с юзером его новый запрос и ответ от чатбота
     делает запрос и возвращает ответ
@@ -273,13 +258,9 @@ def dialog_add_user_request(chat_id: str, text: str, engine: str = 'gpt') -> str
         new_messages = []
 
     # теперь ее надо почистить что бы влезла в запрос к GPT
-    # просто удаляем все кроме max_hist_lines последних
-    if len(new_messages) > cfg.max_hist_lines:
-        new_messages = new_messages[cfg.max_hist_lines:]
-    # удаляем первую запись в истории до тех пор пока общее количество токенов не станет меньше cfg.max_hist_bytes
-    # удаляем по 2 сразу так как первая - промпт для бота
-    while (utils.count_tokens(new_messages) > cfg.max_hist_bytes):
-        new_messages = new_messages[2:]
+    # удаляем первые записи в истории по 2 сразу (запрос+ответ) до тех пор пока общее количество
+    # токенов не станет меньше cfg.max_hist_bytes, и оставляем не больше max_hist_lines последних
+    new_messages = my_history.trim(new_messages, cfg.max_hist_bytes, cfg.max_hist_lines, chatgpt_message_size)
 
     # добавляем в историю новый запрос и отправляем
     new_messages = new_messages + [{"role":    "user",
@@ -312,8 +293,7 @@ def dialog_add_user_request(chat_id: str, text: str, engine: str = 'gpt') -> str
                 r = gpt_basic.ai_compress(p, cfg.max_hist_compressed, 'dialog')
                 new_messages = [{'role':'system','content':r}] + new_messages[-1:]
                 # и на всякий случай еще
-                while (utils.count_tokens(new_messages) > cfg.max_hist_compressed):
-                    new_messages = new_messages[2:]
+                new_messages = my_history.trim(new_messages, cfg.max_hist_compressed, size_func = chatgpt_message_size)
 
                 try:
                     resp = gpt_basic.ai(prompt = text, messages = current_prompt + new_messages, chat_id=chat_id)
@@ -385,6 +365,18 @@ def get_topic_id(message: telebot.types.Message) -> str:
     return f'[{chat_id}] [{topic_id}]'
 
 
+def dispatch(message: telebot.types.Message, func, *args) -> None:
+    """Ставит обработчик в очередь чата, запросы одного чата выполняются по очереди.
+    Если очередь переполнена то отвечает что бот занят."""
+    chat_id_full = get_topic_id(message)
+    if not my_dispatcher.submit(chat_id_full, func, *args):
+        my_log.log2(f'tb:dispatch: queue is full {chat_id_full} {func.__name__}')
+        try:
+            bot.reply_to(message, 'Бот сейчас занят, попробуйте позже')
+        except Exception as error:
+            my_log.log2(f'tb:dispatch: {error}')
+
+
 def is_for_me(cmd: str):
     """Checks who the command is addressed to, this bot or another one.
     
@@ -478,38 +470,28 @@ def get_keyboard(kbd: str, message: telebot.types.Message, flag: str = '') -> te
 @bot.callback_query_handler(func=lambda call: True)
 def callback_inline(call: telebot.types.CallbackQuery):
     """Обработчик клавиатуры"""
-    thread = threading.Thread(target=callback_inline_thread, args=(call,))
-    thread.start()
+    dispatch(call.message, callback_inline_thread, call)
 def callback_inline_thread(call: telebot.types.CallbackQuery):
     """Обработчик клавиатуры"""
 
-    with semaphore_talks:
-        message = call.message
-        chat_id_full = get_topic_id(message)
-        user_id = message.from_user.id
-
-        if chat_id_full in GPT_CHAT_LOCKS:
-            lock = GPT_CHAT_LOCKS[chat_id_full]
-        else:
-            lock = threading.Lock()
-            GPT_CHAT_LOCKS[chat_id_full] = lock
-        with lock:
+    message = call.message
+    chat_id_full = get_topic_id(message)
+    user_id = message.from_user.id
 
-            if call.data == 'tts':
-                lang = my_trans.detect_lang(message.text) or 'ru'
-                message.text = f'/tts {lang} {message.text}'
-                tts(message)
-            elif call.data == 'google':
-                message = message.reply_to_message
-                message.text = '/google ' + message.text
-                google(message)
+    if call.data == 'tts':
+        lang = my_trans.detect_lang(message.text) or 'ru'
+        message.text = f'/tts {lang} {message.text}'
+        tts(message)
+    elif call.data == 'google':
+        message = message.reply_to_message
+        message.text = '/google ' + message.text
+        google(message)
 
 
 @bot.message_handler(content_types = ['voice', 'audio'])
 def handle_voice(message: telebot.types.Message): 
     """Автоматическое распознавание текст из голосовых сообщений"""
-    thread = threading.Thread(target=handle_voice_thread, args=(message,))
-    thread.start()
+    dispatch(message, handle_voice_thread, message)
 def handle_voice_thread(message: telebot.types.Message):
     """Автоматическое распознавание текст из голосовых сообщений и аудио файлов"""
 
@@ -518,56 +500,48 @@ def handle_voice_thread(message: telebot.types.Message):
         return
 
     chat_id_full = get_topic_id(message)
-    if chat_id_full in GPT_CHAT_LOCKS:
-        lock = GPT_CHAT_LOCKS[chat_id_full]
-    else:
-        lock = threading.Lock()
-        GPT_CHAT_LOCKS[chat_id_full] = lock
-    with lock:
 
-        my_log.log_media(message)
+    my_log.log_media(message)
 
-        with semaphore_talks:
-            # Создание временного файла
-            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                file_path = temp_file.name
-            # Скачиваем аудиофайл во временный файл
-            try:
-                file_info = bot.get_file(message.voice.file_id)
-            except AttributeError:
-                file_info = bot.get_file(message.audio.file_id)
-            downloaded_file = bot.download_file(file_info.file_path)
-            with open(file_path, 'wb') as new_file:
-                new_file.write(downloaded_file)
-
-            # Распознаем текст из аудио
-            with ShowAction(message, 'typing'):
-                text = my_stt.stt(file_path)
+    # Создание временного файла
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        file_path = temp_file.name
+    # Скачиваем аудиофайл во временный файл
+    try:
+        file_info = bot.get_file(message.voice.file_id)
+    except AttributeError:
+        file_info = bot.get_file(message.audio.file_id)
+    downloaded_file = bot.download_file(file_info.file_path)
+    with open(file_path, 'wb') as new_file:
+        new_file.write(downloaded_file)
+
+    # Распознаем текст из аудио
+    with ShowAction(message, 'typing'):
+        text = my_stt.stt(file_path)
 
-                os.remove(file_path)
+        os.remove(file_path)
 
-                text = text.strip()
-                # Отправляем распознанный текст
-                if text:
-                    reply_to_long_message(message, text)
-                    my_log.log_echo(message, f'[ASR] {text}')
-                else:
-                    # bot.reply_to(message, 'Очень интересно, но ничего не понятно.', reply_markup=get_keyboard('chat', message))
-                    my_log.log_echo(message, '[ASR] no results')
+        text = text.strip()
+        # Отправляем распознанный текст
+        if text:
+            reply_to_long_message(message, text)
+            my_log.log_echo(message, f'[ASR] {text}')
+        else:
+            # bot.reply_to(message, 'Очень интересно, но ничего не понятно.', reply_markup=get_keyboard('chat', message))
+            my_log.log_echo(message, '[ASR] no results')
 
-                # и при любом раскладе отправляем текст в обработчик текстовых сообщений,
-                # возможно бот отреагирует на него если там есть кодовые слова
-                if text:
-                    message.text = f'[Голосовое сообщение]: {text}'
-                    message.dont_check_topic = True
-                    echo_all(message)
+        # и при любом раскладе отправляем текст в обработчик текстовых сообщений,
+        # возможно бот отреагирует на него если там есть кодовые слова
+        if text:
+            message.text = f'[Голосовое сообщение]: {text}'
+            message.dont_check_topic = True
+            echo_all(message)
 
 
 @bot.message_handler(content_types = ['photo'])
 def handle_photo(message: telebot.types.Message):
     """Обработчик фотографий"""
-    thread = threading.Thread(target=handle_photo_thread, args=(message,))
-    thread.start()
+    dispatch(message, handle_photo_thread, message)
 def handle_photo_thread(message: telebot.types.Message):
     """Обработчик фотографий"""
 
@@ -586,45 +560,43 @@ def handle_photo_thread(message: telebot.types.Message):
         bot.reply_to(message, 'Слишком много сообщений, попробуйте позже')
         return
 
-    with semaphore_talks:
-        with ShowAction(message, 'typing'):
-            photo = message.photo[-1]
-            file_info = bot.get_file(photo.file_id)
-            image = bot.download_file(file_info.file_path)
-            if message.caption:
-                query = 'Отвечай по-русски если не просили другое. ' + message.caption
+    with ShowAction(message, 'typing'):
+        photo = message.photo[-1]
+        file_info = bot.get_file(photo.file_id)
+        image = bot.download_file(file_info.file_path)
+        if message.caption:
+            query = 'Отвечай по-русски если не просили другое. ' + message.caption
+        else:
+            query = 'Опиши максимально подробно что нарисовано на картинке, так что бы человек понял что здесь изображено. Отвечай по-русски если не просили другое.'
+        result = my_gemini.img2txt(image, query)
+        if not result:
+            result = my_bard.chat_image(query, chat_id_full, image)
+
+        # добавить в память что бы боты могли обсудить
+        if result:
+            my_gemini.update_mem('отправил картинку в чат и попросил дать описание', f'{result}', chat_id_full)
+            if chat_id_full in DIALOGS_DB:
+                new_messages = DIALOGS_DB[chat_id_full]
             else:
-                query = 'Опиши максимально подробно что нарисовано на картинке, так что бы человек понял что здесь изображено. Отвечай по-русски если не просили другое.'
-            result = my_gemini.img2txt(image, query)
-            if not result:
-                result = my_bard.chat_image(query, chat_id_full, image)
-
-            # добавить в память что бы боты могли обсудить
-            if result:
-                my_gemini.update_mem('отправил картинку в чат и попросил дать описание', f'{result}', chat_id_full)
-                if chat_id_full in DIALOGS_DB:
-                    new_messages = DIALOGS_DB[chat_id_full]
-                else:
-                    new_messages = []
-                new_messages += [{"role": "user",       "content": 'отправил картинку в чат и попросил дать описание'}]
-                new_messages += [{"role":  "assistant", "content": result}]    
-                DIALOGS_DB[chat_id_full] = new_messages or []
-                DIALOGS_DB[chat_id_full] = DIALOGS_DB[chat_id_full][:20]
+                new_messages = []
+            new_messages += [{"role": "user",       "content": 'отправил картинку в чат и попросил дать описание'}]
+            new_messages += [{"role":  "assistant", "content": result}]    
+            DIALOGS_DB[chat_id_full] = new_messages or []
+            DIALOGS_DB[chat_id_full] = DIALOGS_DB[chat_id_full][:20]
 
-                result = utils.bot_markdown_to_html(result)
-                reply_to_long_message(message, result, parse_mode='HTML',
-                                    reply_markup=get_keyboard('chat', message))
-                message.text = '[юзер отправил картинку] ' + (message.caption or 'без подписи')
-                my_log.log_echo(message, result)
-                my_log.log_report(bot, message, chat_id_full, user_id, message.text, result,
-                                parse_mode='HTML')
+            result = utils.bot_markdown_to_html(result)
+            reply_to_long_message(message, result, parse_mode='HTML',
+                                reply_markup=get_keyboard('chat', message))
+            message.text = '[юзер отправил картинку] ' + (message.caption or 'без подписи')
+            my_log.log_echo(message, result)
+            my_log.log_report(bot, message, chat_id_full, user_id, message.text, result,
+                            parse_mode='HTML')
 
 
 @bot.message_handler(content_types = ['document'])
 def handle_document(message: telebot.types.Message):
     """Обработчик документов"""
-    thread = threading.Thread(target=handle_document_thread, args=(message,))
-    thread.start()
+    dispatch(message, handle_document_thread, message)
 def handle_document_thread(message: telebot.types.Message):
     """Обработчик документов"""
 
@@ -641,24 +613,23 @@ def handle_document_thread(message: telebot.types.Message):
         bot.reply_to(message, 'Слишком много сообщений, попробуйте позже')
         return
 
-    with semaphore_talks:
-        with ShowAction(message, 'typing'):
-            document = message.document
-            if document.mime_type in ('image/jpeg', 'image/png'):
-                with ShowAction(message, 'typing'):
-                    # скачиваем документ в байтовый поток
-                    file_id = message.document.file_id
-                    file_info = bot.get_file(file_id)
-                    image = bot.download_file(file_info.file_path)
-                    query = message.caption or 'Опиши максимально подробно что нарисовано на картинке, так что бы человек понял что здесь изображено.'
-                    result = my_gemini.img2txt(image, query)
-                    result = utils.bot_markdown_to_html(result)
-                    reply_to_long_message(message, result, parse_mode='HTML',
-                                        reply_markup=get_keyboard('chat', message))
-                    message.text = '[юзер отправил картинку] ' + (message.caption or 'без подписи')
-                    my_log.log_echo(message, result)
-                    my_log.log_report(bot, message, chat_id_full, user_id, message.text, result,
-                                    parse_mode='HTML')
+    with ShowAction(message, 'typing'):
+        document = message.document
+        if document.mime_type in ('image/jpeg', 'image/png'):
+            with ShowAction(message, 'typing'):
+                # скачиваем документ в байтовый поток
+                file_id = message.document.file_id
+                file_info = bot.get_file(file_id)
+                image = bot.download_file(file_info.file_path)
+                query = message.caption or 'Опиши максимально подробно что нарисовано на картинке, так что бы человек понял что здесь изображено.'
+                result = my_gemini.img2txt(image, query)
+                result = utils.bot_markdown_to_html(result)
+                reply_to_long_message(message, result, parse_mode='HTML',
+                                    reply_markup=get_keyboard('chat', message))
+                message.text = '[юзер отправил картинку] ' + (message.caption or 'без подписи')
+                my_log.log_echo(message, result)
+                my_log.log_report(bot, message, chat_id_full, user_id, message.text, result,
+                                parse_mode='HTML')
 
 
 @bot.message_handler(commands=['mem'])
@@ -719,8 +690,7 @@ def send_debug_history(message: telebot.types.Message):
 
 @bot.message_handler(commands=['bard'])
 def bard(message: telebot.types.Message):
-    thread = threading.Thread(target=bard_thread, args=(message,))
-    thread.start()
+    dispatch(message, bard_thread, message)
 def bard_thread(message: telebot.types.Message):
     """делает запрос к гугл бард вместо chatGPT"""
 
@@ -757,12 +727,12 @@ def bard_thread(message: telebot.types.Message):
                                             reply_markup=get_keyboard('chat', message))
                 except Exception as bard_error:
                     print(f'tb:do_task: {bard_error}')
-                    my_log.log2(f'tb:do_task: {bard_error}')
+                    my_log.log2(f'tb:do_task: {bard_error}', chat_id_full)
                     reply_to_long_message(message, answer, parse_mode='', disable_web_page_preview = True, 
                                             reply_markup=get_keyboard('chat', message))
         except Exception as error3:
             print(f'tb:do_task: {error3}')
-            my_log.log2(f'tb:do_task: {error3}')
+            my_log.log2(f'tb:do_task: {error3}', chat_id_full)
 
 
 @bot.message_handler(commands=['gemma2'])
@@ -888,7 +858,7 @@ def deactivate(message: telebot.types.Message):
 @bot.message_handler(commands=['add']) 
 def stop_word_add(message: telebot.types.Message):
     """добавить стоп слово"""
-    global STOP_WORDS
+    global STOP_WORDS, STOP_WORDS_INDEX
     if is_admin_member(message):
         with stop_words_lock:
             word = message.text.split(maxsplit=1)[1].strip()
@@ -896,6 +866,7 @@ def stop_word_add(message: telebot.types.Message):
             STOP_WORDS = list(set(STOP_WORDS))
             STOP_WORDS = [x.lower() for x in STOP_WORDS]
             STOP_WORDS = sorted(STOP_WORDS)
+            STOP_WORDS_INDEX = my_fuzzy.StopWords(STOP_WORDS)
             with open('stop_words.txt', 'w', encoding='utf-8') as f:
                 f.write(','.join(STOP_WORDS))
             bot.reply_to(message, f'Добавлено стоп слово {word}')
@@ -907,13 +878,14 @@ def stop_word_add(message: telebot.types.Message):
 def stop_word_del(message: telebot.types.Message):
     """удаляет стоп слово"""
     if is_admin_member(message):
-        global STOP_WORDS
+        global STOP_WORDS, STOP_WORDS_INDEX
         word = message.text.split(maxsplit=1)[1].strip()
         with stop_words_lock:
             STOP_WORDS = [x for x in STOP_WORDS if x != word]
             STOP_WORDS = list(set(STOP_WORDS))
             STOP_WORDS = [x.lower() for x in STOP_WORDS]
             STOP_WORDS = sorted(STOP_WORDS)
+            STOP_WORDS_INDEX = my_fuzzy.StopWords(STOP_WORDS)
             with open('stop_words.txt', 'w', encoding='utf-8') as f:
                 f.write(','.join(STOP_WORDS))
         bot.reply_to(message, f'Удалено стоп слово {word}')
@@ -930,6 +902,15 @@ def restart(message: telebot.types.Message):
         bot.reply_to(message, 'Эта команда только для администраторов')
 
 
+@bot.message_handler(commands=['queue']) 
+def queue_stats(message: telebot.types.Message):
+    """показывает глубину очередей и время ожидания запросов"""
+    if is_admin_member(message):
+        bot.reply_to(message, f'<pre>{my_dispatcher.stats_as_string()}</pre>', parse_mode='HTML')
+    else:
+        bot.reply_to(message, 'Эта команда только для администраторов')
+
+
 @bot.message_handler(commands=['id']) 
 def id_cmd_handler(message: telebot.types.Message):
     """показывает id юзера и группы в которой сообщение отправлено"""
@@ -941,10 +922,11 @@ def id_cmd_handler(message: telebot.types.Message):
 @bot.message_handler(commands=['export']) 
 def export_data(message: telebot.types.Message):
     """Экспорт данных в виде файлов"""
-    thread = threading.Thread(target=export_data_thread, args=(message,))
-    thread.start()
+    dispatch(message, export_data_thread, message)
 def export_data_thread(message: telebot.types.Message):
-    """Экспорт данных в виде файлов"""
+    """Экспорт данных в виде файлов
+    /export [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД] [user_id]
+    """
 
     if not message.chat.type == 'private':
         return
@@ -953,74 +935,23 @@ def export_data_thread(message: telebot.types.Message):
         bot.reply_to(message, 'Эта команда только для администраторов')
         return
 
-    with ShowAction(message, 'upload_document'):
-        # получить список всех файлов в папке логов
-        files = []
-        file_list = glob.glob('logs/*.log')
-        for x in file_list:
-            try:
-                # только те логи у которых имя - цифра.log
-                x = x.replace('\\', '/')
-                user_id = int(x.split('/', maxsplit=1)[1].split('.',maxsplit=1)[0])
-                files.append(x)
-            except ValueError:
-                pass
-            except Exception as error:
-                print(f'tb:export_data_thread: {error}')
-                my_log.log2(f'tb:export_data_thread: {error}')
-
-        # список строк для экспорта в таблицу
-        data = []
+    try:
+        date_from, date_to, user_id = my_reports.parse_export_args(message.text.split()[1:])
+    except ValueError:
+        bot.reply_to(message, 'Использование: /export [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД] [user_id]')
+        return
 
-        for x in files:
-            with open(x, 'r', encoding='utf-8') as f:
-                text = f.read()
-                pattern = re.compile(r'={40}(.*?)={40}', re.DOTALL)
-                matches = pattern.findall(text)
-                sep2 = '-' * 40
-                for match in matches:
-                    try:
-                        text2 = match.strip()
-                        lines2 = text2.splitlines()
-                        _user = x.split('.', maxsplit=1)[0].split('/', maxsplit=1)[1]
-                        _date_in_seconds = pd.to_datetime(float(lines2[0]), unit='s')
-                        _date_and_time = lines2[1]
-                        _chat_id_full = lines2[2]
-                        lines2[2] = lines2[2].replace('[', '').replace(']', '')
-                        _chat_id, _thread_id = lines2[2].split(' ')
-                        _user_request = ''
-                        _bot_response = ''
-                        stage = 0
-                        for l in lines2[4:]:
-                            if l == sep2:
-                                stage += 1
-                                continue
-                            if stage == 0:
-                                _user_request += l + '\n'
-                            else:
-                                _bot_response += l + '\n'
-                        _user_request = _user_request.strip()
-                        _bot_response = _bot_response.strip()
-                        _record = (_chat_id_full, _user, _date_and_time, _user_request[:20], _bot_response[:20], _date_in_seconds, _chat_id, _thread_id)
-                        data.append(_record)
-                    except Exception as error:
-                        # error_traceback = traceback.format_exc()
-                        # my_log.log2(error_traceback)
-                        my_log.log2(f'tb:export_data_thread: {error}')
-
-        # Создаем DataFrame из списка строк.
-        df = pd.DataFrame(data)
-        # Экспортируем DataFrame в файл Excel.
-        with panda_export_lock:
-            try:
-                os.remove("export_file_7682341.xlsx")
-            except FileNotFoundError:
-                pass
-            headers = ['chat_id_full', 'user_id', 'date_time_str', 'user_request', 'bot_response', 'date', 'chat_id', 'thread_id']
-            df.to_excel("export_file_7682341.xlsx", header=headers)
-            bot.send_document(message.chat.id, document = open('export_file_7682341.xlsx', 'rb'))
+    with ShowAction(message, 'upload_document'):
+        path, n = my_reports.export(date_from, date_to, user_id)
+        try:
+            if n:
+                with open(path, 'rb') as f:
+                    bot.send_document(message.chat.id, document = f, visible_file_name = 'export.xlsx')
+            else:
+                bot.reply_to(message, 'Нет данных за этот период')
+        finally:
             try:
-                os.remove("export_file_7682341.xlsx")
+                os.remove(path)
             except Exception as error:
                 print(f'tb:export_data_thread: {error}')
                 my_log.log2(f'tb:export_data_thread: {error}')
@@ -1028,8 +959,7 @@ def export_data_thread(message: telebot.types.Message):
 
 @bot.message_handler(commands=['clear', 'reset']) 
 def clear(message: telebot.types.Message):
-    thread = threading.Thread(target=clear_thread, args=(message,))
-    thread.start()
+    dispatch(message, clear_thread, message)
 def clear_thread(message: telebot.types.Message):
     """стирает память боту"""
 
@@ -1072,8 +1002,7 @@ def clear_thread(message: telebot.types.Message):
 
 @bot.message_handler(commands=['tts']) 
 def tts(message: telebot.types.Message):
-    thread = threading.Thread(target=tts_thread, args=(message,))
-    thread.start()
+    dispatch(message, tts_thread, message)
 def tts_thread(message: telebot.types.Message):
     """ /tts [ru|en|uk|...] [+-XX%] <текст>
         /tts <URL>
@@ -1088,45 +1017,39 @@ def tts_thread(message: telebot.types.Message):
     else: return
 
     chat_id_full = get_topic_id(message)
-    if chat_id_full in GPT_CHAT_LOCKS:
-        lock = GPT_CHAT_LOCKS[chat_id_full]
-    else:
-        lock = threading.Lock()
-        GPT_CHAT_LOCKS[chat_id_full] = lock
-    with lock:
-
-        my_log.log_echo(message)
 
-        # обрабатываем урл, просто достаем текст и показываем с клавиатурой для озвучки
-        args = message.text.split()
-        if len(args) == 2 and my_sum.is_valid_url(args[1]):
-            url = args[1]
-            if '/youtu.be/' in url or 'youtube.com/' in url:
-                text = my_sum.get_text_from_youtube(url)
-            else:
-                text = my_google.download_text([url, ], 100000, no_links = True)
-            if text:
-                reply_to_long_message(message, text, parse_mode='',
-                                    disable_web_page_preview=True)
-            return
+    my_log.log_echo(message)
 
-        # разбираем параметры
-        # регулярное выражение для разбора строки
-        pattern = r'/tts\s+((?P<lang>' + '|'.join(supported_langs_tts) + r')\s+)?\s*(?P<rate>([+-]\d{1,2}%\s+))?\s*(?P<text>.+)'
-        # поиск совпадений с регулярным выражением
-        match = re.match(pattern, message.text, re.DOTALL)
-        # извлечение параметров из найденных совпадений
-        if match:
-            lang = match.group("lang") or "ru"  # если lang не указан, то по умолчанию 'ru'
-            rate = match.group("rate") or "+0%"  # если rate не указан, то по умолчанию '+0%'
-            text = match.group("text") or ''
+    # обрабатываем урл, просто достаем текст и показываем с клавиатурой для озвучки
+    args = message.text.split()
+    if len(args) == 2 and my_sum.is_valid_url(args[1]):
+        url = args[1]
+        if '/youtu.be/' in url or 'youtube.com/' in url:
+            text = my_sum.get_text_from_youtube(url)
         else:
-            text = lang = rate = ''
-        lang = lang.strip()
-        rate = rate.strip()
+            text = my_google.download_text([url, ], 100000, no_links = True)
+        if text:
+            reply_to_long_message(message, text, parse_mode='',
+                                disable_web_page_preview=True)
+        return
 
-        if not text or lang not in supported_langs_tts:
-            help = f"""Использование: /tts [ru|en|uk|...] [+-XX%] <текст>|<URL>
+    # разбираем параметры
+    # регулярное выражение для разбора строки
+    pattern = r'/tts\s+((?P<lang>' + '|'.join(supported_langs_tts) + r')\s+)?\s*(?P<rate>([+-]\d{1,2}%\s+))?\s*(?P<text>.+)'
+    # поиск совпадений с регулярным выражением
+    match = re.match(pattern, message.text, re.DOTALL)
+    # извлечение параметров из найденных совпадений
+    if match:
+        lang = match.group("lang") or "ru"  # если lang не указан, то по умолчанию 'ru'
+        rate = match.group("rate") or "+0%"  # если rate не указан, то по умолчанию '+0%'
+        text = match.group("text") or ''
+    else:
+        text = lang = rate = ''
+    lang = lang.strip()
+    rate = rate.strip()
+
+    if not text or lang not in supported_langs_tts:
+        help = f"""Использование: /tts [ru|en|uk|...] [+-XX%] <текст>|<URL>
 
     +-XX% - ускорение с обязательным указанием направления + или -
 
@@ -1138,44 +1061,42 @@ def tts_thread(message: telebot.types.Message):
     Поддерживаемые языки: {', '.join(supported_langs_tts)}
 
     """
-            bot.reply_to(message, help, parse_mode='Markdown')
-            my_log.log_echo(message, help)
-            return
+        bot.reply_to(message, help, parse_mode='Markdown')
+        my_log.log_echo(message, help)
+        return
 
-        with semaphore_talks:
-            with ShowAction(message, 'record_audio'):
-                gender = 'male'
-                audio = None
+    with ShowAction(message, 'record_audio'):
+        gender = 'male'
+        audio = None
+        try:
+            audio = my_tts.tts(text, lang, rate, gender=gender)
+        except:
+            pass
+        if not audio:
+            audio = my_tts.tts(text, 'de', rate, gender=gender)
+        if audio:
+            try:
+                bot.send_voice(message.chat.id, audio, reply_to_message_id = message.message_id)
+            except Exception as error:
+                print(f'tb:tts: {error}')
+                my_log.log2(f'tb:tts: {error}')
                 try:
-                    audio = my_tts.tts(text, lang, rate, gender=gender)
-                except:
-                    pass
-                if not audio:
-                    audio = my_tts.tts(text, 'de', rate, gender=gender)
-                if audio:
-                    try:
-                        bot.send_voice(message.chat.id, audio, reply_to_message_id = message.message_id)
-                    except Exception as error:
-                        print(f'tb:tts: {error}')
-                        my_log.log2(f'tb:tts: {error}')
-                        try:
-                            bot.send_voice(message.chat.id, audio)
-                        except Exception as error2:
-                            print(f'tb:tts: {error2}')
-                            my_log.log2(f'tb:tts: {error2}')
-                            my_log.log_echo(message, '[Не удалось отправить голосовое сообщение]')
-                            return
-                    my_log.log_echo(message, '[Отправил голосовое сообщение]')
-                else:
-                    msg = 'Не удалось озвучить. Возможно вы перепутали язык, например немецкий голос не читает по-русски.'
-                    bot.reply_to(message, msg)
-                    my_log.log_echo(message, msg)
+                    bot.send_voice(message.chat.id, audio)
+                except Exception as error2:
+                    print(f'tb:tts: {error2}')
+                    my_log.log2(f'tb:tts: {error2}')
+                    my_log.log_echo(message, '[Не удалось отправить голосовое сообщение]')
+                    return
+            my_log.log_echo(message, '[Отправил голосовое сообщение]')
+        else:
+            msg = 'Не удалось озвучить. Возможно вы перепутали язык, например немецкий голос не читает по-русски.'
+            bot.reply_to(message, msg)
+            my_log.log_echo(message, msg)
 
 
 @bot.message_handler(commands=['google',])
 def google(message: telebot.types.Message):
-    thread = threading.Thread(target=google_thread, args=(message,))
-    thread.start()
+    dispatch(message, google_thread, message)
 def google_thread(message: telebot.types.Message):
     """ищет в гугле перед ответом"""
 
@@ -1188,22 +1109,16 @@ def google_thread(message: telebot.types.Message):
     else: return
 
     chat_id_full = get_topic_id(message)
-    if chat_id_full in GPT_CHAT_LOCKS:
-        lock = GPT_CHAT_LOCKS[chat_id_full]
-    else:
-        lock = threading.Lock()
-        GPT_CHAT_LOCKS[chat_id_full] = lock
-    with lock:
 
-        my_log.log_echo(message)
+    my_log.log_echo(message)
 
-        chat_id_full = get_topic_id(message)
+    chat_id_full = get_topic_id(message)
 
-        try:
-            q = message.text.split(maxsplit=1)[1]
-        except Exception as error2:
-            print(error2)
-            help = """/google текст запроса
+    try:
+        q = message.text.split(maxsplit=1)[1]
+    except Exception as error2:
+        print(error2)
+        help = """/google текст запроса
 
 Будет делать запрос в гугл, и потом пытаться найти нужный ответ в результатах
 
@@ -1211,47 +1126,45 @@ def google_thread(message: telebot.types.Message):
 /google текст песни малиновая лада
 /google кто звонил +69997778888, из какой страны
     """
-            return
-
-        if test_for_spam('Ж' * cfg.max_request, message.from_user.id):
-            bot.reply_to(message, 'Слишком много сообщений, попробуйте позже')
-            return
-
-        with ShowAction(message, 'typing'):
-            with semaphore_talks:
-                r, _ = my_google.search_v3(q)
-                if r.strip():
-                    r = utils.bot_markdown_to_html(r)
-                else:
-                    r = 'Ничего не нашлось'
-            try:
-                reply_to_long_message(message, r, parse_mode = 'HTML',
-                                      disable_web_page_preview = True,
-                                      reply_markup=get_keyboard('chat', message))
-            except Exception as error2:
-                print(f'tb:google: {error2}')
-                my_log.log2(f'tb:google: {error2}')
-                reply_to_long_message(message, r, parse_mode = '',
-                                      disable_web_page_preview = True,
-                                      reply_markup=get_keyboard('chat', message))
-            my_log.log_echo(message, r)
+        return
 
-            # сохранить в отчет вопрос и ответ для юзера, и там же сохранение в группу
-            my_log.log_report(bot, message, chat_id_full, message.from_user.id, '/google ' + q, r)
+    if test_for_spam('Ж' * cfg.max_request, message.from_user.id):
+        bot.reply_to(message, 'Слишком много сообщений, попробуйте позже')
+        return
 
-            if chat_id_full not in DIALOGS_DB:
-                DIALOGS_DB[chat_id_full] = []
-            DIALOGS_DB[chat_id_full] += [{"role":    'system',
-                                    "content": f'user попросил сделать запрос в Google: {q}'},
-                                        {"role":    'system',
-                                    "content": f'assistant поискал в Google и ответил: {r}'}
-                                    ]
+    with ShowAction(message, 'typing'):
+        r, _ = my_google.search_v3(q)
+        if r.strip():
+            r = utils.bot_markdown_to_html(r)
+        else:
+            r = 'Ничего не нашлось'
+        try:
+            reply_to_long_message(message, r, parse_mode = 'HTML',
+                                  disable_web_page_preview = True,
+                                  reply_markup=get_keyboard('chat', message))
+        except Exception as error2:
+            print(f'tb:google: {error2}')
+            my_log.log2(f'tb:google: {error2}')
+            reply_to_long_message(message, r, parse_mode = '',
+                                  disable_web_page_preview = True,
+                                  reply_markup=get_keyboard('chat', message))
+        my_log.log_echo(message, r)
+
+        # сохранить в отчет вопрос и ответ для юзера, и там же сохранение в группу
+        my_log.log_report(bot, message, chat_id_full, message.from_user.id, '/google ' + q, r)
+
+        if chat_id_full not in DIALOGS_DB:
+            DIALOGS_DB[chat_id_full] = []
+        DIALOGS_DB[chat_id_full] += [{"role":    'system',
+                                "content": f'user попросил сделать запрос в Google: {q}'},
+                                    {"role":    'system',
+                                "content": f'assistant поискал в Google и ответил: {r}'}
+                                ]
 
 
 @bot.message_handler(commands=['image','img','im','i'])
 def image(message: telebot.types.Message):
-    thread = threading.Thread(target=image_thread, args=(message,))
-    thread.start()
+    dispatch(message, image_thread, message)
 def image_thread(message: telebot.types.Message):
     """генерирует картинку по описанию"""
 
@@ -1266,120 +1179,113 @@ def image_thread(message: telebot.types.Message):
     chat_id_full = get_topic_id(message)
     if CHAT_MODE[chat_id_full] != 'image' and not is_admin_member(message):
         return
-    if chat_id_full in GPT_CHAT_LOCKS:
-        lock = GPT_CHAT_LOCKS[chat_id_full]
-    else:
-        lock = threading.Lock()
-        GPT_CHAT_LOCKS[chat_id_full] = lock
-    with lock:
 
-        my_log.log_echo(message)
+    my_log.log_echo(message)
 
-        with semaphore_talks:
-            help = """/image <текстовое описание картинки, что надо нарисовать>
+    help = """/image <текстовое описание картинки, что надо нарисовать>
 
     Пример:
     `/image мишки на севере, ловят рыбу, рисунок карандашом`
     """
-            prompt = message.text.split(maxsplit = 1)
-            if len(prompt) > 1:
-                prompt = prompt[1]
-                # считаем что рисование тратит 1к символов, хотя на самом деле больше
-                if test_for_spam('Ж' * 1 * 1024, message.from_user.id):
-                    bot_reply(message, 'Слишком много сообщений, попробуйте позже')
-                    return
-                with ShowAction(message, 'upload_photo'):
-                    # moderation_flag = gpt_basic.moderation(prompt)
-                    moderation_flag = ''
-                    if moderation_flag:
-                        msg = 'Что то подозрительное есть в вашем запросе, попробуйте написать иначе.'
-                        bot_reply(message, msg)
-                        return
-                    images = my_genimg.gen_images(prompt, moderation_flag)
-                    if len(images) > 0:
-                        medias = []
-                        has_good_images = False
-                        for x in images:
-                            if isinstance(x, bytes):
-                                has_good_images = True
-                                break
-                        for i in images:
-                            if isinstance(i, str):
-                                if i.startswith('error1_') and has_good_images:
-                                    continue
-                                if 'error1_being_reviewed_prompt' in i:
-                                    bot_reply_tr(message, 'Ваш запрос содержит потенциально неприемлемый контент.')
-                                    return
-                                elif 'error1_blocked_prompt' in i:
-                                    bot_reply_tr(message, 'Ваш запрос содержит неприемлемый контент.')
-                                    return
-                                elif 'error1_unsupported_lang' in i:
-                                    bot_reply_tr(message, 'Не понятный язык.')
-                                    return
-                                elif 'error1_Bad images' in i:
-                                    bot_reply_tr(message, 'Ваш запрос содержит неприемлемый контент.')
-                                    return
-                                if 'https://r.bing.com' in i:
-                                    continue
-
-                            d = None
-                            caption_ = prompt
-                            if isinstance(i, str):
-                                d = utils.download_image_as_bytes(i)
-                                caption_ = 'bing.com\n\n' + caption_
-                            elif isinstance(i, bytes):
-                                caption_ = my_genimg.WHO_AUTOR[hash(i)] + '\n\n' + caption_
-                                del my_genimg.WHO_AUTOR[hash(i)]
-                                d = i
-                            if d:
-                                try:
-                                    medias.append(telebot.types.InputMediaPhoto(d, caption = caption_))
-                                except Exception as add_media_error:
-                                    error_traceback = traceback.format_exc()
-                                    my_log.log2(f'tb:image_thread:add_media_bytes: {add_media_error}\n\n{error_traceback}')
-
-                        with SEND_IMG_LOCK:
-                            bot.send_media_group(message.chat.id, medias,
-                                                reply_to_message_id=message.message_id,
-                                                disable_notification=True)
-
-                            # сохранить результат в галерее
-                            if pics_group:
-                                try:
-                                    bot.send_message(cfg.pics_group, f'{prompt} | #{utils.nice_hash(chat_id_full)}',
-                                                     link_preview_options=telebot.types.LinkPreviewOptions(is_disabled=False))
-                                    bot.send_media_group(pics_group, medias)
-                                except Exception as error2:
-                                    my_log.log2(error2)
-
-                            my_log.log_echo(message, '[image gen] ')
-
-                            # сохранить в отчет вопрос и ответ для юзера, и там же сохранение в группу
-                            log_msg = '[Send images] '
-                            for x in images:
-                                if isinstance(x, str):
-                                    log_msg += x + ' '
-                                elif isinstance(x, bytes):
-                                    log_msg += f'[binary file {round(len(x)/1024)}kb] '
-                            my_log.log_report(bot, message, chat_id_full, message.from_user.id, f'/image {prompt}', log_msg)
-
-                            n = [{'role':'system', 'content':f'user попросил нарисовать\n{prompt}'}, {'role':'system', 'content':'assistant нарисовал с помощью DALL-E'}]
-                            if chat_id_full in DIALOGS_DB:
-                                DIALOGS_DB[chat_id_full] += n
-                            else:
-                                DIALOGS_DB[chat_id_full] = n
+    prompt = message.text.split(maxsplit = 1)
+    if len(prompt) > 1:
+        prompt = prompt[1]
+        # считаем что рисование тратит 1к символов, хотя на самом деле больше
+        if test_for_spam('Ж' * 1 * 1024, message.from_user.id):
+            bot_reply(message, 'Слишком много сообщений, попробуйте позже')
+            return
+        with ShowAction(message, 'upload_photo'):
+            # moderation_flag = gpt_basic.moderation(prompt)
+            moderation_flag = ''
+            if moderation_flag:
+                msg = 'Что то подозрительное есть в вашем запросе, попробуйте написать иначе.'
+                bot_reply(message, msg)
+                return
+            images = my_genimg.gen_images(prompt, moderation_flag)
+            if len(images) > 0:
+                medias = []
+                has_good_images = False
+                for x in images:
+                    if isinstance(x, bytes):
+                        has_good_images = True
+                        break
+                for i in images:
+                    if isinstance(i, str):
+                        if i.startswith('error1_') and has_good_images:
+                            continue
+                        if 'error1_being_reviewed_prompt' in i:
+                            bot_reply_tr(message, 'Ваш запрос содержит потенциально неприемлемый контент.')
+                            return
+                        elif 'error1_blocked_prompt' in i:
+                            bot_reply_tr(message, 'Ваш запрос содержит неприемлемый контент.')
+                            return
+                        elif 'error1_unsupported_lang' in i:
+                            bot_reply_tr(message, 'Не понятный язык.')
+                            return
+                        elif 'error1_Bad images' in i:
+                            bot_reply_tr(message, 'Ваш запрос содержит неприемлемый контент.')
+                            return
+                        if 'https://r.bing.com' in i:
+                            continue
+
+                    d = None
+                    caption_ = prompt
+                    if isinstance(i, str):
+                        d = utils.download_image_as_bytes(i)
+                        caption_ = 'bing.com\n\n' + caption_
+                    elif isinstance(i, bytes):
+                        caption_ = my_genimg.WHO_AUTOR[hash(i)] + '\n\n' + caption_
+                        del my_genimg.WHO_AUTOR[hash(i)]
+                        d = i
+                    if d:
+                        try:
+                            medias.append(telebot.types.InputMediaPhoto(d, caption = caption_))
+                        except Exception as add_media_error:
+                            error_traceback = traceback.format_exc()
+                            my_log.log2(f'tb:image_thread:add_media_bytes: {add_media_error}\n\n{error_traceback}')
+
+                with SEND_IMG_LOCK:
+                    bot.send_media_group(message.chat.id, medias,
+                                        reply_to_message_id=message.message_id,
+                                        disable_notification=True)
+
+                    # сохранить результат в галерее
+                    if pics_group:
+                        try:
+                            bot.send_message(cfg.pics_group, f'{prompt} | #{utils.nice_hash(chat_id_full)}',
+                                             link_preview_options=telebot.types.LinkPreviewOptions(is_disabled=False))
+                            bot.send_media_group(pics_group, medias)
+                        except Exception as error2:
+                            my_log.log2(error2)
+
+                    my_log.log_echo(message, '[image gen] ')
+
+                    # сохранить в отчет вопрос и ответ для юзера, и там же сохранение в группу
+                    log_msg = '[Send images] '
+                    for x in images:
+                        if isinstance(x, str):
+                            log_msg += x + ' '
+                        elif isinstance(x, bytes):
+                            log_msg += f'[binary file {round(len(x)/1024)}kb] '
+                    my_log.log_report(bot, message, chat_id_full, message.from_user.id, f'/image {prompt}', log_msg)
+
+                    n = [{'role':'system', 'content':f'user попросил нарисовать\n{prompt}'}, {'role':'system', 'content':'assistant нарисовал с помощью DALL-E'}]
+                    if chat_id_full in DIALOGS_DB:
+                        DIALOGS_DB[chat_id_full] += n
                     else:
-                        bot.reply_to(message, 'Не смог ничего нарисовать. Может настроения нет, а может надо другое описание дать.')
-                        my_log.log_echo(message, '[image gen error] ')
-                        my_log.log_report(bot, message, chat_id_full, message.from_user.id, f'/image {prompt}', 'Не смог ничего нарисовать. Может настроения нет, а может надо другое описание дать.')
-                        n = [{'role':'system', 'content':f'user попросил нарисовать\n{prompt}'}, {'role':'system', 'content':'assistant не захотел или не смог нарисовать это с помощью DALL-E'}]
-                        if chat_id_full in DIALOGS_DB:
-                            DIALOGS_DB[chat_id_full] += n
-                        else:
-                            DIALOGS_DB[chat_id_full] = n
+                        DIALOGS_DB[chat_id_full] = n
             else:
-                bot.reply_to(message, help, parse_mode = 'Markdown')
-                my_log.log_echo(message, help)
+                bot.reply_to(message, 'Не смог ничего нарисовать. Может настроения нет, а может надо другое описание дать.')
+                my_log.log_echo(message, '[image gen error] ')
+                my_log.log_report(bot, message, chat_id_full, message.from_user.id, f'/image {prompt}', 'Не смог ничего нарисовать. Может настроения нет, а может надо другое описание дать.')
+                n = [{'role':'system', 'content':f'user попросил нарисовать\n{prompt}'}, {'role':'system', 'content':'assistant не захотел или не смог нарисовать это с помощью DALL-E'}]
+                if chat_id_full in DIALOGS_DB:
+                    DIALOGS_DB[chat_id_full] += n
+                else:
+                    DIALOGS_DB[chat_id_full] = n
+    else:
+        bot.reply_to(message, help, parse_mode = 'Markdown')
+        my_log.log_echo(message, help)
 
 
 @bot.message_handler(commands=['bingcookieclear', 'kc'], func=authorized_admin)
@@ -1437,8 +1343,7 @@ def set_bing_cookies(message: telebot.types.Message):
 
 @bot.message_handler(commands=['sum'])
 def summ_text(message: telebot.types.Message):
-    thread = threading.Thread(target=summ_text_thread, args=(message,))
-    thread.start()
+    dispatch(message, summ_text_thread, message)
 def summ_text_thread(message: telebot.types.Message):
 
     # работаем только там где администратор включил
@@ -1450,93 +1355,84 @@ def summ_text_thread(message: telebot.types.Message):
     else: return
 
     chat_id_full = get_topic_id(message)
-    if chat_id_full in GPT_CHAT_LOCKS:
-        lock = GPT_CHAT_LOCKS[chat_id_full]
-    else:
-        lock = threading.Lock()
-        GPT_CHAT_LOCKS[chat_id_full] = lock
 
     if test_for_spam('Ж' * cfg.max_request, message.from_user.id):
         bot.reply_to(message, 'Слишком много сообщений, попробуйте позже')
         return
 
-    with lock:
-
-        my_log.log_echo(message)
+    my_log.log_echo(message)
 
-        text = message.text
+    text = message.text
         
-        if len(text.split(' ', 1)) == 2:
-            url = text.split(' ', 1)[1].strip()
-            if my_sum.is_valid_url(url):
-                # убираем из ютуб урла временную метку
-                if '/youtu.be/' in url or 'youtube.com/' in url:
-                    url = url.split("&t=")[0]
-
-                with semaphore_talks:
-
-                    #смотрим нет ли в кеше ответа на этот урл
-                    r = ''
-                    if url in SUM_CACHE:
-                        r = SUM_CACHE[url]
-                    if r:
-                        reply_to_long_message(message, utils.bot_markdown_to_html(r),
-                                              disable_web_page_preview = True,
-                                              reply_markup=get_keyboard('chat', message),
-                                              parse_mode='HTML')
-                        my_log.log_echo(message, r)
-
-                        # сохранить в отчет вопрос и ответ для юзера, и там же сохранение в группу
-                        my_log.log_report(bot, message, chat_id_full, message.from_user.id, '/sum ' + url, r)
-
-                        if chat_id_full not in DIALOGS_DB:
-                            DIALOGS_DB[chat_id_full] = []
-                        DIALOGS_DB[chat_id_full] += [{"role":    'system',
-                                    "content": f'user попросил кратко пересказать содержание текста по ссылке/из файла'},
-                                    {"role":    'system',
-                                    "content": f'assistant прочитал и ответил: {r}'}
-                                    ]
-                        return
+    if len(text.split(' ', 1)) == 2:
+        url = text.split(' ', 1)[1].strip()
+        if my_sum.is_valid_url(url):
+            # убираем из ютуб урла временную метку
+            if '/youtu.be/' in url or 'youtube.com/' in url:
+                url = url.split("&t=")[0]
 
-                    with ShowAction(message, 'typing'):
-                        res = ''
-                        try:
-                            res, _ = my_sum.summ_url(url)
-                        except Exception as error2:
-                            print(f'tb:sum: {error2}')
-                            my_log.log2(f'tb:sum: {error2}')
-                            m = 'Не нашел тут текста. Возможно что в видео на ютубе нет субтитров или страница не показывает текст роботам'
-                            bot.reply_to(message, m, parse_mode='Markdown')
-                            my_log.log_report(bot, message, chat_id_full, message.from_user.id, '/sum ' + url, m)
-                            my_log.log_echo(message, m)
-                            return
-                        if res:
-                            reply_to_long_message(message, utils.bot_markdown_to_html(res), parse_mode='HTML',
-                                                disable_web_page_preview = True,
-                                                reply_markup=get_keyboard('chat', message))
-                            my_log.log_echo(message, res)
+            #смотрим нет ли в кеше ответа на этот урл
+            r = ''
+            if url in SUM_CACHE:
+                r = SUM_CACHE[url]
+            if r:
+                reply_to_long_message(message, utils.bot_markdown_to_html(r),
+                                      disable_web_page_preview = True,
+                                      reply_markup=get_keyboard('chat', message),
+                                      parse_mode='HTML')
+                my_log.log_echo(message, r)
 
-                            # сохранить в отчет вопрос и ответ для юзера, и там же сохранение в группу
-                            my_log.log_report(bot, message, chat_id_full, message.from_user.id, '/sum ' + url, res)
+                # сохранить в отчет вопрос и ответ для юзера, и там же сохранение в группу
+                my_log.log_report(bot, message, chat_id_full, message.from_user.id, '/sum ' + url, r)
+
+                if chat_id_full not in DIALOGS_DB:
+                    DIALOGS_DB[chat_id_full] = []
+                DIALOGS_DB[chat_id_full] += [{"role":    'system',
+                            "content": f'user попросил кратко пересказать содержание текста по ссылке/из файла'},
+                            {"role":    'system',
+                            "content": f'assistant прочитал и ответил: {r}'}
+                            ]
+                return
 
-                            SUM_CACHE[url] = res
-                            if chat_id_full not in DIALOGS_DB:
-                                DIALOGS_DB[chat_id_full] = []
-                            DIALOGS_DB[chat_id_full] += [{"role":    'system',
-                                    "content": f'user попросил кратко пересказать содержание текста по ссылке/из файла'},
-                                    {"role":    'system',
-                                    "content": f'assistant прочитал и ответил: {res}'}
-                                    ]
-                            return
-                        else:
-                            error = 'Не смог прочитать текст с этой страницы.'
-                            bot.reply_to(message, error)
-                            my_log.log_echo(message, error)
-                            my_log.log_report(bot, message, chat_id_full, message.from_user.id, '/sum ' + url, error)
-                            return
-        help = """Пример: /sum https://youtu.be/3i123i6Bf-U"""
-        bot.reply_to(message, help, parse_mode = 'Markdown')
-        my_log.log_echo(message, help)
+            with ShowAction(message, 'typing'):
+                res = ''
+                try:
+                    res, _ = my_sum.summ_url(url)
+                except Exception as error2:
+                    print(f'tb:sum: {error2}')
+                    my_log.log2(f'tb:sum: {error2}')
+                    m = 'Не нашел тут текста. Возможно что в видео на ютубе нет субтитров или страница не показывает текст роботам'
+                    bot.reply_to(message, m, parse_mode='Markdown')
+                    my_log.log_report(bot, message, chat_id_full, message.from_user.id, '/sum ' + url, m)
+                    my_log.log_echo(message, m)
+                    return
+                if res:
+                    reply_to_long_message(message, utils.bot_markdown_to_html(res), parse_mode='HTML',
+                                        disable_web_page_preview = True,
+                                        reply_markup=get_keyboard('chat', message))
+                    my_log.log_echo(message, res)
+
+                    # сохранить в отчет вопрос и ответ для юзера, и там же сохранение в группу
+                    my_log.log_report(bot, message, chat_id_full, message.from_user.id, '/sum ' + url, res)
+
+                    SUM_CACHE[url] = res
+                    if chat_id_full not in DIALOGS_DB:
+                        DIALOGS_DB[chat_id_full] = []
+                    DIALOGS_DB[chat_id_full] += [{"role":    'system',
+                            "content": f'user попросил кратко пересказать содержание текста по ссылке/из файла'},
+                            {"role":    'system',
+                            "content": f'assistant прочитал и ответил: {res}'}
+                            ]
+                    return
+                else:
+                    error = 'Не смог прочитать текст с этой страницы.'
+                    bot.reply_to(message, error)
+                    my_log.log_echo(message, error)
+                    my_log.log_report(bot, message, chat_id_full, message.from_user.id, '/sum ' + url, error)
+                    return
+    help = """Пример: /sum https://youtu.be/3i123i6Bf-U"""
+    bot.reply_to(message, help, parse_mode = 'Markdown')
+    my_log.log_echo(message, help)
 
 
 @bot.message_handler(commands=['sum2'])
@@ -1617,7 +1513,7 @@ def send_welcome_help(message: telebot.types.Message):
 /id - покажет id юзера и группы
 /add - для добавления стоп слова
 /del - для удаления стоп слова
-/export - для экспорта данных, работает только в привате у бота
+/export - для экспорта данных, работает только в привате у бота, можно указать период и юзера /export 2024-01-01 2024-01-31 123456
 /restart - для перезапуска бота, если он завис
 
 /sum - пересказ текста по ссылке
@@ -1632,14 +1528,8 @@ def reply_to_long_message(message: telebot.types.Message, resp: str, parse_mode:
                           disable_web_page_preview: bool = None,
                           reply_markup: telebot.types.InlineKeyboardMarkup = None,
                           disable_notification = True):
-    """отправляем сообщение, если оно слишком длинное то разбивает на части либо отправляем как текстовый файл"""
-
-    def get_seconds(s):
-        match = re.search(r"after\s+(?P<seconds>\d+)", s)
-        if match:
-            return int(match.group("seconds"))
-        else:
-            return 0
+    """отправляем сообщение, если оно слишком длинное то разбивает на части либо отправляем как текстовый файл
+    все части сразу ставятся в очередь SENDER и уходят так быстро как разрешает телеграм, ждем пока все дойдут"""
 
     preview = telebot.types.LinkPreviewOptions(is_disabled=disable_web_page_preview)
 
@@ -1648,32 +1538,18 @@ def reply_to_long_message(message: telebot.types.Message, resp: str, parse_mode:
             chunks = utils.split_html(resp, 3800)
         else:
             chunks = utils.split_text(resp, 3800)
-        for chunk in chunks:
-            try:
-                bot.reply_to(message, chunk, parse_mode=parse_mode,
-                             link_preview_options=preview,
-                             reply_markup=reply_markup,
-                             disable_notification=disable_notification)
-            except Exception as error:
-                if 'Too Many Requests: retry after' in str(error):
-                    time.sleep(get_seconds(str(error)))
-                    bot.reply_to(message, chunk, parse_mode=parse_mode,
-                                link_preview_options=preview,
-                                reply_markup=reply_markup,
-                                disable_notification=disable_notification)
-                else:
-                    print(f'tb:reply_to_long_message: {error}')
-                    my_log.log2(f'tb:reply_to_long_message: {error}')
-                    bot.reply_to(message, chunk, parse_mode='',
-                                link_preview_options=preview,
-                                reply_markup=reply_markup,
-                                disable_notification=disable_notification)
-            time.sleep(2)
+        futures = [SENDER.send(message.chat.id, bot.reply_to, message, chunk, parse_mode=parse_mode,
+                               link_preview_options=preview,
+                               reply_markup=reply_markup,
+                               disable_notification=disable_notification) for chunk in chunks]
     else:
         buf = io.BytesIO()
         buf.write(resp.encode())
         buf.seek(0)
-        bot.send_document(message.chat.id, document=buf, caption='resp.txt', visible_file_name = 'resp.txt')
+        futures = [SENDER.send(message.chat.id, bot.send_document, message.chat.id, document=buf,
+                               caption='resp.txt', visible_file_name = 'resp.txt')]
+    for future in futures:
+        future.result()
 
 
 def send_message_to_admin(message: telebot.types.Message, bad_word_found: str, stop_words):
@@ -1734,13 +1610,7 @@ def get_history_of_chat(chat_id_full: str) -> str:
             messages = DIALOGS_DB[chat_id_full]
 
         # теперь ее надо почистить что бы влезла в запрос к GPT
-        # просто удаляем все кроме max_hist_lines последних
-        if len(messages) > cfg.max_hist_lines:
-            messages = messages[cfg.max_hist_lines:]
-        # удаляем первую запись в истории до тех пор пока общее количество токенов не станет меньше cfg.max_hist_bytes
-        # удаляем по 2 сразу так как первая - промпт для бота
-        while (utils.count_tokens(messages) > cfg.max_hist_bytes):
-            messages = messages[2:]
+        messages = my_history.trim(messages, cfg.max_hist_bytes, cfg.max_hist_lines, chatgpt_message_size)
 
         prompt = '\n'.join(f'{i["role"]} - {i["content"]}\n' for i in messages) or 'Пусто'
         return prompt
@@ -1751,8 +1621,17 @@ def get_history_of_chat(chat_id_full: str) -> str:
 @bot.message_handler(func=lambda message: True)
 def echo_all(message: telebot.types.Message, custom_prompt: str = '') -> None:
     """Обработчик текстовых сообщений"""
-    thread = threading.Thread(target=do_task, args=(message, custom_prompt))
-    thread.start()
+    if custom_prompt or message.text.startswith('/'):
+        dispatch(message, do_task, message, custom_prompt)
+    else:
+        # куски длинного сообщения собираются в одно, do_task получит их уже склеенными
+        MESSAGE_QUEUE.add(get_topic_id(message), message)
+def do_task_coalesced(chat_id_full: str, messages: list):
+    """все куски сообщения пришли, вызывается из потока планировщика"""
+    message = messages[0]
+    if len(messages) > 1:
+        message.text = '\n\n'.join(x.text for x in messages)
+    dispatch(message, do_task, message)
 def do_task(message, custom_prompt: str = ''):
     """функция обработчик сообщений работающая в отдельном потоке"""
 
@@ -1767,25 +1646,6 @@ def do_task(message, custom_prompt: str = ''):
     if message.text.startswith('/'): return
 
 
-    # отлавливаем слишком длинные сообщения
-    if chat_id_full not in MESSAGE_QUEUE:
-        MESSAGE_QUEUE[chat_id_full] = message.text
-        last_state = MESSAGE_QUEUE[chat_id_full]
-        n = 5
-        while n > 0:
-            n -= 1
-            time.sleep(0.1)
-            new_state = MESSAGE_QUEUE[chat_id_full]
-            if last_state != new_state:
-                last_state = new_state
-                n = 5
-        message.text = last_state
-        del MESSAGE_QUEUE[chat_id_full]
-    else:
-        MESSAGE_QUEUE[chat_id_full] += message.text + '\n\n'
-        return
-
-
     # если админ прислал новые куки для бинга
     if message.chat.id in cfg.admins:
         if '"name": "_U",' in message.text:
@@ -1796,409 +1656,409 @@ def do_task(message, custom_prompt: str = ''):
                         reply_to_long_message(message, "Куки файл обновлен.")
                         return
 
-    with semaphore_talks:
-
-        my_log.log_echo(message)
-
-        user_id = message.from_user.id
-        user_text = message.text
-
-        # является ли это сообщение топика, темы (особые чаты внутри чатов)
-        is_topic = message.is_topic_message or (message.reply_to_message and message.reply_to_message.is_topic_message)
-        # является ли это ответом на сообщение бота
-        is_reply = message.reply_to_message and message.reply_to_message.from_user.id == BOT_ID
+    my_log.log_echo(message)
 
-        # удаляем пробелы в конце каждой строки
-        message.text = "\n".join([line.rstrip() for line in message.text.split("\n")])
+    user_id = message.from_user.id
+    user_text = message.text
+
+    # является ли это сообщение топика, темы (особые чаты внутри чатов)
+    is_topic = message.is_topic_message or (message.reply_to_message and message.reply_to_message.is_topic_message)
+    # является ли это ответом на сообщение бота
+    is_reply = message.reply_to_message and message.reply_to_message.from_user.id == BOT_ID
+
+    # удаляем пробелы в конце каждой строки
+    message.text = "\n".join([line.rstrip() for line in message.text.split("\n")])
+    msg = message.text.lower()
+    # убираем имя бота из запроса
+    if msg.startswith(BOT_NAME):
+        message.text = message.text.split(maxsplit = 1)[1]
         msg = message.text.lower()
-        # убираем имя бота из запроса
-        if msg.startswith(BOT_NAME):
-            message.text = message.text.split(maxsplit = 1)[1]
-            msg = message.text.lower()
-
-        # проверяем нет ли запрещенных слов
-        letters = re.compile('[^а-яА-ЯёЁa-zA-Z0-9\'\`\$\_\-\{\}\[\]\<\>\@\*\|\s]')
-        msg2 = letters.sub(' ', msg)
-        # и разбиваем текст на слова
-        words_in_msg2 = [x.strip() for x in msg2.split()]
-        for x in words_in_msg2:
-            if any(fuzz.ratio(x, keyword) > 90 for keyword in STOP_WORDS):
-                if x not in STOP_WORDS_FALSE_POSITIVE or x in STOP_WORDS:
-                    # сообщить администратору о нарушителе
-                    send_message_to_admin(message, x, [keyword for keyword in STOP_WORDS if fuzz.ratio(x, keyword) > 90])
-                    break
-
-        # не отвечать если это ответ юзера другому юзеру
-        try:
-            _ = message.dont_check_topic
-        except AttributeError:
-            message.dont_check_topic = False
-        if not message.dont_check_topic:
-            if is_topic: # в топиках всё не так как в обычных чатах
-                # если ответ не мне либо запрос ко всем(в топике он выглядит как ответ с content_type == 'forum_topic_created')
-                if not (is_reply or message.reply_to_message.content_type == 'forum_topic_created'):
-                    return
-            else:
-                # если это ответ в обычном чате но ответ не мне то выход
-                if message.reply_to_message and not is_reply:
-                    return
 
-        # по умолчанию отвечает chatGPT
-        if chat_id_full not in CHAT_MODE:
-            CHAT_MODE[chat_id_full] = 'chatGPT'
-
-        # команда для рисования
-        if CHAT_MODE[chat_id_full] == 'image' or is_admin_member(message):
-            first_word = msg.split(maxsplit=1)[0]
-            image_words = ['нарисуй', 'создай', 'изобрази', 'начерти', 'сделай',
-                           'намалюй', 'очерти', 'накидай', 'набросай', 'представь',
-                           'передай', 'рисуй', 'воссоздай', 'отобрази',
-                           'зарисуй']
-            for w in image_words:
-                if fuzz.ratio(first_word, w) > 80:
-                    message.text = '/image ' + message.text.split(maxsplit=1)[1]
-                    image_thread(message)
-                    return
-            if CHAT_MODE[chat_id_full] == 'image':
+    # проверяем нет ли запрещенных слов
+    letters = re.compile('[^а-яА-ЯёЁa-zA-Z0-9\'\`\$\_\-\{\}\[\]\<\>\@\*\|\s]')
+    msg2 = letters.sub(' ', msg)
+    # и разбиваем текст на слова
+    words_in_msg2 = [x.strip() for x in msg2.split()]
+    stop_words_index = STOP_WORDS_INDEX
+    for x in words_in_msg2:
+        keywords = stop_words_index.match(x)
+        if keywords:
+            if x not in STOP_WORDS_FALSE_POSITIVE or x in stop_words_index:
+                # сообщить администратору о нарушителе
+                send_message_to_admin(message, x, keywords)
+                break
+
+    # не отвечать если это ответ юзера другому юзеру
+    try:
+        _ = message.dont_check_topic
+    except AttributeError:
+        message.dont_check_topic = False
+    if not message.dont_check_topic:
+        if is_topic: # в топиках всё не так как в обычных чатах
+            # если ответ не мне либо запрос ко всем(в топике он выглядит как ответ с content_type == 'forum_topic_created')
+            if not (is_reply or message.reply_to_message.content_type == 'forum_topic_created'):
+                return
+        else:
+            # если это ответ в обычном чате но ответ не мне то выход
+            if message.reply_to_message and not is_reply:
                 return
 
-        # можно перенаправить запрос к гуглу или если режим perplexity/google
-        if CHAT_MODE[chat_id_full] == 'perplexity' or msg.startswith(tuple(cfg.search_commands)):
-            if msg.startswith(tuple(cfg.search_commands)):
-                prompt = message.text.split(maxsplit=1)[1].strip()
-            else:
-                prompt = message.text
-            my_log.log2(f'/google {prompt}')
-            message.text = f'/google {prompt}'
-            google(message)
-            return
-
-        # если сообщение начинается на 'забудь' то стираем историю общения GPT
-        if msg.startswith('забудь'):
-            clear_thread(message)
-            return
+    # по умолчанию отвечает chatGPT
+    if chat_id_full not in CHAT_MODE:
+        CHAT_MODE[chat_id_full] = 'chatGPT'
 
-        # если в сообщении только ссылка тогда суммаризируем текст из неё
-        if my_sum.is_valid_url(message.text):
-            message.text = '/sum ' + message.text
-            summ_text(message)
+    # команда для рисования
+    if CHAT_MODE[chat_id_full] == 'image' or is_admin_member(message):
+        first_word = msg.split(maxsplit=1)[0]
+        image_words = ['нарисуй', 'создай', 'изобрази', 'начерти', 'сделай',
+                       'намалюй', 'очерти', 'накидай', 'набросай', 'представь',
+                       'передай', 'рисуй', 'воссоздай', 'отобрази',
+                       'зарисуй']
+        for w in image_words:
+            if fuzz.ratio(first_word, w) > 80:
+                message.text = '/image ' + message.text.split(maxsplit=1)[1]
+                image_thread(message)
+                return
+        if CHAT_MODE[chat_id_full] == 'image':
             return
 
-        # проверяем просят ли нарисовать что-нибудь
-        # if msg.startswith(('нарисуй ', 'нарисуй,')):
-        #     prompt = msg[8:]
-        #     if prompt:
-        #         message.text = f'/image {prompt}'
-        #         image_thread(message)
-        #         n = [{'role':'system', 'content':f'user попросил нарисовать\n{prompt}'}, {'role':'system', 'content':'assistant нарисовал с помощью DALL-E'}]
-        #         if chat_id_full in DIALOGS_DB:
-        #             DIALOGS_DB[chat_id_full] += n
-        #         else:
-        #             DIALOGS_DB[chat_id_full] = n
-        #         return
-
-        # можно перенаправить запрос к барду
-        if msg.startswith(tuple(cfg.bard_commands)):
+    # можно перенаправить запрос к гуглу или если режим perplexity/google
+    if CHAT_MODE[chat_id_full] == 'perplexity' or msg.startswith(tuple(cfg.search_commands)):
+        if msg.startswith(tuple(cfg.search_commands)):
             prompt = message.text.split(maxsplit=1)[1].strip()
-            message.text = f'/bard {prompt}'
-            bard(message)
-            return
+        else:
+            prompt = message.text
+        my_log.log2(f'/google {prompt}')
+        message.text = f'/google {prompt}'
+        google(message)
+        return
 
-        # слишком длинное сообщение для бота
-        if len(msg) > cfg.max_message_from_user:
-            bot.reply_to(message, f'Слишком длинное сообщение чат-для бота: {len(msg)} из {cfg.max_message_from_user}')
-            my_log.log_echo(message, f'Слишком длинное сообщение чат-для бота: {len(msg)} из {cfg.max_message_from_user}')
-            return
+    # если сообщение начинается на 'забудь' то стираем историю общения GPT
+    if msg.startswith('забудь'):
+        clear_thread(message)
+        return
 
-        # если активирован бард
-        if CHAT_MODE[chat_id_full] == 'bard':
-            if len(msg) > my_bard.MAX_REQUEST:
-                bot.reply_to(message, f'Слишком длинное сообщение для барда: {len(msg)} из {my_bard.MAX_REQUEST}')
-                my_log.log_echo(message, f'Слишком длинное сообщение для барда: {len(msg)} из {my_bard.MAX_REQUEST}')
-                return
+    # если в сообщении только ссылка тогда суммаризируем текст из неё
+    if my_sum.is_valid_url(message.text):
+        message.text = '/sum ' + message.text
+        summ_text(message)
+        return
 
-            with ShowAction(message, 'typing'):
-                try:
+    # проверяем просят ли нарисовать что-нибудь
+    # if msg.startswith(('нарисуй ', 'нарисуй,')):
+    #     prompt = msg[8:]
+    #     if prompt:
+    #         message.text = f'/image {prompt}'
+    #         image_thread(message)
+    #         n = [{'role':'system', 'content':f'user попросил нарисовать\n{prompt}'}, {'role':'system', 'content':'assistant нарисовал с помощью DALL-E'}]
+    #         if chat_id_full in DIALOGS_DB:
+    #             DIALOGS_DB[chat_id_full] += n
+    #         else:
+    #             DIALOGS_DB[chat_id_full] = n
+    #         return
+
+    # можно перенаправить запрос к барду
+    if msg.startswith(tuple(cfg.bard_commands)):
+        prompt = message.text.split(maxsplit=1)[1].strip()
+        message.text = f'/bard {prompt}'
+        bard(message)
+        return
+
+    # слишком длинное сообщение для бота
+    if len(msg) > cfg.max_message_from_user:
+        bot.reply_to(message, f'Слишком длинное сообщение чат-для бота: {len(msg)} из {cfg.max_message_from_user}')
+        my_log.log_echo(message, f'Слишком длинное сообщение чат-для бота: {len(msg)} из {cfg.max_message_from_user}')
+        return
+
+    # если активирован бард
+    if CHAT_MODE[chat_id_full] == 'bard':
+        if len(msg) > my_bard.MAX_REQUEST:
+            bot.reply_to(message, f'Слишком длинное сообщение для барда: {len(msg)} из {my_bard.MAX_REQUEST}')
+            my_log.log_echo(message, f'Слишком длинное сообщение для барда: {len(msg)} из {my_bard.MAX_REQUEST}')
+            return
+
+        with ShowAction(message, 'typing'):
+            try:
+                answer = my_bard.chat(message.text, chat_id_full)
+                if not answer:
                     answer = my_bard.chat(message.text, chat_id_full)
-                    if not answer:
-                        answer = my_bard.chat(message.text, chat_id_full)
-                    # my_log.log_echo(message, answer, debug = True)
-
-                    my_log.log_echo(message, answer)
-                    if answer:
-                        images = []
-                        links = []
-                        for x in my_bard.REPLIES:
-                            if x[0] == answer:
-                                images, links = x[1][:10], x[2]
-                                # links_titles = utils.get_page_names(links)
-                                # text_links = ''
-                                # for link, title in links, links_titles:
-                                #     text_links += f'<a href="{link}">{title}</a>\n'
-                                break
-
-                        answer = utils.bot_markdown_to_html(answer)
-                        answer = answer.strip()
-                        answer += '\n\n[Google Bard]'
+                # my_log.log_echo(message, answer, debug = True)
+
+                my_log.log_echo(message, answer)
+                if answer:
+                    images = []
+                    links = []
+                    for x in my_bard.REPLIES:
+                        if x[0] == answer:
+                            images, links = x[1][:10], x[2]
+                            # links_titles = utils.get_page_names(links)
+                            # text_links = ''
+                            # for link, title in links, links_titles:
+                            #     text_links += f'<a href="{link}">{title}</a>\n'
+                            break
 
-                        try:
-                            reply_to_long_message(message, answer, parse_mode='HTML', disable_web_page_preview = True, 
-                                                    reply_markup=get_keyboard('chat', message))
-                        except Exception as error:
-                            print(f'tb:do_task: {error}')
-                            my_log.log2(f'tb:do_task: {error}')
-                            reply_to_long_message(message, answer, parse_mode='', disable_web_page_preview = True, 
-                                                    reply_markup=get_keyboard('chat', message))
+                    answer = utils.bot_markdown_to_html(answer)
+                    answer = answer.strip()
+                    answer += '\n\n[Google Bard]'
 
-                        try:
-                            if images:
-                                images_group = [telebot.types.InputMediaPhoto(i) for i in utils.download_images(images)]
-                                photos_ids = bot.send_media_group(message.chat.id, images_group[:10], reply_to_message_id=message.message_id)
-                        except Exception as error2:
-                            print(f'tb:do_task:bard_send_images: {error2}')
-                            my_log.log2(f'tb:do_task:bard_send_images: {error2}')
+                    try:
+                        reply_to_long_message(message, answer, parse_mode='HTML', disable_web_page_preview = True, 
+                                                reply_markup=get_keyboard('chat', message))
+                    except Exception as error:
+                        print(f'tb:do_task: {error}')
+                        my_log.log2(f'tb:do_task: {error}', chat_id_full)
+                        reply_to_long_message(message, answer, parse_mode='', disable_web_page_preview = True, 
+                                                reply_markup=get_keyboard('chat', message))
 
+                    try:
                         if images:
-                            my_log.log_report(bot, message, chat_id_full, user_id, user_text, answer + '\n\n' + '\n'.join(images), parse_mode='HTML')
-                        else:
-                            my_log.log_report(bot, message, chat_id_full, user_id, user_text, answer, parse_mode='HTML')
-
+                            images_group = [telebot.types.InputMediaPhoto(i) for i in utils.download_images(images)]
+                            photos_ids = bot.send_media_group(message.chat.id, images_group[:10], reply_to_message_id=message.message_id)
+                    except Exception as error2:
+                        print(f'tb:do_task:bard_send_images: {error2}')
+                        my_log.log2(f'tb:do_task:bard_send_images: {error2}', chat_id_full)
+
+                    if images:
+                        my_log.log_report(bot, message, chat_id_full, user_id, user_text, answer + '\n\n' + '\n'.join(images), parse_mode='HTML')
                     else:
-                        # my_log.log_echo(message, resp, debug = True)
-                        my_log.log_report(bot, message, chat_id_full, user_id, user_text, 'Google Bard не ответил', parse_mode='HTML')
-                        bot.reply_to(message, 'Google Bard не ответил, возможно /reset поможет')
-                except Exception as error3:
-                    print(f'tb:do_task: {error3}')
-                    my_log.log2(f'tb:do_task: {error3}')
-
-        # если активирован llama
-        elif CHAT_MODE[chat_id_full] == 'llama':
-            if len(msg) > my_groq.MAX_REQUEST:
-                bot.reply_to(message, f'Слишком длинное сообщение для ламы: {len(msg)} из {my_groq.MAX_REQUEST}')
-                my_log.log_echo(message, f'Слишком длинное сообщение для ламы: {len(msg)} из {my_groq.MAX_REQUEST}')
-                return
-
-            with ShowAction(message, 'typing'):
-                try:
-                    start_time = time.time()
-                    answer = my_groq.chat('(отвечай на русском языке) ' + message.text, chat_id_full)
-                    end_time = time.time()
-                    delta_time = round(end_time - start_time, 2)
-                    my_log.log_echo(message, answer)
-                    if answer:
-                        answer = utils.bot_markdown_to_html(answer)
-                        answer = answer.strip()
-                        answer += f'\n\n[llama 3.1 70b] [Generated in {delta_time} secs]'
-                        try:
-                            reply_to_long_message(message, answer, parse_mode='HTML', disable_web_page_preview = True, 
-                                                    reply_markup=get_keyboard('chat', message))
-                        except Exception as error:
-                            print(f'tb:do_task: {error}')
-                            my_log.log2(f'tb:do_task: {error}')
-                            reply_to_long_message(message, answer, parse_mode='', disable_web_page_preview = True, 
-                                                    reply_markup=get_keyboard('chat', message))
                         my_log.log_report(bot, message, chat_id_full, user_id, user_text, answer, parse_mode='HTML')
-                    else:
-                        my_log.log_report(bot, message, chat_id_full, user_id, user_text, 'Лама не ответила', parse_mode='HTML')
-                        bot.reply_to(message, 'Лама не ответила, возможно /reset поможет')
-                except Exception as error3:
-                    print(f'tb:do_task: {error3}')
-                    my_log.log2(f'tb:do_task: {error3}')
-
-        # если активирован haiku
-        elif CHAT_MODE[chat_id_full] == 'haiku':
-            if len(msg) > gpt_basic_2.MAX_REQUEST:
-                bot.reply_to(message, f'Слишком длинное сообщение для haiku: {len(msg)} из {gpt_basic_2.MAX_REQUEST}')
-                my_log.log_echo(message, f'Слишком длинное сообщение для haiku: {len(msg)} из {gpt_basic_2.MAX_REQUEST}')
-                return
 
-            with ShowAction(message, 'typing'):
-                try:
-                    answer = gpt_basic_2.chat(message.text, chat_id_full)
-                    my_log.log_echo(message, answer)
-                    if answer:
-                        answer = utils.bot_markdown_to_html(answer)
-                        answer = answer.strip()
-                        answer += '\n\n[claude 3 haiku]'
-                        try:
-                            reply_to_long_message(message, answer, parse_mode='HTML', disable_web_page_preview = True, 
-                                                    reply_markup=get_keyboard('chat', message))
-                        except Exception as error:
-                            print(f'tb:do_task: {error}')
-                            my_log.log2(f'tb:do_task: {error}')
-                            reply_to_long_message(message, answer, parse_mode='', disable_web_page_preview = True, 
-                                                    reply_markup=get_keyboard('chat', message))
-                        my_log.log_report(bot, message, chat_id_full, user_id, user_text, answer, parse_mode='HTML')
-                    else:
-                        my_log.log_report(bot, message, chat_id_full, user_id, user_text, 'Claude 3 haiku не ответил', parse_mode='HTML')
-                        bot.reply_to(message, 'haiku не ответила, возможно /reset поможет')
-                except Exception as error3:
-                    print(f'tb:do_task: {error3}')
-                    my_log.log2(f'tb:do_task: {error3}')
+                else:
+                    # my_log.log_echo(message, resp, debug = True)
+                    my_log.log_report(bot, message, chat_id_full, user_id, user_text, 'Google Bard не ответил', parse_mode='HTML')
+                    bot.reply_to(message, 'Google Bard не ответил, возможно /reset поможет')
+            except Exception as error3:
+                print(f'tb:do_task: {error3}')
+                my_log.log2(f'tb:do_task: {error3}', chat_id_full)
+
+    # если активирован llama
+    elif CHAT_MODE[chat_id_full] == 'llama':
+        if len(msg) > my_groq.MAX_REQUEST:
+            bot.reply_to(message, f'Слишком длинное сообщение для ламы: {len(msg)} из {my_groq.MAX_REQUEST}')
+            my_log.log_echo(message, f'Слишком длинное сообщение для ламы: {len(msg)} из {my_groq.MAX_REQUEST}')
+            return
+
+        with ShowAction(message, 'typing'):
+            try:
+                start_time = time.time()
+                answer = my_groq.chat('(отвечай на русском языке) ' + message.text, chat_id_full)
+                end_time = time.time()
+                delta_time = round(end_time - start_time, 2)
+                my_log.log_echo(message, answer)
+                if answer:
+                    answer = utils.bot_markdown_to_html(answer)
+                    answer = answer.strip()
+                    answer += f'\n\n[llama 3.1 70b] [Generated in {delta_time} secs]'
+                    try:
+                        reply_to_long_message(message, answer, parse_mode='HTML', disable_web_page_preview = True, 
+                                                reply_markup=get_keyboard('chat', message))
+                    except Exception as error:
+                        print(f'tb:do_task: {error}')
+                        my_log.log2(f'tb:do_task: {error}', chat_id_full)
+                        reply_to_long_message(message, answer, parse_mode='', disable_web_page_preview = True, 
+                                                reply_markup=get_keyboard('chat', message))
+                    my_log.log_report(bot, message, chat_id_full, user_id, user_text, answer, parse_mode='HTML')
+                else:
+                    my_log.log_report(bot, message, chat_id_full, user_id, user_text, 'Лама не ответила', parse_mode='HTML')
+                    bot.reply_to(message, 'Лама не ответила, возможно /reset поможет')
+            except Exception as error3:
+                print(f'tb:do_task: {error3}')
+                my_log.log2(f'tb:do_task: {error3}', chat_id_full)
 
+    # если активирован haiku
+    elif CHAT_MODE[chat_id_full] == 'haiku':
+        if len(msg) > gpt_basic_2.MAX_REQUEST:
+            bot.reply_to(message, f'Слишком длинное сообщение для haiku: {len(msg)} из {gpt_basic_2.MAX_REQUEST}')
+            my_log.log_echo(message, f'Слишком длинное сообщение для haiku: {len(msg)} из {gpt_basic_2.MAX_REQUEST}')
+            return
 
-        # если активирован gemma2
-        elif CHAT_MODE[chat_id_full] == 'gemma2-9b':
-            if len(msg) > gpt_basic_3.MAX_REQUEST:
-                bot.reply_to(message, f'Слишком длинное сообщение для gemma2 9b: {len(msg)} из {my_groq.MAX_REQUEST}')
-                my_log.log_echo(message, f'Слишком длинное сообщение для gemma2 9b: {len(msg)} из {my_groq.MAX_REQUEST}')
-                return
+        with ShowAction(message, 'typing'):
+            try:
+                answer = gpt_basic_2.chat(message.text, chat_id_full)
+                my_log.log_echo(message, answer)
+                if answer:
+                    answer = utils.bot_markdown_to_html(answer)
+                    answer = answer.strip()
+                    answer += '\n\n[claude 3 haiku]'
+                    try:
+                        reply_to_long_message(message, answer, parse_mode='HTML', disable_web_page_preview = True, 
+                                                reply_markup=get_keyboard('chat', message))
+                    except Exception as error:
+                        print(f'tb:do_task: {error}')
+                        my_log.log2(f'tb:do_task: {error}', chat_id_full)
+                        reply_to_long_message(message, answer, parse_mode='', disable_web_page_preview = True, 
+                                                reply_markup=get_keyboard('chat', message))
+                    my_log.log_report(bot, message, chat_id_full, user_id, user_text, answer, parse_mode='HTML')
+                else:
+                    my_log.log_report(bot, message, chat_id_full, user_id, user_text, 'Claude 3 haiku не ответил', parse_mode='HTML')
+                    bot.reply_to(message, 'haiku не ответила, возможно /reset поможет')
+            except Exception as error3:
+                print(f'tb:do_task: {error3}')
+                my_log.log2(f'tb:do_task: {error3}', chat_id_full)
 
-            with ShowAction(message, 'typing'):
-                try:
-                    start_time = time.time()
-                    answer = my_groq.chat(message.text,
-                                          chat_id_full,
-                                          model = 'gemma2-9b-it', 
-                                          style='отвечай на русском языке')
-                    end_time = time.time()
-                    delta_time = round(end_time - start_time, 2)
-                    my_log.log_echo(message, answer)
-                    if answer:
-                        answer = utils.bot_markdown_to_html(answer)
-                        answer = answer.strip()
-                        answer += f'\n\n[Gemma 2 9b] [Generated in {delta_time} secs]'
-                        try:
-                            reply_to_long_message(message, answer, parse_mode='HTML', disable_web_page_preview = True, 
-                                                    reply_markup=get_keyboard('chat', message))
-                        except Exception as error:
-                            print(f'tb:do_task: {error}')
-                            my_log.log2(f'tb:do_task: {error}')
-                            reply_to_long_message(message, answer, parse_mode='', disable_web_page_preview = True, 
-                                                    reply_markup=get_keyboard('chat', message))
-                        my_log.log_report(bot, message, chat_id_full, user_id, user_text, answer, parse_mode='HTML')
-                    else:
-                        my_log.log_report(bot, message, chat_id_full, user_id, user_text, 'Gemma2 не ответила', parse_mode='HTML')
-                        bot.reply_to(message, 'gemma2 не ответила, возможно /reset поможет')
-                except Exception as error3:
-                    print(f'tb:do_task: {error3}')
-                    my_log.log2(f'tb:do_task: {error3}')
 
+    # если активирован gemma2
+    elif CHAT_MODE[chat_id_full] == 'gemma2-9b':
+        if len(msg) > gpt_basic_3.MAX_REQUEST:
+            bot.reply_to(message, f'Слишком длинное сообщение для gemma2 9b: {len(msg)} из {my_groq.MAX_REQUEST}')
+            my_log.log_echo(message, f'Слишком длинное сообщение для gemma2 9b: {len(msg)} из {my_groq.MAX_REQUEST}')
+            return
 
-        # если активирован gemini
-        elif CHAT_MODE[chat_id_full] == 'gemini':
-            if len(msg) > my_gemini.MAX_REQUEST:
-                bot.reply_to(message, f'Слишком длинное сообщение для барда: {len(msg)} из {my_gemini.MAX_REQUEST}')
-                my_log.log_echo(message, f'Слишком длинное сообщение для барда: {len(msg)} из {my_gemini.MAX_REQUEST}')
-                return
+        with ShowAction(message, 'typing'):
+            try:
+                start_time = time.time()
+                answer = my_groq.chat(message.text,
+                                      chat_id_full,
+                                      model = 'gemma2-9b-it', 
+                                      style='отвечай на русском языке')
+                end_time = time.time()
+                delta_time = round(end_time - start_time, 2)
+                my_log.log_echo(message, answer)
+                if answer:
+                    answer = utils.bot_markdown_to_html(answer)
+                    answer = answer.strip()
+                    answer += f'\n\n[Gemma 2 9b] [Generated in {delta_time} secs]'
+                    try:
+                        reply_to_long_message(message, answer, parse_mode='HTML', disable_web_page_preview = True, 
+                                                reply_markup=get_keyboard('chat', message))
+                    except Exception as error:
+                        print(f'tb:do_task: {error}')
+                        my_log.log2(f'tb:do_task: {error}', chat_id_full)
+                        reply_to_long_message(message, answer, parse_mode='', disable_web_page_preview = True, 
+                                                reply_markup=get_keyboard('chat', message))
+                    my_log.log_report(bot, message, chat_id_full, user_id, user_text, answer, parse_mode='HTML')
+                else:
+                    my_log.log_report(bot, message, chat_id_full, user_id, user_text, 'Gemma2 не ответила', parse_mode='HTML')
+                    bot.reply_to(message, 'gemma2 не ответила, возможно /reset поможет')
+            except Exception as error3:
+                print(f'tb:do_task: {error3}')
+                my_log.log2(f'tb:do_task: {error3}', chat_id_full)
 
-            with ShowAction(message, 'typing'):
-                try:
-                    answer = my_gemini.chat(message.text, chat_id_full)
-                    my_log.log_echo(message, answer)
-                    if answer:
-                        answer = utils.bot_markdown_to_html(answer)
-                        answer = answer.strip()
-                        answer += '\n\n[Gemini Flash]'
-                        try:
-                            reply_to_long_message(message, answer, parse_mode='HTML', disable_web_page_preview = True, 
-                                                    reply_markup=get_keyboard('chat', message))
-                        except Exception as error:
-                            print(f'tb:do_task: {error}')
-                            my_log.log2(f'tb:do_task: {error}')
-                            reply_to_long_message(message, answer, parse_mode='', disable_web_page_preview = True, 
-                                                    reply_markup=get_keyboard('chat', message))
-                        my_log.log_report(bot, message, chat_id_full, user_id, user_text, answer, parse_mode='HTML')
-                    else:
-                        my_log.log_report(bot, message, chat_id_full, user_id, user_text, 'Gemini Flash не ответил', parse_mode='HTML')
-                        bot.reply_to(message, 'Gemini Flash не ответил, возможно /reset поможет')
-                except Exception as error3:
-                    print(f'tb:do_task: {error3}')
-                    my_log.log2(f'tb:do_task: {error3}')
 
+    # если активирован gemini
+    elif CHAT_MODE[chat_id_full] == 'gemini':
+        if len(msg) > my_gemini.MAX_REQUEST:
+            bot.reply_to(message, f'Слишком длинное сообщение для барда: {len(msg)} из {my_gemini.MAX_REQUEST}')
+            my_log.log_echo(message, f'Слишком длинное сообщение для барда: {len(msg)} из {my_gemini.MAX_REQUEST}')
+            return
 
-        # если активирован клод
-        elif CHAT_MODE[chat_id_full] == 'claude':
-            if len(msg) > my_claude.MAX_QUERY:
-                bot.reply_to(message, f'Слишком длинное сообщение для Клода: {len(msg)} из {my_claude.MAX_QUERY}')
-                my_log.log_echo(message, f'Слишком длинное сообщение для Клода: {len(msg)} из {my_claude.MAX_QUERY}')
-                return
-            with ShowAction(message, 'typing'):
-                try:
-                    answer = my_claude.chat(message.text, chat_id_full)
-                    # my_log.log_echo(message, answer, debug = True)
+        with ShowAction(message, 'typing'):
+            try:
+                # ответ показывается по мере генерации, в конце заменяется готовым html
+                reply = my_stream.StreamReply(bot, SENDER, message)
+                answer = ''
+                for text in my_gemini.chat_stream(message.text, chat_id_full):
+                    answer += text
+                    reply.add(text)
+                my_log.log_echo(message, answer)
+                if answer:
                     answer = utils.bot_markdown_to_html(answer)
-                    my_log.log_echo(message, answer)
-                    if answer:
-                        answer = answer.strip()
-                        answer += '\n\n[Claude Anthropic]'
-                        try:
+                    answer = answer.strip()
+                    answer += '\n\n[Gemini Flash]'
+                    try:
+                        if not reply.finish(answer, reply_markup=get_keyboard('chat', message)):
                             reply_to_long_message(message, answer, parse_mode='HTML', disable_web_page_preview = True, 
                                                     reply_markup=get_keyboard('chat', message))
-                        except Exception as error:
-                            print(f'tb:do_task: {error}')
-                            my_log.log2(f'tb:do_task: {error}')
-                            reply_to_long_message(message, answer, parse_mode='', disable_web_page_preview = True, 
-                                                    reply_markup=get_keyboard('chat', message))
-                        my_log.log_report(bot, message, chat_id_full, user_id, user_text, answer, parse_mode='HTML')
-                    else:
-                        # my_log.log_echo(message, resp, debug = True)
-                        my_log.log_report(bot, message, chat_id_full, user_id, user_text, 'Claude Anthropic не ответил', parse_mode='HTML')
-                        bot.reply_to(message, 'Claude Anthropic не ответил, возможно /reset поможет')
-                except Exception as error3:
-                    print(f'tb:do_task: {error3}')
-                    my_log.log2(f'tb:do_task: {error3}')
-
-
-        elif CHAT_MODE[chat_id_full] == 'chatGPT':
-            # if len(msg) > cfg.CHATGPT_MAX_REQUEST:
-            #     bot.reply_to(message, f'Слишком длинное сообщение для chatGPT: {len(msg)} из {cfg.CHATGPT_MAX_REQUEST}')
-            #     my_log.log_echo(message, f'Слишком длинное сообщение для chatGPT: {len(msg)} из {cfg.CHATGPT_MAX_REQUEST}')
-            #     return
-            # if len(msg) > my_shadowjourney.MAX_REQUEST:
-            #     bot.reply_to(message, f'Слишком длинное сообщение для chatGPT: {len(msg)} из {my_shadowjourney.MAX_REQUEST}')
-            #     my_log.log_echo(message, f'Слишком длинное сообщение для chatGPT: {len(msg)} из {my_shadowjourney.MAX_REQUEST}')
-            #     return
-
-            if len(msg) > 40000:
-                bot.reply_to(message, f'Слишком длинное сообщение для chatGPT: {len(msg)} из {40000}')
-                my_log.log_echo(message, f'Слишком длинное сообщение для chatGPT: {len(msg)} из {40000}')
-                return
+                    except Exception as error:
+                        print(f'tb:do_task: {error}')
+                        my_log.log2(f'tb:do_task: {error}', chat_id_full)
+                        reply_to_long_message(message, answer, parse_mode='', disable_web_page_preview = True, 
+                                                reply_markup=get_keyboard('chat', message))
+                    my_log.log_report(bot, message, chat_id_full, user_id, user_text, answer, parse_mode='HTML')
+                else:
+                    my_log.log_report(bot, message, chat_id_full, user_id, user_text, 'Gemini Flash не ответил', parse_mode='HTML')
+                    bot.reply_to(message, 'Gemini Flash не ответил, возможно /reset поможет')
+            except Exception as error3:
+                print(f'tb:do_task: {error3}')
+                my_log.log2(f'tb:do_task: {error3}', chat_id_full)
+
+
+    # если активирован клод
+    elif CHAT_MODE[chat_id_full] == 'claude':
+        if len(msg) > my_claude.MAX_QUERY:
+            bot.reply_to(message, f'Слишком длинное сообщение для Клода: {len(msg)} из {my_claude.MAX_QUERY}')
+            my_log.log_echo(message, f'Слишком длинное сообщение для Клода: {len(msg)} из {my_claude.MAX_QUERY}')
+            return
+        with ShowAction(message, 'typing'):
+            try:
+                answer = my_claude.chat(message.text, chat_id_full)
+                # my_log.log_echo(message, answer, debug = True)
+                answer = utils.bot_markdown_to_html(answer)
+                my_log.log_echo(message, answer)
+                if answer:
+                    answer = answer.strip()
+                    answer += '\n\n[Claude Anthropic]'
+                    try:
+                        reply_to_long_message(message, answer, parse_mode='HTML', disable_web_page_preview = True, 
+                                                reply_markup=get_keyboard('chat', message))
+                    except Exception as error:
+                        print(f'tb:do_task: {error}')
+                        my_log.log2(f'tb:do_task: {error}', chat_id_full)
+                        reply_to_long_message(message, answer, parse_mode='', disable_web_page_preview = True, 
+                                                reply_markup=get_keyboard('chat', message))
+                    my_log.log_report(bot, message, chat_id_full, user_id, user_text, answer, parse_mode='HTML')
+                else:
+                    # my_log.log_echo(message, resp, debug = True)
+                    my_log.log_report(bot, message, chat_id_full, user_id, user_text, 'Claude Anthropic не ответил', parse_mode='HTML')
+                    bot.reply_to(message, 'Claude Anthropic не ответил, возможно /reset поможет')
+            except Exception as error3:
+                print(f'tb:do_task: {error3}')
+                my_log.log2(f'tb:do_task: {error3}', chat_id_full)
 
-            # chatGPT, добавляем новый запрос пользователя в историю диалога пользователя
-            with ShowAction(message, 'typing'):
 
-                # проверка на спам сообщениями
-                if test_for_spam(message.text + get_history_of_chat(chat_id_full), user_id):
-                    bot.reply_to(message, f'Слишком много сообщений, попробуйте попозже')
-                    return
+    elif CHAT_MODE[chat_id_full] == 'chatGPT':
+        # if len(msg) > cfg.CHATGPT_MAX_REQUEST:
+        #     bot.reply_to(message, f'Слишком длинное сообщение для chatGPT: {len(msg)} из {cfg.CHATGPT_MAX_REQUEST}')
+        #     my_log.log_echo(message, f'Слишком длинное сообщение для chatGPT: {len(msg)} из {cfg.CHATGPT_MAX_REQUEST}')
+        #     return
+        # if len(msg) > my_shadowjourney.MAX_REQUEST:
+        #     bot.reply_to(message, f'Слишком длинное сообщение для chatGPT: {len(msg)} из {my_shadowjourney.MAX_REQUEST}')
+        #     my_log.log_echo(message, f'Слишком длинное сообщение для chatGPT: {len(msg)} из {my_shadowjourney.MAX_REQUEST}')
+        #     return
+
+        if len(msg) > 40000:
+            bot.reply_to(message, f'Слишком длинное сообщение для chatGPT: {len(msg)} из {40000}')
+            my_log.log_echo(message, f'Слишком длинное сообщение для chatGPT: {len(msg)} из {40000}')
+            return
 
-                if chat_id_full in GPT_CHAT_LOCKS:
-                    lock = GPT_CHAT_LOCKS[chat_id_full]
-                else:
-                    lock = threading.Lock()
-                    GPT_CHAT_LOCKS[chat_id_full] = lock
-                with lock:
-                    # resp = my_shadowjourney.chat(message.text, chat_id_full)
-                    start_time = time.time()
-                    resp = dialog_add_user_request(chat_id_full, message.text, 'gpt')
-                    end_time = time.time()
-                    delta_time = round(end_time - start_time, 2)
-                    if resp:
-                        resp = resp.strip()
-                        resp += f'\n\n[chatGPT] [Generated in {delta_time} secs]'
-                        # добавляем ответ счетчик юзера что бы детектить спам
-                        test_for_spam(resp, user_id)
+        # chatGPT, добавляем новый запрос пользователя в историю диалога пользователя
+        with ShowAction(message, 'typing'):
+
+            # проверка на спам сообщениями
+            if test_for_spam(message.text + get_history_of_chat(chat_id_full), user_id):
+                bot.reply_to(message, f'Слишком много сообщений, попробуйте попозже')
+                return
+
+            # resp = my_shadowjourney.chat(message.text, chat_id_full)
+            start_time = time.time()
+            resp = dialog_add_user_request(chat_id_full, message.text, 'gpt')
+            end_time = time.time()
+            delta_time = round(end_time - start_time, 2)
+            if resp:
+                resp = resp.strip()
+                resp += f'\n\n[chatGPT] [Generated in {delta_time} secs]'
+                # добавляем ответ счетчик юзера что бы детектить спам
+                test_for_spam(resp, user_id)
                         
-                        # my_log.log_echo(message, resp, debug = True)
-                        resp = utils.bot_markdown_to_html(resp)
-                        my_log.log_echo(message, resp)
+                # my_log.log_echo(message, resp, debug = True)
+                resp = utils.bot_markdown_to_html(resp)
+                my_log.log_echo(message, resp)
 
-                        # сохранить в отчет вопрос и ответ для юзера, и там же сохранение в группу
-                        my_log.log_report(bot, message, chat_id_full, user_id, user_text, resp, parse_mode='HTML')
+                # сохранить в отчет вопрос и ответ для юзера, и там же сохранение в группу
+                my_log.log_report(bot, message, chat_id_full, user_id, user_text, resp, parse_mode='HTML')
 
-                        try:
-                            reply_to_long_message(message, resp, parse_mode='HTML', disable_web_page_preview = True, 
-                                                reply_markup=get_keyboard('chat', message))
-                        except Exception as error2:    
-                            print(error2)
-                            my_log.log2(resp)
-                            reply_to_long_message(message, resp, parse_mode='', disable_web_page_preview = True, 
-                                                reply_markup=get_keyboard('chat', message))
-                    else:
-                        # my_log.log_echo(message, resp, debug = True)
-                        my_log.log_report(bot, message, chat_id_full, user_id, user_text, 'ChatGPT не ответил', parse_mode='HTML')
-                        bot.reply_to(message, 'ChatGPT не ответил, возможно /reset поможет')
+                try:
+                    reply_to_long_message(message, resp, parse_mode='HTML', disable_web_page_preview = True, 
+                                        reply_markup=get_keyboard('chat', message))
+                except Exception as error2:    
+                    print(error2)
+                    my_log.log2(resp)
+                    reply_to_long_message(message, resp, parse_mode='', disable_web_page_preview = True, 
+                                        reply_markup=get_keyboard('chat', message))
+            else:
+                # my_log.log_echo(message, resp, debug = True)
+                my_log.log_report(bot, message, chat_id_full, user_id, user_text, 'ChatGPT не ответил', parse_mode='HTML')
+                bot.reply_to(message, 'ChatGPT не ответил, возможно /reset поможет')
 
 
 def set_default_commands():
@@ -2227,6 +2087,8 @@ def main():
     Runs the main function, which sets default commands and starts polling the bot.
     """
     #set_default_commands()
+    # старые логи в индекс /export до первой записи, потом my_log может их переименовать и сжать
+    my_reports.import_legacy()
     my_gemini.run_proxy_pool_daemon()
     # bot.polling(timeout=90, long_polling_timeout = 90)
     bot.infinity_polling(timeout=90, long_polling_timeout=90)
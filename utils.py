@@ -2,39 +2,35 @@
 
 import datetime
 import hashlib
-import html
 import pytz
 import multiprocessing
 import os
-import random
 import re
-import requests
-import string
 import subprocess
 import telebot
 import tempfile
 import traceback
 import platform as platform_module
 
-import prettytable
-from pylatexenc.latex2text import LatexNodes2Text
-
+import my_http
 import my_log
+import my_markdown
+import my_tokens
 
 
-def count_tokens(messages):
+def count_tokens(messages, model: str = 'gpt-3.5-turbo'):
     """
     Count the number of tokens in the given messages.
 
     Parameters:
         messages (list): A list of messages.
+        model (str): The model name, selects the tokenizer (see my_tokens).
 
     Returns:
         int: The number of tokens in the messages. Returns 0 if messages is empty.
     """
-    # токенты никто из пиратов не считает, так что просто считаем символы
     if messages:
-       return len(str(messages))
+        return my_tokens.count(messages, model)
     return 0
 
 
@@ -126,174 +122,24 @@ def convert_to_mp3(input_file: str) -> str:
 
 
 def bot_markdown_to_html(text: str) -> str:
-    # переделывает маркдаун от чатботов в хтмл для телеграма
-    # сначала делается полное экранирование
-    # затем меняются маркдаун теги и оформление на аналогичное в хтмл
-    # при этом не затрагивается то что внутри тегов код, там только экранирование
-    # латекс код в тегах $ и $$ меняется на юникод текст
-
-    # экранируем весь текст для html
-    text = html.escape(text)
-
-    # найти все куски кода между ``` и заменить на хеши
-    # спрятать код на время преобразований
-    matches = re.findall('```(.*?)```\n', text, flags=re.DOTALL)
-    list_of_code_blocks = []
-    for match in matches:
-        random_string = str(hash(match))
-        list_of_code_blocks.append([match, random_string])
-        text = text.replace(f'```{match}```', random_string)
-
-    matches = re.findall('```(.*?)```', text, flags=re.DOTALL)
-    for match in matches:
-        random_string = str(hash(match))
-        list_of_code_blocks.append([match, random_string])
-        text = text.replace(f'```{match}```', random_string)
-
-    # тут могут быть одиночные поворяющиеся `, меняем их на '
-    text = text.replace('```', "'''")
-
-    matches = re.findall('`(.*?)`', text)
-    list_of_code_blocks2 = []
-    for match in matches:
-        random_string = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(16))
-        list_of_code_blocks2.append([match, random_string])
-        text = text.replace(f'`{match}`', random_string)
-
-    # переделываем списки на более красивые
-    new_text = ''
-    for i in text.split('\n'):
-        ii = i.strip()
-        if ii.startswith('* '):
-            i = i.replace('* ', '• ', 1)
-        if ii.startswith('- '):
-            i = i.replace('- ', '– ', 1)
-        new_text += i + '\n'
-    text = new_text.strip()
-
-    # 2,3,4 # в начале строки меняем всю строку на жирный текст
-    text = re.sub('^#### (.*)$', '<b>\\1</b>', text, flags=re.MULTILINE)
-    text = re.sub('^### (.*)$', '<b>\\1</b>', text, flags=re.MULTILINE)
-    text = re.sub('^## (.*)$', '<b>\\1</b>', text, flags=re.MULTILINE)
-    # точка пробел три хеша и пробел в начале тоже делать жирным
-    text = re.sub('^\. ### (.*)$', '<b>\\1</b>', text, flags=re.MULTILINE)
-    text = re.sub('^\.  ## (.*)$', '<b>\\1</b>', text, flags=re.MULTILINE)
-    text = re.sub('^\.  ### (.*)$', '<b>\\1</b>', text, flags=re.MULTILINE)
-    text = re.sub('^\.  #### (.*)$', '<b>\\1</b>', text, flags=re.MULTILINE)
-
-    # 1 или 2 * в <b></b>
-    text = re.sub('\*\*(.+?)\*\*', '<b>\\1</b>', text)
-
-    # tex в unicode
-    matches = re.findall(r"(?:\$\$?|\\\[|\\\(|\\\[)(.*?)(?:\$\$?|\\\]|\\\)|\\\])", text, flags=re.DOTALL)
-    for match in matches:
-        new_match = LatexNodes2Text().latex_to_text(match.replace('\\\\', '\\'))
-        text = text.replace(f'$${match}$$', new_match)
-        text = text.replace(f'${match}$', new_match)
-        text = text.replace(f'\[{match}\]', new_match)
-        text = text.replace(f'\({match}\)', new_match)
-
-    # меняем маркдаун ссылки на хтмл
-    # text = re.sub(r'\[([^\]]*)\]\(([^\)]*)\)', r'<a href="\2">\1</a>', text)
-    text = re.sub('''\[(.*?)\]\((https?://\S+)\)''', r'<a href="\2">\1</a>', text)
-    # меняем все ссылки на ссылки в хтмл теге кроме тех кто уже так оформлен
-    # а зачем собственно? text = re.sub(r'(?<!<a href=")(https?://\S+)(?!">[^<]*</a>)', r'<a href="\1">\1</a>', text)
-
-    # меняем таблицы до возвращения кода
-    text = replace_tables(text)
-
-    # меняем обратно хеши на блоки кода
-    for match, random_string in list_of_code_blocks2:
-        # new_match = html.escape(match)
-        new_match = match
-        text = text.replace(random_string, f'<code>{new_match}</code>')
-
-    # меняем обратно хеши на блоки кода
-    for match, random_string in list_of_code_blocks:
-        new_match = match
-        text = text.replace(random_string, f'<code>{new_match}</code>')
-
-    text = replace_code_lang(text)
-
-    return text
-
-
-def replace_code_lang(t: str) -> str:
-    """
-    Replaces the code language in the given string with appropriate HTML tags.
-
-    Parameters:
-        t (str): The input string containing code snippets.
+    """переделывает маркдаун от чатботов в хтмл для телеграма, см my_markdown"""
+    return my_markdown.bot_markdown_to_html(text)
 
-    Returns:
-        str: The modified string with code snippets wrapped in HTML tags.
-    """
-    result = ''
-    state = 0
-    for i in t.split('\n'):
-        if i.startswith('<code>') and len(i) > 7:
-            result += f'<pre><code class = "language-{i[6:]}">'
-            state = 1
-        else:
-            if state == 1:
-                if i == '</code>':
-                    result += '</code></pre>\n'
-                    state = 0
-                else:
-                    result += i + '\n'
-            else:
-                result += i + '\n'
-    return result
-
-
-def replace_tables(text: str) -> str:
-    text += '\n'
-    state = 0
-    table = ''
-    results = []
-    for line in text.split('\n'):
-        if line.count('|') > 2 and len(line) > 4:
-            if state == 0:
-                state = 1
-            table += line + '\n'
-        else:
-            if state == 1:
-                results.append(table[:-1])
-                table = ''
-                state = 0
-
-    for table in results:
-        x = prettytable.PrettyTable(align = "l",
-                                    set_style = prettytable.MSWORD_FRIENDLY,
-                                    hrules = prettytable.HEADER,
-                                    junction_char = '|')
-
-        lines = table.split('\n')
-        header = [x.strip().replace('<b>', '').replace('</b>', '') for x in lines[0].split('|') if x]
-        header = [split_long_string(x, header = True) for x in header]
-        try:
-            x.field_names = header
-        except Exception as error:
-            my_log.log2(f'tb:replace_tables: {error}')
-            continue
-        for line in lines[2:]:
-            row = [x.strip().replace('<b>', '').replace('</b>', '') for x in line.split('|') if x]
-            row = [split_long_string(x) for x in row]
-            try:
-                x.add_row(row)
-            except Exception as error2:
-                my_log.log2(f'tb:replace_tables: {error2}')
-                continue
-        new_table = x.get_string()
-        text = text.replace(table, f'<pre><code>{new_table}\n</code></pre>')
 
-    return text
+HTML_TAG = re.compile(r'<(/?)([a-zA-Z][a-zA-Z0-9-]*)[^<>]*>')
+HTML_LINE = re.compile(r'[^\n]*\n|[^\n]+')
+HTML_WORD = re.compile(r'[^ ]* ?')
 
 
 def split_html(text: str, max_length: int = 1500) -> list:
     """
     Split the given HTML text into chunks of maximum length specified by `max_length`.
 
+    The text is walked once keeping a stack of open tags. Chunks are cut after the last
+    line break that fits (or between words, or inside a very long word but never inside
+    an &entity;), tags open at the cut are closed at the end of the chunk and reopened
+    at the start of the next one, so every chunk is valid HTML on its own.
+
     Parameters:
         text (str): The HTML text to be split into chunks.
         max_length (int, optional): The maximum length of each chunk. Defaults to 1500.
@@ -301,81 +147,93 @@ def split_html(text: str, max_length: int = 1500) -> list:
     Returns:
         list: A list of chunks, where each chunk is a string.
     """
-    code_tag = ''
-    in_code_mode = 0
+    # [(kind, text, name)], kind = 'open', 'close' или 'text'
+    atoms = []
+    position = 0
+    for match in HTML_TAG.finditer(text):
+        atoms += [('text', x, '') for x in HTML_LINE.findall(text[position:match.start()])]
+        atoms.append(('close' if match.group(1) else 'open', match.group(0), match.group(2).lower()))
+        position = match.end()
+    atoms += [('text', x, '') for x in HTML_LINE.findall(text[position:])]
+    atoms.reverse()
 
     chunks = []
-    chunk = ''
-
-    for line in text.split('\n'):
-        if line.startswith('<pre><code') and line.find('</code></pre>') == -1:
-            in_code_mode = 1
-            code_tag = line[:line.find('>', 10) + 1]
-
-        elif line.startswith('<code>') and line.find('</code>') == -1:
-            in_code_mode = 2
-            code_tag = '<code>'
-
-        elif line.startswith('<b>') and line.find('</b>') == -1:
-            in_code_mode = 3
-            code_tag = '<b>'
-
-        elif line == '</code></pre>' or line == '</code>' or line == '</b>':
-            code_tag = ''
-            in_code_mode = 0
-
-        else:
-            if len(chunk) + len(line) + 20 > max_length:
-
-                if in_code_mode == 1:
-                    chunk += '</code></pre>\n'
-                    chunks.append(chunk)
-                    chunk = code_tag
-
-                if in_code_mode == 2:
-                    chunk += '</code>\n'
-                    chunks.append(chunk)
-                    chunk = code_tag
-
-                if in_code_mode == 3:
-                    chunk += '</b>\n'
-                    chunks.append(chunk)
-                    chunk = code_tag
-
-                elif in_code_mode == 0:
-                    chunks.append(chunk)
-                    chunk = ''
-
-        chunk += line + '\n'
+    # открытые теги [(name, open_tag)]
+    stack = []
+    buf = []
+    size = 0
+    # длина закрывающих тегов для stack
+    close_size = 0
+    # (len(buf), stack) сразу после последнего переноса строки
+    last_break = None
+    # сколько в начале buf занимают повторно открытые теги
+    reopened = 0
+
+    def emit(parts: list, open_tags: list):
+        chunk = ''.join(parts) + ''.join(f'</{name}>' for name, _ in reversed(open_tags))
+        if HTML_TAG.sub('', chunk).strip():
+            chunks.append(chunk)
+
+    while atoms:
+        kind, atom, name = atoms.pop()
+        new_stack = stack
+        new_close_size = close_size
+        if kind == 'open':
+            new_stack = stack + [(name, atom)]
+            new_close_size += len(name) + 3
+        elif kind == 'close':
+            names = [x[0] for x in stack]
+            if name in names:
+                i = len(names) - 1 - names[::-1].index(name)
+                new_stack = stack[:i]
+                new_close_size = sum(len(x[0]) + 3 for x in new_stack)
+            else:
+                # закрывающий тег без открывающего телеграм не примет
+                continue
 
-    chunks.append(chunk)
+        if size + len(atom) + new_close_size <= max_length:
+            buf.append(atom)
+            size += len(atom)
+            stack, close_size = new_stack, new_close_size
+            if atom.endswith('\n'):
+                last_break = (len(buf), stack)
+            continue
 
-    chunks2 = []
-    for chunk in chunks:
-        if len(chunk) > max_length:
-            chunks2 += split_text(chunk, max_length)
+        atoms.append((kind, atom, name))
+        if last_break and last_break[0] > reopened:
+            # режем после последнего переноса строки, хвост переезжает в следующий кусок
+            n, break_stack = last_break
+            emit(buf[:n], break_stack)
+            buf = [tag for _, tag in break_stack] + buf[n:]
+            reopened = len(break_stack)
+        elif len(buf) > reopened:
+            emit(buf, stack)
+            buf = [tag for _, tag in stack]
+            reopened = len(stack)
         else:
-            chunks2.append(chunk)
-
-    return chunks2
-
-
-def split_long_string(long_string: str, header = False, MAX_LENGTH = 24) -> str:
-    if len(long_string) <= MAX_LENGTH:
-        return long_string
-    if header:
-        return long_string[:MAX_LENGTH-2] + '..'
-    split_strings = []
-    while len(long_string) > MAX_LENGTH:
-        split_strings.append(long_string[:MAX_LENGTH])
-        long_string = long_string[MAX_LENGTH:]
-
-    if long_string:
-        split_strings.append(long_string)
-
-    result = "\n".join(split_strings) 
-    return result
+            # не влезает даже в пустой кусок, это может быть только очень длинный текст
+            # или тег со ссылкой длиннее куска, такой тег выкидывается
+            atoms.pop()
+            if kind != 'text':
+                continue
+            room = max(1, max_length - size - close_size)
+            words = HTML_WORD.findall(atom)[:-1]
+            if len(words) > 1:
+                pieces = words
+            else:
+                piece = atom[:room]
+                # не резать &amp; и тп пополам
+                amp = piece.rfind('&')
+                if amp > 0 and ';' not in piece[amp:] and len(piece) < len(atom):
+                    piece = piece[:amp]
+                pieces = [piece, atom[len(piece):]]
+            atoms += [(kind, x, name) for x in reversed(pieces) if x]
+            continue
+        size = len(''.join(buf))
+        last_break = None
 
+    emit(buf, stack)
+    return chunks
 
 
 def download_image(url):
@@ -388,7 +246,7 @@ def download_image(url):
     Returns:
         bytes or None: The content of the image if the download is successful, otherwise None.
     """
-    response = requests.get(url, timeout=10)
+    response = my_http.get(url, timeout=10)
     if response.status_code == 200:
         return response.content
     else:
@@ -475,7 +333,7 @@ def download_image_as_bytes(url: str) -> bytes:
     """
 
     try:
-        response = requests.get(url, timeout=10)
+        response = my_http.get(url, timeout=10)
     except Exception as error:
         error_traceback = traceback.format_exc()
         my_log.log2(f'download_image_as_bytes: {error}\n\n{error_traceback}')